@@ -336,8 +336,8 @@ def getDataObject(self, key, selection=None):
                 totalElements *= dim
             if totalElements < 2.0E7:
                 try:
-                    data = phynxFile[path].value
-                except MemoryError:
+                    data = phynxFile[path][()]
+                except (MemoryError, ValueError):
                     data = phynxFile[path]
                     pass
             if output.info['selectiontype'] == "1D":
@@ -34,6 +34,11 @@
 import os
 import numpy
 from PyMca5.PyMcaIO import EdfFile
+try:
+    from PyMca5.PyMcaIO import BatchHDF5Output
+    HDF5SUPPORT = True
+except ImportError:
+    HDF5SUPPORT = False
 
 DEBUG = 0
 
@@ -171,8 +176,79 @@ def buildOutput(self, inputdir=None, outputdir=None, delete=None):
             if delete:
                 for filename in edflist:
                     os.remove(filename)
+        self.buildHDF5Output(inputdir, outputdir, delete)
         return edfoutlist, datoutlist, outconlist
 
+    def buildHDF5Output(self, inputdir=None, outputdir=None, delete=None):
+        """
+        Merge the finished rows of the partial HDF5 outputs of the batch
+        and return the list of written files.
+        """
+        if inputdir is None:inputdir = self.inputDir
+        if inputdir is None:inputdir = os.getcwd()
+        if outputdir is None: outputdir = self.outputDir
+        if outputdir is None: outputdir = inputdir
+        if delete is None:
+            if outputdir == inputdir:
+                delete = True
+        h5outlist = []
+        if not HDF5SUPPORT:
+            return h5outlist
+        partialh5list = []
+        for filename in os.listdir(inputdir):
+            if filename.endswith('000000_partial.h5'):
+                partialh5list.append(filename)
+        for filename in partialh5list:
+            if DEBUG:
+                print("Dealing with filename %s" % filename)
+            # the index is not the last number of the name
+            prefix = os.path.join(inputdir,
+                                  filename[:-len('000000_partial.h5')])
+            h5list = []
+            while os.path.exists(prefix + "%06d_partial.h5" % len(h5list)):
+                h5list.append(prefix + "%06d_partial.h5" % len(h5list))
+            h5outname = os.path.join(outputdir,
+                                filename.replace('_000000_partial.h5', ".h5"))
+            output = None
+            for h5name in h5list:
+                # the maps are copied row by row
+                ddict = BatchHDF5Output.readBatchHDF5Output(h5name,
+                                                            data=False)
+                if ddict is None:
+                    print("Cannot read partial output %s" % h5name)
+                    continue
+                if output is None:
+                    attributes = {}
+                    for key in ['file_step', 'mca_step']:
+                        if key in ddict['attributes']:
+                            attributes[key] = ddict['attributes'][key]
+                    output = BatchHDF5Output.BatchHDF5Output(h5outname,
+                                        ddict['nrows'], ddict['ncols'],
+                                        ddict['parameters'],
+                                        concentrations=ddict['concentrations'],
+                                        attributes=attributes)
+                elif (ddict['parameters'] != output.getParameterNames()) or\
+                     (ddict['concentrations'] != \
+                      output.getConcentrationNames()):
+                    print("Incompatible partial output %s" % h5name)
+                    continue
+                rows = numpy.nonzero(ddict['finished'])[0]
+                for row, parameters, uncertainties, chisq, concentrations \
+                    in BatchHDF5Output.readBatchHDF5Rows(h5name, rows):
+                    output.writeRow(row, parameters, uncertainties, chisq,
+                                    concentrations=concentrations)
+            if output is None:
+                continue
+            output.close()
+            h5outlist.append(h5outname)
+            if delete:
+                for h5name in h5list:
+                    try:
+                        os.remove(h5name)
+                    except:
+                        print("Cannot delete file %s" % h5name)
+        return h5outlist
+
     def getIndexedFileList(self, filename, begin=None,end=None, skip = None, fileindex=0):
         name = os.path.basename(filename)
         n = len(name)
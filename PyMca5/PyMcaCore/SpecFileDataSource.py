@@ -73,17 +73,28 @@ def __init__(self, nameInput):
         self.sourceType   = SOURCE_TYPE
         self.__sourceNameList = nameList
         self.__source_info_cached = None
+        self._sourceObjectList = []
 
         self.refresh()
 
     def refresh(self):
-        self._sourceObjectList=[]
-        self.__fileHeaderList = []
         for name in self.__sourceNameList:
             if not os.path.exists(name):
                 raise ValueError("File %s does not exists" % name)
-        for name in self.__sourceNameList:
-            self._sourceObjectList.append(specfile.Specfile(name))
+        oldObjectList = self._sourceObjectList
+        self._sourceObjectList=[]
+        self.__fileHeaderList = []
+        for i, name in enumerate(self.__sourceNameList):
+            sourceObject = None
+            if i < len(oldObjectList):
+                sourceObject = oldObjectList[i]
+            if hasattr(sourceObject, "update"):
+                # only the part of the file added since it was read
+                # has to be scanned
+                sourceObject.update()
+            else:
+                sourceObject = specfile.Specfile(name)
+            self._sourceObjectList.append(sourceObject)
             self.__fileHeaderList.append(False)
         self.__lastKeyInfo = {}
 
@@ -703,6 +714,22 @@ def _getMcaData(self, key):
                 dataObject.data = scan_data
                 return dataObject
 
+    def getMcaArray(self, key, detector=None, first=1, step=1, number=None):
+        """
+        Read at once the spectra of the scan key ("number.order").
+        See the module function getMcaArray for the meaning of the
+        other arguments and the output.
+        """
+        index = 0
+        scan_obj = self._sourceObjectList[index].select(key)
+        scan_info = self.__getScanInfo(key)
+        return getMcaArray(scan_obj,
+                           nbmcadet=int(scan_info.get("NbMcaDet", 1)),
+                           detector=detector,
+                           first=first,
+                           step=step,
+                           number=number)
+
     def __getFileInfo(self):
         index = 0
         source = self._sourceObjectList[index]
@@ -754,6 +781,81 @@ def isUpdated(self, sourceName, key):
         else:
             return False
 
+def _getMcaHeaderValues(scan_obj, label, mcaList, nbmcadet):
+    # one split header line per mca or None. The lines can be given
+    # for each detector, for each mca or once for all of them.
+    lines = scan_obj.header(label)
+    if not len(lines):
+        return None
+    if len(lines) == nbmcadet:
+        return [lines[(mca - 1) % nbmcadet].split() for mca in mcaList]
+    elif len(lines) == scan_obj.nbmca():
+        return [lines[mca - 1].split() for mca in mcaList]
+    elif len(lines) == 1:
+        return [lines[0].split()] * len(mcaList)
+    if DEBUG:
+        print("Number of %s lines does not match number of MCAs" % label)
+    return None
+
+def getMcaArray(scan_obj, nbmcadet=1, detector=None, first=1, step=1,
+                number=None):
+    """
+    Read the spectra of a SPEC scan object in one go.
+
+    The spectra are numbered from 1 as in scan_obj.mca. If detector (from 1
+    to nbmcadet) is given, only the spectra of that detector are considered
+    and they are numbered from 1 within that detector. The spectra first,
+    first + step, ... up to number of them (all if None) are read.
+
+    Returns a 2D array with one spectrum per row and a dictionary with
+    the mca numbers of the rows in scan_obj ("McaIndex") as well as the
+    "Channel0", "McaPresetTime", "McaLiveTime" and "McaRealTime" of each
+    spectrum as arrays. The times are None if not present in the file.
+    """
+    nbmcadet = max(1, int(nbmcadet))
+    if detector is not None:
+        if (detector < 1) or (detector > nbmcadet):
+            raise ValueError("Invalid detector %d" % detector)
+        first = (first - 1) * nbmcadet + detector
+        step = step * nbmcadet
+    if number is None:
+        number = -1
+    if hasattr(scan_obj, "allmca"):
+        data = scan_obj.allmca(first, step, number)
+    else:
+        mcaList = list(range(first, scan_obj.nbmca() + 1, step))
+        if number >= 0:
+            mcaList = mcaList[:number]
+        if len(mcaList):
+            data = numpy.array([scan_obj.mca(mca) for mca in mcaList])
+        else:
+            data = numpy.zeros((0, 0), numpy.float)
+    mcaList = list(range(first, first + data.shape[0] * step, step))
+
+    info = {}
+    info["McaIndex"] = numpy.array(mcaList, dtype=numpy.int32)
+    info["Channel0"] = numpy.zeros((len(mcaList),), numpy.float)
+    values = _getMcaHeaderValues(scan_obj, "@CHANN", mcaList, nbmcadet)
+    if values is not None:
+        for i, ctxt in enumerate(values):
+            if len(ctxt) == 5:
+                info["Channel0"][i] = float(ctxt[2])
+    for key in ["McaPresetTime", "McaLiveTime", "McaRealTime"]:
+        info[key] = None
+    values = _getMcaHeaderValues(scan_obj, "@CTIME", mcaList, nbmcadet)
+    if values is not None:
+        try:
+            times = numpy.array([[float(x) for x in ctxt[1:4]] \
+                                 for ctxt in values if len(ctxt) == 4])
+        except ValueError:
+            times = None
+        if (times is not None) and (len(times) == len(mcaList)) and \
+           len(mcaList):
+            info["McaPresetTime"] = times[:, 0]
+            info["McaLiveTime"] = times[:, 1]
+            info["McaRealTime"] = times[:, 2]
+    return data, info
+
 source_types = { SOURCE_TYPE: SpecFileDataSource}
 
 def DataSource(name="", source_type=SOURCE_TYPE):
@@ -35,12 +35,27 @@
 
 """
 from . import DataObject
+from . import StackROIIndex
 import numpy
 import time
 import os
 import sys
 import glob
+import multiprocessing
+import functools
+from multiprocessing.pool import ThreadPool
+try:
+    import h5py
+    from PyMca5.PyMcaIO import HDF5Reader
+    HDF5 = True
+except ImportError:
+    HDF5 = False
 DEBUG = 0
+# amount of data read at once when calculating ROI images of dynamically
+# loaded stacks and number of threads reading it (processes for HDF5
+# datasets, h5py only runs one call at a time)
+ROI_CHUNK_MEMORY = 32 * 1024 * 1024
+ROI_WORKERS = min(multiprocessing.cpu_count(), 8)
 PLUGINS_DIR = None
 try:
     if os.path.exists(os.path.join(os.path.dirname(__file__), "PyMcaPlugins")):
@@ -59,6 +74,26 @@
     pass
 
 
+def _getROISelection(mcaIndex, i1, i2, start, end):
+    # the data of the images start:end and the axis of the channels
+    if mcaIndex == 0:
+        return (slice(i1, i2), slice(start, end), slice(None)), 0
+    else:
+        return (slice(start, end), slice(None), slice(i1, i2)), 2
+
+def _reduceROIData(tmpData, axis, middle):
+    return (numpy.sum(tmpData, axis=axis, dtype=numpy.float),
+            numpy.argmin(tmpData, axis=axis),
+            numpy.argmax(tmpData, axis=axis),
+            numpy.take(tmpData, 0, axis=axis),
+            numpy.take(tmpData, middle, axis=axis),
+            numpy.take(tmpData, -1, axis=axis))
+
+def _getROIImagesChunk(task):
+    data, mcaIndex, i1, i2, imiddle, start, end = task
+    selection, axis = _getROISelection(mcaIndex, i1, i2, start, end)
+    return (start, end) + _reduceROIData(data[selection], axis, imiddle - i1)
+
 class StackBase(object):
     def __init__(self):
         self._stack = DataObject.DataObject()
@@ -94,6 +129,10 @@ def __init__(self):
         # the sums.
         self._dynamicLimit = 5.0E6
         self._tryNumpy = True
+        # optional precalculated index to obtain the ROI images
+        self._ROIIndex = None
+        self._ROIIndexEnabled = False
+        self._ROIIndexFile = None
 
     def setPluginDirectoryList(self, dirlist):
         for directory in dirlist:
@@ -329,6 +368,9 @@ def stackUpdated(self):
             self._finiteData = False
             self.handleNonFiniteData()
 
+        if self._ROIIndexEnabled:
+            self.__buildROIIndex()
+
         #calculate the ROIs
         self._ROIDict = {'name': "ICR",
                          'type': "CHANNEL",
@@ -340,6 +382,46 @@ def stackUpdated(self):
         for key in self.pluginInstanceDict.keys():
             self.pluginInstanceDict[key].stackUpdated()
 
+    def enableROIIndex(self, filename=None):
+        """
+        Precalculate the cumulative sum of the stack spectra when a stack is
+        loaded in order to obtain the ROI images without going through the
+        whole stack. It needs as much memory as the stack in double
+        precision unless an HDF5 filename to store it is given.
+        """
+        self._ROIIndexEnabled = True
+        self._ROIIndexFile = filename
+        if self._stackImageData is not None:
+            self.__buildROIIndex()
+
+    def disableROIIndex(self):
+        self._ROIIndexEnabled = False
+        self.__closeROIIndex()
+
+    def __closeROIIndex(self):
+        if self._ROIIndex is not None:
+            self._ROIIndex.close()
+            self._ROIIndex = None
+
+    def __buildROIIndex(self):
+        self.__closeROIIndex()
+        if self.mcaIndex not in [0, 2]:
+            if DEBUG:
+                print("ROI index not supported for mca index %d" %\
+                      self.mcaIndex)
+            return
+        if DEBUG:
+            t0 = time.time()
+        try:
+            self._ROIIndex = StackROIIndex.StackROIIndex(self._stack.data,
+                                        mcaindex=self.mcaIndex,
+                                        filename=self._ROIIndexFile)
+        except:
+            print("Error building the ROI index: %s" % sys.exc_info()[1])
+            self._ROIIndex = None
+        if DEBUG:
+            print("ROI index elapsed = %f" % (time.time() - t0))
+
     def isStackFinite(self):
         """
         Returns True if stack does not contain inf or nans
@@ -724,6 +806,12 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
                       'Background': dummy}
             return imageDict
 
+        if self._ROIIndex is not None:
+            if DEBUG:
+                print("Using ROI index")
+            self.__ROIImageCalculationIsUsingSuppliedEnergyAxis = True
+            return self._ROIIndex.getROIImages(i1, i2, imiddle, energy=energy)
+
         isUsingSuppliedEnergyAxis = False
         if self.fileIndex == 0:
             if self.mcaIndex == 1:
@@ -754,31 +842,11 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
                         print("1 ROI image calculation elapsed = %f " %\
                               (time.time() - t0))
                 else:
-                    shape = self._stack.data.shape
-                    roiImage = numpy.zeros(self._stackImageData.shape,
-                                           numpy.float)
-                    background = roiImage * 1
-                    leftImage = roiImage * 1
-                    middleImage = roiImage * 1
-                    rightImage = roiImage * 1
-                    maxImage = roiImage * 1
-                    minImage = roiImage * 1
-                    step = 1
-                    for i in range(shape[0]):
-                        tmpData = self._stack.data[i:i+step,:, i1:i2] * 1
-                        numpy.add(roiImage[i:i+step,:],
-                              numpy.sum(tmpData, axis=2,dtype=numpy.float),
-                              roiImage[i:i+step,:])
-                        numpy.add(minImage[i:i+step,:],
-                                  numpy.min(tmpData, axis=2),
-                                  minImage[i:i + step, :])
-                        numpy.add(maxImage[i:i + step, :],
-                                  numpy.max(tmpData, axis=2),
-                                  maxImage[i:i + step, :])
-                        leftImage[i:i + step, :] += tmpData[:, :, 0]
-                        middleImage[i:i + step, :] += tmpData[:, :, imiddle - i1]
-                        rightImage[i:i + step, :] += tmpData[:, :, -1]
-                    background = 0.5 * (i2 - i1) * (leftImage + rightImage)
+                    roiImage, maxImage, minImage, leftImage, middleImage, \
+                        rightImage, background = \
+                            self.__calculateDynamicROIImages(i1, i2, imiddle,
+                                                             energy)
+                    isUsingSuppliedEnergyAxis = True
                     if DEBUG:
                         print("2 Dynamic ROI image calculation elapsed = %f " %\
                               (time.time() - t0))
@@ -803,34 +871,11 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
                         print("3 ROI image calculation elapsed = %f " %\
                               (time.time() - t0))
                 else:
-                    shape = self._stack.data.shape
-                    roiImage = numpy.zeros(self._stackImageData.shape,
-                                           numpy.float)
-                    background = roiImage * 1
-                    leftImage = roiImage * 1
-                    middleImage = roiImage * 1
-                    rightImage = roiImage * 1
-                    maxImage = roiImage * 1
-                    minImage = roiImage * 1
-                    istep = 1
-                    for i in range(i1, i2):
-                        tmpData = self._stack.data[i:i + istep]
-                        tmpData.shape = roiImage.shape
-                        numpy.add(roiImage, tmpData, roiImage)
-                        if i == i1:
-                            minImage = tmpData * 1
-                            maxImage = tmpData * 1
-                        else:
-                            minImage = numpy.minimum(minImage, tmpData, minImage)
-                            maxImage = numpy.maximum(maxImage, tmpData, minImage)
-                        if (i == i1):
-                            leftImage = tmpData
-                        elif (i == imiddle):
-                            middleImage = tmpData
-                        elif i == (i2 - 1):
-                            rightImage = tmpData
-                    if i2 > i1:
-                        background = (leftImage + rightImage) * 0.5 * (i2 - i1)
+                    roiImage, maxImage, minImage, leftImage, middleImage, \
+                        rightImage, background = \
+                            self.__calculateDynamicROIImages(i1, i2, imiddle,
+                                                             energy)
+                    isUsingSuppliedEnergyAxis = True
                     if DEBUG:
                         print("4 Dynamic ROI elapsed = %f" %\
                               (time.time() - t0))
@@ -852,31 +897,11 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
                         print("5 ROI Image elapsed = %f" %\
                               (time.time() - t0))
                 else:
-                    shape = self._stack.data.shape
-                    roiImage = numpy.zeros(self._stackImageData.shape,
-                                           numpy.float)
-                    background = roiImage * 1
-                    leftImage = roiImage * 1
-                    middleImage = roiImage * 1
-                    rightImage = roiImage * 1
-                    maxImage = roiImage * 1
-                    minImage = roiImage * 1
-                    step = 1
-                    for i in range(shape[0]):
-                        tmpData = self._stack.data[i:i+step,:, i1:i2] * 1
-                        numpy.add(roiImage[i:i+step,:],
-                              numpy.sum(tmpData, axis=2, dtype=numpy.float),
-                              roiImage[i:i+step,:])
-                        numpy.add(minImage[i:i+step,:],
-                                  numpy.min(tmpData, 2),
-                                  minImage[i:i+step,:])
-                        numpy.add(maxImage[i:i+step,:],
-                                  numpy.max(tmpData, 2),
-                                  maxImage[i:i+step,:])
-                        leftImage[i:i+step, :]   += tmpData[:, :, 0]
-                        middleImage[i:i+step, :] += tmpData[:, :, imiddle-i1]
-                        rightImage[i:i+step, :]  += tmpData[:, :,-1]
-                    background = 0.5*(i2-i1)*(leftImage+rightImage)
+                    roiImage, maxImage, minImage, leftImage, middleImage, \
+                        rightImage, background = \
+                            self.__calculateDynamicROIImages(i1, i2, imiddle,
+                                                             energy)
+                    isUsingSuppliedEnergyAxis = True
                     if DEBUG:
                         print("6 Dynamic ROI image calculation elapsed = %f" %\
                                           (time.time() - t0))
@@ -923,6 +948,69 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
             print("ROI images calculated")
         return imageDict
 
+    def __calculateDynamicROIImages(self, i1, i2, imiddle, energy):
+        # all the images are obtained in a single pass over the data, reading
+        # blocks of complete (HDF5) chunks
+        data = self._stack.data
+        shape = data.shape
+        if self.mcaIndex == 0:
+            axis = 1
+        else:
+            axis = 0
+        roiImage = numpy.zeros(self._stackImageData.shape, numpy.float)
+        minImage = roiImage * 1
+        maxImage = roiImage * 1
+        leftImage = roiImage * 1
+        middleImage = roiImage * 1
+        rightImage = roiImage * 1
+        step = 1
+        chunks = getattr(data, "chunks", None)
+        if chunks:
+            step = chunks[axis]
+        itemsize = numpy.dtype(data.dtype).itemsize
+        nBytes = (i2 - i1) * itemsize * roiImage.size / shape[axis]
+        if nBytes > 0:
+            step = max(step, int(ROI_CHUNK_MEMORY / nBytes) // step * step)
+        tasks = [(data, self.mcaIndex, i1, i2, imiddle, i, min(i + step,
+                                                         shape[axis])) \
+                 for i in range(0, shape[axis], step)]
+        pool = None
+        if (len(tasks) < 2) or (ROI_WORKERS < 2):
+            results = (_getROIImagesChunk(task) for task in tasks)
+        elif HDF5 and isinstance(data, h5py.Dataset):
+            # h5py serializes the calls of the threads, the chunks are
+            # read and reduced by the processes of the HDF5 reader
+            reader = HDF5Reader.HDF5Reader(min(ROI_WORKERS, len(tasks)))
+            limits = [task[-2:] for task in tasks]
+            selections = [_getROISelection(self.mcaIndex, i1, i2,
+                                           start, end)[0] \
+                          for start, end in limits]
+            function = functools.partial(_reduceROIData,
+                            axis=_getROISelection(self.mcaIndex, i1, i2,
+                                                  0, 0)[1],
+                            middle=imiddle - i1)
+            results = (limit + reduced for limit, reduced in \
+                       zip(limits, reader.readSelections(data, selections,
+                                                         function)))
+        else:
+            pool = ThreadPool(min(ROI_WORKERS, len(tasks)))
+            results = pool.imap_unordered(_getROIImagesChunk, tasks)
+        try:
+            for start, end, roi, iMin, iMax, left, middle, right in results:
+                roiImage[start:end] = roi
+                minImage[start:end] = energy[iMin + i1]
+                maxImage[start:end] = energy[iMax + i1]
+                leftImage[start:end] = left
+                middleImage[start:end] = middle
+                rightImage[start:end] = right
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        background = 0.5 * (i2 - i1) * (leftImage + rightImage)
+        return roiImage, maxImage, minImage, leftImage, middleImage, \
+               rightImage, background
+
     def setSelectionMask(self, mask):
         if DEBUG:
             print("setSelectionMask called")
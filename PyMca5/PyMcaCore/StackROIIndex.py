@@ -0,0 +1,239 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Precalculated index to obtain the ROI images of a stack without going
+through the data.
+
+The cumulative sum of the spectra along the channels gives the integral
+of any ROI as the difference of two images. The maximum and the minimum
+of the spectra in blocks of channels give the position of the maximum and
+of the minimum of any ROI reading, at most, two blocks of data.
+"""
+import numpy
+HDF5 = False
+try:
+    import h5py
+    HDF5 = True
+except ImportError:
+    pass
+
+DEBUG = 0
+# amount of data read at once when building the index
+MAX_MEMORY = 64 * 1024 * 1024
+
+class StackROIIndex(object):
+    def __init__(self, data, mcaindex=2, filename=None, blocksize=None):
+        """
+        data is the 3D stack and mcaindex the index of its spectral axis.
+        The cumulative sum needs as much memory as the stack in double
+        precision. If filename is given, it is stored in that HDF5 file
+        instead of in memory.
+        """
+        shape = data.shape
+        if mcaindex in [2, -1]:
+            self._mcaIndex = 2
+            nChannels = shape[2]
+            imageShape = shape[0], shape[1]
+        elif mcaindex == 0:
+            self._mcaIndex = 0
+            nChannels = shape[0]
+            imageShape = shape[1], shape[2]
+        else:
+            raise ValueError("Unsupported mca index %d" % mcaindex)
+        if blocksize is None:
+            blocksize = int(numpy.sqrt(nChannels))
+        blocksize = max(1, blocksize)
+        nBlocks = (nChannels + blocksize - 1) // blocksize
+        self._data = data
+        self._nChannels = nChannels
+        self._imageShape = imageShape
+        self._blockSize = blocksize
+        self._h5 = None
+        if filename is None:
+            self._cumulativeSum = numpy.zeros((nChannels + 1,) + imageShape,
+                                              numpy.float64)
+        else:
+            if not HDF5:
+                raise IOError("HDF5 support needed to store the index")
+            # each lookup reads complete images, chunks should not span
+            # several channels
+            chunkRows = max(1, min(imageShape[0],
+                                   (1024 * 1024) // (8 * imageShape[1])))
+            self._h5 = h5py.File(filename, "w")
+            self._cumulativeSum = self._h5.create_dataset("cumulative_sum",
+                                        shape=(nChannels + 1,) + imageShape,
+                                        dtype=numpy.float64,
+                                        chunks=(1, chunkRows, imageShape[1]))
+        self._blockMaximum = numpy.zeros((nBlocks,) + imageShape,
+                                         numpy.float64)
+        self._blockMaximumIndex = numpy.zeros((nBlocks,) + imageShape,
+                                              numpy.int32)
+        self._blockMinimum = numpy.zeros((nBlocks,) + imageShape,
+                                         numpy.float64)
+        self._blockMinimumIndex = numpy.zeros((nBlocks,) + imageShape,
+                                              numpy.int32)
+        self.__build()
+
+    def __build(self):
+        # the index is built reading blocks of image rows
+        nRows = self._imageShape[0]
+        rowSize = 8 * self._nChannels * self._imageShape[1]
+        step = max(1, min(nRows, MAX_MEMORY // max(1, rowSize)))
+        blockSize = self._blockSize
+        for start in range(0, nRows, step):
+            end = min(start + step, nRows)
+            if self._mcaIndex == 2:
+                tmpData = numpy.transpose(self._data[start:end], (2, 0, 1))
+            else:
+                tmpData = self._data[:, start:end, :]
+            tmpData = numpy.asarray(tmpData, dtype=numpy.float64)
+            cumulativeSum = numpy.zeros((self._nChannels + 1,) + \
+                                        tmpData.shape[1:], numpy.float64)
+            numpy.cumsum(tmpData, axis=0, out=cumulativeSum[1:])
+            self._cumulativeSum[:, start:end, :] = cumulativeSum
+            for k in range(self._blockMaximum.shape[0]):
+                block = tmpData[k * blockSize:(k + 1) * blockSize]
+                self._blockMaximumIndex[k, start:end] = \
+                                numpy.argmax(block, axis=0) + k * blockSize
+                self._blockMaximum[k, start:end] = numpy.max(block, axis=0)
+                self._blockMinimumIndex[k, start:end] = \
+                                numpy.argmin(block, axis=0) + k * blockSize
+                self._blockMinimum[k, start:end] = numpy.min(block, axis=0)
+        if self._h5 is not None:
+            self._h5.flush()
+
+    def close(self):
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+
+    def getShape(self):
+        return self._imageShape
+
+    def getNumberOfChannels(self):
+        return self._nChannels
+
+    def getChannelImage(self, channel):
+        return self._cumulativeSum[channel + 1] - self._cumulativeSum[channel]
+
+    def getROIImage(self, index1, index2):
+        """
+        Sum of the channels from index1 to index2 (not included)
+        """
+        return self._cumulativeSum[index2] - self._cumulativeSum[index1]
+
+    def __getChannels(self, index1, index2):
+        # read the data of the channels with the spectral axis first
+        if self._mcaIndex == 2:
+            tmpData = numpy.transpose(self._data[:, :, index1:index2],
+                                      (2, 0, 1))
+        else:
+            tmpData = self._data[index1:index2]
+        return numpy.asarray(tmpData, dtype=numpy.float64)
+
+    def getExtremaIndices(self, index1, index2):
+        """
+        Return the channels at which the spectra reach their maximum and
+        their minimum in the range index1 to index2 (not included). As with
+        numpy.argmax, the first occurrence is returned.
+        """
+        blockSize = self._blockSize
+        firstBlock = (index1 + blockSize - 1) // blockSize
+        lastBlock = index2 // blockSize
+        if firstBlock >= lastBlock:
+            firstBlock = lastBlock = None
+            ranges = [(index1, index2)]
+        else:
+            ranges = [(index1, firstBlock * blockSize),
+                      None,
+                      (lastBlock * blockSize, index2)]
+        maxValue = None
+        rows, columns = numpy.indices(self._imageShape)
+        for item in ranges:
+            if item is None:
+                blockMaximum = self._blockMaximum[firstBlock:lastBlock]
+                k = numpy.argmax(blockMaximum, axis=0)
+                value = blockMaximum[k, rows, columns]
+                index = self._blockMaximumIndex[firstBlock + k, rows, columns]
+                blockMinimum = self._blockMinimum[firstBlock:lastBlock]
+                k = numpy.argmin(blockMinimum, axis=0)
+                minimum = blockMinimum[k, rows, columns]
+                minimumIndex = self._blockMinimumIndex[firstBlock + k,
+                                                       rows, columns]
+            elif item[1] > item[0]:
+                tmpData = self.__getChannels(item[0], item[1])
+                index = numpy.argmax(tmpData, axis=0)
+                value = tmpData[index, rows, columns]
+                index += item[0]
+                minimumIndex = numpy.argmin(tmpData, axis=0)
+                minimum = tmpData[minimumIndex, rows, columns]
+                minimumIndex += item[0]
+            else:
+                continue
+            if maxValue is None:
+                maxValue, maxIndex = value, index
+                minValue, minIndex = minimum, minimumIndex
+            else:
+                # strict comparisons keep the first occurrence
+                mask = value > maxValue
+                maxValue[mask] = value[mask]
+                maxIndex[mask] = index[mask]
+                mask = minimum < minValue
+                minValue[mask] = minimum[mask]
+                minIndex[mask] = minimumIndex[mask]
+        return maxIndex, minIndex
+
+    def getROIImages(self, index1, index2, imiddle=None, energy=None):
+        """
+        Return the same dictionary of images as StackBase.calculateROIImages
+        """
+        i1 = min(index1, index2)
+        i2 = max(index1, index2)
+        if imiddle is None:
+            imiddle = int(0.5 * (i1 + i2))
+        if energy is None:
+            energy = numpy.arange(self._nChannels)
+        lowerImage = self._cumulativeSum[i1]
+        roiImage = self._cumulativeSum[i2] - lowerImage
+        leftImage = self._cumulativeSum[i1 + 1] - lowerImage
+        middleImage = self.getChannelImage(imiddle)
+        rightImage = self.getChannelImage(i2 - 1)
+        background = 0.5 * (i2 - i1) * (leftImage + rightImage)
+        maxIndex, minIndex = self.getExtremaIndices(i1, i2)
+        return {'ROI': roiImage,
+                'Maximum': energy[maxIndex],
+                'Minimum': energy[minIndex],
+                'Left': leftImage,
+                'Middle': middleImage,
+                'Right': rightImage,
+                'Background': background}
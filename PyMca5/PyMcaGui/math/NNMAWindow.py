@@ -92,6 +92,12 @@ def __init__(self, parent = None, options=[1, 2, 3, 4, 5, 10]):
         self._maxIterations.setValue(100)
         self.nnmaConfiguration.mainLayout.addWidget(label, 1, 0)
         self.nnmaConfiguration.mainLayout.addWidget(self._maxIterations, 1, 1)
+        self._blocks = qt.QCheckBox(self.nnmaConfiguration)
+        self._blocks.setText("Process the stack in blocks of rows (NMF)")
+        self._blocks.setChecked(False)
+        # only the NMF method is implemented in blocks
+        self._blocks.stateChanged[int].connect(self._blocksSlot)
+        self.nnmaConfiguration.mainLayout.addWidget(self._blocks, 2, 0, 1, 2)
         self.mainLayout.addWidget(self.nnmaConfiguration)
 
 
@@ -176,21 +182,33 @@ def setParameters(self, ddict):
             self.nPC.setValue(ddict['npc'])
         if 'method' in ddict:
             self.buttonGroup.buttons()[ddict['method']].setChecked(True)
+        if 'blocks' in ddict:
+            self._blocks.setChecked(ddict['blocks'])
         return
 
     def getParameters(self):
         ddict = {}
         i = self.buttonGroup.checkedId()
         ddict['methodlabel'] = self.methods[i]
-        ddict['function'] = NNMAModule.nnma
+        if self._blocks.isChecked():
+            ddict['function'] = NNMAModule.blockNNMA
+        else:
+            ddict['function'] = NNMAModule.nnma
         eps = float(self._tolerance.text())
         maxcount = self._maxIterations.value()
         ddict['binning'] =  int(self.binningCombo.currentText())
         ddict['npc']     = self.nPC.value()
+        ddict['blocks'] = self._blocks.isChecked()
         ddict['kw']   = {'eps':eps,
                          'maxcount':maxcount}
+        if ddict['blocks']:
+            ddict['methodlabel'] = "NMF"
+            ddict['kw']['function'] = "NMF"
         return ddict
 
+    def _blocksSlot(self, state):
+        self.methodOptions.setEnabled(not self._blocks.isChecked())
+
 class NNMAWindow(PCAWindow.PCAWindow):
     def setPCAData(self, images, eigenvalues=None, eigenvectors=None,
                    imagenames = None, vectornames = None):
@@ -1231,7 +1231,8 @@ def __init__(self, parent, configfile, filelist=None, outputdir = None,
                      filestep=1, mcastep=1, concentrations=0,
                      fitfiles=0, filebeginoffset=0, fileendoffset=0,
                      mcaoffset=0, chunk=None,
-                     selection=None, lock=None):
+                     selection=None, lock=None, workers=1,
+                     warmstart=False, hdf5output=False):
         McaAdvancedFitBatch.McaAdvancedFitBatch.__init__(self, configfile, filelist, outputdir,
                                                          roifit=roifit, roiwidth=roiwidth,
                                                          overwrite=overwrite, filestep=filestep,
@@ -1243,7 +1244,10 @@ def __init__(self, parent, configfile, filelist=None, outputdir = None,
                                                          mcaoffset  = mcaoffset,
                                                          chunk=chunk,
                                                          selection=selection,
-                                                         lock=lock)
+                                                         lock=lock,
+                                                         workers=workers,
+                                                         warmstart=warmstart,
+                                                         hdf5output=hdf5output)
         qt.QThread.__init__(self)
         self.parent = parent
         self.pleasePause = 0
@@ -1711,7 +1715,8 @@ def main():
                    'overwrite=', 'filestep=', 'mcastep=', 'html=','htmlindex=',
                    'listfile=','cfglistfile=', 'concentrations=', 'table=', 'fitfiles=',
                    'filebeginoffset=','fileendoffset=','mcaoffset=', 'chunk=',
-                   'nativefiledialogs=','selection=']
+                   'nativefiledialogs=','selection=', 'workers=', 'warmstart=',
+                   'hdf5output=']
     filelist = None
     outdir   = None
     cfg      = None
@@ -1732,6 +1737,9 @@ def main():
     fileendoffset = 0
     mcaoffset = 0
     chunk = None
+    workers = 1
+    warmstart = 0
+    hdf5output = 0
     opts, args = getopt.getopt(
                     sys.argv[1:],
                     options,
@@ -1773,6 +1781,12 @@ def main():
             mcaoffset  = int(arg)
         elif opt in ('--chunk'):
             chunk  = int(arg)
+        elif opt in ('--workers'):
+            workers = int(arg)
+        elif opt in ('--warmstart'):
+            warmstart = int(arg)
+        elif opt in ('--hdf5output'):
+            hdf5output = int(arg)
         elif opt in ('--selection'):
             selection  = int(arg)
             if selection:
@@ -1833,7 +1847,9 @@ def main():
                      overwrite = overwrite, filestep=filestep, mcastep=mcastep,
                       concentrations=concentrations, fitfiles=fitfiles,
                       filebeginoffset=filebeginoffset,fileendoffset=fileendoffset,
-                      mcaoffset=mcaoffset, chunk=chunk, selection=selection)
+                      mcaoffset=mcaoffset, chunk=chunk, selection=selection,
+                      workers=workers, warmstart=warmstart,
+                      hdf5output=hdf5output)
         except:
             msg = qt.QMessageBox()
             msg.setIcon(qt.QMessageBox.Critical)
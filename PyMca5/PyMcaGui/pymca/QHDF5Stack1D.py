@@ -68,6 +68,8 @@ def onBegin(self, nfiles):
 
     def onProgress(self,index):
         self.progressBar.setValue(index)
+        self.progressLabel.setText('Mca Progress (%.1f MB/s):' %\
+                                   (self.throughput / (1024. * 1024.)))
 
     def onEnd(self):
         self.bars.hide()
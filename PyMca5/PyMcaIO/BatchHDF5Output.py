@@ -0,0 +1,283 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+HDF5 output of the results of a batch fit.
+
+The fitted areas, their uncertainties, the reduced chi-square and the
+concentrations are written into chunked and compressed datasets as the
+rows of the map are finished. Each row is flagged once written, so the
+output of an interrupted batch tells which rows have to be fitted again.
+If supported, the file is written in SWMR mode and it can be read, while
+the batch runs, opening it with h5py.File(filename, "r", swmr=True).
+"""
+import os
+import numpy
+import h5py
+from PyMca5.PyMcaIO import ArraySave
+
+DEBUG = 0
+ENTRY = "batch"
+RESULTS = "results"
+
+def _toBytes(names):
+    return numpy.array([name.encode('utf-8') for name in names])
+
+def _toStrings(names):
+    output = []
+    for name in names:
+        if hasattr(name, "decode"):
+            name = name.decode('utf-8')
+        output.append(str(name))
+    return output
+
+def _openFile(filename):
+    try:
+        return h5py.File(filename, "r")
+    except:
+        # the writer did not close the file
+        return h5py.File(filename, "r", swmr=True)
+
+def readBatchHDF5Output(filename, data=True):
+    """
+    Return a dictionary with the parameter and concentration names, the
+    finished rows, the attributes and the maps stored in the file or None
+    if the file cannot be read. If data is False, the maps are not read
+    and their entries are None.
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        h5 = _openFile(filename)
+    except:
+        if DEBUG:
+            raise
+        return None
+    try:
+        try:
+            results = h5[ENTRY][RESULTS]
+            ddict = {}
+            ddict['attributes'] = {}
+            for key in results.attrs.keys():
+                if key in ['NX_class', 'signal']:
+                    continue
+                ddict['attributes'][key] = results.attrs[key]
+            ddict['finished'] = results['finished'][()] > 0
+            ddict['nrows'], ddict['ncols'] = results['chisq'].shape
+            ddict['chisq'] = None
+            if data:
+                ddict['chisq'] = results['chisq'][()]
+            for key, names in [('parameters', 'parameters'),
+                               ('uncertainties', 'parameters'),
+                               ('concentrations', 'concentrations')]:
+                ddict[key + '_data'] = None
+                if key in results:
+                    ddict[names] = _toStrings(results[key].attrs['names'])
+                    if data:
+                        ddict[key + '_data'] = results[key][()]
+                else:
+                    ddict[names] = []
+        except:
+            if DEBUG:
+                raise
+            ddict = None
+    finally:
+        h5.close()
+    return ddict
+
+def readBatchHDF5Rows(filename, rows):
+    """
+    Generator giving (row, parameters, uncertainties, chisq, concentrations)
+    for each of the given rows, with the arrays as taken by
+    BatchHDF5Output.writeRow. Only one row is in memory at a time.
+    concentrations is None if not stored.
+    """
+    h5 = _openFile(filename)
+    try:
+        results = h5[ENTRY][RESULTS]
+        for row in rows:
+            output = [row]
+            for key in ['parameters', 'uncertainties']:
+                output.append(results[key][:, row, :])
+            output.append(results['chisq'][row, :])
+            if 'concentrations' in results:
+                output.append(results['concentrations'][:, row, :])
+            else:
+                output.append(None)
+            yield tuple(output)
+    finally:
+        h5.close()
+
+class BatchHDF5Output(object):
+    def __init__(self, filename, nrows, ncols, parameters,
+                 concentrations=None, attributes=None, append=False):
+        """
+        Create the file overwriting any existing one. parameters and
+        concentrations are the names of the fitted peak groups and of the
+        concentrations. The attributes are stored with the results.
+        If append is True, the file must exist with the same layout and
+        the rows already written are kept.
+        """
+        if concentrations is None:
+            concentrations = []
+        self._parameters = list(parameters)
+        self._concentrations = list(concentrations)
+        self._shape = nrows, ncols
+        self._h5 = None
+        if append:
+            self._openFile(filename)
+        else:
+            self._createFile(filename)
+        if attributes is not None:
+            results = self._h5[ENTRY][RESULTS]
+            for key in attributes:
+                results.attrs[key] = attributes[key]
+        self._h5.flush()
+        if self._swmr and hasattr(self._h5, "swmr_mode"):
+            try:
+                self._h5.swmr_mode = True
+            except:
+                self._swmr = False
+        else:
+            self._swmr = False
+        if DEBUG:
+            print("HDF5 output %s SWMR = %s" % (filename, self._swmr))
+
+    def _getLayout(self):
+        return [('parameters', self._parameters),
+                ('uncertainties', self._parameters),
+                ('concentrations', self._concentrations)]
+
+    def _createFile(self, filename):
+        nrows, ncols = self._shape
+        if os.path.exists(filename):
+            os.remove(filename)
+        try:
+            self._h5 = h5py.File(filename, "w", libver="latest")
+            self._swmr = True
+        except:
+            self._h5 = h5py.File(filename, "w")
+            self._swmr = False
+        entry = self._h5.create_group(ENTRY)
+        entry.attrs['NX_class'] = 'NXentry'.encode('utf-8')
+        entry['title'] = "PyMca batch fit results".encode('utf-8')
+        entry['start_time'] = ArraySave.getDate().encode('utf-8')
+        results = entry.create_group(RESULTS)
+        results.attrs['NX_class'] = 'NXdata'.encode('utf-8')
+        results.attrs['signal'] = 'parameters'.encode('utf-8')
+        # one chunk per row and quantity, a row is written at once
+        self._data = {}
+        for key, names in self._getLayout():
+            if not len(names):
+                continue
+            dataset = results.create_dataset(key,
+                                    shape=(len(names), nrows, ncols),
+                                    dtype=numpy.float64,
+                                    chunks=(1, 1, ncols),
+                                    compression="gzip",
+                                    shuffle=True)
+            dataset.attrs['names'] = _toBytes(names)
+            self._data[key] = dataset
+        self._data['chisq'] = results.create_dataset('chisq',
+                                    shape=(nrows, ncols),
+                                    dtype=numpy.float64,
+                                    chunks=(1, ncols),
+                                    compression="gzip",
+                                    shuffle=True,
+                                    fillvalue=-1.0)
+        self._finished = results.create_dataset('finished',
+                                    shape=(nrows,),
+                                    dtype=numpy.uint8,
+                                    chunks=(min(nrows, 1024),))
+
+    def _openFile(self, filename):
+        # it fails if a writer did not close the file
+        try:
+            self._h5 = h5py.File(filename, "r+", libver="latest")
+            self._swmr = True
+        except:
+            self._h5 = h5py.File(filename, "r+")
+            self._swmr = False
+        try:
+            results = self._h5[ENTRY][RESULTS]
+            self._data = {}
+            for key, names in self._getLayout():
+                if not len(names):
+                    if key in results:
+                        raise ValueError("Unexpected dataset %s" % key)
+                    continue
+                dataset = results[key]
+                if (dataset.shape != ((len(names),) + self._shape)) or \
+                   (_toStrings(dataset.attrs['names']) != names):
+                    raise ValueError("Different %s layout" % key)
+                self._data[key] = dataset
+            self._data['chisq'] = results['chisq']
+            self._finished = results['finished']
+            if (self._data['chisq'].shape != self._shape) or \
+               (self._finished.shape != self._shape[:1]):
+                raise ValueError("Different map shape")
+        except:
+            self._h5.close()
+            self._h5 = None
+            raise
+
+    def getParameterNames(self):
+        return self._parameters * 1
+
+    def getConcentrationNames(self):
+        return self._concentrations * 1
+
+    def writeRow(self, row, parameters, uncertainties, chisq,
+                 concentrations=None):
+        """
+        parameters and uncertainties are arrays of shape (number of
+        parameters, number of columns), concentrations of shape (number of
+        concentrations, number of columns) and chisq has one value per
+        column. The row is flagged as finished once written.
+        """
+        if self._h5 is None:
+            raise ValueError("Output file already closed")
+        for key, data in [('parameters', parameters),
+                          ('uncertainties', uncertainties),
+                          ('concentrations', concentrations)]:
+            if key in self._data:
+                self._data[key][:, row, :] = data
+        self._data['chisq'][row, :] = chisq
+        self._h5.flush()
+        # the flag is set once the data are in the file
+        self._finished[row] = 1
+        self._h5.flush()
+
+    def close(self):
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
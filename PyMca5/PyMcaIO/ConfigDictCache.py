@@ -0,0 +1,258 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Binary cache of the ConfigDict files distributed with PyMca.
+
+Parsing the text files of the physical data takes most of the time needed
+to import the fluorescence modules. The parsed contents are stored, once,
+as pickles in the directory given by the PYMCA_CACHE_DIR environment
+variable (by default the cache subdirectory of the PyMca user directory)
+and used as long as the size and the modification time of the text file
+do not change. Setting the PYMCA_NO_CACHE environment variable to a value
+other than 0, or an empty PYMCA_CACHE_DIR, disables the cache, and the
+text files are simply parsed when the cache directory cannot be written.
+
+The top level sections can be unpickled on first use, what is convenient
+for the files with one section per element.
+"""
+import sys
+import os
+import hashlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from PyMca5.PyMcaIO import ConfigDict
+
+DEBUG = 0
+# to be increased when the format of the cache changes
+CACHE_VERSION = 1
+# readable by python 2 and python 3
+PICKLE_PROTOCOL = 2
+
+def getCacheDirectory():
+    """
+    Return the directory of the cache or None if it is disabled.
+    """
+    if os.getenv("PYMCA_NO_CACHE", "0") not in ["", "0"]:
+        return None
+    directory = os.getenv("PYMCA_CACHE_DIR")
+    if directory is None:
+        if sys.platform == 'win32':
+            home = os.getenv('USERPROFILE')
+        else:
+            home = os.getenv('HOME')
+        if not home:
+            return None
+        directory = os.path.join(home, "PyMca", "cache")
+    if not len(directory):
+        return None
+    return directory
+
+def _md5(data):
+    try:
+        # not used for security, allowed on FIPS systems
+        return hashlib.md5(data, usedforsecurity=False)
+    except TypeError:
+        return hashlib.md5(data)
+
+def _isWritable(directory):
+    # the nearest existing directory has to be writable
+    while not os.path.isdir(directory):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return False
+        directory = parent
+    return os.access(directory, os.W_OK)
+
+def _getCacheFileName(directory, filename):
+    filename = os.path.abspath(filename)
+    key = _md5(filename.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(directory, "%s.%s.py%d.cache" % \
+                        (os.path.basename(filename), key, sys.version_info[0]))
+
+def _getHeader(filename):
+    stat = os.stat(filename)
+    return {'version': CACHE_VERSION,
+            'source': os.path.abspath(filename),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime}
+
+def _readCache(cachefile, header):
+    if not os.path.exists(cachefile):
+        return None
+    try:
+        f = open(cachefile, "rb")
+        try:
+            if pickle.load(f) != header:
+                return None
+            return pickle.load(f)
+        finally:
+            f.close()
+    except:
+        if DEBUG:
+            print("Error reading cache %s: %s" % (cachefile,
+                                                  sys.exc_info()[1]))
+        return None
+
+def _writeCache(cachefile, header, sections):
+    directory = os.path.dirname(cachefile)
+    tmpfile = cachefile + ".%d" % os.getpid()
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = open(tmpfile, "wb")
+        try:
+            pickle.dump(header, f, PICKLE_PROTOCOL)
+            pickle.dump(sections, f, PICKLE_PROTOCOL)
+        finally:
+            f.close()
+        if sys.platform == 'win32' and os.path.exists(cachefile):
+            os.remove(cachefile)
+        os.rename(tmpfile, cachefile)
+    except:
+        # a read-only directory just means no cache
+        if DEBUG:
+            print("Error writing cache %s: %s" % (cachefile,
+                                                  sys.exc_info()[1]))
+        if os.path.exists(tmpfile):
+            try:
+                os.remove(tmpfile)
+            except:
+                pass
+
+class LazyDict(dict):
+    """
+    Dictionary unpickling each of its values on first access.
+
+    Only the access to single items is lazy, the other methods unpickle
+    all the remaining values first. C code reading the dictionary storage
+    directly, as the json encoder does, only sees the values already
+    unpickled: give it a copy.
+    """
+    def __init__(self, pickles):
+        dict.__init__(self)
+        self._pickles = dict(pickles)
+
+    def __missing__(self, key):
+        if key not in self._pickles:
+            raise KeyError(key)
+        value = pickle.loads(self._pickles.pop(key))
+        dict.__setitem__(self, key, value)
+        return value
+
+    def _loadAll(self):
+        for key in list(self._pickles.keys()):
+            self.__missing__(key)
+
+    def _load(self, key):
+        if key in self._pickles:
+            self.__missing__(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (key in self._pickles)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._pickles.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._load(key)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *var):
+        self._load(key)
+        return dict.pop(self, key, *var)
+
+    def setdefault(self, key, default=None):
+        self._load(key)
+        return dict.setdefault(self, key, default)
+
+    def __reduce__(self):
+        # the copies do not need the pickles
+        self._loadAll()
+        return (self.__class__, ({},), None, None, iter(dict.items(self)))
+
+def _loadingMethod(name):
+    method = getattr(dict, name)
+    def wrapper(self, *var, **kw):
+        if self._pickles:
+            self._loadAll()
+        return method(self, *var, **kw)
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ['__iter__', '__len__', '__repr__', '__eq__', '__ne__', 'keys',
+              'items', 'values', 'copy', 'popitem', 'update', 'clear',
+              'iterkeys', 'iteritems', 'itervalues']:
+    if hasattr(dict, _name):
+        setattr(LazyDict, _name, _loadingMethod(_name))
+del _name
+
+def readConfigDict(filename, lazy=False):
+    """
+    Return the contents of the ConfigDict file, from the cache when
+    it is up to date. If lazy is True, a LazyDict is returned.
+    """
+    directory = getCacheDirectory()
+    sections = None
+    if directory is not None:
+        header = _getHeader(filename)
+        cachefile = _getCacheFileName(directory, filename)
+        sections = _readCache(cachefile, header)
+    if sections is None:
+        ddict = ConfigDict.ConfigDict()
+        ddict.read(filename)
+        writeCache = (directory is not None) and _isWritable(directory)
+        if (not lazy) and (not writeCache):
+            return ddict
+        sections = {}
+        for key in ddict.keys():
+            sections[key] = pickle.dumps(ddict[key], PICKLE_PROTOCOL)
+        if writeCache:
+            _writeCache(cachefile, header, sections)
+        if not lazy:
+            return ddict
+    if lazy:
+        return LazyDict(sections)
+    ddict = ConfigDict.ConfigDict()
+    for key in sections:
+        dict.__setitem__(ddict, key, pickle.loads(sections[key]))
+    ddict.filelist.append([filename, None])
+    return ddict
@@ -37,6 +37,8 @@
 import numpy
 import sys
 import os
+import collections
+import threading
 
 # Offer automatic conversion to HDF5 in case of lacking
 # memory to hold the Stack.
@@ -51,12 +53,133 @@
 SOURCE_TYPE = "EdfFileStack"
 DEBUG = 0
 
+# memory used to keep the frames of a lazy stack
+MAX_CACHE_MEMORY = 256 * 1024 * 1024
+# number of frames (or open memory maps) kept by a lazy stack
+MAX_CACHE_FRAMES = 1024
+
 X_AXIS=0
 Y_AXIS=1
 Z_AXIS=2
 
+class EDFFileListData(object):
+    """
+    Read-only array-like access to a list of EDF files in which each file
+    contains one image of the stack (first image of each file). The frames
+    are read on demand, so the stack never needs to fit in memory.
+    Uncompressed files are memory mapped and only the accessed region of
+    each frame is read from disk. A bounded number of open maps (or of
+    decoded frames for the files that cannot be mapped) is kept in a least
+    recently used cache.
+    """
+    def __init__(self, filelist, dtype=None, cachesize=None):
+        if type(filelist) == type(''):
+            filelist = [filelist]
+        self._fileList = filelist
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()
+        firstImage = self._readFrame(0)
+        if len(firstImage.shape) != 2:
+            raise TypeError("Only lists of files containing 2D images supported")
+        if dtype is None:
+            dtype = firstImage.dtype.newbyteorder("=")
+        self.dtype = numpy.dtype(dtype)
+        self.shape = (len(filelist),) + firstImage.shape
+        self.ndim = 3
+        self.size = self.shape[0] * self.shape[1] * self.shape[2]
+        if cachesize is None:
+            frameSize = self.shape[1] * self.shape[2] * self.dtype.itemsize
+            cachesize = min(MAX_CACHE_MEMORY // max(1, frameSize),
+                            MAX_CACHE_FRAMES)
+        self._cacheSize = max(1, min(cachesize, len(filelist)))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        # this materializes the whole stack
+        if dtype is None:
+            return self[:]
+        return self[:].astype(dtype)
+
+    def _readFrame(self, index):
+        # memory mapped unless the file is compressed
+        edf = EdfFile.EdfFile(self._fileList[index], 'rb', memmap=True)
+        return edf.GetData(0)
+
+    def _getFrame(self, index):
+        self._lock.acquire()
+        try:
+            frame = self._frames.pop(index, None)
+            if frame is not None:
+                # most recently used
+                self._frames[index] = frame
+                return frame
+        finally:
+            self._lock.release()
+        # the file is read outside the lock
+        frame = self._readFrame(index)
+        if frame.shape != self.shape[1:]:
+            print(" ERROR on file %s" % self._fileList[index])
+            print(" Assuming missing data were at the end!!!")
+            tmpFrame = numpy.zeros(self.shape[1:], self.dtype)
+            nRows = min(frame.shape[0], self.shape[1])
+            nColumns = min(frame.shape[1], self.shape[2])
+            tmpFrame[:nRows, :nColumns] = frame[:nRows, :nColumns]
+            frame = tmpFrame
+        self._lock.acquire()
+        try:
+            # another reader may have added it meanwhile
+            self._frames.pop(index, None)
+            while len(self._frames) >= self._cacheSize:
+                self._frames.popitem(last=False)
+            self._frames[index] = frame
+        finally:
+            self._lock.release()
+        return frame
+
+    def __getitem__(self, key):
+        if type(key) != type(()):
+            key = (key,)
+        if len(key) > 3:
+            raise IndexError("Too many indices")
+        key = key + (slice(None),) * (3 - len(key))
+        squeeze = []
+        normalized = []
+        for axis, item in enumerate(key):
+            if isinstance(item, slice):
+                normalized.append(item)
+            elif isinstance(item, (int, numpy.integer)):
+                item = int(item)
+                if item < 0:
+                    item += self.shape[axis]
+                if (item < 0) or (item >= self.shape[axis]):
+                    raise IndexError("Index %d out of range" % item)
+                normalized.append(slice(item, item + 1))
+                squeeze.append(axis)
+            else:
+                raise TypeError("Only integers and slices supported")
+        fileIndices = range(*normalized[0].indices(self.shape[0]))
+        output = numpy.zeros((len(fileIndices),
+                    len(range(*normalized[1].indices(self.shape[1]))),
+                    len(range(*normalized[2].indices(self.shape[2])))),
+                    self.dtype)
+        for i, index in enumerate(fileIndices):
+            # a mapped frame only reads the pages of the region
+            output[i] = self._getFrame(index)[normalized[1], normalized[2]]
+        if len(squeeze):
+            output.shape = [output.shape[i] for i in range(3) \
+                            if i not in squeeze]
+        return output
+
 class EDFStack(DataObject.DataObject):
-    def __init__(self, filelist = None, imagestack=None, dtype=None):
+    def __init__(self, filelist = None, imagestack=None, dtype=None,
+                 lazy=None):
+        """
+        If lazy is True, the files are not loaded into memory but accessed
+        on demand. If it is None, that only happens if the stack does not
+        fit into the available physical memory.
+        """
         DataObject.DataObject.__init__(self)
         self.incrProgressBar=0
         self.__keyList = []
@@ -65,6 +188,7 @@ def __init__(self, filelist = None, imagestack=None, dtype=None):
         else:
             self.__imageStack = imagestack
         self.__dtype = dtype
+        self.__lazy = lazy
         if filelist is not None:
             if type(filelist) != type([]):
                 filelist = [filelist]
@@ -108,6 +232,19 @@ def loadFileList(self, filelist, fileindex=0):
         if self.__dtype is None:
             self.__dtype = arrRet.dtype
 
+        lazy = self.__lazy
+        if lazy is None:
+            needed_ = self.nbFiles * arrRet.size * \
+                      numpy.dtype(self.__dtype).itemsize
+            physicalMemory = PhysicalMemory.getPhysicalMemoryOrNone()
+            lazy = (physicalMemory is not None) and \
+                   (physicalMemory < (1.05 * needed_))
+        # the ID24 maps need the I0 correction and are not handled
+        if lazy and (nImages == 1) and (len(arrRet.shape) == 2) and\
+           (fileindex != 1) and ("_sample_" not in filelist[0]):
+            self.__loadLazyFileList(filelist, fileindex)
+            return
+
         self.onBegin(self.nbFiles)
         singleImageShape = arrRet.shape
         actualImageStack = False
@@ -404,9 +541,12 @@ def loadFileList(self, filelist, fileindex=0):
                                 else:
                                     raise MemoryError("Memory Error")
                     self.incrProgressBar=0
+                    # the frames are copied from the mapped files into the
+                    # stack without an intermediate decoded copy
                     if fileindex == 1:
                         for tempEdfFileName in filelist:
-                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb',
+                                                    memmap=True)
                             pieceOfStack=tempEdf.GetData(0)
                             self.data[:,self.incrProgressBar,:] = pieceOfStack[:,:]
                             self.incrProgressBar += 1
@@ -426,7 +566,8 @@ def loadFileList(self, filelist, fileindex=0):
                                     i0End = EdfFile.EdfFile(i0EndFile, 'rb').GetData(0)
                                     i0Slope = (i0End-i0Start)/len(filelist)
                         for tempEdfFileName in filelist:
-                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
+                            tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb',
+                                                    memmap=True)
                             if ID24:
                                 pieceOfStack=-numpy.log(tempEdf.GetData(0)/(i0Start[0,:] + id24idx * i0Slope))
                                 pieceOfStack[numpy.isfinite(pieceOfStack) == False] = 1
@@ -481,6 +622,31 @@ def loadFileList(self, filelist, fileindex=0):
             self.info["Size"] = self.__nFiles * self.__nImagesPerFile
 
 
+    def __loadLazyFileList(self, filelist, fileindex=0):
+        if (fileindex == 2) or (self.__imageStack):
+            self.__imageStack = True
+        self.onBegin(self.nbFiles)
+        try:
+            self.data = EDFFileListData(filelist, dtype=self.__dtype)
+            self.onProgress(self.nbFiles)
+        finally:
+            self.onEnd()
+        self.__nFiles         = self.nbFiles
+        self.__nImagesPerFile = 1
+        shape = self.data.shape
+        for i in range(len(shape)):
+            key = 'Dim_%d' % (i+1,)
+            self.info[key] = shape[i]
+        self.info["SourceType"] = SOURCE_TYPE
+        if self.__imageStack:
+            self.info["McaIndex"] = 0
+            self.info["FileIndex"] = 1
+        else:
+            self.info["FileIndex"] = fileindex
+        self.info["SourceName"] = self.sourceName
+        self.info["NumberOfFiles"] = self.__nFiles * 1
+        self.info["Size"] = self.__nFiles * self.__nImagesPerFile
+
     def onBegin(self, n):
         pass
 
@@ -174,7 +174,7 @@ class  EdfFile(object):
     """
     ############################################################################
     #Interface
-    def __init__(self, FileName, access=None, fastedf=None):
+    def __init__(self, FileName, access=None, fastedf=None, memmap=None):
         """ Constructor
 
         @param  FileName:   Name of the file (either existing or to be created)
@@ -184,6 +184,9 @@ def __init__(self, FileName, access=None, fastedf=None):
         @type access: string
         @type fastedf= True to use the fastedf module
         @param fastedf= boolean
+        @param memmap: True to get read-only memory mapped arrays of the
+                       uncompressed EDF images instead of copies
+        @type memmap: boolean
         """
         self.Images = []
         self.NumImages = 0
@@ -192,6 +195,10 @@ def __init__(self, FileName, access=None, fastedf=None):
         if fastedf is None:
             fastedf = 0
         self.fastedf = fastedf
+        if memmap is None:
+            memmap = False
+        self.memmap = memmap
+        self.__memmaps = {}
         self.ADSC = False
         self.MARCCD = False
         self.TIFF = False
@@ -618,6 +625,13 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
         if Index < 0 or Index >= self.NumImages:
             raise ValueError("EdfFile: Index out of limit")
         if fastedf is None:fastedf = 0
+        if self.memmap and self.__ownedOpen and \
+           not (self.ADSC or self.MARCCD or self.TIFF or \
+                self.PILATUS_CBF or self.SPE):
+            Data = self.__GetMemmapData(Index, Pos, Size)
+            if DataType != "":
+                Data = self.__SetDataType__ (Data, DataType)
+            return Data
         if Pos is None and Size is None:
             if self.ADSC or self.MARCCD or self.PILATUS_CBF or self.SPE:
                 return self.__data
@@ -757,6 +771,49 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
 
 
 
+    def __GetMemmapData(self, Index, Pos=None, Size=None):
+        """ Internal method: returns a read-only memory mapped view of the
+            requested region. Only the accessed pages are read from disk.
+            The array keeps the byte order of the file, numpy takes care of
+            it when the values are used.
+        """
+        if Index not in self.__memmaps:
+            image = self.Images[Index]
+            datatype = numpy.dtype(self.__GetDefaultNumpyType__(image.DataType,
+                                                               index=Index))
+            if image.ByteOrder.upper() == "HIGHBYTEFIRST":
+                datatype = datatype.newbyteorder(">")
+            else:
+                datatype = datatype.newbyteorder("<")
+            if image.NumDim == 3:
+                shape = (image.Dim3, image.Dim2, image.Dim1)
+            elif image.NumDim == 2:
+                shape = (image.Dim2, image.Dim1)
+            else:
+                shape = (image.Dim1,)
+            self.__memmaps[Index] = numpy.memmap(self.FileName,
+                                                 dtype=datatype,
+                                                 mode="r",
+                                                 offset=image.DataPosition,
+                                                 shape=shape)
+        Data = self.__memmaps[Index]
+        if Pos is None and Size is None:
+            return Data
+        # Pos and Size are given as (x, y, z), x being the fastest axis
+        ndim = len(Data.shape)
+        if Pos is None:
+            Pos = (0,) * ndim
+        if Size is None:
+            Size = (0,) * ndim
+        region = [slice(None)] * ndim
+        for i in range(ndim):
+            axis = ndim - 1 - i
+            size = Size[i]
+            if size == 0:
+                size = Data.shape[axis] - Pos[i]
+            region[axis] = slice(Pos[i], Pos[i] + size)
+        return Data[tuple(region)]
+
     def GetPixel(self, Index, Position):
         """ Returns double value of the pixel, regardless the format of the array
             Index:      The zero-based index of the image in the file
@@ -857,6 +914,7 @@ def _WriteImage (self, Header, Data, Append=1, DataType="", ByteOrder=""):
             self.File.truncate(0)
             self.Images = []
             self.NumImages = 0
+            self.__memmaps = {}
         Index = self.NumImages
         self.NumImages = self.NumImages + 1
         self.Images.append(Image())
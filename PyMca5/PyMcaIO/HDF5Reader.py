@@ -0,0 +1,355 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Concurrent reading of HDF5 datasets.
+
+h5py serializes the calls made from the threads of a process, therefore
+the datasets are read by a pool of processes, each one with its own file
+handles. Datasets are read in slabs along their first dimension aligned
+with their chunks, so that the slabs of one dataset are also read
+concurrently. The pool is started the first time it is needed and shared
+by all the readers of the process.
+"""
+import os
+import time
+import atexit
+import collections
+import multiprocessing
+import numpy
+import h5py
+
+DEBUG = 0
+# amount of data read in one request
+MAX_MEMORY = 32 * 1024 * 1024
+WORKERS = min(multiprocessing.cpu_count(), 8)
+
+# file handles of the current process
+_FILES = {}
+_FILES_PID = None
+
+# pool of processes shared by the readers
+_POOL = None
+_POOL_WORKERS = 0
+
+def _openFile(filename, driver=None):
+    global _FILES_PID
+    if _FILES_PID != os.getpid():
+        # handles inherited from the parent process are not to be used
+        _FILES.clear()
+        _FILES_PID = os.getpid()
+    key = (filename, driver)
+    if key not in _FILES:
+        if driver == "family":
+            _FILES[key] = h5py.File(filename, "r", driver="family")
+        else:
+            _FILES[key] = h5py.File(filename, "r")
+    return _FILES[key]
+
+def _closeFiles():
+    if _FILES_PID != os.getpid():
+        return
+    for key in list(_FILES.keys()):
+        try:
+            _FILES[key].close()
+        except:
+            pass
+        del _FILES[key]
+
+def _readFromDataset(dataset, start, end):
+    if start is None:
+        return dataset[()]
+    return dataset[start:end]
+
+def _readSlab(task):
+    # the pool processes do not keep files open between requests
+    filename, driver, path, start, end = task
+    if driver == "family":
+        h5 = h5py.File(filename, "r", driver="family")
+    else:
+        h5 = h5py.File(filename, "r")
+    try:
+        return _readFromDataset(h5[path], start, end)
+    finally:
+        h5.close()
+
+def _readSelection(task):
+    # the function reduces the data before sending them back
+    filename, driver, path, selection, function = task
+    if driver == "family":
+        h5 = h5py.File(filename, "r", driver="family")
+    else:
+        h5 = h5py.File(filename, "r")
+    try:
+        data = h5[path][selection]
+    finally:
+        h5.close()
+    if function is None:
+        return data
+    return function(data)
+
+def _getPool(workers):
+    global _POOL
+    global _POOL_WORKERS
+    if (_POOL is None) or (_POOL_WORKERS != workers):
+        closePool()
+        _POOL = multiprocessing.Pool(workers)
+        _POOL_WORKERS = workers
+    return _POOL
+
+def closePool():
+    """
+    Stop the processes used to read the data. They are started again when
+    needed.
+    """
+    global _POOL
+    global _POOL_WORKERS
+    if _POOL is None:
+        return
+    _POOL.terminate()
+    _POOL.join()
+    _POOL = None
+    _POOL_WORKERS = 0
+
+atexit.register(closePool)
+
+def getSlabLimits(dataset, nbytes=MAX_MEMORY):
+    """
+    Limits along the first dimension of the slabs in which the dataset
+    is read. The slabs contain complete chunks and about nbytes of data.
+    A single (None, None) slab means the dataset is read at once.
+    """
+    shape = dataset.shape
+    if len(shape) == 0:
+        return [(None, None)]
+    rowBytes = dataset.dtype.itemsize
+    for n in shape[1:]:
+        rowBytes *= n
+    if (shape[0] < 2) or ((rowBytes * shape[0]) <= nbytes):
+        return [(None, None)]
+    step = max(1, nbytes // max(1, rowBytes))
+    chunks = dataset.chunks
+    if chunks is not None:
+        step = max(chunks[0], (step // chunks[0]) * chunks[0])
+    return [(start, min(start + step, shape[0])) \
+            for start in range(0, shape[0], step)]
+
+class HDF5Reader(object):
+    def __init__(self, workers=None, nbytes=MAX_MEMORY):
+        """
+        workers is the number of processes reading the data. If one, the
+        data are read by the calling process and no process is started.
+        """
+        if workers is None:
+            workers = WORKERS
+        self._workers = max(1, int(workers))
+        self._nbytes = nbytes
+        self._bytesRead = 0
+        self._startTime = None
+
+    def getThroughput(self):
+        """
+        Bytes per second read by the last call to readDatasets
+        """
+        if self._startTime is None:
+            return 0.0
+        elapsed = time.time() - self._startTime
+        if elapsed <= 0.0:
+            return 0.0
+        return self._bytesRead / elapsed
+
+    def getBytesRead(self):
+        return self._bytesRead
+
+    def _getTasks(self, items):
+        # (number of paths, path index, shape, dtype, slab, last, task)
+        for h5, paths in items:
+            if isinstance(h5, h5py.File):
+                filename = h5.filename
+                driver = h5.driver
+            else:
+                filename = h5
+                driver = None
+                h5 = _openFile(filename)
+            entries = []
+            for pathIndex, path in enumerate(paths):
+                if path is None:
+                    continue
+                dataset = h5[path]
+                for start, end in getSlabLimits(dataset, self._nbytes):
+                    entries.append([len(paths), pathIndex,
+                                    dataset.shape, dataset.dtype,
+                                    start, False,
+                                    (filename, driver, path, start, end)])
+            if len(entries):
+                entries[-1][5] = True
+                for entry in entries:
+                    yield entry
+            else:
+                yield [len(paths), None, None, None, None, True, None]
+
+    def readDatasets(self, items):
+        """
+        items is a sequence of (file, paths) pairs with file an h5py File
+        instance or a file name and paths a list of dataset paths in that
+        file. None paths are allowed.
+
+        It is a generator giving, in the same order as items, the list of
+        arrays read for each item. None is returned for None paths and for
+        datasets that did not fit in memory.
+        """
+        self._bytesRead = 0
+        self._startTime = time.time()
+        pool = None
+        if self._workers > 1:
+            pool = _getPool(self._workers)
+        try:
+            for output in self._readDatasets(items, pool):
+                yield output
+        except Exception:
+            # do not leave unfinished requests in the shared pool
+            closePool()
+            raise
+        finally:
+            # also reached if the generator is not exhausted
+            _closeFiles()
+
+    def readSelections(self, dataset, selections, function=None):
+        """
+        dataset is an h5py Dataset and selections a sequence of indices
+        (tuples of slices) of it.
+
+        It is a generator giving, in the same order as selections, the
+        arrays dataset[selection] or, if given, the result of calling
+        function with them. The function is then called by the reading
+        processes and it has to be defined at module level.
+        """
+        self._bytesRead = 0
+        self._startTime = time.time()
+        if self._workers < 2:
+            for selection in selections:
+                data = dataset[selection]
+                self._bytesRead += data.nbytes
+                if function is not None:
+                    data = function(data)
+                yield data
+            return
+        filename = dataset.file.filename
+        driver = dataset.file.driver
+        path = dataset.name
+        itemsize = dataset.dtype.itemsize
+        pool = _getPool(self._workers)
+        window = 2 * self._workers
+        selections = iter(selections)
+        pending = collections.deque()
+        finished = False
+        try:
+            while True:
+                while (not finished) and (len(pending) < window):
+                    try:
+                        selection = next(selections)
+                    except StopIteration:
+                        finished = True
+                        break
+                    task = (filename, driver, path, selection, function)
+                    pending.append((selection,
+                                    pool.apply_async(_readSelection,
+                                                     (task,))))
+                if not len(pending):
+                    break
+                selection, result = pending.popleft()
+                data = result.get()
+                size = itemsize
+                for i, n in enumerate(dataset.shape):
+                    if i < len(selection):
+                        n = len(range(*selection[i].indices(n)))
+                    size *= n
+                self._bytesRead += size
+                yield data
+        except Exception:
+            # do not leave unfinished requests in the shared pool
+            closePool()
+            raise
+        finally:
+            if len(pending):
+                # the generator was not exhausted
+                closePool()
+
+    def _readDatasets(self, items, pool):
+        window = 2 * self._workers
+        tasks = self._getTasks(items)
+        pending = collections.deque()
+        finished = False
+        output = None
+        while True:
+            while (not finished) and (len(pending) < window):
+                try:
+                    entry = next(tasks)
+                except StopIteration:
+                    finished = True
+                    break
+                if (entry[-1] is not None) and (pool is not None):
+                    entry.append(pool.apply_async(_readSlab,
+                                                        (entry[-1],)))
+                else:
+                    entry.append(None)
+                pending.append(entry)
+            if not len(pending):
+                break
+            nPaths, pathIndex, shape, dtype, start, last, task, result = \
+                                                        pending.popleft()
+            if output is None:
+                output = [None] * nPaths
+                failed = [False] * nPaths
+            if (task is not None) and (not failed[pathIndex]):
+                try:
+                    if result is None:
+                        data = _readFromDataset(\
+                                    _openFile(task[0], task[1])[task[2]],
+                                    task[3], task[4])
+                    else:
+                        data = result.get()
+                    self._bytesRead += data.nbytes
+                    if start is None:
+                        output[pathIndex] = data
+                    else:
+                        if output[pathIndex] is None:
+                            output[pathIndex] = numpy.empty(shape, dtype)
+                        output[pathIndex][start:start + data.shape[0]] = data
+                except (MemoryError, ValueError):
+                    if DEBUG:
+                        print("Cannot read %s into memory" % task[2])
+                    output[pathIndex] = None
+                    failed[pathIndex] = True
+            if last:
+                yield output
+                output = None
@@ -42,9 +42,11 @@
     import PhysicalMemory
 try:
     from PyMca5.PyMcaCore import NexusDataSource
+    from PyMca5.PyMcaIO import HDF5Reader
 except ImportError:
     print("HDF5Stack1D importing NexusDataSource from local directory!")
     import NexusDataSource
+    import HDF5Reader
 
 DEBUG = 0
 SOURCE_TYPE = "HDF5Stack1D"
@@ -59,6 +61,9 @@ def __init__(self, filelist, selection,
         self.__dtype0 = dtype
         self.__dtype  = dtype
 
+        #bytes per second read, updated before each call to onProgress
+        self.throughput = 0.0
+
         if filelist is not None:
             if selection is not None:
                 self.loadFileList(filelist, selection, scanlist)
@@ -311,6 +316,9 @@ def loadFileList(self, filelist, selection, scanlist=None):
             else:
                 self.onBegin(dim0)
             self.incrProgressBar=0
+            # the datasets of all the files and scans are read concurrently
+            # in the order they are needed
+            readItems = []
             for hdf in hdfStack._sourceObjectList:
                 entryNames = list(hdf["/"].keys())
                 goodEntryNames = []
@@ -321,37 +329,41 @@ def loadFileList(self, filelist, selection, scanlist=None):
                 for scan in scanlist:
                     if JUST_KEYS:
                         entryName = goodEntryNames[int(scan.split(".")[-1])-1]
-                        path = entryName + ySelection
-                        if mSelection is not None:
-                            mpath = entryName + mSelection
-                            mDataset = hdf[mpath].value
-                        if xSelection is not None:
-                            xpath = entryName + xSelection
-                            xDataset = hdf[xpath].value
                     else:
-                        path = scan + ySelection
-                        if mSelection is not None:
-                            mpath = scan + mSelection
-                            mDataset = hdf[mpath].value
-                        if xSelection is not None:
-                            xpath = scan + xSelection
-                            xDataset = hdf[xpath].value
-                    try:
-                        yDataset = hdf[path]
-                        tmpShape = yDataset.shape
-                        totalBytes = numpy.ones((1,), yDataset.dtype).itemsize
-                        for nItems in tmpShape:
-                            totalBytes *= nItems
-                        if (totalBytes/(1024.*1024.)) > 500:
-                            #read from disk
-                            IN_MEMORY = False
-                        else:
-                            #read the data into memory
-                            yDataset = hdf[path].value
-                            IN_MEMORY = True
-                    except (MemoryError, ValueError):
+                        entryName = scan
+                    path = entryName + ySelection
+                    mpath = None
+                    xpath = None
+                    if mSelection is not None:
+                        mpath = entryName + mSelection
+                    if xSelection is not None:
+                        xpath = entryName + xSelection
+                    yDataset = hdf[path]
+                    tmpShape = yDataset.shape
+                    totalBytes = numpy.ones((1,), yDataset.dtype).itemsize
+                    for nItems in tmpShape:
+                        totalBytes *= nItems
+                    if (totalBytes/(1024.*1024.)) > 500:
+                        #read from disk
+                        readItems.append((hdf, [None, mpath, xpath], path))
+                    else:
+                        #read the data into memory
+                        readItems.append((hdf, [path, mpath, xpath], path))
+            reader = HDF5Reader.HDF5Reader()
+            readOutput = reader.readDatasets([item[0:2] for item in readItems])
+            readIndex = -1
+            for hdf in hdfStack._sourceObjectList:
+                for scan in scanlist:
+                    readIndex += 1
+                    path = readItems[readIndex][2]
+                    yDataset, mDataset, xDataset = next(readOutput)
+                    self.throughput = reader.getThroughput()
+                    if yDataset is None:
+                        # too large to be read at once
                         yDataset = hdf[path]
                         IN_MEMORY = False
+                    else:
+                        IN_MEMORY = True
                     nMcaInYDataset = 1
                     for dim in yDataset.shape:
                         nMcaInYDataset *= dim
@@ -24,6 +24,9 @@
 else:
     SPECFILE_USE_GNU_SOURCE = int(SPECFILE_USE_GNU_SOURCE)
 
+# keep an index of the scans of large SPEC files next to them
+# to avoid scanning the whole file each time it is opened
+SPECFILE_USE_INDEX_FILE = int(os.getenv("SPECFILE_USE_INDEX_FILE", 1))
 
 srcfiles = [ 'sfheader','sfinit','sflists','sfdata','sfindex',
              'sflabel' ,'sfmca', 'sftools','locale_management','specfile_py']
@@ -49,6 +52,8 @@
         define_macros = [('_GNU_SOURCE', 1)]
 else:
     define_macros = []
+if SPECFILE_USE_INDEX_FILE:
+    define_macros.append(('SPECFILE_USE_INDEX_FILE', None))
 setup (
         name         = "specfile",
         version      = "3.2",
@@ -103,6 +103,7 @@
 #ifdef WIN32
 #include <stdio.h>
 #include <stdlib.h>
+#include <process.h>
 #else
 #include <unistd.h>
 #endif
@@ -120,6 +121,17 @@
 
 #define SF_ISFX      ".sfI"
 
+/*
+ * Files smaller than this are scanned fast enough not to need an index
+ */
+#define SF_INDEX_MIN_SIZE  (1024*1024)
+
+#ifdef WIN32
+#define SF_INDEXFLAG  O_CREAT | O_WRONLY | O_TRUNC | O_BINARY
+#else
+#define SF_INDEXFLAG  O_CREAT | O_WRONLY | O_TRUNC
+#endif
+
 #define SF_INIT      0
 #define SF_READY     1
 #define SF_MODIFIED  2
@@ -136,9 +148,9 @@ DllExport char     * SfError  ( int error);
 
 
 #ifdef linux
-char SF_SIGNATURE[] =  "Linux 2ruru Sf2.0";
+char SF_SIGNATURE[] =  "Linux 2ruru Sf2.1";
 #else
-char SF_SIGNATURE[] =  "2ruru Sf2.0";
+char SF_SIGNATURE[] =  "2ruru Sf2.1";
 #endif
 
 /*
@@ -153,6 +165,8 @@ static void  sfSaveScan    ( SpecFile *sf, SfCursor *cursor, int *error);
 static void  sfAssignScanNumbers (SpecFile *sf);
 static void  sfReadFile    ( SpecFile *sf, SfCursor *cursor, int *error);
 static void  sfResumeRead  ( SpecFile *sf, SfCursor *cursor, int *error);
+static void  sfInitCursor  ( SfCursor *cursor);
+static void  sfClearIndex  ( SpecFile *sf, SfCursor *cursor);
 #ifdef SPECFILE_USE_INDEX_FILE
 static short sfOpenIndex   ( SpecFile *sf, SfCursor *cursor, int *error);
 static short sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, int *error);
@@ -295,15 +309,7 @@ SfOpen2(int fd, char *name,int *error) {
   /*
    * Init cursor
    */
-   cursor.bytecnt      = 0;
-   cursor.cursor       = 0;
-   cursor.scanno       = 0;
-   cursor.hdafoffset   = -1;
-   cursor.dataoffset   = -1;
-   cursor.mcaspectra   = 0;
-   cursor.what         = 0;
-   cursor.data         = 0;
-   cursor.file_header  = 0;
+   sfInitCursor(&cursor);
 
 
 #ifdef SPECFILE_USE_INDEX_FILE
@@ -336,9 +342,10 @@ SfOpen2(int fd, char *name,int *error) {
    sf->cursor = cursor;
 
   /*
-   * Once is all done assign scan numbers and orders
+   * Once is all done assign scan numbers and orders.
+   * An up to date index already has them.
    */
-   sfAssignScanNumbers(sf);
+   if (idxret != SF_READY) sfAssignScanNumbers(sf);
 
 #ifdef SPECFILE_USE_INDEX_FILE
    if (idxret != SF_READY) sfWriteIndex(sf,&cursor,error);
@@ -421,14 +428,32 @@ SfUpdate ( SpecFile *sf, int *error )
 {
     struct stat mystat;
     long   mtime;
+    long   size;
    /*printf("In SfUpdate\n");
    __asm("int3");*/
     stat(sf->sfname,&mystat);
 
     mtime = mystat.st_mtime;
+    size  = (long) mystat.st_size;
 
-    if (sf->m_time != mtime)  {
-       sfResumeRead (sf,&(sf->cursor),error);
+   /*
+    * The modification time has a resolution of one second, a file
+    * being written can grow without changing it.
+    */
+    if (sf->m_time != mtime || sf->cursor.bytecnt != size)  {
+      /*
+       * The scan being read may have grown
+       */
+       freeAllData(sf);
+       sf->current = (ObjectList *)NULL;
+       if (size < sf->cursor.bytecnt) {
+          /*
+           * Truncated or rewritten file. Scan it again.
+           */
+          sfClearIndex (sf,&(sf->cursor));
+       } else {
+          sfResumeRead (sf,&(sf->cursor),error);
+       }
        sfReadFile   (sf,&(sf->cursor),error);
 
        sf->m_time = mtime;
@@ -526,20 +551,69 @@ sfReadFile(SpecFile *sf,SfCursor *cursor,int *error) {
 }
 
 
+/*
+ * Continue reading the file from the beginning of the last block found.
+ * If it is a scan, its entry in the list is updated instead of appended.
+ */
 static void
 sfResumeRead  ( SpecFile *sf, SfCursor *cursor, int *error) {
+    if (sf->list.last == (ObjectList *)NULL) {
+        sfClearIndex(sf,cursor);
+        return;
+    }
+    if (cursor->what == SCAN) {
+        cursor->scanno--;
+        sf->updating = 1;
+    }
     cursor->bytecnt      = cursor->cursor;
     cursor->what         = 0;
     cursor->hdafoffset   = -1;
     cursor->dataoffset   = -1;
     cursor->mcaspectra   = 0;
     cursor->data         = 0;
-    cursor->scanno--;
-    sf->updating = 1;
     lseek(sf->fd,cursor->bytecnt,SEEK_SET);
     return;
 }
 
+
+static void
+sfInitCursor  ( SfCursor *cursor) {
+    cursor->bytecnt      = 0;
+    cursor->cursor       = 0;
+    cursor->scanno       = 0;
+    cursor->hdafoffset   = -1;
+    cursor->dataoffset   = -1;
+    cursor->mcaspectra   = 0;
+    cursor->what         = 0;
+    cursor->data         = 0;
+    cursor->file_header  = 0;
+    cursor->fileh_size   = 0;
+}
+
+
+/*
+ * Forget the scans found so far and prepare to read from the beginning
+ */
+static void
+sfClearIndex  ( SpecFile *sf, SfCursor *cursor) {
+    register ObjectList  *ptr;
+    register ObjectList  *prevptr;
+
+    for( ptr=sf->list.last ; ptr ; ptr=prevptr ) {
+        free( (SpecScan *)ptr->contents );
+        prevptr = ptr->prev;
+        free( (ObjectList *)ptr );
+    }
+    sf->list.first = (ObjectList *)NULL;
+    sf->list.last  = (ObjectList *)NULL;
+    sf->no_scans   = 0;
+    sf->current    = (ObjectList *)NULL;
+    sf->updating   = 0;
+    sfInitCursor(cursor);
+    lseek(sf->fd,0,SEEK_SET);
+    return;
+}
+
 
 #ifdef SPECFILE_USE_INDEX_FILE
 static short
@@ -564,79 +638,148 @@ sfOpenIndex ( SpecFile *sf, SfCursor *cursor, int *error) {
 }
 
 
+/*
+ * The index stores the modification time and the size of the file it
+ * describes followed by the cursor and the scans found. If the file
+ * only grew, the scans are taken from the index and just the tail of
+ * the file is read.
+ */
 static short
 sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, int *error) {
     SfCursor   filecurs;
     char       buffer[200];
     long       bytesread,i=0;
     SpecScan   scan;
-    short      modif = 0;
     long       mtime;
+    long       size;
+    struct stat mystat;
 
    /*
     * read signature
     */
     bytesread = read(sfi,buffer,sizeof(SF_SIGNATURE));
-    if (strcmp(buffer,SF_SIGNATURE) || bytesread == 0 ) {
+    if (bytesread != sizeof(SF_SIGNATURE) || strcmp(buffer,SF_SIGNATURE)) {
+        close(sfi);
         return(SF_INIT);
     }
 
    /*
     * read cursor and specfile structure
     */
-    if ( read(sfi,&mtime,   sizeof(long)) == 0)   return(SF_INIT);
-    if ( read(sfi,&filecurs, sizeof(SfCursor)) == 0) return(SF_INIT);
+    if ( read(sfi,&mtime,   sizeof(long)) != sizeof(long) ||
+         read(sfi,&size,    sizeof(long)) != sizeof(long) ||
+         read(sfi,&filecurs, sizeof(SfCursor)) != sizeof(SfCursor)) {
+        close(sfi);
+        return(SF_INIT);
+    }
+
+   /*
+    * A file smaller than when indexed has been rewritten
+    */
+    fstat(sf->fd,&mystat);
+    if ((long) mystat.st_size < size || filecurs.bytecnt != size) {
+        close(sfi);
+        return(SF_INIT);
+    }
 
-    if (sf->m_time != mtime)  modif = 1;
+   /*
+    * The block to resume reading from has to be still there
+    */
+    if (filecurs.bytecnt > 0) {
+        lseek(sf->fd,filecurs.cursor,SEEK_SET);
+        if (read(sf->fd,buffer,2) != 2 || buffer[0] != '#' ||
+            (buffer[1] != 'S' && buffer[1] != 'F')) {
+            lseek(sf->fd,0,SEEK_SET);
+            close(sfi);
+            return(SF_INIT);
+        }
+    }
 
-    while(read(sfi,&scan, sizeof(SpecScan))) {
+    while(read(sfi,&scan, sizeof(SpecScan)) == sizeof(SpecScan)) {
         addToList(&(sf->list), (void *)&scan, (long)sizeof(SpecScan));
         i++;
     }
+    close(sfi);
     sf->no_scans = i;
 
     memcpy(cursor,&filecurs,sizeof(SfCursor));
 
-    if (modif) return(SF_MODIFIED);
+    if (sf->m_time != mtime || (long) mystat.st_size != size)
+        return(SF_MODIFIED);
 
     return(SF_READY);
 }
 
-
+
+/*
+ * The index is written to a temporary file and renamed, so that
+ * other readers never see it half written.
+ */
 static void
 sfWriteIndex  ( SpecFile *sf, SfCursor *cursor, int *error) {
 
     int         fdi;
     char       *idxname;
-    short       namelength;
+    char       *tmpname;
+    size_t      namelength;
     ObjectList *obj;
     long        mtime;
+    long        size;
+    int         failed = 0;
+
+    if (cursor->bytecnt < SF_INDEX_MIN_SIZE) return;
 
     namelength = strlen(sf->sfname) + strlen(SF_ISFX) + 1;
 
     idxname = (char *)malloc(sizeof(char) * namelength);
+    tmpname = (char *)malloc(sizeof(char) * (namelength + 16));
+    if (idxname == (char *)NULL || tmpname == (char *)NULL) {
+        free(idxname);
+        free(tmpname);
+        return;
+    }
 
     sprintf(idxname,"%s%s",sf->sfname,SF_ISFX);
+    sprintf(tmpname,"%s.%d",idxname,(int) getpid());
 
-    /* if ((fdi = open(idxname,SF_WRITEFLAG,SF_UMASK)) == -1) { */
-    if ((fdi = open(idxname,O_CREAT | O_WRONLY,SF_UMASK)) == -1) {
-        printf("    - cannot open. Error: (%d)\n",errno);
+    if ((fdi = open(tmpname,SF_INDEXFLAG,SF_UMASK)) == -1) {
+       /*
+        * Not being able to write the index is not an error
+        */
+        free(tmpname);
         free(idxname);
         return;
+    }
+    mtime = sf->m_time;
+    size  = cursor->bytecnt;
+    if (write(fdi,SF_SIGNATURE,sizeof(SF_SIGNATURE)) != sizeof(SF_SIGNATURE))
+        failed = 1;
+    if (!failed && write(fdi, (void *) &mtime, sizeof(long)) != sizeof(long))
+        failed = 1;
+    if (!failed && write(fdi, (void *) &size, sizeof(long)) != sizeof(long))
+        failed = 1;
+    if (!failed &&
+        write(fdi, (void *) cursor, sizeof(SfCursor)) != sizeof(SfCursor))
+        failed = 1;
+    for( obj = sf->list.first; obj && !failed; obj = obj->next) {
+        if (write(fdi,(void *) obj->contents, sizeof(SpecScan)) != \
+                                                    sizeof(SpecScan))
+            failed = 1;
+    }
+    if (close(fdi))
+        failed = 1;
+    if (failed) {
+        unlink(tmpname);
     } else {
-        mtime = sf->m_time;
-        write(fdi,SF_SIGNATURE,sizeof(SF_SIGNATURE));
- /*
-  * Swap bytes for linux
-  */
-        write(fdi, (void *) &mtime, sizeof(long));
-        write(fdi, (void *) cursor, sizeof(SfCursor));
-        for( obj = sf->list.first; obj ; obj = obj->next)
-           write(fdi,(void *) obj->contents, sizeof(SpecScan));
-        close(fdi);
-        free(idxname);
-        return;
+#ifdef WIN32
+        unlink(idxname);
+#endif
+        if (rename(tmpname,idxname))
+            unlink(tmpname);
     }
+    free(tmpname);
+    free(idxname);
+    return;
 }
 #endif
 
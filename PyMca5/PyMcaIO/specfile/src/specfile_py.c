@@ -229,6 +229,7 @@ static PyObject   * scandata_header       (PyObject *self,PyObject *args);
 static PyObject   * scandata_fileheader   (PyObject *self,PyObject *args);
 static PyObject   * scandata_nbmca        (PyObject *self,PyObject *args);
 static PyObject   * scandata_mca          (PyObject *self,PyObject *args);
+static PyObject   * scandata_allmca       (PyObject *self,PyObject *args);
 static PyObject   * scandata_show         (PyObject *self,PyObject *args);
 
 static struct PyMethodDef  scandata_methods[] = {
@@ -249,6 +250,7 @@ static struct PyMethodDef  scandata_methods[] = {
    {"fileheader",  scandata_fileheader,  1},
    {"nbmca",       scandata_nbmca,       1},
    {"mca",         scandata_mca,         1},
+   {"allmca",      scandata_allmca,      1},
    {"show",        scandata_show,        1},
    { NULL, NULL}
 };
@@ -1172,6 +1174,87 @@ scandata_mca      (PyObject *self,PyObject *args)
      */
 }
 
+static PyObject   *
+scandata_allmca   (PyObject *self,PyObject *args)
+{
+    int    error;
+    long   ret;
+    long   idx,nomca;
+    long   first = 1, step = 1, number = -1;
+    long   mcano, i;
+    npy_intp dims[2];
+
+    double         *mcadata = NULL;
+    PyArrayObject  *r_array = NULL;
+
+    SpecFile *sf;
+
+    scandataobject *s = (scandataobject *) self;
+
+    if (!PyArg_ParseTuple(args,"|lll",&first,&step,&number))
+            onError("cannot decode arguments for mca data");
+
+    if (first < 1 || step < 1)
+        onError("mca numbering starts at 1 and step has to be positive");
+
+    idx = s->index;
+
+    if (idx == -1 ) {
+        onError("empty scan data");
+    }
+
+    sf  = (s->file)->sf;
+
+    nomca = SfNoMca(sf,idx,&error);
+
+    if (nomca == -1)
+        onError("cannot get number of mca for scan");
+
+    if (first > nomca) {
+        dims[0] = 0;
+    } else {
+        dims[0] = (nomca - first) / step + 1;
+    }
+    if ((number >= 0) && (dims[0] > number))
+        dims[0] = number;
+    dims[1] = 0;
+
+   /*
+    * Consecutive mca of the same scan are read continuing from
+    * the position of the previous one
+    */
+    for (i = 0, mcano = first; i < dims[0]; i++, mcano += step) {
+        ret = SfGetMca(sf,idx,mcano,&mcadata,&error);
+        if (ret == -1) {
+            Py_XDECREF(r_array);
+            onError("cannot get mca for scan");
+        }
+        if (r_array == NULL) {
+            dims[1] = ret;
+            r_array = (PyArrayObject *)PyArray_SimpleNew(2,dims,NPY_DOUBLE);
+            if (r_array == NULL) {
+                free(mcadata);
+                onError("cannot allocate mca array");
+            }
+        } else if (ret != dims[1]) {
+            free(mcadata);
+            Py_DECREF(r_array);
+            onError("mca of different length in scan");
+        }
+        if (mcadata != (double *) NULL){
+            memcpy((char *) PyArray_DATA(r_array) + i * dims[1] * sizeof(double),
+                   mcadata, dims[1] * sizeof(double));
+            free(mcadata);
+            mcadata = NULL;
+        }
+    }
+
+    if (r_array == NULL)
+        r_array = (PyArrayObject *)PyArray_SimpleNew(2,dims,NPY_DOUBLE);
+
+    return PyArray_Return(r_array);
+}
+
 static PyObject   *
 scandata_show      (PyObject *self,PyObject *args)
 {
@@ -533,6 +533,18 @@ def mca(self,number):
             raise ValueError("Specfile mca numberig starts at 1")
         return self.__data[:,number-1]
 
+    def allmca(self, first=1, step=1, number=-1):
+        if first <= 0:
+            raise ValueError("Specfile mca numberig starts at 1")
+        if step <= 0:
+            raise ValueError("Step has to be positive")
+        index = list(range(first - 1, self.nbmca(), step))
+        if number >= 0:
+            index = index[:number]
+        if not len(index):
+            return numpy.zeros((0, 0), numpy.float)
+        return numpy.transpose(self.__data[:, index]) * 1
+
 class BufferedFile(object):
     def __init__(self, filename):
         f = open(filename, 'rb')
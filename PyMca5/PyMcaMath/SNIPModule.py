@@ -35,6 +35,7 @@
 
 snip1d = SpecfitFuns.snip1d
 snip2d = SpecfitFuns.snip2d
+snip1dbackground = SpecfitFuns.snip1dbackground
 
 
 def getSpectrumBackground(spectrum, width, roi_min=None, roi_max=None, smoothing=1):
@@ -48,6 +49,31 @@ def getSpectrumBackground(spectrum, width, roi_min=None, roi_max=None, smoothing
 
 getSnip1DBackground = getSpectrumBackground
 
+def getMultipleSpectraBackground(spectra, width, smoothing_width=None,
+                                 anchors=None, index=-1):
+    """
+    Background of a set of spectra calculated in a single call.
+
+    Each spectrum is smoothed with a Savitsky-Golay filter of the given
+    smoothing_width and the SNIP algorithm is applied independently to
+    the segments delimited by the anchor channels.
+
+    index is the dimension of spectra containing the channels.
+    """
+    spectra = numpy.asarray(spectra)
+    if smoothing_width is None:
+        smoothing_width = 0
+    if anchors is not None:
+        anchors = sorted(anchors)
+    if index in [-1, len(spectra.shape) - 1]:
+        return snip1dbackground(spectra, width, smoothing_width, anchors)
+    elif (index == 0) and (len(spectra.shape) == 2):
+        background = snip1dbackground(spectra.T, width,
+                                      smoothing_width, anchors)
+        return background.T
+    else:
+        raise ValueError("Invalid 1D index %d" % index)
+
 def subtractSnip1DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,  smoothing=1):
     if roi_min is None:
         roi_min = 0
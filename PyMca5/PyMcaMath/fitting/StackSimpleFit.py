@@ -32,6 +32,7 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import sys
 import os
+import multiprocessing
 import numpy
 from PyMca5.PyMcaIO import ConfigDict
 from . import SimpleFitModule
@@ -40,6 +41,105 @@
 
 DEBUG = 0
 
+# fit instance of the worker processes
+_WORKER_FIT = {}
+# a fit started from a neighbour is repeated from the estimation when its
+# chi square is worse than this factor times the one of the neighbour
+SEED_CHISQ_FACTOR = 2.0
+
+def _initializeWorker(config):
+    fit = SimpleFitModule.SimpleFit()
+    fit.setConfiguration(config, try_import=True)
+    _WORKER_FIT['fit'] = fit
+
+def _seedFit(fit, values):
+    # use the given values as starting point of the next fit
+    i = 0
+    for param in fit.paramlist:
+        if param['code'] != 'IGNORE':
+            param['estimation'] = values[i]
+        i += 1
+
+def _getFitSeed(fit, chisq):
+    return [param['fitresult'] for param in fit.paramlist \
+            if param['code'] != 'IGNORE'], chisq
+
+def _startFit(fit, seed=None):
+    if seed is None:
+        return fit.startFit()
+    _seedFit(fit, seed[0])
+    try:
+        result = fit.startFit()
+        if numpy.all(numpy.isfinite(result[0])) and \
+           (result[1] <= SEED_CHISQ_FACTOR * seed[1]):
+            return result
+    except:
+        if DEBUG:
+            print("Fit from neighbour failed %s" % sys.exc_info()[1])
+    # the neighbour was not a good starting point
+    fit.estimate()
+    return fit.startFit()
+
+def _fitRow(fit, x, y, sigma, mask, xmin, xmax, alwaysEstimate, seed):
+    # fit the spectra of one row, y is an array (columns, channels)
+    results = []
+    estimated = False
+    for column in range(y.shape[0]):
+        if not mask[column]:
+            continue
+        if x.shape == y.shape:
+            xColumn = x[column]
+        else:
+            xColumn = x
+        if sigma is None:
+            sigmaColumn = None
+        elif sigma.shape == y.shape:
+            sigmaColumn = sigma[column]
+        else:
+            sigmaColumn = sigma
+        try:
+            fit.setData(xColumn, y[column], sigma=sigmaColumn,
+                        xmin=xmin, xmax=xmax)
+            if alwaysEstimate or (not estimated):
+                fit.estimate()
+                estimated = True
+            if seed and (not alwaysEstimate) and len(results):
+                fitResult = _startFit(fit, results[-1][4])
+            else:
+                fitResult = fit.startFit()
+        except:
+            print("Error %s processing column = %d" % \
+                  (sys.exc_info()[1], column))
+            if DEBUG:
+                raise
+            continue
+        result = fit.getResult(configuration=False)['result']
+        if result is None:
+            continue
+        results.append((column,
+                        result['parameters'],
+                        result['fittedvalues'],
+                        result['sigma_values'],
+                        _getFitSeed(fit, fitResult[1]),
+                        result['chisq']))
+    return results
+
+def _fitRowInWorker(task):
+    row = task[0]
+    return row, _fitRow(_WORKER_FIT['fit'], *task[1:])
+
+def _getRow(data, row, data_index):
+    # the spectra of one row of the output images as (columns, channels)
+    if len(data.shape) == 3:
+        if data_index == 0:
+            return numpy.transpose(data[:, row, :])
+        elif data_index == 1:
+            return numpy.transpose(data[row])
+        return data[row]
+    if data_index == 0:
+        return numpy.transpose(data[:, row:row + 1])
+    return data[row:row + 1]
+
 class StackSimpleFit(object):
     def __init__(self, fit=None):
         if fit is None:
@@ -56,6 +156,8 @@ def __init__(self, fit=None):
         # optimization variables
         self.mask = None
         self.__ALWAYS_ESTIMATE = True
+        self._seedFromNeighbours = False
+        self._workers = 1
 
     def setProgressCallback(self, method):
         """
@@ -74,6 +176,26 @@ def progressUpdate(self):
         ddict['status'] = self._status
         return ddict
 
+    def setSeedFromNeighbours(self, flag=True):
+        """
+        When the estimation is not made for every spectrum, start each fit
+        from the results of the previous spectrum in the row, or from the
+        first spectrum of the previous row for the first column.
+        When several workers are used the rows are fitted independently and
+        the first spectrum of each row starts from the estimation.
+        """
+        self._seedFromNeighbours = flag
+
+    def setNumberOfWorkers(self, workers=None):
+        """
+        Distribute the rows of the stack among several processes. Only
+        used with fixed length output. If workers is None, use as many as
+        CPUs.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self._workers = max(1, int(workers))
+
     def setOutputDirectory(self, outputdir):
         self.outputDir = outputdir
 
@@ -88,7 +210,7 @@ def setData(self, stack_x, stack_y, sigma=None, xmin=None, xmax=None):
         self.xMax = xmax
 
     def setDataIndex(self, data_index=None):
-        self.data_index = data_index
+        self.dataIndex = data_index
 
     def setConfigurationFile(self, fname):
         if not os.path.exists(fname):
@@ -170,6 +292,12 @@ def processStack(self, mask=None):
         self._column = -1
         self._progress = 0
         self._status = "Fitting"
+        self._lastSeed = None
+        self._rowSeed = None
+        if (self._workers > 1) and self.fixedLenghtOutput and \
+           (self._nRows > 1):
+            self._processStackInParallel(nPixels)
+            return
         for i in range(nPixels):
             self._progress = (i * 100.)/ nPixels
             if (self._column+1) == self._nColumns:
@@ -194,6 +322,7 @@ def processStackData(self, i):
         self.aboutToGetStackData(i)
         x, y, sigma, xmin, xmax = self.getFitInputValues(i)
         self.fit.setData(x, y, sigma=sigma, xmin=xmin, xmax=xmax)
+        seed = None
         if self._parameters is None:
             if DEBUG:
                 print("First estimation")
@@ -202,10 +331,81 @@ def processStackData(self, i):
             if DEBUG:
                 print("Estimation due to settings")
             self.fit.estimate()
+        elif self._seedFromNeighbours:
+            if self._column == 0:
+                seed = self._rowSeed
+            else:
+                seed = self._lastSeed
         self.estimateFinished()
-        values, chisq, sigma, niter, lastdeltachi = self.fit.startFit()
+        self._lastSeed = None
+        values, chisq, sigma, niter, lastdeltachi = _startFit(self.fit, seed)
+        self._lastSeed = _getFitSeed(self.fit, chisq)
+        if self._column == 0:
+            self._rowSeed = self._lastSeed
         self.fitFinished()
 
+    def _processStackInParallel(self, nPixels):
+        data_index = self.stackDataIndexList[0]
+        y = self.stack_y
+        if hasattr(y, "info") and hasattr(y, "data"):
+            y = y.data
+        if self.stack_x is None:
+            x = numpy.arange(float(y.shape[data_index]))
+        elif self.stack_x.shape == y.shape:
+            x = None
+        else:
+            x = numpy.array(self.stack_x, dtype=numpy.float).reshape(-1)
+        sigma = self.stack_sigma
+        if (sigma is not None) and (sigma.shape != y.shape):
+            sigma = numpy.array(sigma, dtype=numpy.float).reshape(-1)
+
+        # widgets cannot be sent to other processes
+        config = self.fit.getConfiguration()
+        for key in config['functions']:
+            config['functions'][key]['widget'] = None
+        pool = multiprocessing.Pool(min(self._workers, self._nRows),
+                                    initializer=_initializeWorker,
+                                    initargs=(config,))
+
+        def tasks():
+            for row in range(self._nRows):
+                if x is None:
+                    xRow = _getRow(self.stack_x, row, data_index)
+                else:
+                    xRow = x
+                if (sigma is None) or (sigma.shape != y.shape):
+                    sigmaRow = sigma
+                else:
+                    sigmaRow = _getRow(sigma, row, data_index)
+                yield (row, xRow,
+                       numpy.array(_getRow(y, row, data_index),
+                                   dtype=numpy.float),
+                       sigmaRow, self.mask[row],
+                       self.xMin, self.xMax,
+                       self.__ALWAYS_ESTIMATE, self._seedFromNeighbours)
+        try:
+            nRows = 0
+            for row, results in pool.imap_unordered(_fitRowInWorker,
+                                                    tasks()):
+                for column, parameters, values, sigmas, seed, chisq in \
+                                                                    results:
+                    self._row = row
+                    self._column = column
+                    self._storeResult(parameters, values, sigmas, chisq)
+                nRows += 1
+                self._progress = (nRows * 100.) / self._nRows
+                if self.progressCallback is not None:
+                    self.progressCallback(nRows * self._nColumns, nPixels)
+        finally:
+            pool.terminate()
+            pool.join()
+        if self._parameters is None:
+            raise ValueError("No valid fit results")
+        self.onProcessStackFinished()
+        self._status = "Ready"
+        if self.progressCallback is not None:
+            self.progressCallback(nPixels, nPixels)
+
     def getFitInputValues(self, index):
         """
         Returns the fit parameters x, y, sigma, xmin, xmax
@@ -226,7 +426,10 @@ def getFitInputValues(self, index):
         elif len(yShape) == 2:
             if column > 0:
                 raise ValueError("Column index > 0 on a single column stack")
-            y = self.stack_y[row]
+            if data_index == 0:
+                y = self.stack_y[:, row]
+            else:
+                y = self.stack_y[row]
         else:
             raise TypeError("Unsupported y data shape lenght")
 
@@ -252,7 +455,10 @@ def getFitInputValues(self, index):
             elif len(xShape) == 2:
                 if column > 0:
                     raise ValueError("Column index > 0 on a single column stack")
-                x = self.stack_x[row]
+                if data_index == 0:
+                    x = self.stack_x[:, row]
+                else:
+                    x = self.stack_x[row]
             else:
                 raise TypeError("Unsupported x data shape lenght")
         elif xSize == y.size:
@@ -282,7 +488,10 @@ def getFitInputValues(self, index):
             elif len(sigmaShape) == 2:
                 if column > 0:
                     raise ValueError("Column index > 0 on a single column stack")
-                sigma = self.stack_sigma[row]
+                if data_index == 0:
+                    sigma = self.stack_sigma[:, row]
+                else:
+                    sigma = self.stack_sigma[row]
             else:
                 raise TypeError("Unsupported sigma data shape lenght")
         elif sigmaSize == y.size:
@@ -325,7 +534,20 @@ def fitFinished(self):
             print("result not valid for row %d, column %d" % (row, column))
             return
 
-        if self.fixedLenghtOutput and (self._parameters is None):
+        if self.fixedLenghtOutput:
+            self._storeResult(result['parameters'],
+                              result['fittedvalues'],
+                              result['sigma_values'],
+                              result['chisq'])
+        else:
+            #specfile output always available
+            specfile = self.getOutputFileNames()['specfile']
+            self._appendOneResultToSpecfile(specfile, result=fitOutput)
+
+    def _storeResult(self, parameters, fittedvalues, sigma_values, chisq):
+        row = self._row
+        column = self._column
+        if self._parameters is None:
             #If it is the first fit, initialize results array
             imgdir = os.path.join(self.outputDir, "IMAGES")
             if not os.path.exists(imgdir):
@@ -337,7 +559,7 @@ def fitFinished(self):
             self._parameters  = []
             self._images      = {}
             self._sigmas      = {}
-            for parameter in result['parameters']:
+            for parameter in parameters:
                 self._parameters.append(parameter)
                 self._images[parameter] = numpy.zeros((self._nRows,
                                                        self._nColumns),
@@ -349,19 +571,12 @@ def fitFinished(self):
                                                        self._nColumns),
                                                        numpy.float32)
 
-        if self.fixedLenghtOutput:
-            i = 0
-            for parameter in self._parameters:
-                self._images[parameter] [row, column] =\
-                                        result['fittedvalues'][i]
-                self._sigmas[parameter] [row, column] =\
-                                        result['sigma_values'][i]
-                i += 1
-            self._images['chisq'][row, column] = result['chisq']
-        else:
-            #specfile output always available
-            specfile = self.getOutputFileNames()['specfile']
-            self._appendOneResultToSpecfile(specfile, result=fitOutput)
+        i = 0
+        for parameter in self._parameters:
+            self._images[parameter] [row, column] = fittedvalues[i]
+            self._sigmas[parameter] [row, column] = sigma_values[i]
+            i += 1
+        self._images['chisq'][row, column] = chisq
 
     def _appendOneResultToSpecfile(self, filename, result=None):
         if result is None:
@@ -4077,38 +4077,20 @@ SpecfitFuns_pileup(PyObject *self, PyObject *args)
 }
 
 
-static PyObject *
-SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
+/* Savitsky-Golay smoothing of data in place. buffer must hold n doubles */
+static void
+savitsky_golay(double *data, double *buffer, int n, int npoints)
 {
-    PyObject *input;
-    PyArrayObject *ret;
-    int n, npoints;
-    double dpoints = 5.;
     double coeff[MAX_SAVITSKY_GOLAY_WIDTH];
     int i, j, m;
     double  dhelp, den;
-    double  *data;
-    double  *output;
 
-    if (!PyArg_ParseTuple(args, "O|d", &input, &dpoints))
-        return NULL;
-
-    ret = (PyArrayObject *)
-             PyArray_FROMANY(input, NPY_DOUBLE, 1, 1, NPY_ARRAY_ENSURECOPY);
-
-    if (ret == NULL){
-        printf("Cannot create 1D array from input\n");
-        return NULL;
-    }
-    npoints = (int )  dpoints;
     if (!(npoints % 2)) npoints +=1;
 
-    n = (int) PyArray_DIMS(ret)[0];
-
     if((npoints < MIN_SAVITSKY_GOLAY_WIDTH) ||  (n < npoints))
     {
         /* do not smooth data */
-        return PyArray_Return(ret);
+        return;
     }
 
     /* calculate the coefficients */
@@ -4119,40 +4101,168 @@ SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
         coeff[m-i] = coeff[m+i];
     }
 
-    /* do the job */
-    output = (double *) PyArray_DATA(ret);
-
     /* simple smoothing at the beginning */
     for (j=0; j<=(int)(npoints/3); j++)
     {
-        smooth1d(output, m);
+        smooth1d(data, m);
     }
 
     /* simple smoothing at the end */
     for (j=0; j<=(int)(npoints/3); j++)
     {
-        smooth1d((output+n-m-1), m);
+        smooth1d((data+n-m-1), m);
     }
 
     /*one does not need the whole spectrum buffer, but code is clearer */
-    data = (double *) malloc(n * sizeof(double));
-    memcpy(data, output, n * sizeof(double));
+    memcpy(buffer, data, n * sizeof(double));
 
     /* the actual SG smoothing in the middle */
     for (i=m; i<(n-m); i++){
         dhelp = 0;
         for (j=-m;j<=m;j++) {
-            dhelp += coeff[m+j] * (*(data+i+j));
+            dhelp += coeff[m+j] * (*(buffer+i+j));
         }
         if(dhelp > 0.0){
-            *(output+i) = dhelp / den;
+            *(data+i) = dhelp / den;
         }
     }
-    free(data);
+}
+
+static PyObject *
+SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
+{
+    PyObject *input;
+    PyArrayObject *ret;
+    int n, npoints;
+    double dpoints = 5.;
+    double  *buffer;
+
+    if (!PyArg_ParseTuple(args, "O|d", &input, &dpoints))
+        return NULL;
+
+    ret = (PyArrayObject *)
+             PyArray_FROMANY(input, NPY_DOUBLE, 1, 1, NPY_ARRAY_ENSURECOPY);
+
+    if (ret == NULL){
+        printf("Cannot create 1D array from input\n");
+        return NULL;
+    }
+    npoints = (int )  dpoints;
+    if (npoints > MAX_SAVITSKY_GOLAY_WIDTH)
+    {
+        npoints = MAX_SAVITSKY_GOLAY_WIDTH;
+    }
+
+    n = (int) PyArray_DIMS(ret)[0];
+
+    buffer = (double *) malloc(n * sizeof(double));
+    if (buffer == NULL)
+    {
+        Py_DECREF(ret);
+        return PyErr_NoMemory();
+    }
+    savitsky_golay((double *) PyArray_DATA(ret), buffer, n, npoints);
+    free(buffer);
     return PyArray_Return(ret);
 
 }
 
+static PyObject *
+SpecfitFuns_snip1dbackground(PyObject *self, PyObject *args)
+{
+    /* Background of a set of spectra (n_spectra, n_channels) obtained
+       applying a Savitsky-Golay smoothing followed by SNIP to each of the
+       segments delimited by the supplied (sorted) anchor channels */
+    PyObject *input;
+    PyObject *anchorsInput = NULL;
+    double width0 = 50.;
+    double sgwidth0 = 0.;
+    PyArrayObject *ret;
+    PyArrayObject *anchors = NULL;
+    double *spectrum;
+    double *buffer;
+    int *anchorsData = NULL;
+    int n_anchors = 0;
+    int i, n, n_channels, n_spectra, width, sg_width;
+    int lastAnchor, anchor;
+
+    if (!PyArg_ParseTuple(args, "Od|dO", &input, &width0, &sgwidth0, &anchorsInput))
+        return NULL;
+
+    ret = (PyArrayObject *)
+             PyArray_FROMANY(input, NPY_DOUBLE, 1, 2, NPY_ARRAY_ENSURECOPY);
+
+    if (ret == NULL){
+        printf("Cannot create 1D array from input\n");
+        return NULL;
+    }
+
+    if(PyArray_NDIM(ret) == 1)
+    {
+        n_spectra = 1;
+        n_channels = (int) (PyArray_DIMS(ret)[0]);
+    }
+    else
+    {
+        n_spectra = (int) (PyArray_DIMS(ret)[0]);
+        n_channels = (int) (PyArray_DIMS(ret)[1]);
+    }
+
+    if ((anchorsInput != NULL) && (anchorsInput != Py_None))
+    {
+        anchors = (PyArrayObject *)
+                    PyArray_ContiguousFromObject(anchorsInput, NPY_INT, 0, 1);
+        if (anchors == NULL)
+        {
+            Py_DECREF(ret);
+            return NULL;
+        }
+        n_anchors = (int) PyArray_SIZE(anchors);
+        anchorsData = (int *) PyArray_DATA(anchors);
+    }
+
+    width = (int) width0;
+    sg_width = (int) sgwidth0;
+    if (sg_width > MAX_SAVITSKY_GOLAY_WIDTH)
+    {
+        sg_width = MAX_SAVITSKY_GOLAY_WIDTH;
+    }
+
+    buffer = (double *) malloc(n_channels * sizeof(double));
+    if (buffer == NULL)
+    {
+        Py_DECREF(ret);
+        Py_XDECREF(anchors);
+        return PyErr_NoMemory();
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    for (n = 0; n < n_spectra; n++)
+    {
+        spectrum = ((double *) PyArray_DATA(ret)) + n * n_channels;
+        savitsky_golay(spectrum, buffer, n_channels, sg_width);
+        lastAnchor = 0;
+        for (i = 0; i < n_anchors; i++)
+        {
+            anchor = anchorsData[i];
+            if ((anchor > lastAnchor) && (anchor < n_channels))
+            {
+                snip1d(spectrum + lastAnchor, anchor - lastAnchor, width);
+                lastAnchor = anchor;
+            }
+        }
+        if (lastAnchor < n_channels)
+        {
+            snip1d(spectrum + lastAnchor, n_channels - lastAnchor, width);
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    free(buffer);
+    Py_XDECREF(anchors);
+    return PyArray_Return(ret);
+}
+
 /* List of functions defined in the module */
 
 static PyMethodDef SpecfitFuns_methods[] = {
@@ -4181,6 +4291,7 @@ static PyMethodDef SpecfitFuns_methods[] = {
     {"voxelize",    SpecfitFuns_voxelize,   METH_VARARGS},
     {"pileup",      SpecfitFuns_pileup,   METH_VARARGS},
     {"SavitskyGolay",   SpecfitFuns_SavitskyGolay,   METH_VARARGS},
+    {"snip1dbackground",   SpecfitFuns_snip1dbackground,   METH_VARARGS},
     {"splitgauss",  SpecfitFuns_splitgauss,   METH_VARARGS},
     {"splitlorentz",SpecfitFuns_splitlorentz, METH_VARARGS},
     {"splitpvoigt", SpecfitFuns_splitpvoigt, METH_VARARGS},
@@ -17,6 +17,7 @@
 #   TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 #   SOFTWARE OR THE USE OR OTHER DEALINGS IN THIS SOFTWARE.
 #
+import sys
 import numpy
 __license__ = "BSD"
 __author__ = "V.A. Sole - ESRF Data Analysis"
@@ -29,6 +30,9 @@
 
 # Linear Least Squares
 
+# memory used to build the weighted normal matrices
+MAX_MEMORY = 32 * 1024 * 1024
+
 def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
           uncertainties=True, covariances=False, digested_output=False, svd=True,
           last_svd=None):
@@ -271,29 +275,16 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
                     if covariances:
                         covarianceMatrix[i] = _covariance
         elif 1:
-            # Pure matrix inversion (faster than SVD)
-            # I do not seem to gain anything by re-using the storage
-            #alpha = numpy.empty((n, n), numpy.float)
-            #beta = numpy.empty((n, 1), numpy.float)
-            for i in range(b_shape[1]):
-                tmpWeight = w[:, i:i+1]
-                A = a / tmpWeight
-                tmpData =  b[:, i:i+1] / tmpWeight
-                #numpy.dot(A.T, A, alpha)
-                #numpy.dot(A.T, tmpData, beta)
-                alpha = numpy.dot(A.T, A)
-                beta = numpy.dot(A.T, tmpData)
-                try:
-                    _covariance = numpy.linalg.inv(alpha)
-                except:
-                    print("Exception")
-                    print("Exception", sys.exc_info()[1])
-                    continue
-                parameters[:, i:i+1] = numpy.dot(_covariance, beta)
-                if uncertainties:
-                    sigmapar[:, i] = numpy.sqrt(numpy.diag(_covariance))
-                if covariances:
-                    covarianceMatrix[i] = covariance
+            # Pure matrix inversion (faster than SVD) solving all the
+            # weighted normal equations together
+            result = weightedLstsq(a, b, w,
+                                   uncertainties=uncertainties,
+                                   covariances=covariances)
+            parameters = result[0]
+            if uncertainties or covariances:
+                sigmapar = result[1]
+            if covariances:
+                covarianceMatrix = result[2]
         else:
             # Matrix inversion with buffers does not improve
             bufferProduct = numpy.empty((n, n + 1), numpy.float)
@@ -346,6 +337,72 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
         return result
 
 
+def weightedLstsq(a, b, sigma_b, uncertainties=True, covariances=False):
+    """
+    Solve the equations `a x = b[:, k]` weighting each of the K columns of
+    b by its own uncertainties sigma_b[:, k] through the normal equations.
+
+    The K weighted normal matrices are built as a single (K, N, N) array
+    and inverted together.
+
+    Parameters
+    ----------
+    a : array_like, shape (M, N)
+        "Model" matrix.
+    b : array_like, shape (M, K)
+    sigma_b : array_like, shape (M, K) with the non-zero uncertainties on b
+
+    Returns
+    -------
+    x : ndarray, shape (N, K)
+    uncertainties : ndarray, shape (N, K) if requested
+    covariances : ndarray, shape (K, N, N) if requested
+    """
+    a = numpy.array(a, dtype=numpy.float, copy=False)
+    b = numpy.array(b, dtype=numpy.float, copy=False)
+    m, n = a.shape
+    k = b.shape[1]
+    weight = 1.0 / numpy.array(sigma_b, dtype=numpy.float, copy=False) ** 2
+    # alpha[k] = a.T * diag(weight[:, k]) * a is obtained from a single
+    # product with the products of the columns of a
+    alpha = numpy.zeros((k, n * n), numpy.float)
+    step = max(1, int(MAX_MEMORY / (8 * n * n)))
+    for i in range(0, m, step):
+        products = a[i:i + step, :, numpy.newaxis] * \
+                   a[i:i + step, numpy.newaxis, :]
+        products.shape = -1, n * n
+        alpha += numpy.dot(weight[i:i + step].T, products)
+    alpha.shape = k, n, n
+    beta = numpy.dot(a.T, b * weight)
+    parameters = numpy.zeros((n, k), numpy.float)
+    try:
+        covarianceMatrix = numpy.linalg.inv(alpha)
+        good = range(k)
+    except numpy.linalg.LinAlgError:
+        # at least one singular matrix, go one by one
+        covarianceMatrix = numpy.zeros((k, n, n), numpy.float)
+        good = []
+        for i in range(k):
+            try:
+                covarianceMatrix[i] = numpy.linalg.inv(alpha[i])
+                good.append(i)
+            except numpy.linalg.LinAlgError:
+                print("Exception", sys.exc_info()[1])
+    good = numpy.array(good, dtype=numpy.int32)
+    parameters[:, good] = numpy.sum(covarianceMatrix[good] * \
+                                    beta.T[good, numpy.newaxis, :],
+                                    axis=2).T
+    result = [parameters]
+    if uncertainties or covariances:
+        sigmapar = numpy.sqrt(numpy.abs(numpy.diagonal(covarianceMatrix,
+                                                       axis1=1,
+                                                       axis2=2))).T
+        sigmapar[:, numpy.setdiff1d(numpy.arange(k), good)] = 0.0
+        result.append(sigmapar)
+    if covariances:
+        result.append(covarianceMatrix)
+    return result
+
 def getModelMatrixFromFunction(model_function, dummy_parameters, xdata, derivative=None):
     nPoints = xdata.size
     nParameters = len(dummy_parameters)
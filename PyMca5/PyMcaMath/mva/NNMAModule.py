@@ -164,6 +164,7 @@
     MDP = False
 
 from . import py_nnma
+from . import PCATools
 DEBUG = 0
 
 function_list = ['FNMAI', 'ALS', 'FastHALS', 'GDCLS']
@@ -179,6 +180,45 @@
                  "FastHALS": py_nnma.FastHALS,
                  "SNMF": py_nnma.SNMF,
                  }
+def _sortComponents(images, X, original_intensity, n_more=0):
+    ncomponents = images.shape[0]
+    #order and scale images according to Gerd Wellenreuthers' recipe
+    #normalize all maps to be in the range [0, 1]
+    for i in range(ncomponents):
+        norm_factor = numpy.max(images[i, :])
+        if norm_factor > 0:
+            images[i, :] *= 1.0/norm_factor
+            X[i, :] *= norm_factor
+
+    #sort NNMA-spectra and maps
+    total_nnma_intensity = []
+    for i in range(ncomponents):
+        total_nnma_intensity += [[numpy.sum(images[i,:])*\
+                                  numpy.sum(X[i,:]), i]]
+
+    sorted_idx = [item[1] for item in sorted(total_nnma_intensity)]
+    sorted_idx.reverse()
+
+    new_images  = numpy.zeros((ncomponents + n_more, images.shape[1]),
+                              numpy.float32)
+    new_vectors = numpy.zeros((X.shape[0]+n_more, X.shape[1]), numpy.float32)
+    values      = numpy.zeros((ncomponents+n_more,), numpy.float32)
+    for i in range(ncomponents):
+        idx = sorted_idx[i]
+        if 1:
+            new_images[i, :] = images[idx, :]
+        else:
+            #imaging the projected sum gives same results
+            Atmp = images[idx, :]
+            Atmp.shape = -images.shape[1], 1
+            Xtmp = X[idx,:]
+            Xtmp.shape = 1, -1
+            new_images[i, :] = numpy.sum(numpy.dot(Atmp, Xtmp), axis=1)
+        new_vectors[i,:] = X[idx,:]
+        values[i] = 100.*total_nnma_intensity[idx][0]/original_intensity
+    return new_images, values, new_vectors
+
+
 def nnma(stack, ncomponents, binning=None,
          function=None, eps=5e-5, verbose=DEBUG, maxcount=1000, kmeans=False):
     if kmeans and (not MDP):
@@ -278,23 +318,6 @@ def nnma(stack, ncomponents, binning=None,
         images.shape = ncomponents, r, c
         return images, numpy.ones((ncomponents), numpy.float32),X
 
-    #order and scale images according to Gerd Wellenreuthers' recipe
-    #normalize all maps to be in the range [0, 1]
-    for i in range(ncomponents):
-        norm_factor = numpy.max(images[i, :])
-        if norm_factor > 0:
-            images[i, :] *= 1.0/norm_factor
-            X[i, :] *= norm_factor
-
-    #sort NNMA-spectra and maps
-    total_nnma_intensity = []
-    for i in range(ncomponents):
-        total_nnma_intensity += [[numpy.sum(images[i,:])*\
-                                  numpy.sum(X[i,:]), i]]
-
-    sorted_idx = [item[1] for item in sorted(total_nnma_intensity)]
-    sorted_idx.reverse()
-
     #original data intensity
     original_intensity = numpy.sum(data)
 
@@ -303,22 +326,9 @@ def nnma(stack, ncomponents, binning=None,
         n_more = 1
     else:
         n_more = 0
-    new_images  = numpy.zeros((ncomponents + n_more, r*c), numpy.float32)
-    new_vectors = numpy.zeros((X.shape[0]+n_more, X.shape[1]), numpy.float32)
-    values      = numpy.zeros((ncomponents+n_more,), numpy.float32)
-    for i in range(ncomponents):
-        idx = sorted_idx[i]
-        if 1:
-            new_images[i, :] = images[idx, :]
-        else:
-            #imaging the projected sum gives same results
-            Atmp = images[idx, :]
-            Atmp.shape = -r*c, 1
-            Xtmp = X[idx,:]
-            Xtmp.shape = 1, -1
-            new_images[i, :] = numpy.sum(numpy.dot(Atmp, Xtmp), axis=1)
-        new_vectors[i,:] = X[idx,:]
-        values[i] = 100.*total_nnma_intensity[idx][0]/original_intensity
+    new_images, values, new_vectors = _sortComponents(images, X,
+                                                      original_intensity,
+                                                      n_more=n_more)
     new_images.shape = ncomponents + n_more, r, c
     if kmeans:
         classifier = mdp.nodes.KMeansClassifier(ncomponents)
@@ -332,6 +342,131 @@ def nnma(stack, ncomponents, binning=None,
                 k += 1
     return new_images, values, new_vectors
 
+def _blockNNMAChunk(task):
+    data, i, start, end, binning, N, A, X, XXT, first = task
+    Y = numpy.array(data[start:end], dtype=numpy.float64)
+    Y.shape = -1, Y.shape[-1]
+    if binning > 1:
+        Y = Y[:, :N * binning].reshape(-1, N, binning).sum(axis=-1)
+    Ab = A[start:end].reshape(-1, A.shape[-1])
+    if first:
+        # scale the random start to the data
+        AX = numpy.dot(Ab, X)
+        norm = (AX * AX).sum()
+        if norm > 0:
+            Ab *= (Y * AX).sum() / norm
+    # Lee and Seung multiplicative update of the block images
+    Ab *= numpy.dot(Y, X.T) / (1e-9 + numpy.dot(Ab, XXT))
+    A[start:end] = Ab.reshape(A[start:end].shape)
+    residual = Y - numpy.dot(Ab, X)
+    return i, numpy.dot(Y.T, Ab), numpy.dot(Ab.T, Ab), \
+           (residual * residual).sum(), (Y * Y).sum(), Y.sum()
+
+
+def blockNNMA(stack, ncomponents, binning=None, function=None, eps=5e-5,
+              verbose=DEBUG, maxcount=1000, callback=None, workers=None,
+              seed=None):
+    """
+    Multiplicative updates NNMA reading the spectra in blocks of rows.
+
+    Only the images and the binned statistics of the blocks are kept in
+    memory. The images of each block are updated when the block is read,
+    several blocks being processed by parallel threads, and the spectra
+    are updated after each group of blocks from the running statistics.
+
+    Only the Lee and Seung multiplicative updates of the "NMF" function
+    are implemented, other functions raise a ValueError.
+
+    If given, callback is called after each pass over the data with a
+    dictionary with the keys iteration, maxcount and objective. If it
+    returns False the iterations are stopped.
+
+    It returns the same images, values and spectra as nnma.
+    """
+    if function not in [None, "NMF"]:
+        raise ValueError("Function %s not supported in blocks" % function)
+    if binning is None:
+        binning = 1
+    if workers is None:
+        workers = PCATools.WORKERS
+    workers = max(1, workers)
+
+    if hasattr(stack, "info") and hasattr(stack, "data"):
+        data = stack.data
+    else:
+        data = stack
+    oldShape = data.shape
+    if len(oldShape) == 3:
+        r, c, nChannels = oldShape
+    else:
+        r, nChannels = oldShape
+        c = 1
+    N = int(nChannels / binning)
+    if (ncomponents < 1) or (ncomponents > N):
+        raise ValueError("number k of components is invalid")
+
+    random = numpy.random.RandomState(seed)
+    A = random.rand(r, c, ncomponents)
+    X = random.rand(ncomponents, N)
+    limits = PCATools._getBlockLimits(data, -1)
+    nBlocks = len(limits)
+    blockYTA = [None] * nBlocks
+    blockATA = [None] * nBlocks
+    residuals = numpy.zeros((nBlocks,), numpy.float64)
+    YTA = numpy.zeros((N, ncomponents), numpy.float64)
+    ATA = numpy.zeros((ncomponents, ncomponents), numpy.float64)
+    norm = 0.0
+    original_intensity = 0.0
+    obj_old = 1e99
+    count = 0
+    while count < maxcount:
+        first = count == 0
+        count += 1
+        for b0 in range(0, nBlocks, workers):
+            XXT = numpy.dot(X, X.T)
+            tasks = [(data, i, limits[i][0], limits[i][1], binning, N,
+                      A, X, XXT, first) \
+                     for i in range(b0, min(b0 + workers, nBlocks))]
+            for i, yta, ata, residual, y2, ysum in \
+                    PCATools._mapBlocks(_blockNNMAChunk, tasks, workers):
+                if blockYTA[i] is not None:
+                    YTA -= blockYTA[i]
+                    ATA -= blockATA[i]
+                blockYTA[i] = yta
+                blockATA[i] = ata
+                YTA += yta
+                ATA += ata
+                residuals[i] = residual
+                if first:
+                    norm += y2
+                    original_intensity += ysum
+            # mini-batch update of the spectra
+            X *= YTA.T / (1e-9 + numpy.dot(ATA, X))
+        if norm <= 0:
+            raise ValueError("No positive data to factorize")
+        obj = numpy.sqrt(residuals.sum() / norm)
+        delta_obj = obj - obj_old
+        if verbose:
+            if count % verbose == 0:
+                print("count=%6d obj=%E d_obj=%E" % (count, obj, delta_obj))
+        if callback is not None:
+            if callback({'iteration': count,
+                         'maxcount': maxcount,
+                         'objective': obj}) is False:
+                break
+        # the mini-batch updates do not ensure a monotonic decrease
+        if abs(delta_obj) < eps:
+            break
+        obj_old = obj
+    if count >= maxcount:
+        print("WARNING: Possible problems converging")
+
+    A.shape = r * c, ncomponents
+    new_images, values, new_vectors = _sortComponents(A.T, X,
+                                                      original_intensity)
+    new_images.shape = ncomponents, r, c
+    return new_images, values, new_vectors
+
 if __name__ == "__main__":
     from PyMca.PyMcaIO import EDFStack
     from PyMca.PyMcaIO import EdfFile
@@ -413,6 +413,21 @@ def numpyPCA(stack, ncomponents=10, binning=None, **kw):
                              binning=binning,
                              **kw)
 
+def randomizedPCA(stack, ncomponents=10, binning=None, **kw):
+    """
+    This is a randomized method reading the data in blocks a few times
+    """
+    if DEBUG:
+        print("PCAModule.randomizedPCA called")
+    index = -1
+    if hasattr(stack, "info"):
+        index = stack.info.get('McaIndex', -1)
+    return PCATools.randomizedPCA(stack,
+                                  index=index,
+                                  ncomponents=ncomponents,
+                                  binning=binning,
+                                  **kw)
+
 def mdpPCASVDFloat32(stack, ncomponents=10, binning=None, mask=None):
     return mdpPCA(stack, ncomponents,
                   binning=binning, dtype='float32', svd='True', mask=mask)
@@ -31,8 +31,17 @@
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import sys
+import multiprocessing
+import functools
+from multiprocessing.pool import ThreadPool
 import numpy
 import numpy.linalg
+try:
+    import h5py
+    from PyMca5.PyMcaIO import HDF5Reader
+    HDF5 = True
+except ImportError:
+    HDF5 = False
 try:
     # make a explicit import to warn about missing optimized libraries
     import numpy.core._dotblas as dotblas
@@ -41,6 +50,11 @@
     dotblas = numpy
 
 DEBUG = 0
+# amount of data read at once by each thread when accumulating the
+# covariance matrix and number of threads (processes for HDF5 datasets,
+# h5py only runs one call at a time)
+MAX_MEMORY = 32 * 1024 * 1024
+WORKERS = min(multiprocessing.cpu_count(), 8)
 
 def getCovarianceMatrix(stack,
                         index=-1,
@@ -83,6 +97,37 @@ def getCovarianceMatrix(stack,
         if i != actualIndex:
             nPixels *= oldShape[i]
 
+    if force or (not isinstance(data, numpy.ndarray)):
+        #we are dealing with dynamically loaded data
+        if DEBUG:
+            print("DYNAMICALLY LOADED DATA")
+        #workaround a problem with h5py
+        try:
+            if actualIndex in [0]:
+                testException = data[0:1]
+            else:
+                if len(data.shape) == 2:
+                    testException = data[0:1,-1]
+                elif len(data.shape) == 3:
+                    testException = data[0:1,0:1,-1]
+        except AttributeError:
+            txt = "%s" % type(data)
+            if 'h5py' in txt:
+                print("Implementing h5py workaround")
+                import h5py
+                data = h5py.Dataset(data.id)
+            else:
+                raise
+        #read in blocks of spectra
+        accumulator = getCovarianceAccumulator(data,
+                                               index=actualIndex,
+                                               binning=binning,
+                                               weights=weights,
+                                               spatial_mask=spatial_mask)
+        covMatrix, average, usedPixels = \
+                            accumulator.getCovarianceMatrix(center=center)
+        return numpy.asarray(covMatrix, dtype=dtype), average, usedPixels
+
     #remove inf or nan
     #image_data = data.sum(axis=actualIndex)
     #spatial_mask = numpy.isfinite(image_data)
@@ -108,389 +153,295 @@ def getCovarianceMatrix(stack,
         cleanMask = None
         usedPixels = nPixels
 
-    nChannels = int(N / binning)
     cleanWeights = weights[::binning]
 
     #end of checking part
-    eigenvectorLength = nChannels
-
-    if (not force)and isinstance(data, numpy.ndarray):
-        if DEBUG:
-            print("Memory consuming calculation")
-        #make a direct calculation (memory cosuming)
-        #take a view to the data
-        dataView = data[:]
-        if index in [0]:
-            #reshape the view to allow the matrix multiplication
-            dataView.shape = -1, nPixels
-            cleanWeights.shape = -1, 1
-            dataView = dataView[::binning] * cleanWeights
-            if cleanMask is not None:
-                dataView[:, badMask] = 0
-            sumSpectrum = dataView.sum(axis=1, dtype=numpy.float64)
-            #and return the standard covariance matrix as a matrix product
-            covMatrix = dotblas.dot(dataView, dataView.T)\
-                / float(usedPixels - 1)
-        else:
-            #the last index
-            dataView.shape = nPixels, -1
-            cleanWeights.shape = 1, -1
-            dataView = dataView[:, ::binning] * cleanWeights
-            if cleanMask is not None:
-                cleanMask.shape = -1
-                if 0:
-                    for i in range(dataView.shape[-1]):
-                        dataView[badMask, i] = 0
-                else:
-                    dataView[badMask] = 0
-            sumSpectrum = dataView.sum(axis=0, dtype=numpy.float64)
-            #and return the standard covariance matrix as a matrix product
-            covMatrix = dotblas.dot(dataView.T, dataView )\
-                / float(usedPixels - 1)
-        if center:
-            averageMatrix = numpy.outer(sumSpectrum, sumSpectrum)\
-                / (usedPixels * (usedPixels - 1))
-            covMatrix -= averageMatrix
-            averageMatrix = None
-        return covMatrix, sumSpectrum / usedPixels, usedPixels
-
-    #we are dealing with dynamically loaded data
     if DEBUG:
-        print("DYNAMICALLY LOADED DATA")
-    #create the needed storage space for the covariance matrix
-    try:
-        covMatrix = numpy.zeros((eigenvectorLength, eigenvectorLength),
-                                dtype=dtype)
-        sumSpectrum = numpy.zeros((eigenvectorLength,), numpy.float64)
-    except:
-        #make sure no reference to the original input data is kept
-        cleanWeights = None
-        covMatrix = None
+        print("Memory consuming calculation")
+    #make a direct calculation (memory cosuming)
+    #take a view to the data
+    dataView = data[:]
+    if index in [0]:
+        #reshape the view to allow the matrix multiplication
+        dataView.shape = -1, nPixels
+        cleanWeights.shape = -1, 1
+        dataView = dataView[::binning] * cleanWeights
+        if cleanMask is not None:
+            dataView[:, badMask] = 0
+        sumSpectrum = dataView.sum(axis=1, dtype=numpy.float64)
+        #and return the standard covariance matrix as a matrix product
+        covMatrix = dotblas.dot(dataView, dataView.T)\
+            / float(usedPixels - 1)
+    else:
+        #the last index
+        dataView.shape = nPixels, -1
+        cleanWeights.shape = 1, -1
+        dataView = dataView[:, ::binning] * cleanWeights
+        if cleanMask is not None:
+            cleanMask.shape = -1
+            if 0:
+                for i in range(dataView.shape[-1]):
+                    dataView[badMask, i] = 0
+            else:
+                dataView[badMask] = 0
+        sumSpectrum = dataView.sum(axis=0, dtype=numpy.float64)
+        #and return the standard covariance matrix as a matrix product
+        covMatrix = dotblas.dot(dataView.T, dataView )\
+            / float(usedPixels - 1)
+    if center:
+        averageMatrix = numpy.outer(sumSpectrum, sumSpectrum)\
+            / (usedPixels * (usedPixels - 1))
+        covMatrix -= averageMatrix
         averageMatrix = None
-        data = None
-        raise
+    return covMatrix, sumSpectrum / usedPixels, usedPixels
 
-    #workaround a problem with h5py
-    try:
-        if actualIndex in [0]:
-            testException = data[0:1]
+
+class CovarianceAccumulator(object):
+    def __init__(self, nChannels, binning=None, weights=None):
+        """
+        Accumulate the average spectrum and the covariance matrix of spectra
+        of nChannels channels supplied in blocks. The spectra are sampled
+        and weighted as in getCovarianceMatrix.
+
+        Each block is centered on its own average and added using the
+        pairwise update of Chan et al., therefore the accumulators filled
+        with different parts of a dataset can be merged to get the same
+        result as if the whole dataset had been supplied to a single one.
+        An accumulator is not meant to be fed by several threads at the
+        same time, use one per thread and merge them.
+        """
+        if binning is None:
+            binning = 1
+        self._binning = binning
+        N = int(nChannels / binning)
+        self._nInputChannels = nChannels
+        self._nChannels = N
+        self._inputWeights = weights
+        if weights is None:
+            self._weights = None
         else:
-            if len(data.shape) == 2:
-                testException = data[0:1,-1]
-            elif len(data.shape) == 3:
-                testException = data[0:1,0:1,-1]
-    except AttributeError:
-        txt = "%s" % type(data)
-        if 'h5py' in txt:
-            print("Implementing h5py workaround")
-            import h5py
-            data = h5py.Dataset(data.id)
+            self._weights = numpy.array(weights[::binning][:N],
+                                        dtype=numpy.float64)
+        self._nSpectra = 0
+        self._average = numpy.zeros((N,), numpy.float64)
+        self._deviations = numpy.zeros((N, N), numpy.float64)
+
+    def getNumberOfChannels(self):
+        return self._nChannels
+
+    def getNumberOfSpectra(self):
+        return self._nSpectra
+
+    def addSpectra(self, spectra, mask=None):
+        """
+        spectra is an array with the channels as last dimension. If given,
+        only the spectra for which mask is not zero are considered.
+        """
+        spectra = numpy.asarray(spectra)
+        if spectra.shape[-1] != self._nInputChannels:
+            raise ValueError("Expected %d channels, got %d" % \
+                             (self._nInputChannels, spectra.shape[-1]))
+        spectra = spectra.reshape(-1, self._nInputChannels)
+        if mask is not None:
+            spectra = spectra[numpy.asarray(mask).reshape(-1) > 0]
+        spectra = numpy.array(spectra[:, ::self._binning][:, :self._nChannels],
+                              dtype=numpy.float64)
+        if self._weights is not None:
+            spectra *= self._weights
+        n = spectra.shape[0]
+        if n == 0:
+            return
+        average = spectra.sum(axis=0) / n
+        spectra -= average
+        self._add(n, average, dotblas.dot(spectra.T, spectra))
+
+    def _add(self, n, average, deviations):
+        total = self._nSpectra + n
+        delta = average - self._average
+        self._average += delta * (n / float(total))
+        self._deviations += deviations
+        self._deviations += numpy.outer(delta, delta) * \
+                            (self._nSpectra * (n / float(total)))
+        self._nSpectra = total
+
+    def merge(self, other):
+        """
+        Add the spectra accumulated by other
+        """
+        if (other._nChannels != self._nChannels) or \
+           (other._binning != self._binning):
+            raise ValueError("Cannot merge accumulators of different channels")
+        if (other._weights is None) != (self._weights is None) or \
+           ((self._weights is not None) and \
+            (not numpy.array_equal(other._weights, self._weights))):
+            raise ValueError("Cannot merge accumulators of different weights")
+        if other._nSpectra:
+            self._add(other._nSpectra, other._average, other._deviations)
+
+    def getCovarianceMatrix(self, center=True):
+        """
+        Return the same covariance matrix, average spectrum and number of
+        used spectra as getCovarianceMatrix
+        """
+        n = self._nSpectra
+        if n < 2:
+            raise ValueError("At least two spectra are needed")
+        if center:
+            covMatrix = self._deviations / float(n - 1)
         else:
-            raise
+            covMatrix = (self._deviations + \
+                         n * numpy.outer(self._average, self._average)) / \
+                         float(n - 1)
+        return covMatrix, self._average.copy(), n
 
-    if actualIndex in [0]:
-        #divider is used to decide the fraction of images to keep in memory
-        #in order to limit file access on dynamically loaded data.
-        #Since two chunks of the same size are used, the amount of memory
-        #needed is twice the data size divided by the divider.
-        #For instance, divider = 10 implies the data to be read 5.5 times
-        #from disk while having a memory footprint of about one fifth of
-        #the dataset size.
-        step = 0
-        divider = 10
-        while step < 1:
-            step = int(oldShape[index] / divider)
-            divider -= 2
-            if divider <= 0:
-                step = oldShape[index]
-                break
-        if DEBUG:
-            print("Reading chunks of %d images" % step)
-        nImagesRead = 0
-        if (binning == 1) and oldShape[index] >= step:
-            chunk1 = numpy.zeros((step, nPixels), numpy.float64)
-            chunk2 = numpy.zeros((nPixels, step), numpy.float64)
-            if spatial_mask is not None:
-                badMask.shape = -1
-                cleanMask.shape = -1
-            i = 0
-            while i < N:
-                iToRead = min(step, N - i)
-                #get step images for the first chunk
-                chunk1[0:iToRead] = data[i:i + iToRead].reshape(iToRead, -1)
-                if spatial_mask is not None:
-                    chunk1[0:iToRead, badMask] = 0
-                sumSpectrum[i:i + iToRead] = chunk1[0:iToRead].sum(axis=1)
-                if center:
-                    average = sumSpectrum[i:i + iToRead] / usedPixels
-                    average.shape = iToRead, 1
-                    chunk1[0:iToRead] -= average
-                if spatial_mask is not None:
-                    chunk1[0:iToRead, badMask] = 0
-                nImagesRead += iToRead
-                j = 0
-                while j <= i:
-                    #get step images for the second chunk
-                    if j == i:
-                        jToRead = iToRead
-                        if 0:
-                            for k in range(0, jToRead):
-                                chunk2[:, k] = chunk1[k]
-                        else:
-                            chunk2[:, 0:jToRead] = chunk1[0:jToRead, :].T
-                    else:
-                        #get step images for the second chunk
-                        jToRead = min(step, nChannels - j)
-
-                        #with loop:
-                        #for k in range(0, jToRead):
-                        #    chunk2[:,k] = data[(j+k):(j+k+1)].reshape(1,-1)
-                        #    if spatial_mask is not None:
-                        #        chunk2[badMask[(j+k):(j+k+1),k]] = 0
-                        #equivalent without loop:
-                        chunk2[:, 0:jToRead] =\
-                            data[j:(j + jToRead)].reshape(jToRead, -1).T
-                        if spatial_mask is not None:
-                            chunk2[badMask, 0:jToRead] = 0
-                        nImagesRead += jToRead
-                        if center:
-                            average = \
-                                chunk2[:, 0:jToRead].sum(axis=0) / usedPixels
-                            average.shape = 1, jToRead
-                            chunk2[:, 0:jToRead] -= average
-                            if spatial_mask is not None:
-                                chunk2[badMask, 0:jToRead] = 0
-
-                    #dot product
-                    if (iToRead != step) or (jToRead != step):
-                        covMatrix[i: (i + iToRead), j: (j + jToRead)] =\
-                                        dotblas.dot(chunk1[:iToRead, :nPixels],
-                                                    chunk2[:nPixels, :jToRead])
-                    else:
-                        covMatrix[i: (i + iToRead), j: (j + jToRead)] =\
-                                        dotblas.dot(chunk1, chunk2)
-
-                    if i != j:
-                        covMatrix[j: (j + jToRead), i: (i + iToRead)] =\
-                                covMatrix[i: (i + iToRead), j: (j + jToRead)].T
-
-                    #increment j
-                    j += jToRead
-                i += iToRead
-            chunk1 = None
-            chunk2 = None
-            if DEBUG:
-                print("totalImages Read = ", nImagesRead)
-        elif (binning > 1) and (oldShape[index] >= step):
-            chunk1 = numpy.zeros((step, nPixels), numpy.float64)
-            chunk2 = numpy.zeros((nPixels, step), numpy.float64)
-            #one by one reading till we fill the chunks
-            imagesToRead = numpy.arange(0, oldShape[index], binning)
-            i = int(imagesToRead[weights > 0][0])
-            spectrumIndex = 0
-            nImagesRead = 0
-            while i < N:
-                #fill chunk1
-                jj = 0
-                for iToRead in range(0, int(min(step * binning, N - i)),
-                                     binning):
-                    chunk1[jj] = data[i + iToRead].reshape(1, -1) * \
-                                 weights[i + iToRead]
-                    jj += 1
-                sumSpectrum[spectrumIndex:(spectrumIndex + jj)] = \
-                                                    chunk1[0:jj].sum(axis=1)
-                if center:
-                    average = \
-                        sumSpectrum[spectrumIndex:(spectrumIndex + jj)] / nPixels
-                    average.shape = jj, 1
-                    chunk1[0:jj] -= average
-                nImagesRead += jj
-                iToRead = jj
-                j = 0
-                while j <= i:
-                    #get step images for the second chunk
-                    if j == i:
-                        jToRead = iToRead
-                        chunk2[:, 0:jToRead] = chunk1[0:jToRead, :].T
-                    else:
-                        #get step images for the second chunk
-                        jj = 0
-                        for jToRead in range(0,
-                                             int(min(step * binning, N - j)),
-                                             binning):
-                            chunk2[:, jj] =\
-                                data[j + jToRead].reshape(1, -1)\
-                                * weights[j + jToRead]
-                            jj += 1
-                        nImagesRead += jj
-                        if center:
-                            average = chunk2[:, 0:jj].sum(axis=0) / nPixels
-                            average.shape = 1, jj
-                            chunk2 -= average
-                        jToRead = jj
-                    #dot product
-                    if (iToRead != step) or (jToRead != step):
-                        covMatrix[i:(i + iToRead), j:(j + jToRead)] =\
-                                dotblas.dot(chunk1[:iToRead, :nPixels],
-                                            chunk2[:nPixels, :jToRead])
-                    else:
-                        covMatrix[i:(i + iToRead), j:(j + jToRead)] =\
-                                dotblas.dot(chunk1, chunk2)
-
-                    if i != j:
-                        covMatrix[j:(j + jToRead), i:(i + iToRead)] =\
-                                covMatrix[i:(i + iToRead), j:(j + jToRead)].T
-
-                    #increment j
-                    j += jToRead * step
-                i += iToRead * step
-            chunk1 = None
-            chunk2 = None
-        else:
-            raise ValueError("Unhandled case")
 
-        #should one divide by N or by N-1 ??  if we use images, we
-        #assume the observables are the images, not the spectra!!!
-        #so, covMatrix /= nChannels is wrong and one has to use:
-        covMatrix /= usedPixels
-    else:
-        #the data are already arranged as (nPixels, nChannels) and we
-        #basically have to return data.T * data to get back the covariance
-        #matrix as (nChannels, nChannels)
-        #if someone had the bad idea to store the data in HDF5 with a chunk
-        #size based on the pixels and not on the spectra a loop based on
-        #reading spectrum per spectrum can be very slow
-        step = 0
-        divider = 10
-        while step < 1:
-            step = int(nPixels / divider)
-            divider -= 1
-            if divider <= 0:
-                step = nPixels
-                break
-        step = nPixels
-        if DEBUG:
-            print("Reading chunks of %d spectra" % step)
+def _getSpectraSelection(index, start, end):
+    # the rows start to end of the spatial dimensions
+    if index == 0:
+        return (slice(None), slice(start, end))
+    return (slice(start, end),)
 
-        cleanWeights.shape = 1, -1
-        if len(data.shape) == 2:
-            if cleanMask is not None:
-                badMask.shape = -1
-            tmpData = numpy.zeros((step, nChannels), numpy.float64)
-            k = 0
-            while k < nPixels:
-                kToRead = min(step, nPixels - k)
-                tmpData[0:kToRead] = data[k: k + kToRead, ::binning]
-                if cleanMask is not None:
-                    tmpData[badMask[k: k + kToRead]] = 0
-                a = tmpData[0:kToRead] * cleanWeights
-                sumSpectrum += a.sum(axis=0)
-                covMatrix += dotblas.dot(a.T, a)
-                a = None
-                k += kToRead
-            tmpData = None
-        elif len(data.shape) == 3:
-            if oldShape[0] == 1:
-                #close to the previous case
-                tmpData = numpy.zeros((step, nChannels), numpy.float64)
-                if cleanMask is not None:
-                    badMask.shape = data.shape[0], data.shape[1]
-                for i in range(oldShape[0]):
-                    k = 0
-                    while k < oldShape[1]:
-                        kToRead = min(step, oldShape[1] - k)
-                        tmpData[0:kToRead] = data[i, k:k + kToRead, ::binning]\
-                                             * cleanWeights
-                        if cleanMask is not None:
-                            tmpData[0:kToRead][badMask[i, k: k + kToRead]] = 0
-                        a = tmpData[0:kToRead]
-                        sumSpectrum += a.sum(axis=0)
-                        covMatrix += dotblas.dot(a.T, a)
-                        a = None
-                        k += kToRead
-                tmpData = None
-            elif oldShape[1] == 1:
-                #almost identical to the previous case
-                tmpData = numpy.zeros((step, nChannels), numpy.float64)
-                if cleanMask is not None:
-                    badMask.shape = data.shape[0], data.shape[1]
-                for i in range(oldShape[1]):
-                    k = 0
-                    while k < oldShape[0]:
-                        kToRead = min(step, oldShape[0] - k)
-                        tmpData[0:kToRead] = data[k: k + kToRead, i, ::binning]\
-                                             * cleanWeights
-                        if cleanMask is not None:
-                            tmpData[0:kToRead][badMask[k: k + kToRead, i]] = 0
-                        a = tmpData[0:kToRead]
-                        sumSpectrum += a.sum(axis=0)
-                        covMatrix += dotblas.dot(a.T, a)
-                        a = None
-                        k += kToRead
-                tmpData = None
-            elif oldShape[0] < 21:
-                if step > oldShape[1]:
-                    step = oldShape[1]
-                tmpData = numpy.zeros((step, nChannels), numpy.float64)
-                if cleanMask is not None:
-                    badMask.shape = data.shape[0], data.shape[1]
-                for i in range(oldShape[0]):
-                    k = 0
-                    while k < oldShape[1]:
-                        kToRead = min(step, oldShape[1] - k)
-                        tmpData[0:kToRead] = data[i, k: k + kToRead, ::binning]\
-                                             * cleanWeights
-                        if cleanMask is not None:
-                            tmpData[0:kToRead][badMask[i, k: k + kToRead]] = 0
-                        a = tmpData[0:kToRead]
-                        sumSpectrum += a.sum(axis=0)
-                        covMatrix += dotblas.dot(a.T, a)
-                        a = None
-                        k += kToRead
-                tmpData = None
+
+def _getSpectra(block, index=-1):
+    # the spectra as last dimension
+    if index == 0:
+        if len(block.shape) == 3:
+            return numpy.transpose(block, (1, 2, 0))
+        return block.T
+    return block
+
+
+def _getSpectraBlock(data, index, start, end):
+    # the spectra of the rows start to end of the spatial dimensions
+    return _getSpectra(data[_getSpectraSelection(index, start, end)], index)
+
+
+def _getBlockLimits(data, index, nbytes=8):
+    # divide the first spatial dimension in blocks of about MAX_MEMORY
+    # bytes, reading complete HDF5 chunks
+    shape = data.shape
+    if index == 0:
+        spatialShape = shape[1:]
+        axis = 1
+    else:
+        spatialShape = shape[:-1]
+        axis = 0
+    rowSize = nbytes * shape[index]
+    for i in range(1, len(spatialShape)):
+        rowSize *= spatialShape[i]
+    step = max(1, int(MAX_MEMORY / rowSize))
+    chunks = getattr(data, "chunks", None)
+    if chunks:
+        step = max(chunks[axis], step // chunks[axis] * chunks[axis])
+    return [(i, min(i + step, spatialShape[0])) \
+            for i in range(0, spatialShape[0], step)]
+
+
+def _mapBlocks(function, tasks, workers=None):
+    # apply function to the tasks using a pool of threads
+    if workers is None:
+        workers = WORKERS
+    pool = None
+    if len(tasks) and HDF5 and isinstance(tasks[0][0], h5py.Dataset):
+        # h5py serializes the calls, the threads would just wait
+        workers = 1
+    if (len(tasks) > 1) and (workers > 1):
+        pool = ThreadPool(min(workers, len(tasks)))
+        results = pool.imap_unordered(function, tasks)
+    else:
+        results = (function(task) for task in tasks)
+    try:
+        for result in results:
+            yield result
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _accumulateCovarianceChunk(task):
+    data, index, start, end, mask, template = task
+    spectra = _getSpectraBlock(data, index, start, end)
+    if mask is not None:
+        mask = mask[start:end]
+    accumulator = CovarianceAccumulator(template._nInputChannels,
+                                        binning=template._binning,
+                                        weights=template._inputWeights)
+    accumulator.addSpectra(spectra, mask=mask)
+    return accumulator
+
+
+def getCovarianceAccumulator(stack,
+                             index=-1,
+                             binning=None,
+                             weights=None,
+                             spatial_mask=None,
+                             accumulator=None,
+                             workers=None):
+    """
+    Read the stack in blocks of rows of the spatial dimensions and add
+    them to a CovarianceAccumulator, using several threads, or the
+    processes of an HDF5Reader for HDF5 datasets, when the stack needs
+    more than one block. If an accumulator is given, the stack is
+    added to it and its binning and weights are used. A ValueError is
+    raised if the given binning or weights are not those of the
+    accumulator. The stack can be any object supporting slicing, for
+    instance a numpy array, an HDF5 dataset or a list of EDF files.
+    """
+    if hasattr(stack, "info") and hasattr(stack, "data"):
+        data = stack.data
+    else:
+        data = stack
+    shape = data.shape
+    if index not in [0, -1, len(shape) - 1]:
+        raise IndexError("1D index must be one of 0, -1 or %d" % len(shape))
+    if index != 0:
+        index = len(shape) - 1
+    nChannels = shape[index]
+    if accumulator is None:
+        accumulator = CovarianceAccumulator(nChannels,
+                                            binning=binning,
+                                            weights=weights)
+    else:
+        if accumulator._nInputChannels != nChannels:
+            raise ValueError("Expected %d channels, got %d" % \
+                             (accumulator._nInputChannels, nChannels))
+        if (binning is not None) and (binning != accumulator._binning):
+            raise ValueError("Binning %s differs from accumulator one %s" % \
+                             (binning, accumulator._binning))
+        if (weights is not None) and \
+           ((accumulator._inputWeights is None) or \
+            (not numpy.array_equal(weights, accumulator._inputWeights))):
+            raise ValueError("Weights differ from accumulator weights")
+    if spatial_mask is not None:
+        if index == 0:
+            spatial_mask = numpy.asarray(spatial_mask).reshape(shape[1:])
+        else:
+            spatial_mask = numpy.asarray(spatial_mask).reshape(shape[:-1])
+    limits = _getBlockLimits(data, index)
+    if workers is None:
+        workers = WORKERS
+    if HDF5 and isinstance(data, h5py.Dataset) and \
+       (len(limits) > 1) and (workers > 1):
+        # the blocks are read by the processes of the HDF5 reader
+        reader = HDF5Reader.HDF5Reader(min(workers, len(limits)))
+        selections = [_getSpectraSelection(index, start, end) \
+                      for start, end in limits]
+        function = functools.partial(_getSpectra, index=index)
+        for (start, end), spectra in \
+                zip(limits, reader.readSelections(data, selections,
+                                                  function)):
+            if spatial_mask is None:
+                mask = None
             else:
-                #I should choose the sizes in terms of the size
-                #of the dataset
-                if oldShape[0] < 41:
-                    #divide by 10
-                    deltaRow = 4
-                elif oldShape[0] < 101:
-                    #divide by 10
-                    deltaRow = 10
-                else:
-                    #take pieces of one tenth
-                    deltaRow = int(oldShape[0] / 10)
-                deltaCol = oldShape[1]
-                tmpData = numpy.zeros((deltaRow, deltaCol, nChannels),
-                                      numpy.float64)
-                if cleanMask is not None:
-                    badMask.shape = data.shape[0], data.shape[1]
-                i = 0
-                while i < oldShape[0]:
-                    iToRead = min(deltaRow, oldShape[0] - i)
-                    kToRead = iToRead * oldShape[1]
-                    tmpData[:iToRead] = data[i:(i + iToRead), :, ::binning]
-                    if cleanMask is not None:
-                        tmpData[0:kToRead][badMask[i:(i + iToRead), :]] = 0
-                    a = tmpData[:iToRead]
-                    a.shape = kToRead, nChannels
-                    a *= cleanWeights
-                    if 0:
-                        #weight each spectrum
-                        a /= (a.sum(axis=1).reshape(-1, 1))
-                    sumSpectrum += a.sum(axis=0)
-                    covMatrix += dotblas.dot(a.T, a)
-                    a = None
-                    i += iToRead
-        #should one divide by N or by N-1 ??
-        covMatrix /= usedPixels - 1
-        if center:
-            #the n-1 appears again here
-            averageMatrix = numpy.outer(sumSpectrum, sumSpectrum)\
-                            / (usedPixels * (usedPixels - 1))
-            covMatrix -= averageMatrix
-            averageMatrix = None
-    return covMatrix, sumSpectrum / usedPixels, usedPixels
+                mask = spatial_mask[start:end]
+            accumulator.addSpectra(spectra, mask=mask)
+        return accumulator
+    tasks = [(data, index, start, end, spatial_mask, accumulator) \
+             for start, end in limits]
+    for result in _mapBlocks(_accumulateCovarianceChunk, tasks, workers):
+        accumulator.merge(result)
+    return accumulator
 
 
 def numpyPCA(stack, index=-1, ncomponents=10, binning=None,
@@ -555,7 +506,15 @@ def numpyPCA(stack, index=-1, ncomponents=10, binning=None,
         raise ValueError(msg)
 
     # avgSpectrum is unused, but it makes the code readable
-    cov, avgSpectrum, calculatedPixels = getCovarianceMatrix(stack,
+    accumulator = kw.get("accumulator", None)
+    if accumulator is not None:
+        # covariance matrix already accumulated
+        if accumulator.getNumberOfChannels() != N:
+            raise ValueError("Accumulator does not match the binned channels")
+        cov, avgSpectrum, calculatedPixels = \
+                            accumulator.getCovarianceMatrix(center=center)
+    else:
+        cov, avgSpectrum, calculatedPixels = getCovarianceMatrix(stack,
                                                              index=index,
                                                              binning=binning,
                                                              force=force,
@@ -647,6 +606,133 @@ def numpyPCA(stack, index=-1, ncomponents=10, binning=None,
     return images, eigenvalues, eigenvectors
 
 
+def _randomizedPCAChunk(task):
+    data, index, start, end, mask, binning, N, basis, project = task
+    spectra = _getSpectraBlock(data, index, start, end)
+    spectra = spectra.reshape(-1, spectra.shape[-1])
+    spectra = numpy.array(spectra[:, ::binning][:, :N], dtype=numpy.float64)
+    if project:
+        # the projections of all the spectra
+        return start, end, dotblas.dot(spectra, basis)
+    if mask is not None:
+        spectra = spectra[mask[start:end].reshape(-1) > 0]
+    return spectra.shape[0], \
+           spectra.sum(axis=0), \
+           (spectra * spectra).sum(axis=0), \
+           dotblas.dot(spectra.T, dotblas.dot(spectra, basis))
+
+
+def randomizedPCA(stack, index=-1, ncomponents=10, binning=None,
+                  center=True, scale=False, mask=None, **kw):
+    """
+    Randomized subspace iteration on the covariance matrix of the spectra.
+
+    The covariance matrix is never built. Each iteration multiplies a basis
+    of ncomponents + oversampling vectors by the covariance matrix reading
+    the data once in blocks of rows. The eigenvalues and eigenvectors are
+    obtained from the projection of the covariance matrix on the final
+    basis. The data are read iterations + 2 times.
+
+    Keywords:
+    oversampling -- additional vectors of the basis (default 10)
+    iterations -- number of power iterations (default 2)
+    seed -- seed of the random starting basis
+    """
+    if DEBUG:
+        print("PCATools.randomizedPCA")
+    if hasattr(stack, "info") and hasattr(stack, "data"):
+        data = stack.data
+    else:
+        data = stack
+    if scale:
+        raise ValueError("Scaling not supported by randomized PCA")
+    oldShape = data.shape
+    if index not in [0, -1, len(oldShape) - 1]:
+        raise IndexError("1D index must be one of 0, -1 or %d, got %d" %\
+                             (len(oldShape) - 1, index))
+    if index != 0:
+        index = len(oldShape) - 1
+    if index == 0:
+        spatialShape = oldShape[1:]
+    else:
+        spatialShape = oldShape[:-1]
+    nPixels = 1
+    for item in spatialShape:
+        nPixels *= item
+    if binning is None:
+        binning = 1
+    N = int(oldShape[index] / binning)
+    if ncomponents > N:
+        msg = "Requested %d components for a maximum of %d" % (ncomponents, N)
+        raise ValueError(msg)
+    if mask is not None:
+        mask = numpy.asarray(mask).reshape(spatialShape)
+    nVectors = min(N, ncomponents + kw.get("oversampling", 10))
+    iterations = kw.get("iterations", 2)
+    workers = kw.get("workers", None)
+    limits = _getBlockLimits(data, index)
+
+    random = numpy.random.RandomState(kw.get("seed", None))
+    basis = numpy.linalg.qr(random.standard_normal((N, nVectors)))[0]
+    totalVariance = None
+    for iteration in range(iterations + 1):
+        # product of the covariance matrix by the basis
+        tasks = [(data, index, start, end, mask, binning, N, basis, False) \
+                 for start, end in limits]
+        nSpectra = 0
+        sumSpectrum = numpy.zeros((N,), numpy.float64)
+        sumSquares = numpy.zeros((N,), numpy.float64)
+        product = numpy.zeros((N, nVectors), numpy.float64)
+        for n, s, s2, p in _mapBlocks(_randomizedPCAChunk, tasks, workers):
+            nSpectra += n
+            sumSpectrum += s
+            sumSquares += s2
+            product += p
+        if center:
+            average = sumSpectrum / nSpectra
+            product -= nSpectra * numpy.outer(average,
+                                              dotblas.dot(average, basis))
+            sumSquares -= nSpectra * average * average
+        product /= nSpectra - 1
+        if totalVariance is None:
+            totalVariance = sumSquares.sum() / (nSpectra - 1)
+            print("Total Variance = ", totalVariance)
+        if iteration < iterations:
+            basis = numpy.linalg.qr(product)[0]
+
+    # Rayleigh-Ritz projection on the basis
+    projected = dotblas.dot(basis.T, product)
+    projected = 0.5 * (projected + projected.T)
+    evalues, evectors = numpy.linalg.eigh(projected)
+    order = numpy.argsort(evalues)[::-1][:ncomponents]
+    evectors = dotblas.dot(basis, evectors[:, order])
+
+    dtype = numpy.float32
+    eigenvalues = numpy.array(evalues[order], dtype)
+    eigenvectors = numpy.array(evectors.T, dtype)
+    totalExplainedVariance = 0.0
+    for i in range(ncomponents):
+        partialExplainedVariance = 100. * eigenvalues[i] / totalVariance
+        print("PC%02d  Explained variance %.5f %% " %\
+                                    (i + 1, partialExplainedVariance))
+        totalExplainedVariance += partialExplainedVariance
+    print("Total explained variance = %.2f %% " % totalExplainedVariance)
+
+    # calculate the projections
+    images = numpy.zeros((nPixels, ncomponents), dtype)
+    images.shape = spatialShape[0], -1, ncomponents
+    tasks = [(data, index, start, end, None, binning, N, evectors, True) \
+             for start, end in limits]
+    for start, end, projection in _mapBlocks(_randomizedPCAChunk,
+                                             tasks, workers):
+        images[start:end] = projection.reshape(end - start, -1, ncomponents)
+    images.shape = nPixels, ncomponents
+    images = images.T.copy()
+    if len(spatialShape) == 2:
+        images.shape = ncomponents, spatialShape[0], spatialShape[1]
+    return images, eigenvalues, eigenvectors
+
+
 def test():
     x = numpy.array([[0.0,  2.0,  3.0],
                      [3.0,  0.0, -1.0],
@@ -34,6 +34,7 @@
 import sys
 import numpy
 import copy
+import collections
 from .Strategies import STRATEGIES
 from . import ConcentrationsTool
 FISX = ConcentrationsTool.FISX
@@ -49,6 +50,47 @@
 CONTINUUM_LIST = [None,'Constant','Linear','Parabolic','Linear Polynomial','Exp. Polynomial']
 OLDESCAPE = 0
 MAX_ATTENUATION = 1.0E-300
+# number of configurations whose peak description is kept in memory
+MAX_CONFIGURATION_CACHE = 10
+
+def _getConfigurationKey(config, *var):
+    """
+    Return a hashable representation of the (nested) configuration.
+    """
+    if isinstance(config, dict):
+        keys = list(config.keys())
+        keys.sort()
+        key = tuple([(item, _getConfigurationKey(config[item])) \
+                     for item in keys])
+    elif isinstance(config, (list, tuple)):
+        key = tuple([_getConfigurationKey(item) for item in config])
+    elif isinstance(config, numpy.ndarray):
+        key = (config.shape, _getConfigurationKey(config.tolist()))
+    else:
+        key = repr(config)
+    if len(var):
+        key = (key, _getConfigurationKey(var))
+    return key
+
+def _getMaterialsKey():
+    """
+    Return a hashable representation of the materials known to Elements.
+    """
+    materials = {}
+    for name in Elements.Material.keys():
+        material = dict(Elements.Material[name])
+        # Elements converts single compounds to lists of floats when used
+        for item in ['CompoundList', 'CompoundFraction']:
+            if type(material.get(item, None)) != type([]):
+                material[item] = [material.get(item, None)]
+        try:
+            material['CompoundFraction'] = [float(x) for x in \
+                                            material['CompoundFraction']]
+        except (TypeError, ValueError):
+            pass
+        materials[name] = material
+    return _getConfigurationKey(materials)
+
 class McaTheory(object):
     def __init__(self, initdict=None, filelist=None, **kw):
         self.ydata0  = None
@@ -103,9 +145,11 @@ def __init__(self, initdict=None, filelist=None, **kw):
         self.laststripanchorsflag = None
         self.laststripanchorslist = None
         self.disableOptimizedLinearFit()
+        self.disableWarmStart()
+        self._configurationCache = collections.OrderedDict()
         self.__configure()
-        #incompatible with multiple energies
-        #Elements.registerUpdate(self._updateCallback)
+        #the cached peak descriptions depend on the element data
+        Elements.registerUpdate(self.clearConfigurationCache)
 
     def enableOptimizedLinearFit(self):
         self._batchFlag = True
@@ -114,6 +158,46 @@ def disableOptimizedLinearFit(self):
         self._batchFlag = False
         self.linearMatrix = None
 
+    def enableWarmStart(self, chisqfactor=2.0):
+        """
+        Start the non linear fits from the parameters of the previous fit
+        instead of from the estimation. If the obtained reduced chi square
+        is larger than chisqfactor times the one of the previous fit, the
+        fit is repeated starting from the estimation.
+        Useful when fitting neighbouring spectra of a map.
+        """
+        self._warmStart = True
+        self._warmStartChisqFactor = chisqfactor
+        self._warmStartSeed = None
+        self.__estimatedParameters = None
+
+    def disableWarmStart(self):
+        self._warmStart = False
+        self._warmStartSeed = None
+        self.__estimatedParameters = None
+
+    def getWarmStartSeed(self):
+        """
+        Return the parameters and the reduced chi square to be used as
+        starting point of the next fit (None if not available).
+        """
+        return self._warmStartSeed
+
+    def setWarmStartSeed(self, seed):
+        """
+        Set the (parameters, chisq) tuple to be used as starting point of the
+        next fit. It allows to start from any previously fitted spectrum and
+        not only from the last one.
+        """
+        self._warmStartSeed = seed
+
+    def clearConfigurationCache(self):
+        """
+        Forget the peak descriptions calculated for previous configurations.
+        It has to be called if the underlying physical data are modified.
+        """
+        self._configurationCache.clear()
+
     def setConfiguration(self, ddict):
         """
         The current fit configuration dictionary is updated, but not replaced,
@@ -163,7 +247,104 @@ def __configure(self):
         for material in self.config['materials'].keys():
             Elements.Material[material] = copy.deepcopy(self.config['materials'][material])
         #that was it
+        #the description of the peaks only depends on the configuration
+        #it can be reused when fitting many spectra (batch fitting)
+        key = (_getConfigurationKey(self.config, self.attflag),
+               _getMaterialsKey())
+        if key in self._configurationCache:
+            if DEBUG:
+                print("Using cached peak description")
+            # most recently used
+            config, state = self._configurationCache.pop(key)
+            self._configurationCache[key] = (config, state)
+            self.config.update(copy.deepcopy(config))
+            state = copy.deepcopy(state)
+        else:
+            self.__configurePeaks()
+            state = {'PEAKS0':self.PEAKS0,
+                     'PEAKS0ESCAPE':self.PEAKS0ESCAPE,
+                     'PEAKS0NAMES':self.PEAKS0NAMES,
+                     'PEAKSW':self.PEAKSW,
+                     'HYPERMET':self.__HYPERMET,
+                     'NGLOBAL':self.NGLOBAL,
+                     'PARAMETERS':self.PARAMETERS,
+                     'CONTINUUM':self.__CONTINUUM,
+                     'fluorates':self._fluoRates}
+            # the configuration is completed with the default values, the
+            # next calls will find them in self.config
+            key = (_getConfigurationKey(self.config, self.attflag),
+                   _getMaterialsKey())
+            while len(self._configurationCache) >= MAX_CONFIGURATION_CACHE:
+                self._configurationCache.popitem(last=False)
+            self._configurationCache[key] = (copy.deepcopy(self.config),
+                                             copy.deepcopy(state))
+        self.PEAKS0     = state['PEAKS0']
+        self.PEAKS0ESCAPE = state['PEAKS0ESCAPE']
+        self.PEAKS0NAMES= state['PEAKS0NAMES']
+        self.PEAKSW     = state['PEAKSW']
+        self.FASTER     = 1
+        self.__HYPERMET   = state['HYPERMET']
+        self.NGLOBAL    = state['NGLOBAL']
+        self.PARAMETERS = state['PARAMETERS']
+        self.__CONTINUUM     = state['CONTINUUM']
+        self._fluoRates = state['fluorates']
+        self.ESCAPE     = self.config['fit']['escapeflag']
+        self.__SUM        = self.config['fit']['sumflag']
+        self.MAXITER    = self.config['fit']['maxiter']
+        self.STRIP      = self.config['fit']['stripflag']
+        #if self.laststrip is not None:
+        self.__mycounter = 0
+        calculateStrip = False
+        if (self.STRIP != self.laststrip) or \
+           (self.config['fit']['stripalgorithm'] != self.laststripalgorithm) or \
+           (self.config['fit']['stripfilterwidth'] != self.laststripfilterwidth) or \
+           (self.config['fit']['stripanchorsflag'] != self.laststripanchorsflag) or \
+           (self.config['fit']['stripanchorslist'] != self.laststripanchorslist):
+            calculateStrip = True
+        if not calculateStrip:
+            if self.config['fit']['stripalgorithm'] == 1:
+                #checking if needed to calculate SNIP
+                if (self.config['fit']['snipwidth'] != self.lastsnipwidth):
+                    calculateStrip = True
+            else:
+                #checking if needed to calculate strip
+                if (self.config['fit']['stripiterations'] != self.laststripiterations) or \
+                   (self.config['fit']['stripwidth'] != self.laststripwidth) or \
+                   (self.config['fit']['stripconstant'] != self.laststripconstant):
+                    calculateStrip = True
+        if (self.lastxmin != self.config['fit']['xmin']) or\
+           (self.lastxmax != self.config['fit']['xmax']):
+            if self.ydata0 is not None:
+                if DEBUG:
+                    print("Limits changed")
+                self.setData(x=self.xdata0,
+                             y=self.ydata0,
+                             sigmay=self.sigmay0,
+                             xmin = self.config['fit']['xmin'],
+                             xmax = self.config['fit']['xmax'],
+                             time = self.__lastTime)
+                return
+
+        if hasattr(self, "xdata"):
+            if self.STRIP:
+                if calculateStrip:
+                    if DEBUG:
+                        print("Calling to calculate non analytical background in config")
+                    self.__getselfzz()
+                else:
+                    if DEBUG:
+                        print("Using previous non analytical background in config")
+                self.datatofit = numpy.concatenate((self.xdata,
+                                self.ydata-self.zz, self.sigmay),1)
+                self.laststrip = 1
+            else:
+                if DEBUG:
+                    print("Using previous data")
+                self.datatofit = numpy.concatenate((self.xdata,
+                                self.ydata, self.sigmay),1)
+                self.laststrip = 0
 
+    def __configurePeaks(self):
         #default peak shape parameters for pseudo-voigt function
         self.config['peakshape']['eta_factor'] = self.config['peakshape'].get('eta_factor', 0.02)
         self.config['peakshape']['fixedeta_factor'] = self.config['peakshape'].get('fixedeta_factor',
@@ -296,7 +477,8 @@ def __configure(self):
               else:
                   ele = element.upper()
               if maxenergy != Elements.Element[ele]['buildparameters']['energy']:
-                  Elements.updateDict (energy= maxenergy)
+                  # the cached peak descriptions are still valid
+                  Elements.updateDict (energy= maxenergy, cb=False)
               if type(self.config['peaks'][element]) == type([]):
                   for peak in self.config['peaks'][element]:
                       data.append([Elements.getz(ele),ele,peak])
@@ -495,7 +677,8 @@ def __configure(self):
                     else:
                         ele = element.upper()
                     if maxenergy != Elements.Element[ele]['buildparameters']['energy']:
-                        Elements.updateDict (energy= maxenergy)
+                        # the cached peak descriptions are still valid
+                        Elements.updateDict (energy= maxenergy, cb=False)
                     if type(self.config['peaks'][element]) == type([]):
                         for peak in self.config['peaks'][element]:
                             data.append([Elements.getz(ele),ele,peak])
@@ -883,62 +1066,7 @@ def __configure(self):
         self.__HYPERMET   = HYPERMET
         self.NGLOBAL    = NGLOBAL
         self.PARAMETERS = PARAMETERS
-        self.ESCAPE     = self.config['fit']['escapeflag']
-        self.__SUM        = self.config['fit']['sumflag']
         self.__CONTINUUM     = CONTINUUM
-        self.MAXITER    = self.config['fit']['maxiter']
-        self.STRIP      = self.config['fit']['stripflag']
-        #if self.laststrip is not None:
-        self.__mycounter = 0
-        calculateStrip = False
-        if (self.STRIP != self.laststrip) or \
-           (self.config['fit']['stripalgorithm'] != self.laststripalgorithm) or \
-           (self.config['fit']['stripfilterwidth'] != self.laststripfilterwidth) or \
-           (self.config['fit']['stripanchorsflag'] != self.laststripanchorsflag) or \
-           (self.config['fit']['stripanchorslist'] != self.laststripanchorslist):
-            calculateStrip = True
-        if not calculateStrip:
-            if self.config['fit']['stripalgorithm'] == 1:
-                #checking if needed to calculate SNIP
-                if (self.config['fit']['snipwidth'] != self.lastsnipwidth):
-                    calculateStrip = True
-            else:
-                #checking if needed to calculate strip
-                if (self.config['fit']['stripiterations'] != self.laststripiterations) or \
-                   (self.config['fit']['stripwidth'] != self.laststripwidth) or \
-                   (self.config['fit']['stripconstant'] != self.laststripconstant):
-                    calculateStrip = True
-        if (self.lastxmin != self.config['fit']['xmin']) or\
-           (self.lastxmax != self.config['fit']['xmax']):
-            if self.ydata0 is not None:
-                if DEBUG:
-                    print("Limits changed")
-                self.setData(x=self.xdata0,
-                             y=self.ydata0,
-                             sigmay=self.sigmay0,
-                             xmin = self.config['fit']['xmin'],
-                             xmax = self.config['fit']['xmax'],
-                             time = self.__lastTime)
-                return
-
-        if hasattr(self, "xdata"):
-            if self.STRIP:
-                if calculateStrip:
-                    if DEBUG:
-                        print("Calling to calculate non analytical background in config")
-                    self.__getselfzz()
-                else:
-                    if DEBUG:
-                        print("Using previous non analytical background in config")
-                self.datatofit = numpy.concatenate((self.xdata,
-                                self.ydata-self.zz, self.sigmay),1)
-                self.laststrip = 1
-            else:
-                if DEBUG:
-                    print("Using previous data")
-                self.datatofit = numpy.concatenate((self.xdata,
-                                self.ydata, self.sigmay),1)
-                self.laststrip = 0
 
     def setdata(self, *var, **kw):
         print("ClassMcaTheory.setdata deprecated, please use setData")
@@ -1725,6 +1853,29 @@ def estimate(self):
                 print("CONFIGURING FROM ESTIMATION")
             self.configure(self.__originalConfiguration)
         self.parameters, self.codes = self.specfitestimate(self.xdata, self.ydata,self.zz)
+        self.__estimatedParameters = None
+        if self._warmStart and (self._warmStartSeed is not None) and \
+           (not self.config['fit'].get("linearfitflag", 0)):
+            seed = self._warmStartSeed[0]
+            if len(seed) == len(self.parameters):
+                # keep the estimation in case the previous fit is not good
+                # enough as starting point
+                self.__estimatedParameters = self.parameters
+                parameters = []
+                for i in range(len(seed)):
+                    if self.codes[0, i] == Gefit.CFIXED:
+                        parameters.append(self.parameters[i])
+                    elif self.codes[0, i] == Gefit.CQUOTED:
+                        # a parameter sitting on one of its limits has a
+                        # null derivative and would not be fitted any more
+                        pmin = min(self.codes[1, i], self.codes[2, i])
+                        pmax = max(self.codes[1, i], self.codes[2, i])
+                        delta = 0.01 * (pmax - pmin)
+                        parameters.append(min(max(seed[i], pmin + delta),
+                                              pmax - delta))
+                    else:
+                        parameters.append(seed[i])
+                self.parameters = parameters
         #self.estimatelinpoly(self.xdata, self.ydata,self.zz)
         #self.estimateexppoly(self.xdata, self.ydata,self.zz)
         #print self.codes[:,3]
@@ -2057,65 +2208,20 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
         if linear is None:
             linear = self.config['fit'].get("linearfitflag", 0)
 
-        if linear and self._batchFlag and (self.linearMatrix is not None):
-            fitresult =  Gefit.LeastSquaresFit(self.linearMcaTheory,
-                                           self.parameters,
-                                           self.datatofit,
-                                           constrains=self.codes,
-                                           weightflag=self.config['fit']['fitweight'],
-                                           maxiter=self.MAXITER,
-                                    model_deriv=self.linearMcaTheoryDerivative,
-                                           deltachi=self.config['fit']['deltachi'],
-                                           fulloutput=1, linear=linear)
-            if self.__SUM:
-                #This is a patch but the alternative is
-                #to forbid linear fits with pile-up.
-                self.parameters = fitresult[0]
-                zero = self.parameters[0]
-                gain = self.parameters[1]
-                xw = self.datatofit[:,0]
-                yfitw = self.mcatheory(fitresult[0], xw,summing=0)
-                pileup= self.parameters[4]*SpecfitFuns.pileup(yfitw,int(xw[0]), zero, gain)
-                self.datatofit[:,1] -= pileup
-                fitresult =  Gefit.LeastSquaresFit(self.linearMcaTheory,
-                                           self.parameters,
-                                           self.datatofit,
-                                           constrains=self.codes,
-                                           weightflag=self.config['fit']['fitweight'],
-                                           maxiter=self.MAXITER,
-                                    model_deriv=self.linearMcaTheoryDerivative,
-                                           deltachi=self.config['fit']['deltachi'],
-                                           fulloutput=1, linear=linear)
-
-        else:
-            fitresult =  Gefit.LeastSquaresFit(self.mcatheory,
-                                           self.parameters,
-                                           self.datatofit,
-                                           constrains=self.codes,
-                                           weightflag=self.config['fit']['fitweight'],
-                                           maxiter=self.MAXITER,
-                                           model_deriv=self.analyticalDerivative,
-                                           deltachi=self.config['fit']['deltachi'],
-                                           fulloutput=1, linear=linear)
-            if self.__SUM and linear:
-                #This is a patch but the alternative is
-                #to forbid linear fits with pile-up.
-                self.parameters = fitresult[0]
-                zero = self.parameters[0]
-                gain = self.parameters[1]
-                xw = self.datatofit[:,0]
-                yfitw = self.mcatheory(fitresult[0], xw,summing=0)
-                pileup= self.parameters[4]*SpecfitFuns.pileup(yfitw,int(xw[0]), zero, gain)
-                self.datatofit[:,1] -= pileup
-                fitresult =  Gefit.LeastSquaresFit(self.mcatheory,
-                                           self.parameters,
-                                           self.datatofit,
-                                           constrains=self.codes,
-                                           weightflag=self.config['fit']['fitweight'],
-                                           maxiter=self.MAXITER,
-                                           model_deriv=self.analyticalDerivative,
-                                           deltachi=self.config['fit']['deltachi'],
-                                           fulloutput=1, linear=linear)
+        estimatedParameters = self.__estimatedParameters
+        self.__estimatedParameters = None
+        if estimatedParameters is not None:
+            # pile-up correction modifies the data to be fitted
+            datatofit = self.datatofit.copy()
+        fitresult = self.__leastSquaresFit(linear)
+        if estimatedParameters is not None:
+            if not (fitresult[1] <= \
+                    self._warmStartChisqFactor * self._warmStartSeed[1]):
+                if DEBUG:
+                    print("Warm start failed, fitting from estimation")
+                self.datatofit = datatofit
+                self.parameters = estimatedParameters
+                fitresult = self.__leastSquaresFit(linear)
         self.fittedpar=fitresult[0]
         self.chisq    =fitresult[1]
         self.sigmapar =fitresult[2]
@@ -2159,6 +2265,8 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                 self.__niter  =fitresult[3]
                 self.__lastdeltachi = fitresult[4]
 
+        if self._warmStart and (currentIteration is None):
+            self._warmStartSeed = (copy.deepcopy(self.fittedpar), self.chisq)
         self.digest = digest
         if digest:
             digestedResult = self.digestresult()
@@ -2179,6 +2287,68 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                     self.__toBeConfigured = True
             return fitresult
 
+    def __leastSquaresFit(self, linear):
+        if linear and self._batchFlag and (self.linearMatrix is not None):
+            fitresult =  Gefit.LeastSquaresFit(self.linearMcaTheory,
+                                           self.parameters,
+                                           self.datatofit,
+                                           constrains=self.codes,
+                                           weightflag=self.config['fit']['fitweight'],
+                                           maxiter=self.MAXITER,
+                                    model_deriv=self.linearMcaTheoryDerivative,
+                                           deltachi=self.config['fit']['deltachi'],
+                                           fulloutput=1, linear=linear)
+            if self.__SUM:
+                #This is a patch but the alternative is
+                #to forbid linear fits with pile-up.
+                self.parameters = fitresult[0]
+                zero = self.parameters[0]
+                gain = self.parameters[1]
+                xw = self.datatofit[:,0]
+                yfitw = self.mcatheory(fitresult[0], xw,summing=0)
+                pileup= self.parameters[4]*SpecfitFuns.pileup(yfitw,int(xw[0]), zero, gain)
+                self.datatofit[:,1] -= pileup
+                fitresult =  Gefit.LeastSquaresFit(self.linearMcaTheory,
+                                           self.parameters,
+                                           self.datatofit,
+                                           constrains=self.codes,
+                                           weightflag=self.config['fit']['fitweight'],
+                                           maxiter=self.MAXITER,
+                                    model_deriv=self.linearMcaTheoryDerivative,
+                                           deltachi=self.config['fit']['deltachi'],
+                                           fulloutput=1, linear=linear)
+
+        else:
+            fitresult =  Gefit.LeastSquaresFit(self.mcatheory,
+                                           self.parameters,
+                                           self.datatofit,
+                                           constrains=self.codes,
+                                           weightflag=self.config['fit']['fitweight'],
+                                           maxiter=self.MAXITER,
+                                           model_deriv=self.analyticalDerivative,
+                                           deltachi=self.config['fit']['deltachi'],
+                                           fulloutput=1, linear=linear)
+            if self.__SUM and linear:
+                #This is a patch but the alternative is
+                #to forbid linear fits with pile-up.
+                self.parameters = fitresult[0]
+                zero = self.parameters[0]
+                gain = self.parameters[1]
+                xw = self.datatofit[:,0]
+                yfitw = self.mcatheory(fitresult[0], xw,summing=0)
+                pileup= self.parameters[4]*SpecfitFuns.pileup(yfitw,int(xw[0]), zero, gain)
+                self.datatofit[:,1] -= pileup
+                fitresult =  Gefit.LeastSquaresFit(self.mcatheory,
+                                           self.parameters,
+                                           self.datatofit,
+                                           constrains=self.codes,
+                                           weightflag=self.config['fit']['fitweight'],
+                                           maxiter=self.MAXITER,
+                                           model_deriv=self.analyticalDerivative,
+                                           deltachi=self.config['fit']['deltachi'],
+                                           fulloutput=1, linear=linear)
+        return fitresult
+
     def imagingDigestResult(self):
         """
         minimalist dictionnary for imaging purposes
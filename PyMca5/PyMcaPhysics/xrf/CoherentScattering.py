@@ -32,7 +32,7 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import os
 import numpy
-from PyMca5.PyMcaIO import ConfigDict
+from PyMca5.PyMcaIO import ConfigDictCache
 from PyMca5 import PyMcaDataDir
 
 dirmod = PyMcaDataDir.PYMCA_DATA_DIR
@@ -51,8 +51,7 @@
     if not os.path.exists(ffile):
         print("Cannot find file ", ffile)
         raise IOError("Cannot find file %s" % ffile)
-COEFFICIENTS = ConfigDict.ConfigDict()
-COEFFICIENTS.read(ffile)
+COEFFICIENTS = ConfigDictCache.readConfigDict(ffile, lazy=True)
 KEVTOANG = 12.39852000
 R0 = 2.82E-13 #electron radius in cm
 
@@ -42,6 +42,8 @@
 except ImportError:
     print("WARNING: fisx features not available")
 
+DEBUG = 0
+
 class ConcentrationsConversion(object):
     def getConcentrationsAsHtml(self, concentrations=None):
         text = ""
@@ -243,36 +245,10 @@ def processFitResult(self, config=None, fitresult=None,
         if secondary and (not FISX):
             raise  ImportError("Module fisx does not seem to be available")
         # get attenuators and matrix from fit
-        attenuators = []
-        beamfilters = []
-        funnyfilters = []
-        matrix = None
-        detectoratt = None
+        attenuators, beamfilters, funnyfilters, detectoratt, matrix, \
+                     alphain, alphaout = \
+                     self._getAttenuators(fitresult['result']['config'])
         multilayer = None
-        for attenuator in fitresult['result']['config']['attenuators'].keys():
-            if not fitresult['result']['config']['attenuators'][attenuator][0]:
-                continue
-            if attenuator.upper() == "MATRIX":
-                matrix = fitresult['result']['config']['attenuators'][attenuator][1:4]
-                alphain  = fitresult['result']['config']['attenuators'][attenuator][4]
-                alphaout = fitresult['result']['config']['attenuators'][attenuator][5]
-            elif attenuator.upper()[:-1] == "BEAMFILTER":
-                beamfilters.append(fitresult['result']['config']['attenuators']\
-                                                                [attenuator][1:])
-            elif attenuator.upper() == "DETECTOR":
-                detectoratt = fitresult['result']['config']['attenuators'][attenuator][1:]
-            else:
-                if len(fitresult['result']['config']['attenuators'][attenuator][1:]) == 4:
-                   fitresult['result']['config']['attenuators'][attenuator].append(1.0)
-                if abs(fitresult['result']['config']['attenuators'][attenuator][4]-1.0) > 1.0e-10:
-                    #funny attenuator
-                    funnyfilters.append(fitresult['result']['config']['attenuators']\
-                                                                [attenuator][1:])
-                else:
-                    attenuators.append(fitresult['result']['config']['attenuators']\
-                                                                [attenuator][1:])
-        if matrix is None:
-            raise ValueError("Invalid or undefined sample matrix")
 
         if matrix[0].upper() == "MULTILAYER":
             layerlist = fitresult['result']['config']['multilayer'].keys()
@@ -293,45 +269,8 @@ def processFitResult(self, config=None, fitresult=None,
         if xrfmcSecondary and (len(layerlist) > 1):
             txt = "Multilayer Monte Carlo correction not implemented yet"
             raise ValueError(txt)
-        energyList = fitresult['result']['config']['fit']['energy']
-        if energyList is None:
-            raise ValueError("Invalid energy")
-        if type(energyList) != type([]):
-            energyList    = [energyList]
-            flagList   = [1]
-            weightList = [1.0]
-        else:
-            flagList   = fitresult['result']['config']['fit']['energyflag']
-            weightList = fitresult['result']['config']['fit']['energyweight']
-        finalEnergy = []
-        finalWeight = []
-        finalFlag = []
-        for idx in range(len(energyList)):
-            if flagList[idx]:
-                energy = energyList[idx]
-                if energy is None:
-                    raise ValueError(\
-                          "Energy %d isn't a valid energy" % idx)
-                if energy <= 0.001:
-                    raise ValueError(\
-                          "Energy %d with value %f isn't a valid energy" %\
-                          (idx, energy))
-                if weightList[idx] is None:
-                    raise ValueError(\
-                          "Weight %d isn't a valid weight" % idx)
-                if weightList[idx] < 0.0:
-                    raise ValueError(\
-                          "Weight %d with value %f isn't a valid weight" %\
-                          (idx, weightList[idx]))
-                finalEnergy.append(energy)
-                finalWeight.append(weightList[idx])
-                finalFlag.append(1)
-        totalWeight = sum(weightList)
-        if totalWeight == 0.0:
-            raise ValueError("Sum of energy weights is 0.0")
-        weightList = [x / totalWeight for x in finalWeight]
-        energyList = finalEnergy
-        flagList   = finalFlag
+        energyList, weightList, flagList = \
+                    self._getExcitation(fitresult['result']['config'])
 
         # get elements list from fit, not from matrix
         groupsList = fitresult['result']['groups'] * 1
@@ -760,6 +699,476 @@ def processFitResult(self, config=None, fitresult=None,
         else:
             return ddict
 
+    def _getAttenuators(self, fitconfig):
+        attenuators = []
+        beamfilters = []
+        funnyfilters = []
+        matrix = None
+        detectoratt = None
+        alphain = None
+        alphaout = None
+        for attenuator in fitconfig['attenuators'].keys():
+            if not fitconfig['attenuators'][attenuator][0]:
+                continue
+            if attenuator.upper() == "MATRIX":
+                matrix = fitconfig['attenuators'][attenuator][1:4]
+                alphain  = fitconfig['attenuators'][attenuator][4]
+                alphaout = fitconfig['attenuators'][attenuator][5]
+            elif attenuator.upper()[:-1] == "BEAMFILTER":
+                beamfilters.append(fitconfig['attenuators'][attenuator][1:])
+            elif attenuator.upper() == "DETECTOR":
+                detectoratt = fitconfig['attenuators'][attenuator][1:]
+            else:
+                if len(fitconfig['attenuators'][attenuator][1:]) == 4:
+                   fitconfig['attenuators'][attenuator].append(1.0)
+                if abs(fitconfig['attenuators'][attenuator][4]-1.0) > 1.0e-10:
+                    #funny attenuator
+                    funnyfilters.append(fitconfig['attenuators'][attenuator][1:])
+                else:
+                    attenuators.append(fitconfig['attenuators'][attenuator][1:])
+        if matrix is None:
+            raise ValueError("Invalid or undefined sample matrix")
+        return attenuators, beamfilters, funnyfilters, detectoratt, matrix, \
+               alphain, alphaout
+
+    def _getExcitation(self, fitconfig):
+        energyList = fitconfig['fit']['energy']
+        if energyList is None:
+            raise ValueError("Invalid energy")
+        if type(energyList) != type([]):
+            energyList    = [energyList]
+            flagList   = [1]
+            weightList = [1.0]
+        else:
+            flagList   = fitconfig['fit']['energyflag']
+            weightList = fitconfig['fit']['energyweight']
+        finalEnergy = []
+        finalWeight = []
+        finalFlag = []
+        for idx in range(len(energyList)):
+            if flagList[idx]:
+                energy = energyList[idx]
+                if energy is None:
+                    raise ValueError(\
+                          "Energy %d isn't a valid energy" % idx)
+                if energy <= 0.001:
+                    raise ValueError(\
+                          "Energy %d with value %f isn't a valid energy" %\
+                          (idx, energy))
+                if weightList[idx] is None:
+                    raise ValueError(\
+                          "Weight %d isn't a valid weight" % idx)
+                if weightList[idx] < 0.0:
+                    raise ValueError(\
+                          "Weight %d with value %f isn't a valid weight" %\
+                          (idx, weightList[idx]))
+                finalEnergy.append(energy)
+                finalWeight.append(weightList[idx])
+                finalFlag.append(1)
+        totalWeight = sum(weightList)
+        if totalWeight == 0.0:
+            raise ValueError("Sum of energy weights is 0.0")
+        weightList = [x / totalWeight for x in finalWeight]
+        return finalEnergy, weightList, finalFlag
+
+    def processAreaImages(self, areas, fitconfig, config=None, groups=None,
+                          fluorates=None, iterations=None):
+        """
+        Mass fractions of the fitted groups for all the pixels of a map.
+
+        areas is a dictionary with the image of the fitted areas of each
+        group and fitconfig the fit configuration used to obtain them.
+        The output is a dictionary as the one given by processFitResult
+        but containing images.
+
+        The flux, the solid angle, the internal reference and the
+        secondary excitation corrections are obtained calling
+        processFitResult with the average areas. If the single layer
+        strategy is enabled in the fit configuration, or if a number of
+        iterations is given, the composition of the sample matrix is
+        then updated pixel by pixel from the obtained mass fractions and
+        the matrix effects are calculated again for all the pixels at
+        once. This is only possible for a single layer matrix without
+        internal reference. Otherwise the strategy of the fit
+        configuration is ignored and, if iterations is given, a
+        ValueError is raised.
+        """
+        if config is None:
+            config = self.config
+        else:
+            self.config = config
+        if groups is None:
+            # only the element groups, not the scatter peaks
+            groups = [group for group in areas.keys()
+                      if group.split()[0] in Elements.ElementList]
+            groups.sort(key=lambda group: (Elements.getz(group.split()[0]),
+                                           group))
+        else:
+            groups = [group for group in groups
+                      if group.split()[0] in Elements.ElementList]
+
+        shape = None
+        images = {}
+        for group in groups:
+            image = numpy.asarray(areas[group], dtype=numpy.float64)
+            if shape is None:
+                shape = image.shape
+            elif image.shape != shape:
+                raise ValueError("All the area images must have the same shape")
+            images[group] = image.reshape(-1)
+
+        # average result
+        fitresult = {}
+        fitresult['result'] = {}
+        fitresult['result']['config'] = fitconfig
+        fitresult['result']['groups'] = groups
+        for group in groups:
+            area = images[group].mean()
+            if area <= 0.0:
+                # give a tiny area
+                area = 1.0e-6
+            fitresult['result'][group] = {}
+            fitresult['result'][group]['fitarea'] = area
+            fitresult['result'][group]['sigmaarea'] = 0.0
+        ddict, addInfo = self.processFitResult(config=config,
+                                               fitresult=fitresult,
+                                               elementsfrommatrix=False,
+                                               fluorates=fluorates,
+                                               addinfo=True)
+
+        # the pixel flux is obtained from the internal reference if any
+        referenceElement = addInfo['ReferenceElement']
+        if referenceElement is None:
+            scale = numpy.ones(images[groups[0]].shape, numpy.float64)
+        else:
+            referenceGroup = referenceElement + " " + \
+                             addInfo['ReferenceTransitions'].split()[0]
+            if referenceGroup not in images:
+                raise ValueError("Invalid reference:  <%s> <%s>" %\
+                                 (referenceElement,
+                                  addInfo['ReferenceTransitions']))
+            referenceArea = images[referenceGroup]
+            scale = numpy.zeros(referenceArea.shape, numpy.float64)
+            goodIdx = referenceArea > 0
+            scale[goodIdx] = fitresult['result'][referenceGroup]['fitarea'] / \
+                             referenceArea[goodIdx]
+
+        result = {}
+        result['groups'] = groups
+        result['elements'] = ddict['elements']
+        result['layerlist'] = ddict['layerlist']
+        result['mass fraction'] = {}
+        for group in groups:
+            result['mass fraction'][group] = scale * images[group] * \
+                    (ddict['mass fraction'][group] / \
+                     fitresult['result'][group]['fitarea'])
+        for layer in ddict['layerlist']:
+            result[layer] = {}
+            result[layer]['mass fraction'] = {}
+            for group in groups:
+                concentration = ddict[layer]['mass fraction'][group]
+                if concentration < 0.0:
+                    # unknown
+                    result[layer]['mass fraction'][group] = \
+                            -numpy.ones(scale.shape, numpy.float64)
+                else:
+                    result[layer]['mass fraction'][group] = \
+                            scale * images[group] * \
+                            (concentration / fitresult['result'][group]['fitarea'])
+
+        # matrix effects pixel by pixel
+        if iterations is None:
+            requested = False
+            iterations = 0
+            if fitconfig['fit'].get("strategyflag", False):
+                strategy = fitconfig['fit'].get("strategy", None)
+                if strategy == "SingleLayerStrategy":
+                    iterations = fitconfig['SingleLayerStrategy']['iterations']
+                else:
+                    print("WARNING: Strategy %s not supported for maps. "
+                          "Matrix not updated." % strategy)
+        else:
+            requested = True
+        if iterations > 0:
+            text = self._checkMatrixIterations(fitconfig, referenceElement)
+            if text is not None:
+                if requested:
+                    raise ValueError(text)
+                # the strategy of the fit configuration cannot be applied
+                # to the maps, they are calculated with the configured matrix
+                print("WARNING: %s. Matrix not updated." % text)
+                iterations = 0
+        if iterations > 0:
+            strategy = fitconfig["SingleLayerStrategy"]
+            model = self._getMatrixModel(fitconfig, groups, strategy)
+            referenceRates = self._getMatrixRates(model,
+                                                  model['composition'])
+            firstGuess = result['mass fraction']
+            massFractions = firstGuess
+            for i in range(iterations):
+                composition = self._getStrategyComposition(model, strategy,
+                                                           massFractions)
+                rates = self._getMatrixRates(model, composition)
+                massFractions = {}
+                for group in groups:
+                    correction = numpy.zeros(rates[group].shape,
+                                             numpy.float64)
+                    goodIdx = rates[group] > 0.0
+                    correction[goodIdx] = referenceRates[group] / \
+                                          rates[group][goodIdx]
+                    massFractions[group] = firstGuess[group] * correction
+            result['mass fraction'] = massFractions
+
+        if 'mmolar' in ddict:
+            result['mmolar'] = {}
+            for group in groups:
+                if ddict['mass fraction'][group] > 0.0:
+                    conversionFactor = ddict['mmolar'][group] / \
+                                       ddict['mass fraction'][group]
+                else:
+                    conversionFactor = 0.0
+                result['mmolar'][group] = conversionFactor * \
+                                          result['mass fraction'][group]
+            for layer in ddict['layerlist']:
+                result[layer]['mmolar'] = {}
+                for group in groups:
+                    concentration = ddict[layer]['mass fraction'][group]
+                    if concentration > 0.0:
+                        conversionFactor = ddict[layer]['mmolar'][group] / \
+                                           concentration
+                    else:
+                        conversionFactor = 0.0
+                    result[layer]['mmolar'][group] = conversionFactor * \
+                                            result[layer]['mass fraction'][group]
+
+        # back to the shape of the input images
+        for key in ['mass fraction', 'mmolar']:
+            if key in result:
+                for group in groups:
+                    result[key][group].shape = shape
+            for layer in ddict['layerlist']:
+                if key in result[layer]:
+                    for group in groups:
+                        result[layer][key][group].shape = shape
+        return result
+
+    def _checkMatrixIterations(self, fitconfig, referenceElement):
+        """
+        Return the reason why the matrix cannot be updated pixel by pixel
+        or None if it can be done.
+        """
+        if referenceElement is not None:
+            return "Matrix iterations cannot use an internal reference"
+        if "SingleLayerStrategy" not in fitconfig:
+            return "Single layer strategy not configured"
+        matrix, alphain, alphaout = self._getAttenuators(fitconfig)[4:]
+        if matrix[0].upper() == "MULTILAYER":
+            return "Matrix iterations only implemented for single layer samples"
+        if (alphain < 0.0) and (alphaout > 0.0):
+            return "Matrix iterations not implemented for bottom excitation"
+        return None
+
+    def _getMatrixModel(self, fitconfig, groups, strategy):
+        """
+        Composition independent terms of the fluorescence rates of the
+        groups in a single layer sample.
+        """
+        attenuators, beamfilters, funnyfilters, detector, matrix, \
+                     alphain, alphaout = self._getAttenuators(fitconfig)
+        if not self.config['useattenuators']:
+            attenuators = []
+            funnyfilters = []
+        energyList, weightList, flagList = self._getExcitation(fitconfig)
+        energyList = numpy.array(energyList, numpy.float64)
+        weightList = numpy.array(weightList, numpy.float64)
+        if len(beamfilters):
+            coeffs = numpy.zeros(len(energyList), numpy.float64)
+            for beamfilter in beamfilters:
+                coeffs += beamfilter[1] * beamfilter[2] * \
+                    numpy.array(Elements.getMaterialMassAttenuationCoefficients( \
+                                beamfilter[0], 1.0, energyList)['total'])
+            weightList = weightList * numpy.exp(-coeffs)
+
+        # the elements whose attenuation can change
+        composition = Elements.getMaterialMassFractions([matrix[0]], [1.0])
+        if composition == {}:
+            raise ValueError("Invalid matrix material %s" % matrix[0])
+        elementList = list(composition.keys())
+        materials = []
+        for i, group in enumerate(strategy["peaks"]):
+            if "-" in group:
+                continue
+            if group not in groups:
+                raise ValueError("Strategy group %s not among fitted groups" % \
+                                 group)
+            ele = group.split()[0]
+            material = strategy["materials"][i]
+            if material in ["-", ele, ele + "1"]:
+                materials.append({ele: 1.0})
+            else:
+                materials.append(Elements.getMaterialMassFractions([material],
+                                                                   [1.0]))
+                if ele not in materials[-1]:
+                    raise ValueError("Element %s not in material %s" % \
+                                     (ele, material))
+        if strategy["completer"] not in ["-"]:
+            completer = Elements.getMaterialMassFractions( \
+                                    [strategy["completer"]], [1.0])
+        else:
+            completer = None
+        for item in materials + [completer]:
+            if item is None:
+                continue
+            for ele in item:
+                if ele not in elementList:
+                    elementList.append(ele)
+
+        # fluorescence lines
+        newelements = [[Elements.getz(group.split()[0]),
+                        group.split()[0],
+                        group.split()[1]] for group in groups]
+        elementDict = Elements._getAttFilteredElementDict(newelements,
+                                            attenuators=attenuators,
+                                            detector=detector,
+                                            funnyfilters=funnyfilters,
+                                            energy=max(energyList))
+        shelllist = ['K', 'L1', 'L2', 'L3', 'M1', 'M2', 'M3', 'M4', 'M5']
+        energies = list(energyList)
+        lines = {}
+        for group in groups:
+            ele, family = group.split()
+            rays = family + " xrays"
+            if rays not in elementDict[ele]:
+                lines[group] = None
+                continue
+            if family.upper()[0] == 'K':
+                shellIdent = 'K'
+            elif len(family) == 2:
+                shellIdent = family.upper()
+            elif family.upper() == 'L':
+                shellIdent = 'L3'
+            elif family.upper() == 'M':
+                shellIdent = 'M5'
+            else:
+                raise ValueError("Unknown Element shell %s" % family)
+            bindingEnergy = Elements.Element[ele]['binding'][shellIdent]
+            nrgi = numpy.nonzero(energyList >= bindingEnergy)[0]
+            if len(nrgi) == 0:
+                nrgi = numpy.array([0])
+            transitions = elementDict[ele][rays]
+            rates = numpy.array([elementDict[ele][transition]['rate'] \
+                                 for transition in transitions])
+            shells = []
+            for transition in transitions:
+                if transition[0] == "K":
+                    shells.append(0)
+                else:
+                    shells.append(shelllist.index(transition[0:2]))
+            factors = numpy.zeros((len(nrgi), len(transitions)),
+                                  numpy.float64)
+            for k, iene in enumerate(nrgi):
+                fluoWeights = Elements._getFluorescenceWeights(ele,
+                                            energyList[iene],
+                                            normalize=False,
+                                            cascade=True)
+                muphoto = Elements.getMaterialMassAttenuationCoefficients( \
+                                        ele, 1.0, energyList[iene])['photo']
+                factors[k] = numpy.take(fluoWeights, shells) * rates * \
+                             muphoto[-1]
+            lineIndex = numpy.arange(len(energies),
+                                     len(energies) + len(transitions))
+            energies += [elementDict[ele][transition]['energy'] \
+                         for transition in transitions]
+            lines[group] = (nrgi, weightList[nrgi] * 1, factors, lineIndex)
+
+        # mass attenuation coefficients of the elements
+        mu = numpy.zeros((len(energies), len(elementList)), numpy.float64)
+        for i, ele in enumerate(elementList):
+            mu[:, i] = Elements.getMaterialMassAttenuationCoefficients( \
+                                        ele, 1.0, energies)['total']
+
+        model = {}
+        model['elements'] = elementList
+        model['composition'] = numpy.array([[composition.get(ele, 0.0)] \
+                                            for ele in elementList],
+                                           numpy.float64)
+        model['materials'] = [numpy.array([item.get(ele, 0.0) \
+                                           for ele in elementList],
+                                          numpy.float64) \
+                              for item in materials]
+        if completer is None:
+            model['completer'] = None
+        else:
+            model['completer'] = numpy.array([completer.get(ele, 0.0) \
+                                              for ele in elementList],
+                                             numpy.float64)
+        model['mu'] = mu
+        model['lines'] = lines
+        model['thickness'] = matrix[1] * matrix[2]
+        model['sinalphain'] = numpy.sin(abs(alphain) * numpy.pi / 180.)
+        model['sinalphaout'] = numpy.sin(abs(alphaout) * numpy.pi / 180.)
+        return model
+
+    def _getStrategyComposition(self, model, strategy, massFractions):
+        """
+        Matrix composition of each pixel as the single layer strategy
+        obtains it from the mass fractions of the groups.
+        """
+        nPixels = massFractions[list(massFractions.keys())[0]].size
+        total = numpy.zeros(nPixels, numpy.float64)
+        composition = numpy.zeros((len(model['elements']), nPixels),
+                                  numpy.float64)
+        iMaterial = 0
+        for group in strategy["peaks"]:
+            if "-" in group:
+                continue
+            ele = group.split()[0]
+            material = model['materials'][iMaterial]
+            iMaterial += 1
+            # mass fraction of the compound giving the element
+            fraction = numpy.clip(massFractions[group], 0.0, None) / \
+                       material[model['elements'].index(ele)]
+            composition += material[:, None] * fraction
+            total += fraction
+        if model['completer'] is not None:
+            rest = numpy.clip(1.0 - total, 0.0, None)
+            composition += model['completer'][:, None] * rest
+            total = total + rest
+        # keep the configured matrix where nothing is found
+        emptyIdx = total <= 0.0
+        total[emptyIdx] = 1.0
+        composition /= total
+        composition[:, emptyIdx] = model['composition']
+        return composition
+
+    def _getMatrixRates(self, model, composition):
+        """
+        Fluorescence rates of the groups for the given compositions
+        (one column per pixel) with unit mass fraction.
+        """
+        mu = numpy.dot(model['mu'], composition)
+        ratio = model['sinalphain'] / model['sinalphaout']
+        thickness = model['thickness']
+        rates = {}
+        for group in model['lines']:
+            item = model['lines'][group]
+            if item is None:
+                rates[group] = numpy.zeros(composition.shape[1:],
+                                           numpy.float64)
+                continue
+            nrgi, weights, factors, lineIndex = item
+            mulines = mu[lineIndex]
+            rate = 0.0
+            for k, iene in enumerate(nrgi):
+                mu0 = mu[iene]
+                trans = factors[k][:, None] / (mu0 + mulines * ratio)
+                if thickness > 0.0:
+                    trans *= 1.0 - numpy.exp(-(mu0 / model['sinalphain'] + \
+                                    mulines / model['sinalphaout']) * thickness)
+                rate = rate + weights[k] * trans.sum(axis=0)
+            rates[group] = rate
+        return rates
+
     def _figureOfMerit(self, element, fluo, fitresult):
         weight = 0.0
         for transitions in fluo[element]['rates'].keys():
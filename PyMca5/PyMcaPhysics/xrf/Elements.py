@@ -33,11 +33,14 @@
 LOGLOG = True
 import sys
 import os
+import copy
 import numpy
 import re
 import weakref
+import threading
 import types
-from PyMca5.PyMcaIO import ConfigDict
+import collections
+from PyMca5.PyMcaIO import ConfigDictCache
 from . import CoherentScattering
 from . import IncoherentScattering
 from . import PyMcaEPDL97
@@ -176,6 +179,8 @@
 ElementShells = BindingEnergies.ElementShells[1:]
 ElementBinding = BindingEnergies.ElementBinding
 
+# the shell tables are read by the C specfile parser in a few milliseconds,
+# they are not worth a ConfigDictCache entry
 from . import KShell
 from . import LShell
 from . import MShell
@@ -545,6 +550,80 @@ def getPhotoWeight(ele,shelllist,energy, normalize = None, totals = None):
     else:
         return w
 
+# fluorescence rates, escape peaks and x-ray lines already calculated
+# (all the caches are cleared when the element dictionnaries are updated)
+FLUORESCENCE_CACHE_SIZE = 512
+_fluorescenceCache = collections.OrderedDict()
+
+if sys.version < '3.0':
+    _STRING_TYPES = types.StringTypes
+else:
+    _STRING_TYPES = (str,)
+
+def _getFluorescenceCacheKey(item, materials, visited=()):
+    """
+    Hashable description of the content of an argument. The materials
+    are replaced by their current definition.
+    """
+    if isinstance(item, dict):
+        return dict, tuple([(key, _getFluorescenceCacheKey(item[key],
+                                                           materials,
+                                                           visited)) \
+                            for key in sorted(item.keys())])
+    if isinstance(item, (list, tuple)):
+        return type(item), tuple([_getFluorescenceCacheKey(x,
+                                                           materials,
+                                                           visited) \
+                                  for x in item])
+    if isinstance(item, numpy.ndarray):
+        return item.dtype.str, item.shape, item.tobytes()
+    if type(item) in _STRING_TYPES:
+        key = materials.get(item.upper(), None)
+        if (key is not None) and (key not in visited):
+            material = dict(Material[key])
+            # getMaterialMassFractions converts single compounds to lists
+            for name in ['CompoundList', 'CompoundFraction']:
+                if type(material.get(name, None)) != type([]):
+                    material[name] = [material.get(name, None)]
+            return item, _getFluorescenceCacheKey(material,
+                                                  materials,
+                                                  visited + (key,))
+    return item
+
+def _clearCaches():
+    # everything calculated from the element dictionnaries
+    _fluorescenceCache.clear()
+    _massAttenuationCache.clear()
+    _xcomPairLog10.clear()
+
+def _cachedFluorescence(function):
+    """
+    Keep the results of the function in memory. The arguments are compared
+    by content, hence the callers are free to modify them and the results.
+    """
+    def wrapper(*var, **kw):
+        materials = {}
+        for key in Material.keys():
+            materials[key.upper()] = key
+        try:
+            cacheKey = function.__name__, \
+                       _getFluorescenceCacheKey(var, materials), \
+                       _getFluorescenceCacheKey(kw, materials)
+            value = _fluorescenceCache.pop(cacheKey, None)
+        except TypeError:
+            # unhashable or not sortable argument
+            return function(*var, **kw)
+        if value is None:
+            value = function(*var, **kw)
+        _fluorescenceCache[cacheKey] = value
+        while len(_fluorescenceCache) > FLUORESCENCE_CACHE_SIZE:
+            _fluorescenceCache.popitem(last=False)
+        return copy.deepcopy(value)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+@_cachedFluorescence
 def _getFluorescenceWeights(ele, energy, normalize = None, cascade = None):
     if normalize is None:normalize = True
     if cascade   is None:cascade   = False
@@ -726,6 +805,7 @@ def _getFluorescenceWeights(ele, energy, normalize = None, cascade = None):
                 w[i] /= cum
     return w
 
+@_cachedFluorescence
 def getEscape(matrix, energy, ethreshold=None, ithreshold=None, nthreshold = None,
                         alphain = None, cascade = None, fluorescencemode=None):
     """
@@ -970,6 +1050,7 @@ def _filterPeaks(peaklist, ethreshold = None, ithreshold = None,
     return output
 
 
+@_cachedFluorescence
 def _getAttFilteredElementDict(elementsList,
                                attenuators= None,
                                detector   = None,
@@ -1091,6 +1172,7 @@ def _getAttFilteredElementDict(elementsList,
                 i += 1
     return outputDict
 
+@_cachedFluorescence
 def getMultilayerFluorescence(multilayer0,
                               energyList,
                               layerList = None,
@@ -2167,6 +2249,133 @@ def getMaterialKey(compound):
         return matkeys[index]
     return None
 
+# interpolated mass attenuation coefficients of the most recently used
+# elements, compositions and energy grids
+MASS_ATTENUATION_CACHE_SIZE = 256
+_massAttenuationCache = collections.OrderedDict()
+
+def _getCachedMassAttenuation(key):
+    value = _massAttenuationCache.pop(key, None)
+    if value is not None:
+        _massAttenuationCache[key] = value
+    return value
+
+def _setCachedMassAttenuation(key, value):
+    for item in value:
+        item.flags.writeable = False
+    _massAttenuationCache[key] = value
+    while len(_massAttenuationCache) > MASS_ATTENUATION_CACHE_SIZE:
+        _massAttenuationCache.popitem(last=False)
+
+# logarithm of the pair production cross sections of the elements
+_xcomPairLog10 = {}
+
+def _getXcomTables(ele):
+    # the pair production cross section can be zero, its logarithm is
+    # only used where it is positive
+    if 'xcom' not in Element[ele]:
+        getelementmassattcoef(ele, None)
+    xcom_data = Element[ele]['xcom']
+    cached = _xcomPairLog10.get(ele, None)
+    if (cached is None) or (cached[0] is not xcom_data):
+        # not calculated yet or the table has been replaced
+        pair = numpy.array(xcom_data['pair'], numpy.float64)
+        cached = xcom_data, pair > 0.0, \
+                 numpy.log10(numpy.where(pair > 0.0, pair, 1.0))
+        _xcomPairLog10[ele] = cached
+    return xcom_data, cached[1:]
+
+def _getElementMassAttenuationArrays(ele, energy):
+    """
+    Coherent, Compton, photoelectric and pair production mass attenuation
+    coefficients of the element at the energies of the given 1D array
+    """
+    key = ele, energy.tobytes()
+    value = _getCachedMassAttenuation(key)
+    if value is not None:
+        return value
+    cohe = numpy.zeros(energy.shape, numpy.float64)
+    comp = numpy.zeros(energy.shape, numpy.float64)
+    photo = numpy.zeros(energy.shape, numpy.float64)
+    pair = numpy.zeros(energy.shape, numpy.float64)
+    low = energy < 1.0
+    if low.any():
+        if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
+            #make sure the binding energies are those used by this module and not EADL ones
+            PyMcaEPDL97.setElementBindingEnergies(ele,
+                                                  Element[ele]['binding'])
+        tmpDict = PyMcaEPDL97.getElementCrossSections(ele, energy[low])
+        cohe[low] = tmpDict['coherent']
+        comp[low] = tmpDict['compton']
+        photo[low] = tmpDict['photo']
+    high = ~low
+    if high.any():
+        xcom_data, (pairPositive, pairLog10) = _getXcomTables(ele)
+        xcom_energy = xcom_data['energy']
+        ene = energy[high]
+        # first tabulated energy not below ene
+        i1 = numpy.searchsorted(xcom_energy, ene, side='left')
+        if (i1 >= len(xcom_energy)).any() or (ene < xcom_energy[0]).any():
+            raise ValueError("Energy outside the tabulated range of %s" % ele)
+        exact = xcom_energy[i1] == ene
+        i0 = numpy.where(exact, i1, i1 - 1)
+        if LOGLOG:
+            A = xcom_data['energylog10'][i0]
+            B = xcom_data['energylog10'][i1]
+            x = numpy.log10(ene)
+        else:
+            A = xcom_energy[i0]
+            B = xcom_energy[i1]
+            x = ene
+        delta = numpy.where(exact, 1.0, B - A)
+        c2 = (x - A) / delta
+        c1 = (B - x) / delta
+        values = []
+        for label in ['coherent', 'compton', 'photo']:
+            logvalues = xcom_data[label + 'log10']
+            value = pow(10.0, c2 * logvalues[i1] + c1 * logvalues[i0])
+            value[exact] = xcom_data[label][i1[exact]]
+            values.append(value)
+        cohe[high], comp[high], photo[high] = values
+        positive = pairPositive[i0] & pairPositive[i1]
+        value = pow(10.0, c2 * pairLog10[i1] + c1 * pairLog10[i0]) * positive
+        value[exact] = xcom_data['pair'][i1[exact]]
+        pair[high] = value
+    value = cohe, comp, photo, pair
+    _setCachedMassAttenuation(key, value)
+    return value
+
+def _getMassAttenuationArrays(composition, energy):
+    """
+    composition is a list of (element, mass fraction) pairs and energy
+    a 1D array. Returns the coherent, Compton, photoelectric, pair
+    production and total mass attenuation coefficients.
+    """
+    key = tuple(composition), energy.tobytes()
+    value = _getCachedMassAttenuation(key)
+    if value is not None:
+        return value
+    value = [numpy.zeros(energy.shape, numpy.float64) for i in range(5)]
+    for ele, fraction in composition:
+        elementValues = _getElementMassAttenuationArrays(ele, energy)
+        for i in range(4):
+            value[i] += elementValues[i] * fraction
+        value[4] += (elementValues[0] + elementValues[1] + \
+                     elementValues[2] + elementValues[3]) * fraction
+    value = tuple(value)
+    _setCachedMassAttenuation(key, value)
+    return value
+
+def _getMassAttenuationDict(composition, energy):
+    energy = numpy.array(energy, numpy.float64).reshape(-1)
+    values = _getMassAttenuationArrays(composition, energy)
+    ddict = {}
+    ddict['energy'] = energy.tolist()
+    for i, label in enumerate(['coherent', 'compton', 'photo',
+                               'pair', 'total']):
+        ddict[label] = values[i].tolist()
+    return ddict
+
 def getmassattcoef(compound, energy=None):
     """
     Usage: getmassattcoef(element symbol/composite, energy in kev)
@@ -2208,14 +2417,6 @@ def getmassattcoef(compound, energy=None):
     div      = sum(fraction)
     fraction = [x/div for x in fraction]
     #print "fraction = ",fraction
-    ddict={}
-    ddict['energy']   = []
-    ddict['coherent'] = []
-    ddict['compton']  = []
-    ddict['photo']    = []
-    ddict['pair']     = []
-    ddict['total']    = []
-    eltindex = 0
     if energy is None:
         energy=[]
         for ele in elts:
@@ -2224,75 +2425,7 @@ def getmassattcoef(compound, energy=None):
                 if ene not in energy:
                     energy.append(ene)
         energy.sort()
-
-    for ele in elts:
-        xcom_data = getelementmassattcoef(ele,None)
-        #now I have to interpolate at the different energies
-        if not hasattr(energy, "__len__"):
-            energy =[energy]
-        eneindex = 0
-        for ene in energy:
-            if ene < 1.0:
-                if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                    #make sure the binding energies are those used by this module and not EADL ones
-                    PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                          Element[ele]['binding'])
-                tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-                cohe  = tmpDict['coherent'][0]
-                comp  = tmpDict['compton'][0]
-                photo = tmpDict['photo'][0]
-                pair  = 0.0
-            else:
-                i0=max(numpy.nonzero(xcom_data['energy'] <= ene)[0])
-                i1=min(numpy.nonzero(xcom_data['energy'] >= ene)[0])
-                if (i1 == i0) or (i0>i1):
-                    cohe=xcom_data['coherent'][i1]
-                    comp=xcom_data['compton'][i1]
-                    photo=xcom_data['photo'][i1]
-                    pair=xcom_data['pair'][i1]
-                else:
-                    if LOGLOG:
-                        A=xcom_data['energylog10'][i0]
-                        B=xcom_data['energylog10'][i1]
-                        logene = numpy.log10(ene)
-                        c2=(logene-A)/(B-A)
-                        c1=(B-logene)/(B-A)
-                    else:
-                        A=xcom_data['energy'][i0]
-                        B=xcom_data['energy'][i1]
-                        c2=(ene-A)/(B-A)
-                        c1=(B-ene)/(B-A)
-                    cohe= pow(10.0,c2*xcom_data['coherentlog10'][i1]+\
-                                   c1*xcom_data['coherentlog10'][i0])
-                    comp= pow(10.0,c2*xcom_data['comptonlog10'][i1]+\
-                                   c1*xcom_data['comptonlog10'][i0])
-                    photo=pow(10.0,c2*xcom_data['photolog10'][i1]+\
-                                   c1*xcom_data['photolog10'][i0])
-                    if xcom_data['pair'][i1] > 0.0:
-                        c2 = c2*numpy.log10(xcom_data['pair'][i1])
-                        if xcom_data['pair'][i0] > 0.0:
-                            c1 = c1*numpy.log10(xcom_data['pair'][i0])
-                            pair = pow(10.0,c1+c2)
-                        else:
-                            pair =0.0
-                    else:
-                        pair =0.0
-            if eltindex == 0:
-                ddict['energy'].append(ene)
-                ddict['coherent'].append(cohe *fraction[eltindex])
-                ddict['compton'].append(comp *fraction[eltindex])
-                ddict['photo'].append(photo *fraction[eltindex])
-                ddict['pair'].append(pair*fraction[eltindex])
-                ddict['total'].append((cohe+comp+photo+pair)*fraction[eltindex])
-            else:
-                ddict['coherent'][eneindex] += cohe  *fraction[eltindex]
-                ddict['compton'] [eneindex] += comp  *fraction[eltindex]
-                ddict['photo']   [eneindex] += photo *fraction[eltindex]
-                ddict['pair']    [eneindex] += pair  *fraction[eltindex]
-                ddict['total']   [eneindex] += (cohe+comp+photo+pair) * fraction[eltindex]
-            eneindex += 1
-        eltindex += 1
-    return ddict
+    return _getMassAttenuationDict(list(zip(elts, fraction)), energy)
 
 def __materialInCompoundList(lst):
     for item in lst:
@@ -2452,85 +2585,9 @@ def getMaterialMassAttenuationCoefficients(compoundList0, fractionList0, energy0
         energy.sort()
 
     #I have the energy grid, the elements and their fractions
-    dict={}
-    dict['energy']   = []
-    dict['coherent'] = []
-    dict['compton']  = []
-    dict['photo']    = []
-    dict['pair']     = []
-    dict['total']    = []
-    eltindex = 0
-    for ele in materialElements.keys():
-        if 'xcom' in Element[ele]:
-            xcom_data = Element[ele]['xcom']
-        else:
-            xcom_data = getelementmassattcoef(ele,None)
-        #now I have to interpolate at the different energies
-        if (type(energy) != type([])):
-            energy =[energy]
-        eneindex = 0
-        for ene in energy:
-            if ene < 1.0:
-                if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                    #make sure the binding energies are those used by this module and not EADL ones
-                    PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                          Element[ele]['binding'])
-                tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-                cohe  = tmpDict['coherent'][0]
-                comp  = tmpDict['compton'][0]
-                photo = tmpDict['photo'][0]
-                pair  = 0.0
-            else:
-                i0=max(numpy.nonzero(xcom_data['energy'] <= ene)[0])
-                i1=min(numpy.nonzero(xcom_data['energy'] >= ene)[0])
-                if (i1 == i0) or (i0>i1):
-                    cohe=xcom_data['coherent'][i1]
-                    comp=xcom_data['compton'][i1]
-                    photo=xcom_data['photo'][i1]
-                    pair=xcom_data['pair'][i1]
-                else:
-                    if LOGLOG:
-                        A=xcom_data['energylog10'][i0]
-                        B=xcom_data['energylog10'][i1]
-                        logene = numpy.log10(ene)
-                        c2=(logene-A)/(B-A)
-                        c1=(B-logene)/(B-A)
-                    else:
-                        A=xcom_data['energy'][i0]
-                        B=xcom_data['energy'][i1]
-                        c2=(ene-A)/(B-A)
-                        c1=(B-ene)/(B-A)
-                    cohe= pow(10.0,c2*xcom_data['coherentlog10'][i1]+\
-                                   c1*xcom_data['coherentlog10'][i0])
-                    comp= pow(10.0,c2*xcom_data['comptonlog10'][i1]+\
-                                   c1*xcom_data['comptonlog10'][i0])
-                    photo=pow(10.0,c2*xcom_data['photolog10'][i1]+\
-                                   c1*xcom_data['photolog10'][i0])
-                    if xcom_data['pair'][i1] > 0.0:
-                        c2 = c2*numpy.log10(xcom_data['pair'][i1])
-                        if xcom_data['pair'][i0] > 0.0:
-                            c1 = c1*numpy.log10(xcom_data['pair'][i0])
-                            pair = pow(10.0,c1+c2)
-                        else:
-                            pair =0.0
-                    else:
-                        pair =0.0
-            if eltindex == 0:
-                dict['energy'].append(ene)
-                dict['coherent'].append(cohe * materialElements[ele])
-                dict['compton'].append(comp * materialElements[ele])
-                dict['photo'].append(photo * materialElements[ele])
-                dict['pair'].append(pair* materialElements[ele])
-                dict['total'].append((cohe+comp+photo+pair)* materialElements[ele])
-            else:
-                dict['coherent'][eneindex] += cohe  * materialElements[ele]
-                dict['compton'] [eneindex] += comp  * materialElements[ele]
-                dict['photo']   [eneindex] += photo * materialElements[ele]
-                dict['pair']    [eneindex] += pair  * materialElements[ele]
-                dict['total']   [eneindex] += (cohe+comp+photo+pair) *  materialElements[ele]
-            eneindex += 1
-        eltindex += 1
-    return dict
+    composition = [(ele, materialElements[ele]) \
+                   for ele in materialElements.keys()]
+    return _getMassAttenuationDict(composition, energy)
 
 
 def getcandidates(energy,threshold=None,targetrays=None):
@@ -2736,69 +2793,9 @@ def getelementmassattcoef(ele,energy=None):
 
     if energy is None:
         return  Element[ele]['xcom']
-    ddict={}
-    ddict['energy']   = []
-    ddict['coherent'] = []
-    ddict['compton']  = []
-    ddict['photo']    = []
-    ddict['pair']     = []
-    ddict['total']    = []
     if not hasattr(energy, "__len__"):
         energy =[energy]
-    for ene in energy:
-        if ene < 1.0:
-            if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                #make sure the binding energies are those used by this module and not EADL ones
-                PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                      Element[ele]['binding'])
-            tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-            cohe  = tmpDict['coherent'][0]
-            comp  = tmpDict['compton'][0]
-            photo = tmpDict['photo'][0]
-            pair  = 0.0
-        else:
-            i0=max(numpy.nonzero(Element[ele]['xcom']['energy'] <= ene)[0])
-            i1=min(numpy.nonzero(Element[ele]['xcom']['energy'] >= ene)[0])
-            if i1 <= i0:
-                cohe=Element[ele]['xcom']['coherent'][i1]
-                comp=Element[ele]['xcom']['compton'][i1]
-                photo=Element[ele]['xcom']['photo'][i1]
-                pair=Element[ele]['xcom']['pair'][i1]
-            else:
-                if LOGLOG:
-                    A=Element[ele]['xcom']['energylog10'][i0]
-                    B=Element[ele]['xcom']['energylog10'][i1]
-                    logene = numpy.log10(ene)
-                    c2=(logene-A)/(B-A)
-                    c1=(B-logene)/(B-A)
-                else:
-                    A=Element[ele]['xcom']['energy'][i0]
-                    B=Element[ele]['xcom']['energy'][i1]
-                    c2=(ene-A)/(B-A)
-                    c1=(B-ene)/(B-A)
-
-                cohe= pow(10.0,c2*Element[ele]['xcom']['coherentlog10'][i1]+\
-                               c1*Element[ele]['xcom']['coherentlog10'][i0])
-                comp= pow(10.0,c2*Element[ele]['xcom']['comptonlog10'][i1]+\
-                               c1*Element[ele]['xcom']['comptonlog10'][i0])
-                photo=pow(10.0,c2*Element[ele]['xcom']['photolog10'][i1]+\
-                               c1*Element[ele]['xcom']['photolog10'][i0])
-                if Element[ele]['xcom']['pair'][i1] > 0.0:
-                    c2 = c2*numpy.log10(Element[ele]['xcom']['pair'][i1])
-                    if Element[ele]['xcom']['pair'][i0] > 0.0:
-                        c1 = c1*numpy.log10(Element[ele]['xcom']['pair'][i0])
-                        pair = pow(10.0,c1+c2)
-                    else:
-                        pair =0.0
-                else:
-                    pair =0.0
-        ddict['energy'].append(ene)
-        ddict['coherent'].append(cohe)
-        ddict['compton'].append(comp)
-        ddict['photo'].append(photo)
-        ddict['pair'].append(pair)
-        ddict['total'].append(cohe+comp+photo+pair)
-    return ddict
+    return _getMassAttenuationDict([(ele, 1.0)], energy)
 
 def getElementLShellRates(symbol,energy=None,photoweights = None):
     """
@@ -2872,6 +2869,7 @@ def getElementMShellRates(symbol,energy=None, photoweights = None):
     return shellrates
 
 
+@_cachedFluorescence
 def _getUnfilteredElementDict(symbol, energy, photoweights=None):
     if photoweights == None:photoweights = False
     ddict = {}
@@ -2985,15 +2983,77 @@ def _updateElementDict(symbol, dict, energy=None, minenergy=MINENERGY, minrate=0
     dict['buildparameters']['minenergy'] = minenergy
     dict['buildparameters']['minrate']   = minrate
 
+# serializes the updates of the element dictionaries
+_elementLock = threading.RLock()
+
+class _ElementDict(dict):
+    """
+    Element dictionary. The x-ray lines requested by updateDict are only
+    calculated when the dictionary is used.
+    """
+    def __init__(self, symbol):
+        dict.__init__(self)
+        self._symbol = symbol
+        self._pendingUpdate = None
+        self._updating = False
+
+    def _setPendingUpdate(self, **kw):
+        with _elementLock:
+            self._pendingUpdate = kw
+            # the methods apply the update before doing anything else
+            self.__class__ = _PendingElementDict
+
+class _PendingElementDict(_ElementDict):
+    def _update(self):
+        with _elementLock:
+            kw = self._pendingUpdate
+            if (kw is None) or self._updating:
+                # already done or being done by this thread
+                return
+            self._updating = True
+            try:
+                _updateElementDict(self._symbol, self, **kw)
+                self._pendingUpdate = None
+                self.__class__ = _ElementDict
+            finally:
+                self._updating = False
+            # discard what was calculated with the partially updated data
+            _clearCaches()
+
+    def __reduce_ex__(self, protocol):
+        self._update()
+        return self.__reduce_ex__(protocol)
+
+def _updatingMethod(name):
+    method = getattr(dict, name)
+    def wrapper(self, *var, **kw):
+        self._update()
+        return method(self, *var, **kw)
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ['__getitem__', '__setitem__', '__delitem__', '__contains__',
+              '__iter__', '__len__', '__repr__', '__eq__', '__ne__',
+              'get', 'keys', 'items', 'values', 'copy', 'pop', 'popitem',
+              'setdefault', 'update', 'clear', 'has_key', 'iterkeys',
+              'iteritems', 'itervalues']:
+    if hasattr(dict, _name):
+        setattr(_PendingElementDict, _name, _updatingMethod(_name))
+del _name
+
 def updateDict(energy=None, minenergy=MINENERGY, minrate=0.0010, cb=True):
+    # the elements are updated on first use
     for ele in ElementList:
-        _updateElementDict(ele, Element[ele], energy=energy, minenergy=minenergy, minrate=minrate)
+        Element[ele]._setPendingUpdate(energy=energy, minenergy=minenergy,
+                                       minrate=minrate)
     if cb:
         _updateCallback()
+    else:
+        # the cached values depend on the element data
+        _clearCaches()
     return
 
 def _getMaterialDict():
-    cDict = ConfigDict.ConfigDict()
     dirmod = PyMcaDataDir.PYMCA_DATA_DIR
     matdict = os.path.join(dirmod,"attdata")
     matdict = os.path.join(matdict,"MATERIALS.DICT")
@@ -3011,8 +3071,7 @@ def _getMaterialDict():
         print("Cannot find file ", matdict)
         #raise IOError("Cannot find %s" % matdict)
         return {}
-    cDict.read(matdict)
-    return cDict
+    return ConfigDictCache.readConfigDict(matdict)
 
 class BoundMethodWeakref:
     """Helper class to get a weakref to a bound method"""
@@ -3022,8 +3081,8 @@ def remove(ref):
                 self.deleteCb(self)
 
         self.deleteCb = onDelete
-        self.func_ref = weakref.ref(bound_method.im_func, remove)
-        self.obj_ref = weakref.ref(bound_method.im_self, remove)
+        self.func_ref = weakref.ref(bound_method.__func__, remove)
+        self.obj_ref = weakref.ref(bound_method.__self__, remove)
 
     def __call__(self):
         obj = self.obj_ref()
@@ -3051,7 +3110,8 @@ def delCallback(ref):
         except:
             pass
 
-    if hasattr(callback, 'im_self') and callback.im_self is not None:
+    if hasattr(callback, '__func__') and \
+       getattr(callback, '__self__', None) is not None:
         ref = BoundMethodWeakref(callback, delCallback)
     else:
         # function weakref
@@ -3062,16 +3122,18 @@ def delCallback(ref):
 
 
 def _updateCallback():
-    for methodref in _registeredCallbacks:
+    for methodref in _registeredCallbacks[:]:
         method = methodref()
         if method is not None:
             method()
 
+registerUpdate(_clearCaches)
+
 
 Element={}
 for ele in ElementList:
     z = getz(ele)
-    Element[ele]={}
+    Element[ele]=_ElementDict(ele)
     Element[ele]['Z']       = z
     Element[ele]['name']    = ElementsInfo[z-1][4]
     Element[ele]['mass']    = ElementsInfo[z-1][5]
@@ -32,16 +32,86 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import os
 import numpy
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from PyMca5.PyMcaMath.linalg import lstsq
 from . import ClassMcaTheory
-from PyMca5.PyMcaMath.fitting import Gefit
 from . import ConcentrationsTool
-from PyMca5.PyMcaMath.fitting import SpecfitFuns
+from PyMca5.PyMcaMath import SNIPModule
 from PyMca5.PyMcaIO import ConfigDict
+from PyMca5.PyMcaIO import EDFStack
 import time
 
 DEBUG = 0
 
+# maximum number of bytes of data to be read at once
+MAX_MEMORY = 256 * 1024 * 1024
+
+# fit context of the worker processes
+_WORKER_CONTEXT = {}
+
+def _initializeWorker(context):
+    _WORKER_CONTEXT.clear()
+    _WORKER_CONTEXT.update(context)
+
+def _fitChunkInWorker(task):
+    return _fitChunk(task, _WORKER_CONTEXT)
+
+def _stripBackground(spectra, context):
+    """
+    Subtract the SNIP background from each of the columns of spectra.
+    """
+    spectra -= SNIPModule.getMultipleSpectraBackground(spectra,
+                                        context['snipwidth'],
+                                        context['stripfilterwidth'],
+                                        context['anchorslist'],
+                                        index=0)
+
+def _fitChunk(task, context):
+    """
+    Fit a chunk of spectra (channels x spectra) of row i starting at
+    column jStart. Returns the row and column indices together with the
+    fitted parameters and uncertainties.
+    """
+    i, jStart, jEnd, chunk = task
+    if context['stripflag']:
+        _stripBackground(chunk, context)
+    ddict = lstsq(context['derivatives'], chunk,
+                  sigma_b=context['sigma_b'],
+                  weight=context['weight'],
+                  digested_output=True,
+                  svd=context['svd'],
+                  last_svd=context['last_svd'])
+    # the decomposition of the model matrix does not change between chunks
+    if context['last_svd'] is None:
+        context['last_svd'] = ddict.get('svd', None)
+    return i, jStart, jEnd, ddict['parameters'], ddict['uncertainties']
+
+def _getBlockList(nRows, nColumns, spectrumSize, maxMemory):
+    """
+    Split the map in blocks of complete rows (or of columns of a single
+    row if a row does not fit) of at most maxMemory bytes.
+    """
+    blockList = []
+    nSpectra = max(1, int(maxMemory / max(spectrumSize, 1)))
+    if nSpectra >= nColumns:
+        rowStep = int(nSpectra / nColumns)
+        for iStart in range(0, nRows, rowStep):
+            blockList.append((iStart, min(iStart + rowStep, nRows),
+                              0, nColumns))
+    else:
+        for iStart in range(nRows):
+            for jStart in range(0, nColumns, nSpectra):
+                blockList.append((iStart, iStart + 1,
+                                  jStart, min(jStart + nSpectra, nColumns)))
+    return blockList
+
+def _storeChunkResult(chunkResult, results, uncertainties):
+    i, jStart, jEnd, parameters, sigmas = chunkResult
+    results[:, i, jStart:jEnd] = parameters
+    uncertainties[:, i, jStart:jEnd] = sigmas
+
 class FastXRFLinearFit(object):
     def __init__(self, mcafit=None):
         self._config = None
@@ -62,7 +132,27 @@ def setFitConfigurationFile(self, ffile):
 
     def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                            configuration=None, concentrations=False,
-                           ysum=None, weight=None):
+                           ysum=None, weight=None, workers=1, processes=False,
+                           maxMemory=None):
+        """
+        Fit all the spectra of a 3D stack using a linear fit.
+
+        workers: Number of workers used to fit the chunks of spectra. One
+                 means serial execution in the calling thread and a value
+                 less than one means one worker per available CPU.
+        processes: If True, the chunks are distributed to a pool of
+                   processes instead of a pool of threads.
+        maxMemory: Maximum number of bytes of data to be read at once. If
+                   None, the module MAX_MEMORY value is used.
+
+        y can be a 3D array, an h5py dataset, a DataObject or a list of
+        EDF files containing one row of the map each. The data are read in
+        blocks limited by maxMemory, so they do not need to fit in memory.
+
+        The secondary fits of the pixels with negative areas are always
+        performed serially after all the chunks have been fitted in order
+        to keep the result independent of the number of workers.
+        """
         if y is None:
             raise RuntimeError("y keyword argument is mandatory!")
 
@@ -129,6 +219,10 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         if hasattr(y, "info") and hasattr(y, "data"):
             data = y.data
             mcaIndex = y.info.get("McaIndex", -1)
+        elif isinstance(y, list):
+            # list of EDF files, one row of the map per file
+            data = EDFStack.EDFFileListData(y)
+            mcaIndex = -1
         else:
             data = y
             mcaIndex = -1
@@ -212,8 +306,8 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         #loop for anchors
         xdata = self._mcaTheory.xdata
 
+        anchorslist = []
         if config['fit']['stripflag']:
-            anchorslist = []
             if config['fit']['stripanchorsflag']:
                 if config['fit']['stripanchorslist'] is not None:
                     ravelled = numpy.ravel(xdata)
@@ -233,8 +327,8 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         # TODO: check for original ordering.
         if x is None:
             # we have an enumerated channels axis
-            iXMin = xdata[0]
-            iXMax = xdata[-1]
+            iXMin = int(xdata[0])
+            iXMax = int(xdata[-1])
         else:
             iXMin = numpy.nonzero(x <= xdata[0])[0][-1]
             iXMax = numpy.nonzero(x >= xdata[-1])[0][0]
@@ -262,53 +356,71 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         else:
             SVD = True
             sigma_b = None
-        last_svd = None
-        for i in range(0, data.shape[0]):
-            #print(i)
-            #chunks of nColumns spectra
-            if i == 0:
-                chunk = numpy.zeros((dummySpectrum.shape[0],
-                                     jStep),
-                                     numpy.float)
-            jStart = 0
-            while jStart < data.shape[1]:
-                jEnd = min(jStart + jStep, data.shape[1])
-                chunk[:,:(jEnd - jStart)] = data[i, jStart:jEnd, iXMin:iXMax+1].T
-                if config['fit']['stripflag']:
-                    for k in range(jStep):
-                        # obtain the smoothed spectrum
-                        background=SpecfitFuns.SavitskyGolay(chunk[:, k],
-                                                config['fit']['stripfilterwidth'])
-                        lastAnchor = 0
-                        for anchor in anchorslist:
-                            if (anchor > lastAnchor) and (anchor < background.size):
-                                background[lastAnchor:anchor] =\
-                                        SpecfitFuns.snip1d(background[lastAnchor:anchor],
-                                                           config['fit']['snipwidth'],
-                                                           0)
-                                lastAnchor = anchor
-                        if lastAnchor < background.size:
-                            background[lastAnchor:] =\
-                                    SpecfitFuns.snip1d(background[lastAnchor:],
-                                                       config['fit']['snipwidth'],
-                                                       0)
-                        chunk[:, k] -= background
-
-                # perform the multiple fit to all the spectra in the chunk
-                #print("SHAPES")
-                #print(derivatives.shape)
-                #print(chunk[:,:(jEnd - jStart)].shape)
-                ddict=lstsq(derivatives, chunk[:,:(jEnd - jStart)],
-                            sigma_b=sigma_b,
-                            weight=weight,
-                            digested_output=True,
-                            svd=SVD,
-                            last_svd=last_svd)
-                last_svd = ddict.get('svd', None)
-                parameters = ddict['parameters']
-                results[:, i, jStart:jEnd] = parameters
-                uncertainties[:, i, jStart:jEnd] = ddict['uncertainties']
-                jStart = jEnd
+        context = {'derivatives': derivatives,
+                   'sigma_b': sigma_b,
+                   'weight': weight,
+                   'svd': SVD,
+                   'last_svd': None,
+                   'stripflag': config['fit']['stripflag'],
+                   'stripfilterwidth': config['fit']['stripfilterwidth'],
+                   'snipwidth': config['fit']['snipwidth'],
+                   'anchorslist': anchorslist}
+        if workers is None:
+            workers = 1
+        elif workers < 1:
+            workers = multiprocessing.cpu_count()
+        if workers > 1:
+            if processes:
+                pool = multiprocessing.Pool(workers,
+                                            initializer=_initializeWorker,
+                                            initargs=(context,))
+            else:
+                pool = ThreadPool(workers)
+        else:
+            pool = None
+        # the data are read in blocks of rows (or columns) whose size
+        # is limited by the memory budget
+        if maxMemory is None:
+            maxMemory = MAX_MEMORY
+        blockList = _getBlockList(nRows, nColumns,
+                                  (iXMax + 1 - iXMin) * numpy.dtype(data.dtype).itemsize,
+                                  maxMemory)
+        try:
+            # keep a bounded number of chunks in flight so that memory
+            # usage does not depend on the size of the map
+            pending = collections.deque()
+            for iStart, iEnd, jBlockStart, jBlockEnd in blockList:
+                block = data[iStart:iEnd, jBlockStart:jBlockEnd, iXMin:iXMax+1]
+                for i in range(iStart, iEnd):
+                    jStart = jBlockStart
+                    while jStart < jBlockEnd:
+                        jEnd = min(jStart + jStep, jBlockEnd)
+                        chunk = numpy.array(block[i - iStart,
+                                                  (jStart - jBlockStart):(jEnd - jBlockStart)].T,
+                                            dtype=numpy.float)
+                        task = (i, jStart, jEnd, chunk)
+                        if pool is None:
+                            _storeChunkResult(_fitChunk(task, context),
+                                              results, uncertainties)
+                        else:
+                            if processes:
+                                pending.append(pool.apply_async(_fitChunkInWorker,
+                                                                (task,)))
+                            else:
+                                pending.append(pool.apply_async(_fitChunk,
+                                                                (task, context)))
+                            if len(pending) >= (2 * workers):
+                                _storeChunkResult(pending.popleft().get(),
+                                                  results, uncertainties)
+                        jStart = jEnd
+                block = None
+            while len(pending):
+                _storeChunkResult(pending.popleft().get(),
+                                  results, uncertainties)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
         if DEBUG:
             t = time.time() - t0
             print("First fit elapsed = %f" % t)
@@ -371,44 +483,32 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                     print("Number of secondary fits = %d" % (nFits + 1))
                 nFits += 1
                 A = derivatives[:, [i for i in range(nFree) if i not in badParameters]]
-                #assume we'll not have too many spectra
-                spectra = data[badMask, iXMin:iXMax+1]
-                spectra.shape = badMask.sum(), -1
-                spectra = spectra.T
-                #
-                if config['fit']['stripflag']:
-                    for k in range(spectra.shape[1]):
-                        # obtain the smoothed spectrum
-                        background=SpecfitFuns.SavitskyGolay(spectra[:, k],
-                                                config['fit']['stripfilterwidth'])
-                        lastAnchor = 0
-                        for anchor in anchorslist:
-                            if (anchor > lastAnchor) and (anchor < background.size):
-                                background[lastAnchor:anchor] =\
-                                        SpecfitFuns.snip1d(background[lastAnchor:anchor],
-                                                           config['fit']['snipwidth'],
-                                                           0)
-                                lastAnchor = anchor
-                        if lastAnchor < background.size:
-                            background[lastAnchor:] =\
-                                    SpecfitFuns.snip1d(background[lastAnchor:],
-                                                       config['fit']['snipwidth'],
-                                                       0)
-                    spectra[:, k] -= background
-                ddict = lstsq(A, spectra,
-                              sigma_b=sigma_b,
-                              weight=weight,
-                              digested_output=True,
-                              svd=SVD)
-                idx = 0
-                for i in range(nFree):
-                    if i in badParameters:
-                        results[i][badMask] = 0.0
-                        uncertainties[i][badMask] = 0.0
-                    else:
-                        results[i][badMask] = ddict['parameters'][idx]
-                        uncertainties[i][badMask] = ddict['uncertainties'][idx]
-                        idx += 1
+                # only read the blocks containing pixels to be fitted
+                for iStart, iEnd, jStart, jEnd in blockList:
+                    blockMask = badMask[iStart:iEnd, jStart:jEnd]
+                    if not blockMask.any():
+                        continue
+                    block = data[iStart:iEnd, jStart:jEnd, iXMin:iXMax+1]
+                    spectra = numpy.array(block[blockMask].T, dtype=numpy.float)
+                    block = None
+                    if config['fit']['stripflag']:
+                        _stripBackground(spectra, context)
+                    ddict = lstsq(A, spectra,
+                                  sigma_b=sigma_b,
+                                  weight=weight,
+                                  digested_output=True,
+                                  svd=SVD)
+                    idx = 0
+                    for i in range(nFree):
+                        if i in badParameters:
+                            results[i, iStart:iEnd, jStart:jEnd][blockMask] = 0.0
+                            uncertainties[i, iStart:iEnd, jStart:jEnd][blockMask] = 0.0
+                        else:
+                            results[i, iStart:iEnd, jStart:jEnd][blockMask] = \
+                                                    ddict['parameters'][idx]
+                            uncertainties[i, iStart:iEnd, jStart:jEnd][blockMask] = \
+                                                    ddict['uncertainties'][idx]
+                            idx += 1
 
         if DEBUG:
             t = time.time() - t0
@@ -418,128 +518,42 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         outputDict = {'parameters':results, 'uncertainties':uncertainties, 'names':freeNames}
 
         if concentrations:
-            # check if an internal reference is used and if it is set to auto
             ####################################################
             # CONCENTRATIONS
             cTool = ConcentrationsTool.ConcentrationsTool()
             cToolConf = cTool.configure()
             cToolConf.update(config['concentrations'])
 
-            fitFirstSpectrum = False
-            if config['concentrations']['usematrix']:
-                if DEBUG:
-                    print("USING MATRIX")
-                if config['concentrations']['reference'].upper() == "AUTO":
-                    fitFirstSpectrum = True
-
-            fitresult = {}
-            if fitFirstSpectrum:
-                # we have to fit the "reference" spectrum just to get the reference element
-                mcafitresult = self._mcaTheory.startfit(digest=0, linear=True)
-                # if one of the elements has zero area this cannot be made directly
-                fitresult['result'] = self._mcaTheory.imagingDigestResult()
-                fitresult['result']['config'] = config
-                concentrationsResult, addInfo = cTool.processFitResult(config=cToolConf,
-                                                    fitresult=fitresult,
-                                                    elementsfrommatrix=False,
-                                                    fluorates=self._mcaTheory._fluoRates,
-                                                    addinfo=True)
-                # and we have to make sure that all the areas are positive
-                for group in fitresult['result']['groups']:
-                    if fitresult['result'][group]['fitarea'] <= 0.0:
-                        # give a tiny area
-                        fitresult['result'][group]['fitarea'] = 1.0e-6
-                config['concentrations']['reference'] = addInfo['ReferenceElement']
-            else:
-                fitresult['result'] = {}
-                fitresult['result']['config'] = config
-                fitresult['result']['groups'] = []
-                idx = 0
-                for i, param in enumerate(self._mcaTheory.PARAMETERS):
-                    if self._mcaTheory.codes[0][i] == Gefit.CFIXED:
-                        continue
-                    if i < self._mcaTheory.NGLOBAL:
-                        # background
-                        pass
-                    else:
-                        fitresult['result']['groups'].append(param)
-                        fitresult['result'][param] = {}
-                        # we are just interested on the factor to be applied to the area to get the
-                        # concentrations
-                        fitresult['result'][param]['fitarea'] = 1.0
-                        fitresult['result'][param]['sigmaarea'] = 1.0
-                    idx += 1
-            concentrationsResult, addInfo = cTool.processFitResult(config=cToolConf,
-                                                    fitresult=fitresult,
-                                                    elementsfrommatrix=False,
-                                                    fluorates=self._mcaTheory._fluoRates,
-                                                    addinfo=True)
+            # the internal reference and the matrix updates of the single
+            # layer strategy are handled pixel by pixel
+            groupsList = freeNames[nFreeBackgroundParameters:]
+            areas = {}
+            for i, group in enumerate(groupsList):
+                areas[group] = results[nFreeBackgroundParameters + i]
+            concentrationsResult = cTool.processAreaImages(areas,
+                                        config,
+                                        config=cToolConf,
+                                        groups=groupsList,
+                                        fluorates=self._mcaTheory._fluoRates)
+            layerlist = concentrationsResult['layerlist']
             nValues = 1
-            if len(concentrationsResult['layerlist']) > 1:
-                nValues += len(concentrationsResult['layerlist'])
-            nElements = len(list(concentrationsResult['mass fraction'].keys()))
+            if len(layerlist) > 1:
+                nValues += len(layerlist)
+            nElements = len(concentrationsResult['groups'])
             massFractions = numpy.zeros((nValues * nElements, nRows, nColumns),
                                         numpy.float32)
-
-
-            referenceElement = addInfo['ReferenceElement']
-            referenceTransitions = addInfo['ReferenceTransitions']
-            if DEBUG:
-                print("Reference <%s>  transition <%s>" % (referenceElement, referenceTransitions))
-            if referenceElement in ["", None, "None"]:
-                if DEBUG:
-                    print("No reference")
-                counter = 0
-                for i, group in enumerate(fitresult['result']['groups']):
-                    if group.lower().startswith("scatter"):
-                        if DEBUG:
-                            print("skept %s" % group)
-                        continue
-                    outputDict['names'].append("C(%s)" % group)
-                    massFractions[counter] = results[nFreeBackgroundParameters+i] *\
-                        (concentrationsResult['mass fraction'][group]/fitresult['result'][param]['fitarea'])
-                    if len(concentrationsResult['layerlist']) > 1:
-                        for layer in concentrationsResult['layerlist']:
-                            outputDict['names'].append("C(%s)-%s" % (group, layer))
-                            massFractions[counter] = results[nFreeBackgroundParameters+i] *\
-                        (concentrationsResult[layer]['mass fraction'][group]/fitresult['result'][param]['fitarea'])
-            else:
-                if DEBUG:
-                    print("With reference")
-                idx = None
-                testGroup = referenceElement+ " " + referenceTransitions.split()[0]
-                for i, group in enumerate(fitresult['result']['groups']):
-                    if group == testGroup:
-                        idx = i
-                if idx is None:
-                    raise ValueError("Invalid reference:  <%s> <%s>" %\
-                                     (referenceElement, referenceTransitions))
-
-                group = fitresult['result']['groups'][idx]
-                referenceArea = fitresult['result'][group]['fitarea']
-                referenceConcentrations = concentrationsResult['mass fraction'][group]
-                goodIdx = results[nFreeBackgroundParameters+idx] > 0
-                massFractions[idx] = referenceConcentrations
-                counter = 0
-                for i, group in enumerate(fitresult['result']['groups']):
-                    if group.lower().startswith("scatter"):
-                        if DEBUG:
-                            print("skept %s" % group)
-                        continue
-                    outputDict['names'].append("C(%s)" % group)
-                    if i == idx:
-                        continue
-                    goodI = results[nFreeBackgroundParameters+i] > 0
-                    tmp = results[nFreeBackgroundParameters+idx][goodI]
-                    massFractions[i][goodI] = (results[nFreeBackgroundParameters+i][goodI]/(tmp + (tmp == 0))) *\
-                                ((referenceArea/fitresult['result'][group]['fitarea']) *\
-                                (concentrationsResult['mass fraction'][group]))
-                    if len(concentrationsResult['layerlist']) > 1:
-                        for layer in concentrationsResult['layerlist']:
-                            outputDict['names'].append("C(%s)-%s" % (group, layer))
-                            massFractions[i][goodI] = (results[nFreeBackgroundParameters+i][goodI]/(tmp + (tmp == 0))) *\
-                                ((referenceArea/fitresult['result'][group]['fitarea']) *\
-                                (concentrationsResult[layer]['mass fraction'][group]))
+            counter = 0
+            for group in concentrationsResult['groups']:
+                outputDict['names'].append("C(%s)" % group)
+                massFractions[counter] = \
+                                concentrationsResult['mass fraction'][group]
+                counter += 1
+                if len(layerlist) > 1:
+                    for layer in layerlist:
+                        outputDict['names'].append("C(%s)-%s" % (group, layer))
+                        massFractions[counter] = \
+                                concentrationsResult[layer]['mass fraction'][group]
+                        counter += 1
             outputDict['concentrations'] = massFractions
             if DEBUG:
                 t = time.time() - t0
@@ -552,7 +566,6 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
 if __name__ == "__main__":
     DEBUG = True
     import glob
-    from PyMca.PyMcaIO import EDFStack
     if 1:
         #configurationFile = "G4-4720eV-NOWEIGHT-NO_Constant-batch.cfg"
         configurationFile = "G4-4720eV-WEIGHT-NO_Constant-batch.cfg"
@@ -32,7 +32,7 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import os
 import numpy
-from PyMca5.PyMcaIO import ConfigDict
+from PyMca5.PyMcaIO import ConfigDictCache
 from PyMca5 import PyMcaDataDir
 
 ElementList= ['H','He','Li','Be','B','C','N','O','F','Ne',
@@ -62,8 +62,7 @@
         print("Cannot find file ", ffile)
         raise IOError("Cannot find file %s" % ffile)
 
-COEFFICIENTS = ConfigDict.ConfigDict()
-COEFFICIENTS.read(ffile)
+COEFFICIENTS = ConfigDictCache.readConfigDict(ffile, lazy=True)
 xvalues = COEFFICIENTS['ISCADT']['XSVAL']
 svalues = numpy.reshape(COEFFICIENTS['ISCADT']['SCATF'], (100, len(xvalues)))
 #svalues = COEFFICIENTS['ISCADT']['SCATF']
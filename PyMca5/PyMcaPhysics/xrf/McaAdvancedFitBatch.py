@@ -33,8 +33,12 @@
 import sys
 import os
 import numpy
+import hashlib
+import collections
+import multiprocessing
 from . import ClassMcaTheory
 from PyMca5.PyMcaCore import SpecFileLayer
+from PyMca5.PyMcaCore import SpecFileDataSource
 from PyMca5.PyMcaCore import EdfFileLayer
 from PyMca5.PyMcaIO import EdfFile
 from PyMca5.PyMcaIO import LuciaMap
@@ -43,12 +47,140 @@
 try:
     import h5py
     from PyMca5.PyMcaIO import HDF5Stack1D
+    from PyMca5.PyMcaIO import BatchHDF5Output
     HDF5SUPPORT = True
 except ImportError:
     HDF5SUPPORT = False
 from PyMca5.PyMcaIO import ConfigDict
 from . import ConcentrationsTool
 
+# fit engine of the worker processes
+_WORKER_FIT = {}
+# number of spectra of a SPEC scan read at once
+MCA_BLOCK_SIZE = 1024
+
+def _md5():
+    try:
+        # not used for security, allowed on FIPS systems
+        return hashlib.md5(usedforsecurity=False)
+    except TypeError:
+        return hashlib.md5()
+
+def _updateHash(h, item):
+    # independent of the order of the dictionary keys
+    if isinstance(item, dict):
+        for key in sorted(item.keys(), key=str):
+            _updateHash(h, key)
+            _updateHash(h, item[key])
+    elif isinstance(item, (list, tuple)):
+        h.update(b"[")
+        for value in item:
+            _updateHash(h, value)
+        h.update(b"]")
+    elif isinstance(item, numpy.ndarray):
+        _updateHash(h, item.tolist())
+    else:
+        h.update(repr(item).encode('utf-8'))
+
+def _initializeWorker(config, concentrations):
+    mcafit = ClassMcaTheory.McaTheory(config)
+    mcafit.enableOptimizedLinearFit()
+    _WORKER_FIT['mcafit'] = mcafit
+    _WORKER_FIT['config'] = config
+    if concentrations:
+        _WORKER_FIT['tool'] = ConcentrationsTool.ConcentrationsTool()
+    else:
+        _WORKER_FIT['tool'] = None
+
+def _fitMcaInWorker(task):
+    x, y, info, fitfiles, concentrations, outfile = task
+    mcafit = _WORKER_FIT['mcafit']
+    try:
+        return _fitMca(mcafit, _WORKER_FIT['tool'], x, y, info,
+                       fitfiles, concentrations, outfile)
+    except:
+        if mcafit.config['fit'].get("strategyflag", False):
+            mcafit.configure(_WORKER_FIT['config'])
+        raise
+
+def _fitMca(mcafit, tool, x, y, info, fitfiles, concentrations, outfile):
+    """
+    Fit one spectrum with the given McaTheory instance and return the
+    digested fit result and the concentrations (None if not requested).
+    If fitfiles is set, the result is also written to outfile.
+    """
+    result = None
+    concentrationsdone = 0
+    concentrationsResult = None
+    #I make sure I take the fit limits configuration
+    mcafit.config['fit']['use_limit'] = 1
+    mcafit.setData(x, y, time=info.get("McaLiveTime", None))
+    mcafit.estimate()
+    if fitfiles:
+        fitresult, result = mcafit.startfit(digest=1)
+    elif concentrations and (mcafit._fluoRates is None):
+        fitresult, result = mcafit.startfit(digest=1)
+    elif concentrations:
+        fitresult = mcafit.startfit(digest=0)
+        try:
+            fitresult0 = {}
+            fitresult0['fitresult'] = fitresult
+            fitresult0['result'] = mcafit.imagingDigestResult()
+            fitresult0['result']['config'] = mcafit.config
+            result = fitresult0['result']
+            conf = mcafit.configure()
+            tconf = tool.configure()
+            if 'concentrations' in conf:
+                tconf.update(conf['concentrations'])
+            else:
+                #what to do?
+                pass
+            concentrationsResult = tool.processFitResult(config=tconf,
+                                fitresult=fitresult0,
+                                elementsfrommatrix=False,
+                                fluorates = mcafit._fluoRates)
+        except:
+            print("error in concentrations")
+            print(sys.exc_info()[0:-1])
+        concentrationsdone = True
+    else:
+        #just images
+        fitresult = mcafit.startfit(digest=0)
+    if concentrations and (concentrationsdone == 0):
+        if not ('concentrations' in result):
+            fitresult0={}
+            fitresult0['result']    = result
+            fitresult0['fitresult'] = fitresult
+            conf = mcafit.configure()
+            tconf = tool.configure()
+            if 'concentrations' in conf:
+                tconf.update(conf['concentrations'])
+            try:
+                concentrationsResult = tool.processFitResult(config=tconf,
+                                fitresult=fitresult0,
+                                elementsfrommatrix=False)
+            except:
+                print("error in concentrations")
+                print(sys.exc_info()[0:-1])
+    if fitfiles:
+        result = mcafit.digestresult(outfile=outfile, info=info)
+        if concentrationsResult is not None:
+            try:
+                f=ConfigDict.ConfigDict()
+                f.read(outfile)
+                f['concentrations'] = concentrationsResult
+                try:
+                    os.remove(outfile)
+                except:
+                    print("error deleting fit file")
+                f.write(outfile)
+            except:
+                print("Error writing concentrations to fit file")
+                print(sys.exc_info())
+    elif result is None:
+        result = mcafit.imagingDigestResult()
+    return result, concentrationsResult
+
 
 class McaAdvancedFitBatch(object):
     def __init__(self,initdict,filelist=None,outputdir=None,
@@ -57,7 +189,8 @@ def __init__(self,initdict,filelist=None,outputdir=None,
                     concentrations=0, fitfiles=1, fitimages=1,
                     filebeginoffset = 0, fileendoffset=0,
                     mcaoffset=0, chunk = None,
-                    selection=None, lock=None):
+                    selection=None, lock=None, workers=1,
+                    warmstart=False, hdf5output=False):
         #for the time being the concentrations are bound to the .fit files
         #that is not necessary, but it will be correctly implemented in
         #future releases
@@ -73,9 +206,30 @@ def __init__(self,initdict,filelist=None,outputdir=None,
             self.__currentConfig = 0
             self.mcafit = ClassMcaTheory.McaTheory(initdict)
         self.__concentrationsKeys = []
+        self._tool = None
         if self._concentrations:
             self._tool = ConcentrationsTool.ConcentrationsTool()
             self._toolConversion = ConcentrationsTool.ConcentrationsConversion()
+        # number of worker processes fitting the spectra
+        self._workers = workers
+        self._pool = None
+        self._pending = collections.deque()
+        # start the fits from the previously fitted spectra
+        self._warmStart = warmstart
+        self.__rowSeed = None
+        self.__firstInRow = False
+        # write the images to an HDF5 file as the rows are finished
+        self._hdf5Output = hdf5output
+        if hdf5output and not HDF5SUPPORT:
+            print("HDF5 output requires h5py. Not written.")
+            self._hdf5Output = False
+        self.__hdf5 = None
+        self.__lastRow = None
+        self.__finishedRows = set()
+        self.__checkpoint = None
+        self.__resuming = False
+        self.__listedFitFiles = set()
+        self.__configurationHash = ""
         self.setFileList(filelist)
         self.setOutputDir(outputdir)
         if fitimages:
@@ -155,6 +309,42 @@ def processList(self):
         self.counter =  0
         self.__row   = self.fileBeginOffset - 1
         self.__stack = None
+        self._pending.clear()
+        self.__lastRow = None
+        self.__finishedRows = set()
+        self.__checkpoint = None
+        self.__resuming = False
+        if self._hdf5Output and (not self.roiFit):
+            self.__configurationHash = self.getConfigurationHash()
+            self.__readCheckpoint()
+        # the text outputs of a resumed run are kept and completed
+        self.__resuming = self.__checkpoint is not None
+        if (self._workers > 1) and (not self.roiFit) and \
+           (len(self.__configList) == 1):
+            # all the workers share the same fit configuration
+            self._pool = multiprocessing.Pool(self._workers,
+                        initializer=_initializeWorker,
+                        initargs=(self.__configList[self.__currentConfig],
+                                  self._concentrations))
+            if self._warmStart:
+                # the seeds would depend on the scheduling of the workers
+                print("Warm start not used with several workers")
+        elif self._warmStart:
+            self.mcafit.enableWarmStart()
+            self.__rowSeed = None
+        try:
+            self.__processList()
+        finally:
+            if self.__hdf5 is not None:
+                self.__hdf5.close()
+                self.__hdf5 = None
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+                self._pending.clear()
+
+    def __processList(self):
         for i in range(0+self.fileBeginOffset,
                        len(self._filelist)-self.fileEndOffset,
                        self.fileStep):
@@ -167,6 +357,9 @@ def processList(self):
             inputfile   = self._filelist[i]
             self.__row += 1 #should be plus fileStep?
             self.onNewFile(inputfile, self._filelist)
+            if (self.__stack is False) and (self.__row in self.__finishedRows):
+                # already fitted by a previous run
+                continue
             self.file = self.getFileHandle(inputfile)
             if self.pleaseBreak: break
             if self.__stack is None:
@@ -181,15 +374,25 @@ def processList(self):
                 if self._HDF5:
                     # The complete stack has been analyzed
                     break
-            else:
+            elif self.__row not in self.__finishedRows:
                 self.__processOneFile()
+        self.__storePendingResults()
+        if (self.__hdf5 is not None) and (self.__lastRow is not None):
+            if not self.pleaseBreak:
+                self.__writeHDF5Row(self.__lastRow)
         if self.counter:
             if not self.roiFit:
                 if self.fitFiles:
                     self.listfile.write(']\n')
                     self.listfile.close()
+                if self.__resuming and self._concentrations:
+                    self.__removeRepeatedConcentrations()
             if self.__ncols is not None:
                 if self.__ncols:self.saveImage()
+        elif (self.__checkpoint is not None) and self.fitImages:
+            # all the rows were fitted by a previous run
+            self.__restoreImages()
+            self.saveImage()
         self.onEnd()
 
     def getFileHandle(self,inputfile):
@@ -303,11 +506,14 @@ def __processStack(self):
             if self.pleaseBreak: break
             self.onImage(keylist[i], keylist)
             self.__ncols = numberofmca
+            if i in self.__finishedRows:
+                continue
             colsToIter = range(0+self.mcaOffset,
                                      numberofmca,
                                      self.mcaStep)
             self.__row = i
             self.__col = -1
+            self.__firstInRow = True
             try:
                 cache_data = data[i, :, :]
             except:
@@ -356,6 +562,7 @@ def __processOneFile(self):
                     numberofmca  = ncols
                     self.__ncols = len(range(0+self.mcaOffset,numberofmca,self.mcaStep))
                     self.__col  = -1
+                    self.__firstInRow = True
                     for mca_index in range(self.__ncols):
                         mca = 0 + self.mcaOffset + mca_index * self.mcaStep
                         if self.pleaseBreak: break
@@ -384,52 +591,55 @@ def __processOneFile(self):
                         self.__ncols = len(range(0+self.mcaOffset,
                                              numberofmca,self.mcaStep))
                         self.__col   = -1
+                        self.__firstInRow = True
                         scan_key = "%s.%s" % (scan,order)
                         scan_obj= ffile.Source.select(scan_key)
-                        #I assume always same number of detectors and
-                        #same offset for each detector otherways I would
-                        #slow down everything to deal with not very common
-                        #situations
-                        #if self.__row == 0:
-                        if self.counter == 0:
-                            self.__chann0List = numpy.zeros(info['NbMcaDet'])
-                            chan0list = scan_obj.header('@CHANN')
-                            if len(chan0list):
-                                for i in range(info['NbMcaDet']):
-                                    self.__chann0List[i] = int(chan0list[i].split()[2])
-                        #import time
-                        for mca_index in range(self.__ncols):
-                            i = 0 + self.mcaOffset + mca_index * self.mcaStep
-                            #e0 = time.time()
-                            if self.pleaseBreak: break
-                            self.__col += 1
-                            point = int(i/info['NbMcaDet']) + 1
-                            mca   = (i % info['NbMcaDet'])  + 1
-                            key = "%s.%s.%05d.%d" % (scan,order,point,mca)
-                            autotime = self.mcafit.config["concentrations"].get(\
+                        autotime = self.mcafit.config["concentrations"].get(\
                                         "useautotime", False)
-                            if autotime:
-                                #slow info reading methods needed to access time
-                                mcainfo,mcadata = ffile.LoadSource(key)
-                                info['McaLiveTime'] = mcainfo.get('McaLiveTime',
-                                                              None)
-                            else:
-                                mcadata = scan_obj.mca(i+1)
-                            y0  = numpy.array(mcadata)
-                            x = numpy.arange(len(y0))*1.0 + \
-                                self.__chann0List[mca-1]
-                            filename = os.path.basename(info['SourceName'])
-
-                            infoDict = {}
-                            infoDict['SourceName'] = info['SourceName']
-                            infoDict['Key']        = key
-                            infoDict['McaLiveTime'] = info.get('McaLiveTime',
-                                                               None)
-                            self.__processOneMca(x,y0,filename,key,info=infoDict)
-                            self.onMca(i, info['NbMca'],filename=filename,
-                                                    key=key,
-                                                    info=infoDict)
-                            #print "remaining = ",(time.time()-e0) * (info['NbMca'] - i)
+                        filename = os.path.basename(info['SourceName'])
+                        nbmcadet = int(info['NbMcaDet'])
+                        mca_index = 0
+                        while mca_index < self.__ncols:
+                            if self.pleaseBreak: break
+                            # the spectra and their times are parsed in blocks
+                            mcaArray, mcaInfo = SpecFileDataSource.getMcaArray(\
+                                    scan_obj,
+                                    nbmcadet=nbmcadet,
+                                    first=self.mcaOffset + \
+                                          mca_index * self.mcaStep + 1,
+                                    step=self.mcaStep,
+                                    number=min(MCA_BLOCK_SIZE,
+                                               self.__ncols - mca_index))
+                            if not mcaArray.shape[0]:
+                                break
+                            x = numpy.arange(mcaArray.shape[1]) * 1.0
+                            for k in range(mcaArray.shape[0]):
+                                if self.pleaseBreak: break
+                                i = int(mcaInfo['McaIndex'][k]) - 1
+                                self.__col += 1
+                                point = int(i/nbmcadet) + 1
+                                mca   = (i % nbmcadet)  + 1
+                                key = "%s.%s.%05d.%d" % (scan,order,point,mca)
+                                if autotime:
+                                    if mcaInfo['McaLiveTime'] is None:
+                                        info['McaLiveTime'] = None
+                                    else:
+                                        info['McaLiveTime'] = \
+                                                mcaInfo['McaLiveTime'][k]
+                                y0  = mcaArray[k]
+
+                                infoDict = {}
+                                infoDict['SourceName'] = info['SourceName']
+                                infoDict['Key']        = key
+                                infoDict['McaLiveTime'] = info.get('McaLiveTime',
+                                                                   None)
+                                self.__processOneMca(x + mcaInfo['Channel0'][k],
+                                                     y0, filename, key,
+                                                     info=infoDict)
+                                self.onMca(i, info['NbMca'],filename=filename,
+                                                        key=key,
+                                                        info=infoDict)
+                            mca_index += mcaArray.shape[0]
 
     def __getFitFile(self, filename, key):
         fitdir = self.os_path_join(self._outputdir,"FIT")
@@ -459,13 +669,396 @@ def os_path_join(self, a, b):
                                            a.decode('latin-1'))
         return outfile
 
+    def __getFitFileOutput(self, filename, key):
+        # make sure the output directory of the .fit files exists
+        fitdir = self.os_path_join(self._outputdir,"FIT")
+        if not os.path.exists(fitdir):
+            try:
+                os.mkdir(fitdir)
+            except:
+                print("I could not create directory %s" % fitdir)
+                return None
+        fitdir = self.os_path_join(fitdir,filename+"_FITDIR")
+        if not os.path.exists(fitdir):
+            try:
+                os.mkdir(fitdir)
+            except:
+                print("I could not create directory %s" % fitdir)
+                return None
+        if not os.path.isdir(fitdir):
+            print("%s does not seem to be a valid directory" % fitdir)
+            return None
+        outfile = filename +"_"+key+".fit"
+        return self.os_path_join(fitdir,  outfile)
+
+    def __storePendingResults(self, n=None):
+        # store the results of the workers in submission order
+        if n is None:
+            n = len(self._pending)
+        for i in range(n):
+            asyncResult, filename, key, outfile, row, col = \
+                                            self._pending.popleft()
+            try:
+                result, concentrations = asyncResult.get()
+            except:
+                print("Error fitting file with output = %s: %s)" %\
+                      (filename, sys.exc_info()[1]))
+                continue
+            self.__storeMcaResult(filename, key, outfile, row, col,
+                                  result, concentrations)
+
+    def __storeMcaResult(self, filename, key, outfile, row, col,
+                         result, concentrations):
+        if self._concentrations:
+            self._concentrationsAsAscii=self._toolConversion.getConcentrationsAsAscii(concentrations)
+            if len(self._concentrationsAsAscii) > 1:
+                text  = ""
+                text += "SOURCE: "+ filename +"\n"
+                text += "KEY: "+key+"\n"
+                text += self._concentrationsAsAscii + "\n"
+                f=open(self._concentrationsFile,"a")
+                f.write(text)
+                f.close()
+
+        #output options
+        # .FIT files
+        if self.fitFiles:
+            #python like output list
+            if not self.counter:
+                self.__openFitFileList()
+            if outfile not in self.__listedFitFiles:
+                if len(self.__listedFitFiles):
+                    self.listfile.write(',')
+                self.listfile.write('\n'+outfile)
+                self.__listedFitFiles.add(outfile)
+
+        #IMAGES
+        if self.fitImages:
+            #this only works with EDF
+            if self.__ncols is not None:
+                if not self.counter:
+                    imgdir = self.os_path_join(self._outputdir,"IMAGES")
+                    if not os.path.exists(imgdir):
+                        try:
+                            os.mkdir(imgdir)
+                        except:
+                            print("I could not create directory %s" %\
+                                  imgdir)
+                            return
+                    elif not os.path.isdir(imgdir):
+                        print("%s does not seem to be a valid directory" %\
+                              imgdir)
+                    self.imgDir = imgdir
+                    self.__peaks  = []
+                    self.__images = {}
+                    self.__sigmas = {}
+                    if not self.__stack:
+                        self.__nrows   = len(range(0,len(self._filelist),self.fileStep))
+                    for group in result['groups']:
+                        self.__peaks.append(group)
+                        self.__images[group]= numpy.zeros((self.__nrows,
+                                                           self.__ncols),
+                                                           numpy.float)
+                        self.__sigmas[group]= numpy.zeros((self.__nrows,
+                                                           self.__ncols),
+                                                           numpy.float)
+                    self.__images['chisq']  = numpy.zeros((self.__nrows,
+                                                           self.__ncols),
+                                                           numpy.float) - 1.
+                    if self._concentrations:
+                        layerlist = concentrations['layerlist']
+                        if 'mmolar' in concentrations:
+                            self.__conLabel = " mM"
+                            self.__conKey   = "mmolar"
+                        else:
+                            self.__conLabel = " mass fraction"
+                            self.__conKey   = "mass fraction"
+                        for group in concentrations['groups']:
+                            key = group+self.__conLabel
+                            self.__concentrationsKeys.append(key)
+                            self.__images[key] = numpy.zeros((self.__nrows,
+                                                              self.__ncols),
+                                                              numpy.float)
+                            if len(layerlist) > 1:
+                                for layer in layerlist:
+                                    key = group+" "+layer
+                                    self.__concentrationsKeys.append(key)
+                                    self.__images[key] = numpy.zeros((self.__nrows,
+                                                                self.__ncols),
+                                                                numpy.float)
+                    if self._hdf5Output:
+                        self.__openHDF5Output(row)
+            for peak in self.__peaks:
+                try:
+                    self.__images[peak][row, col] = result[peak]['fitarea']
+                    self.__sigmas[peak][row, col] = result[peak]['sigmaarea']
+                except:
+                    pass
+            if self._concentrations:
+                layerlist = concentrations['layerlist']
+                for group in concentrations['groups']:
+                    self.__images[group+self.__conLabel][row, col] = \
+                                          concentrations[self.__conKey][group]
+                    if len(layerlist) > 1:
+                        for layer in layerlist:
+                            self.__images[group+" "+layer] [row, col] = \
+                                          concentrations[layer][self.__conKey][group]
+            try:
+                self.__images['chisq'][row, col] = result['chisq']
+            except:
+                print("Error on chisq row %d col %d" %\
+                      (row, col))
+                print("File = %s\n" % filename)
+                pass
+            if self.__hdf5 is not None:
+                # the results are stored in order, a new row means the
+                # previous one is finished
+                if (self.__lastRow is not None) and (row != self.__lastRow):
+                    self.__writeHDF5Row(self.__lastRow)
+                self.__lastRow = row
+
+        #update counter
+        self.counter += 1
+
+    def __openFitFileList(self):
+        name = os.path.splitext(self._rootname)[0]+"_fitfilelist.py"
+        name = self.os_path_join(self._outputdir,name)
+        previous = []
+        if self.__resuming and os.path.exists(name):
+            # keep the fit files of the previous run
+            f = open(name, "r")
+            for line in f.read().splitlines()[1:]:
+                line = line.strip().rstrip(",]")
+                if len(line):
+                    previous.append(line)
+            f.close()
+        try:
+            os.remove(name)
+        except:
+            pass
+        self.listfile=open(name,"w+")
+        self.listfile.write("fitfilelist = [")
+        if len(previous):
+            self.listfile.write('\n' + ',\n'.join(previous))
+        self.__listedFitFiles = set(previous)
+
+    def __removeRepeatedConcentrations(self):
+        # the spectra of the row interrupted by the previous run were fitted
+        # again, only their last concentrations are kept
+        if not os.path.exists(self._concentrationsFile):
+            return
+        f = open(self._concentrationsFile, "r")
+        text = f.read()
+        f.close()
+        if text.endswith("\n"):
+            text = text[:-1]
+        blocks = ("\n" + text).split("\nSOURCE: ")[1:]
+        results = collections.OrderedDict()
+        for block in blocks:
+            results["\n".join(block.split("\n")[:2])] = block
+        if len(results) == len(blocks):
+            return
+        f = open(self._concentrationsFile, "w")
+        for block in results.values():
+            f.write("SOURCE: " + block + "\n")
+        f.close()
+
+    def __getHDF5OutputName(self):
+        ffile = os.path.splitext(self._rootname)[0]
+        if (self.fileStep > 1) or (self.mcaStep > 1):
+            trailing = "_filestep_%02d_mcastep_%02d" % ( self.fileStep,
+                                                         self.mcaStep )
+        else:
+            trailing = ""
+        if self.chunk is None:
+            suffix = ".h5"
+        else:
+            suffix = "_%06d_partial.h5" % self.chunk
+        imgdir = self.os_path_join(self._outputdir, "IMAGES")
+        return self.os_path_join(imgdir, ffile + trailing + suffix)
+
+    def getConfigurationHash(self):
+        """
+        Hash of the fit configuration, of the file list and of the options
+        selecting the spectra. The rows finished by a previous run are only
+        used if it matches.
+        """
+        configList = []
+        for config in self.__configList:
+            if (type(config) == type("")) and os.path.exists(config):
+                config = ConfigDict.ConfigDict(filelist=config)
+            configList.append(config)
+        h = _md5()
+        _updateHash(h, [configList, self._filelist, self.selection,
+                        self._concentrations, self.fileStep, self.mcaStep,
+                        self.fileBeginOffset, self.fileEndOffset,
+                        self.mcaOffset])
+        return h.hexdigest()
+
+    def __readCheckpoint(self):
+        # rows already fitted by an interrupted run
+        filename = self.__getHDF5OutputName()
+        if not os.path.exists(filename):
+            return
+        previous = BatchHDF5Output.readBatchHDF5Output(filename)
+        if previous is None:
+            print("Cannot read previous output %s" % filename)
+            return
+        configurationHash = previous['attributes'].get('configuration_hash',
+                                                       b"")
+        if hasattr(configurationHash, "decode"):
+            configurationHash = configurationHash.decode('utf-8')
+        if configurationHash != self.__configurationHash:
+            print("Configuration changed. Previous output %s not used" %\
+                  filename)
+            return
+        self.__checkpoint = previous
+        self.__finishedRows = set(numpy.nonzero(previous['finished'])[0])
+        print("Resuming batch, %d rows read from %s" % \
+              (len(self.__finishedRows), filename))
+
+    def __restoreRows(self, currentRow=None):
+        # copy the rows of the previous run into the images
+        previous = self.__checkpoint
+        rows = [row for row in sorted(self.__finishedRows) \
+                if row != currentRow]
+        for row in rows:
+            for i, peak in enumerate(self.__peaks):
+                self.__images[peak][row] = previous['parameters_data'][i, row]
+                self.__sigmas[peak][row] = \
+                                    previous['uncertainties_data'][i, row]
+            self.__images['chisq'][row] = previous['chisq'][row]
+            if self._concentrations:
+                for i, key in enumerate(self.__concentrationsKeys):
+                    self.__images[key][row] = \
+                                    previous['concentrations_data'][i, row]
+        return rows
+
+    def __restoreImages(self):
+        # nothing left to fit, the images are those of the previous run
+        previous = self.__checkpoint
+        self.imgDir = os.path.dirname(self.__getHDF5OutputName())
+        self.__nrows = previous['nrows']
+        self.__ncols = previous['ncols']
+        self.__peaks = previous['parameters']
+        self.__images = {}
+        self.__sigmas = {}
+        keys = self.__peaks + ['chisq']
+        if self._concentrations:
+            self.__concentrationsKeys = previous['concentrations']
+            keys += self.__concentrationsKeys
+        for key in keys:
+            self.__images[key] = numpy.zeros((self.__nrows, self.__ncols),
+                                             numpy.float)
+        for peak in self.__peaks:
+            self.__sigmas[peak] = numpy.zeros((self.__nrows, self.__ncols),
+                                              numpy.float)
+        self.__images['chisq'] -= 1.
+        self.__restoreRows()
+
+    def __openHDF5Output(self, currentRow):
+        filename = self.__getHDF5OutputName()
+        concentrationsKeys = []
+        if self._concentrations:
+            concentrationsKeys = self.__concentrationsKeys
+        previous = self.__checkpoint
+        if previous is not None:
+            if ((previous['nrows'], previous['ncols']) != \
+                (self.__nrows, self.__ncols)) or \
+               (previous['parameters'] != self.__peaks) or \
+               (previous['concentrations'] != concentrationsKeys):
+                # same configuration but, for instance, different data
+                print("Layout changed. Previous output %s not used" %\
+                      filename)
+                previous = None
+                self.__checkpoint = None
+                self.__finishedRows = set()
+        attributes = {'file_step': self.fileStep,
+                      'file_begin_offset': self.fileBeginOffset,
+                      'file_end_offset': self.fileEndOffset,
+                      'mca_step': self.mcaStep,
+                      'mca_offset': self.mcaOffset,
+                      'configuration_hash': \
+                                    self.__configurationHash.encode('utf-8')}
+        if previous is not None:
+            # the finished rows are kept in the file
+            rows = self.__restoreRows(currentRow)
+            try:
+                self.__hdf5 = BatchHDF5Output.BatchHDF5Output(filename,
+                                            self.__nrows, self.__ncols,
+                                            self.__peaks,
+                                            concentrations=concentrationsKeys,
+                                            attributes=attributes,
+                                            append=True)
+                return
+            except:
+                # for instance, the writer of the previous run was killed
+                print("I could not append to HDF5 output file %s" % filename)
+                print(sys.exc_info())
+            # the restored rows are written to a new file that only replaces
+            # the previous one once complete
+            tmpFilename = filename + ".tmp"
+            try:
+                self.__hdf5 = BatchHDF5Output.BatchHDF5Output(tmpFilename,
+                                            self.__nrows, self.__ncols,
+                                            self.__peaks,
+                                            concentrations=concentrationsKeys,
+                                            attributes=attributes)
+                for row in rows:
+                    self.__writeHDF5Row(row)
+                self.__hdf5.close()
+                self.__hdf5 = None
+                if hasattr(os, "replace"):
+                    os.replace(tmpFilename, filename)
+                else:
+                    os.remove(filename)
+                    os.rename(tmpFilename, filename)
+                self.__hdf5 = BatchHDF5Output.BatchHDF5Output(filename,
+                                            self.__nrows, self.__ncols,
+                                            self.__peaks,
+                                            concentrations=concentrationsKeys,
+                                            append=True)
+            except:
+                print("I could not restore HDF5 output file %s" % filename)
+                print(sys.exc_info())
+                if self.__hdf5 is not None:
+                    self.__hdf5.close()
+                self.__hdf5 = None
+            return
+        try:
+            self.__hdf5 = BatchHDF5Output.BatchHDF5Output(filename,
+                                            self.__nrows, self.__ncols,
+                                            self.__peaks,
+                                            concentrations=concentrationsKeys,
+                                            attributes=attributes)
+        except:
+            print("I could not create HDF5 output file %s" % filename)
+            print(sys.exc_info())
+            self.__hdf5 = None
+
+    def __writeHDF5Row(self, row):
+        parameters = numpy.array([self.__images[peak][row] \
+                                  for peak in self.__peaks])
+        uncertainties = numpy.array([self.__sigmas[peak][row] \
+                                     for peak in self.__peaks])
+        concentrations = None
+        if self._concentrations:
+            concentrations = numpy.array([self.__images[key][row] \
+                                    for key in self.__concentrationsKeys])
+        try:
+            self.__hdf5.writeRow(row, parameters, uncertainties,
+                                 self.__images['chisq'][row],
+                                 concentrations=concentrations)
+        except:
+            print("Error writing row %d to HDF5 output" % row)
+            print(sys.exc_info())
+
     def __processOneMca(self,x,y,filename,key,info=None):
         self._concentrationsAsAscii = ""
         if not self.roiFit:
             result = None
             concentrationsdone = 0
             concentrations = None
-            outfile=self.os_path_join(self._outputdir, filename)
             fitfile = self.__getFitFile(filename,key)
             if self.chunk is not None:
                 con_extension = "_%06d_partial_concentrations.txt" % self.chunk
@@ -474,7 +1067,7 @@ def __processOneMca(self,x,y,filename,key,info=None):
             self._concentrationsFile = self.os_path_join(self._outputdir,
                                     self._rootname+ con_extension)
             #                        self._rootname+"_concentrationsNEW.txt")
-            if self.counter == 0:
+            if (self.counter == 0) and (not self.__resuming):
                 if os.path.exists(self._concentrationsFile):
                     try:
                         os.remove(self._concentrationsFile)
@@ -482,95 +1075,36 @@ def __processOneMca(self,x,y,filename,key,info=None):
                         print("I could not delete existing concentrations file %s" %\
                               self._concentrationsFile)
             #print "self._concentrationsFile", self._concentrationsFile
+            if self.fitFiles:
+                outfile = self.__getFitFileOutput(filename, key)
+                if outfile is None:
+                    return
+            else:
+                outfile = None
             if self.useExistingFiles and os.path.exists(fitfile):
-                useExistingResult = 1
+                # the results of the previous spectra still being fitted
+                # by the workers have to be stored first
+                self.__storePendingResults()
                 try:
                     dict = ConfigDict.ConfigDict()
                     dict.read(fitfile)
                     result = dict['result']
                     if 'concentrations' in dict:
+                        concentrations = dict['concentrations']
                         concentrationsdone = 1
                 except:
                     print("Error trying to use result file %s" % fitfile)
                     print("Please, consider deleting it.")
                     print(sys.exc_info())
                     return
-            else:
-                useExistingResult = 0
-                try:
-                    #I make sure I take the fit limits configuration
-                    self.mcafit.config['fit']['use_limit'] = 1
-                    self.mcafit.setData(x,y, time=info.get("McaLiveTime", None))
-                except:
-                    print("Error entering data of file with output = %s\n%s" %\
-                          (filename, sys.exc_info()[1]))
-                    # make sure the configuration is restored
-                    if self.mcafit.config['fit'].get("strategyflag", False):
-                        config = self.__configList[self.__currentConfig]
-                        print("Restoring fitconfiguration")
-                        self.mcafit.configure(config)
-                    return
-                try:
-                    self.mcafit.estimate()
-                    if self.fitFiles:
-                        fitresult, result = self.mcafit.startfit(digest=1)
-                    elif self._concentrations and (self.mcafit._fluoRates is None):
-                        fitresult, result = self.mcafit.startfit(digest=1)
-                    elif self._concentrations:
-                        fitresult = self.mcafit.startfit(digest=0)
-                        try:
-                            fitresult0 = {}
-                            fitresult0['fitresult'] = fitresult
-                            fitresult0['result'] = self.mcafit.imagingDigestResult()
-                            fitresult0['result']['config'] = self.mcafit.config
-                            conf = self.mcafit.configure()
-                            tconf = self._tool.configure()
-                            if 'concentrations' in conf:
-                                tconf.update(conf['concentrations'])
-                            else:
-                                #what to do?
-                                pass
-                            concentrations = self._tool.processFitResult(config=tconf,
-                                            fitresult=fitresult0,
-                                            elementsfrommatrix=False,
-                                            fluorates = self.mcafit._fluoRates)
-                        except:
-                            print("error in concentrations")
-                            print(sys.exc_info()[0:-1])
-                        concentrationsdone = True
-                    else:
-                        #just images
-                        fitresult = self.mcafit.startfit(digest=0)
-                except:
-                    print("Error fitting file with output = %s: %s)" %\
-                          (filename, sys.exc_info()[1]))
-                    if self.mcafit.config['fit'].get("strategyflag", False):
-                        config = self.__configList[self.__currentConfig]
-                        print("Restoring fitconfiguration")
-                        self.mcafit.configure(config)
-                    return
-            if self._concentrations:
-                if concentrationsdone == 0:
+                if self._concentrations and (concentrationsdone == 0):
                     if not ('concentrations' in result):
-                        if useExistingResult:
-                            fitresult0={}
-                            fitresult0['result'] = result
-                            conf = result['config']
-                        else:
-                            fitresult0={}
-                            if result is None:
-                                result = self.mcafit.digestresult()
-                            fitresult0['result']    = result
-                            fitresult0['fitresult'] = fitresult
-                            conf = self.mcafit.configure()
+                        fitresult0={}
+                        fitresult0['result'] = result
+                        conf = result['config']
                         tconf = self._tool.configure()
                         if 'concentrations' in conf:
                             tconf.update(conf['concentrations'])
-                        else:
-                            pass
-                            #print "Concentrations not calculated"
-                            #print "Is your fit configuration file correct?"
-                            #return
                         try:
                             concentrations = self._tool.processFitResult(config=tconf,
                                             fitresult=fitresult0,
@@ -578,156 +1112,47 @@ def __processOneMca(self,x,y,filename,key,info=None):
                         except:
                             print("error in concentrations")
                             print(sys.exc_info()[0:-1])
-                            #return
-                self._concentrationsAsAscii=self._toolConversion.getConcentrationsAsAscii(concentrations)
-                if len(self._concentrationsAsAscii) > 1:
-                    text  = ""
-                    text += "SOURCE: "+ filename +"\n"
-                    text += "KEY: "+key+"\n"
-                    text += self._concentrationsAsAscii + "\n"
-                    f=open(self._concentrationsFile,"a")
-                    f.write(text)
-                    f.close()
-
-            #output options
-            # .FIT files
-            if self.fitFiles:
-                fitdir = self.os_path_join(self._outputdir,"FIT")
-                if not os.path.exists(fitdir):
-                    try:
-                        os.mkdir(fitdir)
-                    except:
-                        print("I could not create directory %s" % fitdir)
-                        return
-                fitdir = self.os_path_join(fitdir,filename+"_FITDIR")
-                if not os.path.exists(fitdir):
-                    try:
-                        os.mkdir(fitdir)
-                    except:
-                        print("I could not create directory %s" % fitdir)
-                        return
-                if not os.path.isdir(fitdir):
-                    print("%s does not seem to be a valid directory" % fitdir)
-                else:
-                    outfile = filename +"_"+key+".fit"
-                    outfile = self.os_path_join(fitdir,  outfile)
-                if not useExistingResult:
-                    result = self.mcafit.digestresult(outfile=outfile,
-                                                      info=info)
-                if concentrations is not None:
-                    try:
-                        f=ConfigDict.ConfigDict()
-                        f.read(outfile)
-                        f['concentrations'] = concentrations
-                        try:
-                            os.remove(outfile)
-                        except:
-                            print("error deleting fit file")
-                        f.write(outfile)
-                    except:
-                        print("Error writing concentrations to fit file")
-                        print(sys.exc_info())
-
-                #python like output list
-                if not self.counter:
-                    name = os.path.splitext(self._rootname)[0]+"_fitfilelist.py"
-                    name = self.os_path_join(self._outputdir,name)
-                    try:
-                        os.remove(name)
-                    except:
-                        pass
-                    self.listfile=open(name,"w+")
-                    self.listfile.write("fitfilelist = [")
-                    self.listfile.write('\n'+outfile)
-                else:
-                    self.listfile.write(',\n'+outfile)
+            elif self._pool is not None:
+                # the fit is performed by one of the workers and the
+                # result is stored once all the previous ones are stored
+                self._pending.append((self._pool.apply_async(_fitMcaInWorker,
+                                        ((x, y, info, self.fitFiles,
+                                          self._concentrations, outfile),)),
+                                      filename, key, outfile,
+                                      self.__row, self.__col))
+                if len(self._pending) >= (4 * self._workers):
+                    self.__storePendingResults(1)
+                return
             else:
-                if not useExistingResult:
-                    if 0:
-                        #this is very slow and not needed just for imaging
-                        if result is None:
-                            result = self.mcafit.digestresult()
-                    else:
-                        if result is None:
-                            result = self.mcafit.imagingDigestResult()
-
-            #IMAGES
-            if self.fitImages:
-                #this only works with EDF
-                if self.__ncols is not None:
-                    if not self.counter:
-                        imgdir = self.os_path_join(self._outputdir,"IMAGES")
-                        if not os.path.exists(imgdir):
-                            try:
-                                os.mkdir(imgdir)
-                            except:
-                                print("I could not create directory %s" %\
-                                      imgdir)
-                                return
-                        elif not os.path.isdir(imgdir):
-                            print("%s does not seem to be a valid directory" %\
-                                  imgdir)
-                        self.imgDir = imgdir
-                        self.__peaks  = []
-                        self.__images = {}
-                        self.__sigmas = {}
-                        if not self.__stack:
-                            self.__nrows   = len(range(0,len(self._filelist),self.fileStep))
-                        for group in result['groups']:
-                            self.__peaks.append(group)
-                            self.__images[group]= numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float)
-                            self.__sigmas[group]= numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float)
-                        self.__images['chisq']  = numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float) - 1.
-                        if self._concentrations:
-                            layerlist = concentrations['layerlist']
-                            if 'mmolar' in concentrations:
-                                self.__conLabel = " mM"
-                                self.__conKey   = "mmolar"
-                            else:
-                                self.__conLabel = " mass fraction"
-                                self.__conKey   = "mass fraction"
-                            for group in concentrations['groups']:
-                                key = group+self.__conLabel
-                                self.__concentrationsKeys.append(key)
-                                self.__images[key] = numpy.zeros((self.__nrows,
-                                                                  self.__ncols),
-                                                                  numpy.float)
-                                if len(layerlist) > 1:
-                                    for layer in layerlist:
-                                        key = group+" "+layer
-                                        self.__concentrationsKeys.append(key)
-                                        self.__images[key] = numpy.zeros((self.__nrows,
-                                                                    self.__ncols),
-                                                                    numpy.float)
-                for peak in self.__peaks:
-                    try:
-                        self.__images[peak][self.__row, self.__col] = result[peak]['fitarea']
-                        self.__sigmas[peak][self.__row, self.__col] = result[peak]['sigmaarea']
-                    except:
-                        pass
-                if self._concentrations:
-                    layerlist = concentrations['layerlist']
-                    for group in concentrations['groups']:
-                        self.__images[group+self.__conLabel][self.__row, self.__col] = \
-                                              concentrations[self.__conKey][group]
-                        if len(layerlist) > 1:
-                            for layer in layerlist:
-                                self.__images[group+" "+layer] [self.__row, self.__col] = \
-                                              concentrations[layer][self.__conKey][group]
+                firstInRow = self.__firstInRow
+                self.__firstInRow = False
+                if self._warmStart and firstInRow:
+                    # first spectrum fitted in a row, start from its
+                    # neighbour in the previous row instead of from the
+                    # end of that row
+                    if self.__rowSeed is not None:
+                        self.mcafit.setWarmStartSeed(self.__rowSeed)
                 try:
-                    self.__images['chisq'][self.__row, self.__col] = result['chisq']
+                    result, concentrations = _fitMca(self.mcafit,
+                                                     self._tool,
+                                                     x, y, info,
+                                                     self.fitFiles,
+                                                     self._concentrations,
+                                                     outfile)
                 except:
-                    print("Error on chisq row %d col %d" %\
-                          (self.__row, self.__col))
-                    print("File = %s\n" % filename)
-                    pass
-
+                    print("Error fitting file with output = %s: %s)" %\
+                          (filename, sys.exc_info()[1]))
+                    if self.mcafit.config['fit'].get("strategyflag", False):
+                        config = self.__configList[self.__currentConfig]
+                        print("Restoring fitconfiguration")
+                        self.mcafit.configure(config)
+                    return
+                if self._warmStart and firstInRow:
+                    self.__rowSeed = self.mcafit.getWarmStartSeed()
+            self.__storeMcaResult(filename, key, outfile,
+                                  self.__row, self.__col,
+                                  result, concentrations)
+            return
         else:
                 dict=self.mcafit.roifit(x,y,width=self.roiWidth)
                 #this only works with EDF
@@ -890,13 +1315,28 @@ def saveImage(self,ffile=None):
 
 if __name__ == "__main__":
     import getopt
+    usage = """Usage: McaAdvancedFitBatch.py --cfg=fit.cfg --outdir=dir [options] files
+
+Options:
+    --roifit=0/1       ROI fit instead of the fit of the spectra
+    --roiwidth=250.    width of the ROIs
+    --workers=1        number of processes fitting the spectra
+    --warmstart=0/1    seed each fit with the previous one (one worker only)
+    --hdf5output=0/1   write the results into an HDF5 file as the rows are
+                       finished. Required to resume an interrupted batch:
+                       the rows found in that file are not fitted again if
+                       the configuration did not change."""
     options     = 'f'
-    longoptions = ['cfg=','pkm=','outdir=','roifit=','roi=','roiwidth=']
+    longoptions = ['cfg=','pkm=','outdir=','roifit=','roi=','roiwidth=',
+                   'workers=', 'warmstart=', 'hdf5output=']
     filelist = None
     outdir   = None
     cfg      = None
     roifit   = 0
     roiwidth = 250.
+    workers  = 1
+    warmstart = 0
+    hdf5output = 0
     opts, args = getopt.getopt(
                     sys.argv[1:],
                     options,
@@ -910,10 +1350,19 @@ def saveImage(self,ffile=None):
             roifit   = int(arg)
         elif opt in ('--roiwidth'):
             roiwidth = float(arg)
+        elif opt in ('--workers'):
+            workers = int(arg)
+        elif opt in ('--warmstart'):
+            warmstart = int(arg)
+        elif opt in ('--hdf5output'):
+            hdf5output = int(arg)
     filelist=args
     if len(filelist) == 0:
         print("No input files, run GUI")
+        print(usage)
         sys.exit(0)
 
-    b = McaAdvancedFitBatch(cfg,filelist,outdir,roifit,roiwidth)
+    b = McaAdvancedFitBatch(cfg,filelist,outdir,roifit,roiwidth,
+                            workers=workers, warmstart=warmstart,
+                            hdf5output=hdf5output)
     b.processList()
@@ -33,6 +33,7 @@
 __doc__= "Interface to the PyMca EPDL97 description"
 import os
 import sys
+import collections
 try:
     from PyMca5.PyMcaIO import specfile
 except ImportError:
@@ -126,8 +127,6 @@ def setElementBindingEnergies(element, ddict):
     respect other programs absorption edges. Data will be extrapolated when
     needed. WARNING: Coherent resonances are not replaced.
     """
-    if len(EPDL97_DICT[element]['EPDL97'].keys()) < 2:
-        _initializeElement(element)
     EPDL97_DICT[element]['original'] = False
     EPDL97_DICT[element]['binding']={}
     if 'binding' in ddict:
@@ -135,15 +134,37 @@ def setElementBindingEnergies(element, ddict):
     else:
         EPDL97_DICT[element]['binding'].update(ddict)
 
+ATOMIC_SHELLS = ['M5', 'M4', 'M3', 'M2', 'M1', 'L3', 'L2', 'L1', 'K']
+
+# quantities interpolated at the requested energies besides the shells
+_INTERPOLATED_KEYS = ['coherent', 'compton', 'pair', 'all other']
+
+# rows of the packed array holding the data of an initialized element
+_PACKED_KEYS = ['energy', 'photo', 'photoelectric', 'total'] + \
+               _INTERPOLATED_KEYS + ATOMIC_SHELLS
+_FIRST_INTERPOLATED_ROW = _PACKED_KEYS.index(_INTERPOLATED_KEYS[0])
+_EPDL97_PACKED = {}
+
+_EPDL97_SPECFILE = None
+
+def _getSpecfile():
+    # the file is indexed only once and not for every element
+    global _EPDL97_SPECFILE
+    if _EPDL97_SPECFILE is None:
+        _EPDL97_SPECFILE = specfile.Specfile(EPDL97_FILE)
+    return _EPDL97_SPECFILE
+
 def _initializeElement(element):
     """
     _initializeElement(element)
     Supposed to be of internal use.
     Reads the file and loads all the relevant element information contained
     int the EPDL97 file into the internal dictionnary.
+    The data are kept in a single array, the dictionnary entries are views
+    of its rows.
     """
     #read the specfile data
-    sf = specfile.Specfile(EPDL97_FILE)
+    sf = _getSpecfile()
     scan_index = ElementList.index(element)
     if scan_index > 99:
         #just to avoid a crash
@@ -154,72 +175,164 @@ def _initializeElement(element):
     data = scan.data()
     scan = None
 
-    #fill the information into the dictionnary
+    #translate the labels to the PyMca keys
+    rows = {}
     i = -1
     for label0 in labels:
         i += 1
         label = label0.lower()
-        #translate the label to the PyMca keys
         if ('coherent' in label) and ('incoherent' not in label):
-            EPDL97_DICT[element]['EPDL97']['coherent'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['coherent'].shape = -1
+            rows['coherent'] = i
             continue
         if ('incoherent' in label) and ('plus' not in label):
-            EPDL97_DICT[element]['EPDL97']['compton'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['compton'].shape = -1
+            rows['compton'] = i
             continue
         if 'allother' in label:
-            EPDL97_DICT[element]['EPDL97']['all other'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['all other'].shape = -1
+            rows['all other'] = i
             continue
         label = label.replace(" ","").split("(")[0]
         if 'energy' in label:
-            EPDL97_DICT[element]['EPDL97']['energy'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['energy'].shape = -1
+            rows['energy'] = i
             continue
         if 'photoelectric' in label:
-            EPDL97_DICT[element]['EPDL97']['photo'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['photo'].shape = -1
-            #a reference should not be expensive ...
-            EPDL97_DICT[element]['EPDL97']['photoelectric'] =\
-                                EPDL97_DICT[element]['EPDL97']['photo']
+            rows['photoelectric'] = i
             continue
         if 'total' in label:
-            EPDL97_DICT[element]['EPDL97']['total'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['total'].shape = -1
+            rows['total'] = i
             continue
         if label[0].upper() in ['K', 'L', 'M']:
             #for the time being I do not use the other shells in PyMca
-            EPDL97_DICT[element]['EPDL97'][label.upper()] = data[i, :]
-            EPDL97_DICT[element]['EPDL97'][label.upper()].shape = -1
+            rows[label.upper()] = i
             continue
-    EPDL97_DICT[element]['EPDL97']['pair'] = 0.0 *\
-                                             EPDL97_DICT[element]['EPDL97']['energy']
-    EPDL97_DICT[element]['EPDL97']['photo'] = \
-            EPDL97_DICT[element]['EPDL97']['total'] -\
-            EPDL97_DICT[element]['EPDL97']['compton']-\
-            EPDL97_DICT[element]['EPDL97']['coherent']-\
-            EPDL97_DICT[element]['EPDL97']['pair']
 
-    atomic_shells = ['M5', 'M4', 'M3', 'M2', 'M1', 'L3', 'L2', 'L1', 'K']
+    packed = numpy.zeros((len(_PACKED_KEYS), data.shape[1]), numpy.float64)
+    wdata = {}
+    for i, key in enumerate(_PACKED_KEYS):
+        wdata[key] = packed[i]
+        if key in rows:
+            packed[i] = data[rows[key], :]
+    # pair production is not considered below 500 keV
+    wdata['photo'][:] = wdata['total'] - wdata['compton'] - \
+                        wdata['coherent'] - wdata['pair']
 
     # with the new (short) version of the cross-sections file, "all other" contains all
     # shells above the M5. Nevertheless, we calculate it
     if scan_index > 17:
-        idx = EPDL97_DICT[element]['EPDL97']['all other'] > 0.0
+        idx = wdata['all other'] > 0.0
         delta = 0.0
-        for key in atomic_shells:
-            delta += EPDL97_DICT[element]['EPDL97'][key]
-        EPDL97_DICT[element]['EPDL97']['all other'] =\
-                        (EPDL97_DICT[element]['EPDL97']['photo'] - delta) * idx
+        for key in ATOMIC_SHELLS:
+            delta += wdata[key]
+        wdata['all other'][:] = (wdata['photo'] - delta) * idx
     else:
-        EPDL97_DICT[element]['EPDL97']['all other'] = 0.0 * \
-                        EPDL97_DICT[element]['EPDL97']['photo']
+        wdata['all other'][:] = 0.0
 
     #take care of rounding problems
-    idx = EPDL97_DICT[element]['EPDL97']['all other'] < 0.0
-    EPDL97_DICT[element]['EPDL97']['all other'][idx] = 0.0
+    wdata['all other'][wdata['all other'] < 0.0] = 0.0
+    _EPDL97_PACKED[element] = packed
+    EPDL97_DICT[element]['EPDL97'] = wdata
+
+CROSS_SECTIONS_CACHE_SIZE = 256
+_crossSectionsCache = collections.OrderedDict()
+
+def _calculateElementCrossSections(element, energy, forced_shells):
+    """
+    Cross sections of the element at all the energies of the given 1D array
+    """
+    binding = EPDL97_DICT[element]['binding']
+    packed = _EPDL97_PACKED[element]
+    wenergy = packed[0]
+    nPoints = len(wenergy)
+
+    #find interpolation points
+    j0 = numpy.searchsorted(wenergy, energy, side='left') - 1
+    end = energy > wenergy[-2]
+    if end.any():
+        #take last value or extrapolate?
+        print("Warning: Extrapolating data at the end")
+        j0[end] = nPoints - 2
+    beginning = energy <= wenergy[0]
+    if beginning.any():
+        #take first value or extrapolate?
+        print("Warning: Extrapolating data at the beginning")
+        j0[beginning] = 0
+    j1 = j0 + 1
+    #at the absorption edges the energy is repeated, take the upper value
+    edge = numpy.nonzero((energy == wenergy[j1]) & ((j1 + 1) < nPoints))[0]
+    edge = edge[wenergy[j1[edge] + 1] == wenergy[j1[edge]]]
+    j0[edge] = j1[edge]
+    j1[edge] += 1
+    x0 = wenergy[j0]
+    x1 = wenergy[j1]
+    x = energy
+    close = ((x1 - x0) < 5.E-10) | ((x1 - x) < 5.E-10)
+
+    # all the interpolated quantities are handled at once, one row each
+    nInterpolated = len(_INTERPOLATED_KEYS)
+    y0 = packed[_FIRST_INTERPOLATED_ROW:, j0]
+    y1 = packed[_FIRST_INTERPOLATED_ROW:, j1]
+    with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        logX = log(x1/x0)
+        interpolated = exp((log(y0) * log(x1/x) + log(y1) * log(x/x0))/logX)
+
+        #coherent and incoherent
+        values = numpy.where((y0[:nInterpolated] > 0) & \
+                             (y1[:nInterpolated] > 0),
+                             interpolated[:nInterpolated],
+                             0.0)
+        idx = (y0[:nInterpolated] <= 0) & (y1[:nInterpolated] > 0) & \
+              ((x - x0) > 1.E-5)
+        if idx.any():
+            values = numpy.where(idx,
+                            exp((log(y1[:nInterpolated]) * log(x/x0))/logX),
+                            values)
+        values = numpy.where(close, y1[:nInterpolated], values)
+
+        #partial cross sections
+        y0 = y0[nInterpolated:]
+        y1 = y1[nInterpolated:]
+        shellBinding = numpy.array([binding[key] for key in ATOMIC_SHELLS],
+                                   numpy.float64)
+        above = x >= shellBinding[:, None]
+        standard = (y0 > 0.0) & above
+        shellValues = numpy.where(standard,
+                                  numpy.where(close,
+                                              y1,
+                                              interpolated[nInterpolated:]),
+                                  0.0)
+        #enforce the excitation extrapolating the first values
+        forced = numpy.array([key in forced_shells for key in ATOMIC_SHELLS])
+        idx = (~standard) & (above | forced[:, None])
+        if idx.any():
+            shells = packed[_FIRST_INTERPOLATED_ROW + nInterpolated:]
+            for i in numpy.nonzero(idx.any(axis=1))[0]:
+                l = numpy.nonzero(shells[i] > 0.0)[0]
+                if not len(l):
+                    continue
+                j00 = l[0]
+                j01 = j00 + 1
+                x00 = wenergy[j00]
+                x01 = wenergy[j01]
+                shellValues[i, idx[i]] = exp((log(shells[i, j00]) * \
+                                              log(x01/x[idx[i]]) + \
+                                              log(shells[i, j01]) * \
+                                              log(x[idx[i]]/x00)) / \
+                                              log(x01/x00))
 
+    ddict = {}
+    ddict['energy'] = energy
+    for i, key in enumerate(_INTERPOLATED_KEYS):
+        ddict[key] = values[i]
+    for i, key in enumerate(ATOMIC_SHELLS):
+        ddict[key] = shellValues[i]
+    photo = numpy.zeros(energy.shape, numpy.float64)
+    for key in ['all other'] + ATOMIC_SHELLS:
+        photo += ddict[key]
+    ddict['photo'] = photo
+    total = numpy.zeros(energy.shape, numpy.float64)
+    for key in ['coherent', 'compton', 'photo']:
+        total += ddict[key]
+    ddict['total'] = total
+    return ddict
 
 def getElementCrossSections(element, energy=None, forced_shells=None):
     """
@@ -229,6 +342,8 @@ def getElementCrossSections(element, energy=None, forced_shells=None):
     binding energies of EPDL97 for all shells. If forced_shells is specified,
     it enforces excitation of the relevant shells via log-log extrapolation
     if needed.
+    All the energies are calculated at once and the last results are kept
+    in memory.
     """
     if forced_shells is None:
         forced_shells = []
@@ -241,107 +356,24 @@ def getElementCrossSections(element, energy=None, forced_shells=None):
         return EPDL97_DICT[element]['EPDL97']
     elif energy is None:
         energy = EPDL97_DICT[element]['EPDL97']['energy']
+    energy = numpy.asarray(energy, dtype=numpy.float64).reshape(-1)
 
-    try:
-        n = len(energy)
-    except TypeError:
-        energy = numpy.array([energy])
-    if type(energy) in [type(1), type(1.0)]:
-        energy = numpy.array([energy])
-    elif type(energy) in [type([]), type((1,))]:
-        energy = numpy.array(energy)
-
+    # the binding energies can be changed at any time
     binding = EPDL97_DICT[element]['binding']
-    wdata = EPDL97_DICT[element]['EPDL97']
-    ddict = {}
-    ddict['energy']     = energy
-    ddict['coherent']   = 0.0 * energy
-    ddict['compton']    = 0.0 * energy
-    ddict['photo']      = 0.0 * energy
-    ddict['pair']       = 0.0 * energy
-    ddict['all other']  = 0.0 * energy
-    ddict['total']      = 0.0 * energy
-    atomic_shells = ['M5', 'M4', 'M3', 'M2', 'M1', 'L3', 'L2', 'L1', 'K']
-    for key in atomic_shells:
-        ddict[key] = 0.0 * energy
-
-    #find interpolation point
-    len_energy = len(energy)
-    for i in range(len_energy):
-        x = energy[i]
-        if x > wdata['energy'][-2]:
-            #take last value or extrapolate?
-            print("Warning: Extrapolating data at the end")
-            j1 = len(wdata['energy']) - 1
-            j0 = j1 - 1
-        elif x <= wdata['energy'][0]:
-            #take first value or extrapolate?
-            print("Warning: Extrapolating data at the beginning")
-            j1 = 1
-            j0 = 0
-        else:
-            j0 = numpy.max(numpy.nonzero(wdata['energy'] < x), axis=1)
-            j1 = j0 + 1
-        x0 = wdata['energy'][j0]
-        x1 = wdata['energy'][j1]
-        if x == x1:
-            if (j1 + 1 ) < len(wdata['energy']):
-                if x1 == wdata['energy'][j1 + 1]:
-                    j0 = j1
-                    j1 += 1
-                    x0 = wdata['energy'][j0]
-                    x1 = wdata['energy'][j1]
-
-        #coherent and incoherent
-        for key in ['coherent', 'compton', 'pair', 'all other']:
-            if (j0 == j1) or ((x1 - x0) < 5.E-10) or ((x1 - x) < 5.E-10) :
-                ddict[key][i] =  wdata[key][j1]
-            else:
-                y0 = wdata[key][j0]
-                y1 = wdata[key][j1]
-                if (y0 > 0) and (y1 > 0):
-                    ddict[key][i] = exp((log(y0) * log(x1/x) +\
-                                     log(y1) * log(x/x0))/log(x1/x0))
-                elif (y1 > 0) and ((x-x0) > 1.E-5):
-                    ddict[key][i] = exp((log(y1) * log(x/x0))/log(x1/x0))
-
-
-        #partial cross sections
-        for key in atomic_shells:
-            y0 = wdata[key][j0]
-            if (y0 > 0.0) and (x >= binding[key]):
-                #standard way
-                y1 = wdata[key][j1]
-                if (((x1 - x0) < 5.E-10) or ((x1 - x) < 5.E-10)):
-                    # no interpolation needed
-                    ddict[key][i] = y1
-                else:
-                    ddict[key][i] = exp((log(y0) * log(x1/x) +\
-                                 log(y1) * log(x/x0))/log(x1/x0))
-            elif (forced_shells == []) and (x < binding[key]):
-                continue
-            elif (key in forced_shells) or (x >= binding[key]):
-                l = numpy.nonzero(wdata[key] > 0.0)
-                if not len(l[0]):
-                    continue
-                j00 = numpy.min(l)
-                j01 = j00 + 1
-                x00 = wdata['energy'][j00]
-                x01 = wdata['energy'][j01]
-                y0 = wdata[key][j00]
-                y1 = wdata[key][j01]
-                ddict[key][i] = exp((log(y0) * log(x01/x) +\
-                                 log(y1) * log(x/x00))/log(x01/x00))
-
-        for key in ['all other'] + atomic_shells:
-            ddict['photo'][i] += ddict[key][i]
-
-        for key in ['coherent', 'compton', 'photo']:
-            ddict['total'][i] += ddict[key][i]
-    for key in ddict.keys():
-        ddict[key] = ddict[key].tolist()
-    return ddict
-
+    cacheKey = element, energy.tobytes(), tuple(sorted(forced_shells)), \
+               tuple([binding.get(key, None) for key in ATOMIC_SHELLS])
+    ddict = _crossSectionsCache.pop(cacheKey, None)
+    if ddict is None:
+        ddict = _calculateElementCrossSections(element, energy, forced_shells)
+        for key in ddict:
+            ddict[key] = ddict[key].tolist()
+    _crossSectionsCache[cacheKey] = ddict
+    while len(_crossSectionsCache) > CROSS_SECTIONS_CACHE_SIZE:
+        _crossSectionsCache.popitem(last=False)
+    output = {}
+    for key in ddict:
+        output[key] = ddict[key][:]
+    return output
 
 def getPhotoelectricWeights(element, shelllist, energy, normalize = None, totals = None):
     """
@@ -32,10 +32,9 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import sys
 import os
-from PyMca5.PyMcaIO import ConfigDict
+from PyMca5.PyMcaIO import ConfigDictCache
 from PyMca5 import PyMcaDataDir
 
-dict = ConfigDict.ConfigDict()
 dirmod = PyMcaDataDir.PYMCA_DATA_DIR
 dictfile = os.path.join(dirmod, "Scofield1973.dict")
 if not os.path.exists(dictfile):
@@ -48,6 +47,7 @@
 if not os.path.exists(dictfile):
     print("Cannot find file ", dictfile)
     raise IOError("Cannot find file %s " % dictfile)
-dict.read(dictfile)
+# one section per element, read on first use
+dict = ConfigDictCache.readConfigDict(dictfile, lazy=True)
 
 
@@ -127,8 +127,8 @@ def applyStrategy(self, fitResult, fluorescenceRates, currentIteration=None):
             else:
                 massFractions = Elements.getMaterialMassFractions( \
                             [material], [1.0])
-                CompoundFraction.append(massFractions[ele] / \
-                                       ddict["mass fraction"][group])
+                CompoundFraction.append(ddict["mass fraction"][group] / \
+                                        massFractions[ele])
                 CompoundList.append(material)
             total += CompoundFraction[-1]
         if strategyConfiguration["completer"] not in ["-"]:
@@ -84,6 +84,7 @@ def __init__(self, stackWindow, **kw):
         self.configurationWidget = None
         self.widget = None
         self.thread = None
+        self._progressMessage = None
 
     def stackUpdated(self):
         if DEBUG:
@@ -184,6 +185,7 @@ def _executeFunctionAndParameters(self):
                      self.threadFinished)
         self.configurationWidget.show()
         message = "Please wait. NNMA Calculation going on."
+        self._progressMessage = message
         if DEBUG:
             print("NNMAStackPlugin starting thread")
         self.thread.start()
@@ -191,7 +193,8 @@ def _executeFunctionAndParameters(self):
             print("NNMAStackPlugin waitingMessageDialog")
         CalculationThread.waitingMessageDialog(self.thread,
                                 message=message,
-                                parent=self.configurationWidget)
+                                parent=self.configurationWidget,
+                                update_callback=self._waitingCallback)
         if DEBUG:
             print("NNMAStackPlugin waitingMessageDialog passed")
 
@@ -209,6 +212,8 @@ def actualCalculation(self):
         ddict.update(nnmaParameters['kw'])
         ddict['ncomponents'] = nnmaParameters['npc']
         ddict['binning'] = nnmaParameters['binning']
+        if nnmaParameters.get('blocks', False):
+            ddict['callback'] = self._progressCallback
         #ddict['kmeans'] = False
         del nnmaParameters
         stack = self.getStackDataObject()
@@ -225,6 +230,20 @@ def actualCalculation(self):
             stack.data.shape = oldShape
         return result
 
+    def _progressCallback(self, ddict):
+        # called from the calculation thread, the message is shown by
+        # the waiting dialog from the main thread
+        self._progressMessage = "Iteration %d of %d. Objective %g" % \
+                                                    (ddict['iteration'],
+                                                     ddict['maxcount'],
+                                                     ddict['objective'])
+        return True
+
+    def _waitingCallback(self):
+        ddict = {}
+        ddict['message'] = self._progressMessage
+        return ddict
+
     def threadFinished(self):
         if DEBUG:
             print("NNMAStackPlugin threadFinished")
@@ -0,0 +1,202 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+try:
+    import h5py
+    HDF5 = True
+except ImportError:
+    HDF5 = False
+
+DEBUG = 0
+
+class testBatchHDF5Output(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.nRows = 6
+        self.nColumns = 5
+        self.parameters = ["Ca K", "Fe K"]
+        self.concentrations = ["Ca K mass fraction", "Fe K mass fraction"]
+        data = numpy.arange(self.nRows * self.nColumns, dtype=numpy.float64)
+        data.shape = self.nRows, self.nColumns
+        self.data = {}
+        self.data['parameters_data'] = numpy.array([data, 2 * data])
+        self.data['uncertainties_data'] = numpy.sqrt(\
+                                            self.data['parameters_data'])
+        self.data['concentrations_data'] = 0.001 * \
+                                            self.data['parameters_data']
+        self.data['chisq'] = 1.0 + 0.01 * data
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def _writeRows(self, output, rows):
+        for row in rows:
+            output.writeRow(row,
+                            self.data['parameters_data'][:, row],
+                            self.data['uncertainties_data'][:, row],
+                            self.data['chisq'][row],
+                            concentrations=\
+                                self.data['concentrations_data'][:, row])
+
+    def _getOutput(self, filename, **kw):
+        from PyMca5.PyMcaIO import BatchHDF5Output
+        return BatchHDF5Output.BatchHDF5Output(filename,
+                                        self.nRows, self.nColumns,
+                                        self.parameters,
+                                        concentrations=self.concentrations,
+                                        **kw)
+
+    def testAppendAndReadRows(self):
+        if DEBUG:
+            print()
+            print("Testing the rows kept by an appended output")
+        if not HDF5:
+            print("skipping HDF5 batch output test, h5py not available")
+            return
+        from PyMca5.PyMcaIO import BatchHDF5Output
+        filename = os.path.join(self.tmpDir, "output.h5")
+        output = self._getOutput(filename, attributes={'mca_step': 1})
+        self._writeRows(output, [0, 1])
+        output.close()
+
+        output = self._getOutput(filename, append=True)
+        self._writeRows(output, [3])
+        output.close()
+        ddict = BatchHDF5Output.readBatchHDF5Output(filename)
+        self.assertEqual(list(ddict['finished']),
+                         [True, True, False, True, False, False])
+        self.assertEqual(ddict['attributes']['mca_step'], 1)
+        for key in self.data:
+            for row in [0, 1, 3]:
+                self.assertTrue(numpy.all(ddict[key][..., row, :] == \
+                                          self.data[key][..., row, :]))
+
+        # only the names and the finished rows
+        ddict = BatchHDF5Output.readBatchHDF5Output(filename, data=False)
+        self.assertEqual(ddict['parameters'], self.parameters)
+        self.assertEqual(ddict['concentrations'], self.concentrations)
+        self.assertEqual((ddict['nrows'], ddict['ncols']),
+                         (self.nRows, self.nColumns))
+        for key in self.data:
+            self.assertTrue(ddict[key] is None)
+        rows = []
+        for row, parameters, uncertainties, chisq, concentrations in \
+            BatchHDF5Output.readBatchHDF5Rows(filename, [3, 1]):
+            rows.append(row)
+            self.assertTrue(numpy.all(parameters == \
+                                      self.data['parameters_data'][:, row]))
+            self.assertTrue(numpy.all(uncertainties == \
+                                    self.data['uncertainties_data'][:, row]))
+            self.assertTrue(numpy.all(chisq == self.data['chisq'][row]))
+            self.assertTrue(numpy.all(concentrations == \
+                                self.data['concentrations_data'][:, row]))
+        self.assertEqual(rows, [3, 1])
+
+        # a different layout cannot be appended
+        self.assertRaises(ValueError, BatchHDF5Output.BatchHDF5Output,
+                          filename, self.nRows, self.nColumns,
+                          self.parameters[:1],
+                          concentrations=self.concentrations, append=True)
+        self.assertRaises(ValueError, BatchHDF5Output.BatchHDF5Output,
+                          filename, self.nRows + 1, self.nColumns,
+                          self.parameters,
+                          concentrations=self.concentrations, append=True)
+        ddict = BatchHDF5Output.readBatchHDF5Output(filename)
+        self.assertEqual(int(ddict['finished'].sum()), 3)
+
+    def testBuildOutput(self):
+        if DEBUG:
+            print()
+            print("Testing the merge of the partial outputs")
+        if not HDF5:
+            print("skipping HDF5 batch output test, h5py not available")
+            return
+        from PyMca5.PyMcaIO import BatchHDF5Output
+        from PyMca5.PyMcaCore import PyMcaBatchBuildOutput
+        # as written by two processes fitting half of the rows each
+        partialRows = [[0, 2, 4], [1, 3]]
+        for i, rows in enumerate(partialRows):
+            filename = os.path.join(self.tmpDir,
+                                    "map_%06d_partial.h5" % i)
+            output = self._getOutput(filename)
+            self._writeRows(output, rows)
+            output.close()
+        outputDir = os.path.join(self.tmpDir, "merged")
+        os.mkdir(outputDir)
+        readRows = []
+        readBatchHDF5Rows = BatchHDF5Output.readBatchHDF5Rows
+        def countRows(filename, rows):
+            for item in readBatchHDF5Rows(filename, rows):
+                readRows.append(item[0])
+                yield item
+        BatchHDF5Output.readBatchHDF5Rows = countRows
+        try:
+            work = PyMcaBatchBuildOutput.PyMcaBatchBuildOutput(self.tmpDir,
+                                                               outputDir)
+            outputList = work.buildHDF5Output(delete=True)
+        finally:
+            BatchHDF5Output.readBatchHDF5Rows = readBatchHDF5Rows
+        filename = os.path.join(outputDir, "map.h5")
+        self.assertEqual(outputList, [filename])
+        self.assertEqual(readRows, [0, 2, 4, 1, 3])
+        for i in range(len(partialRows)):
+            self.assertFalse(os.path.exists(os.path.join(self.tmpDir,
+                                        "map_%06d_partial.h5" % i)))
+        ddict = BatchHDF5Output.readBatchHDF5Output(filename)
+        self.assertEqual(list(ddict['finished']),
+                         [True] * 5 + [False])
+        for key in self.data:
+            self.assertTrue(numpy.all(ddict[key][..., :5, :] == \
+                                      self.data[key][..., :5, :]))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testBatchHDF5Output))
+    else:
+        # use a predefined order
+        testSuite.addTest(testBatchHDF5Output("testAppendAndReadRows"))
+        testSuite.addTest(testBatchHDF5Output("testBuildOutput"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
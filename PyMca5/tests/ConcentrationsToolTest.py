@@ -0,0 +1,285 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import copy
+import numpy
+
+DEBUG = 0
+
+class testConcentrationsTool(unittest.TestCase):
+    GROUPS = ['Ca K', 'Fe K', 'Cu K', 'Zn K', 'Sr K', 'Pb L']
+
+    def setUp(self):
+        from PyMca5.PyMcaPhysics.xrf import Elements
+        from PyMca5.PyMcaPhysics.xrf import ConcentrationsTool
+        from PyMca5.PyMcaPhysics.xrf import SingleLayerStrategy
+        self._elements = Elements
+        self._concentrationsTool = ConcentrationsTool
+        self._strategy = SingleLayerStrategy
+        energies = [10.0, 17.5, 25.0]
+        self.fitConfiguration = {
+            'attenuators': {'Matrix': [1, 'Goethite', 4.0, 0.01, 45.0, 45.0],
+                            'air': [1, 'Air', 0.0012, 2.0, 1.0],
+                            'BeamFilter0': [1, 'Kapton', 1.42, 0.001, 1.0],
+                            'Detector': [1, 'Si1', 2.33, 0.5, 1.0]},
+            'fit': {'energy': energies,
+                    'energyflag': [1] * len(energies),
+                    'energyweight': [1.0, 0.5, 0.25],
+                    'strategyflag': 0,
+                    'strategy': 'SingleLayerStrategy'},
+            'concentrations': {'usematrix': 0,
+                               'useattenuators': 1,
+                               'usemultilayersecondary': 0,
+                               'usexrfmc': 0,
+                               'flux': 1.0e10,
+                               'time': 1.0,
+                               'area': 30.0,
+                               'distance': 10.0,
+                               'reference': 'Auto',
+                               'mmolarflag': 0},
+            'SingleLayerStrategy': {'iterations': 3,
+                                    'peaks': ['Fe K', 'Ca K', '-'],
+                                    'materials': ['Fe2O3', 'Ca1C1O3', '-'],
+                                    'completer': 'Si1O2',
+                                    'layer': 'Auto',
+                                    'flags': [1, 1, 0]},
+            'materials': {}}
+        numpy.random.seed(0)
+        self.areas = {}
+        for group in self.GROUPS:
+            self.areas[group] = numpy.random.uniform(1.0e4, 1.0e5, (3, 4))
+        self.areas['Zn K'][0, 0] = -3.0
+
+    def _getFitResult(self, fitConfiguration, i, j):
+        fitResult = {}
+        fitResult['config'] = copy.deepcopy(fitConfiguration)
+        fitResult['groups'] = self.GROUPS * 1
+        for group in self.GROUPS:
+            fitResult[group] = {'fitarea': self.areas[group][i, j],
+                                'sigmaarea': 1.0}
+        return fitResult
+
+    def testMatrixRates(self):
+        if DEBUG:
+            print()
+            print("Testing vectorized matrix fluorescence rates")
+        tool = self._concentrationsTool.ConcentrationsTool()
+        tool.configure(self.fitConfiguration['concentrations'])
+        model = tool._getMatrixModel(copy.deepcopy(self.fitConfiguration),
+                                     self.GROUPS,
+                                     self.fitConfiguration['SingleLayerStrategy'])
+        # one pixel per material
+        materials = ['Goethite', 'Fe2O3', 'Si1O2']
+        composition = numpy.zeros((len(model['elements']), len(materials)))
+        for i, material in enumerate(materials):
+            massFractions = self._elements.getMaterialMassFractions([material],
+                                                                    [1.0])
+            for ele in massFractions:
+                composition[model['elements'].index(ele), i] = \
+                                                    massFractions[ele]
+        rates = tool._getMatrixRates(model, composition)
+        attenuators, beamfilters, funnyfilters, detector, matrix, \
+                     alphain, alphaout = \
+                     tool._getAttenuators(copy.deepcopy(self.fitConfiguration))
+        energyList, weightList, flagList = \
+                     tool._getExcitation(self.fitConfiguration)
+        elementsList = [[self._elements.getz(group.split()[0]),
+                         group.split()[0],
+                         group.split()[1]] for group in self.GROUPS]
+        for i, material in enumerate(materials):
+            fluo = self._elements.getMultilayerFluorescence( \
+                                    [[material, matrix[1], matrix[2]]],
+                                    energyList,
+                                    weightList=weightList,
+                                    flagList=flagList,
+                                    beamfilters=beamfilters,
+                                    attenuators=attenuators,
+                                    elementsList=elementsList * 1,
+                                    alphain=alphain,
+                                    alphaout=alphaout,
+                                    cascade=True,
+                                    detector=detector,
+                                    forcepresent=1)
+            for group in self.GROUPS:
+                ele, family = group.split()
+                refRate = fluo[ele]['rates'][family + " xrays"]
+                self.assertTrue(refRate > 0.0)
+                self.assertTrue(abs(rates[group][i] - refRate) < \
+                                1.0e-12 * refRate,
+                                "%s in %s: %g != %g" % \
+                                (group, material, rates[group][i], refRate))
+
+    def testAreaImages(self):
+        if DEBUG:
+            print()
+            print("Testing area images against single spectrum results")
+        tool = self._concentrationsTool.ConcentrationsTool()
+        for reference in [None, 'Fe']:
+            config = tool.configure(self.fitConfiguration['concentrations'])
+            fitConfiguration = copy.deepcopy(self.fitConfiguration)
+            if reference is not None:
+                config['usematrix'] = 1
+                config['reference'] = reference
+            result = tool.processAreaImages(self.areas,
+                                            copy.deepcopy(fitConfiguration),
+                                            config=config)
+            for i, j in [(0, 0), (1, 2), (2, 3)]:
+                fitResult = self._getFitResult(fitConfiguration, i, j)
+                ddict = tool.processFitResult(config=config,
+                                              fitresult={'result': fitResult})
+                for group in self.GROUPS:
+                    self.assertEqual(result['mass fraction'][group].shape,
+                                     (3, 4))
+                    value = result['mass fraction'][group][i, j]
+                    refValue = ddict['mass fraction'][group]
+                    self.assertTrue(abs(value - refValue) <= \
+                                    1.0e-12 * abs(refValue),
+                                    "%s: %g != %g" % (group, value, refValue))
+
+        # the scatter peaks are not element groups
+        areas = dict(self.areas)
+        areas["Scatter Peak000"] = numpy.ones((3, 4))
+        areas["Scatter Compton000"] = numpy.ones((3, 4))
+        result = tool.processAreaImages(areas,
+                                        copy.deepcopy(self.fitConfiguration),
+                                        config=config)
+        self.assertEqual(sorted(result['groups']), sorted(self.GROUPS))
+
+    def testAreaImagesStrategy(self):
+        if DEBUG:
+            print()
+            print("Testing area images with the single layer strategy")
+        tool = self._concentrationsTool.ConcentrationsTool()
+        config = tool.configure(self.fitConfiguration['concentrations'])
+        fitConfiguration = copy.deepcopy(self.fitConfiguration)
+        fitConfiguration['fit']['strategyflag'] = 1
+        result = tool.processAreaImages(self.areas,
+                                        copy.deepcopy(fitConfiguration),
+                                        config=config)
+        # compare with the strategy applied to single spectra
+        strategy = self._strategy.SingleLayerStrategy()
+        materialName = "SingleLayerStrategyMaterial"
+        try:
+            for i, j in [(0, 0), (2, 3)]:
+                fitResult = self._getFitResult(fitConfiguration, i, j)
+                iteration = None
+                while True:
+                    newConfiguration, iteration = strategy.applyStrategy( \
+                                            fitResult,
+                                            None,
+                                            currentIteration=iteration)
+                    if not len(newConfiguration):
+                        break
+                    self._elements.Material[materialName] = \
+                            newConfiguration['materials'][materialName]
+                    fitResult['config'] = newConfiguration
+                ddict = tool.processFitResult(config=config,
+                                              fitresult={'result': fitResult})
+                for group in self.GROUPS:
+                    value = result['mass fraction'][group][i, j]
+                    refValue = ddict['mass fraction'][group]
+                    self.assertTrue(abs(value - refValue) <= \
+                                    1.0e-12 * abs(refValue),
+                                    "%s: %g != %g" % (group, value, refValue))
+        finally:
+            if materialName in self._elements.Material:
+                del self._elements.Material[materialName]
+
+        # the strategy cannot be applied with an internal reference
+        config['usematrix'] = 1
+        config['reference'] = 'Fe'
+        result = tool.processAreaImages(self.areas,
+                                        copy.deepcopy(fitConfiguration),
+                                        config=config)
+        fitConfiguration['fit']['strategyflag'] = 0
+        refResult = tool.processAreaImages(self.areas,
+                                           copy.deepcopy(fitConfiguration),
+                                           config=config)
+        for group in self.GROUPS:
+            self.assertTrue(numpy.allclose(result['mass fraction'][group],
+                                           refResult['mass fraction'][group],
+                                           rtol=1.0e-12, atol=0.0))
+        self.assertRaises(ValueError, tool.processAreaImages,
+                          self.areas, copy.deepcopy(fitConfiguration),
+                          config=config, iterations=2)
+
+    def testSingleLayerStrategyComposition(self):
+        if DEBUG:
+            print()
+            print("Testing single layer strategy compound fractions")
+        tool = self._concentrationsTool.ConcentrationsTool()
+        config = tool.configure(self.fitConfiguration['concentrations'])
+        fitResult = self._getFitResult(self.fitConfiguration, 1, 1)
+        ddict = tool.processFitResult(config=copy.deepcopy(config),
+                                      fitresult={'result': \
+                                                 copy.deepcopy(fitResult)})
+        strategy = self._strategy.SingleLayerStrategy()
+        newConfiguration, iteration = strategy.applyStrategy(fitResult, None)
+        self.assertEqual(iteration,
+                self.fitConfiguration['SingleLayerStrategy']['iterations'] - 1)
+        material = newConfiguration['materials']["SingleLayerStrategyMaterial"]
+        self.assertEqual(material['CompoundList'],
+                         ['Fe2O3', 'Ca1C1O3', 'Si1O2'])
+        # the fraction of a compound is the concentration of the element
+        # divided by its mass fraction in the compound
+        expected = []
+        for group, compound in [('Fe K', 'Fe2O3'), ('Ca K', 'Ca1C1O3')]:
+            massFractions = self._elements.getMaterialMassFractions([compound],
+                                                                    [1.0])
+            expected.append(ddict['mass fraction'][group] / \
+                            massFractions[group.split()[0]])
+        self.assertTrue(sum(expected) < 1.0)
+        expected.append(1.0 - sum(expected))
+        for value, refValue in zip(material['CompoundFraction'], expected):
+            self.assertTrue(abs(value - refValue) <= 1.0e-12 * refValue)
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testConcentrationsTool))
+    else:
+        testSuite.addTest(testConcentrationsTool("testMatrixRates"))
+        testSuite.addTest(testConcentrationsTool("testAreaImages"))
+        testSuite.addTest(testConcentrationsTool("testAreaImagesStrategy"))
+        testSuite.addTest(\
+            testConcentrationsTool("testSingleLayerStrategyComposition"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
@@ -111,6 +111,87 @@ def testConfigDictIO(self):
                 self.assertTrue( read == original,
                             "Read <%s> instead of <%s>" % (read, original))
 
+    def testConfigDictCache(self):
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaIO import ConfigDictCache
+        import shutil
+        import copy
+        import pickle
+        tmpFile = tempfile.mkstemp(text=False)
+        os.close(tmpFile[0])
+        self._tmpFileName = tmpFile[1]
+        cacheDir = tempfile.mkdtemp()
+        oldValue = os.environ.get("PYMCA_CACHE_DIR", None)
+        os.environ["PYMCA_CACHE_DIR"] = cacheDir
+        try:
+            testDict = {'Fe': {'c': [1.0, 2.0], 'name': 'Iron'},
+                        'Cu': {'c': [3.0, 4.0], 'name': 'Copper'}}
+            ConfigDict.ConfigDict(initdict=testDict).write(self._tmpFileName)
+            # the second reading comes from the cache
+            for i in range(2):
+                readInstance = ConfigDictCache.readConfigDict(\
+                                                    self._tmpFileName)
+                self.assertEqual(readInstance, testDict)
+                self.assertTrue(len(os.listdir(cacheDir)) == 1)
+            lazyInstance = ConfigDictCache.readConfigDict(self._tmpFileName,
+                                                          lazy=True)
+            self.assertEqual(lazyInstance['Cu']['name'], 'Copper')
+            self.assertTrue('Fe' in lazyInstance)
+            self.assertEqual(sorted(lazyInstance.keys()), ['Cu', 'Fe'])
+            # a modified file is read again
+            testDict['Fe']['name'] = 'Ferrum'
+            ConfigDict.ConfigDict(initdict=testDict).write(self._tmpFileName)
+            readInstance = ConfigDictCache.readConfigDict(self._tmpFileName)
+            self.assertEqual(readInstance['Fe']['name'], 'Ferrum')
+
+            # the whole dictionary is loaded when needed
+            for method in [copy.deepcopy, copy.copy, dict,
+                           lambda x: x.copy(),
+                           lambda x: pickle.loads(pickle.dumps(x, 2))]:
+                lazyInstance = ConfigDictCache.readConfigDict(\
+                                            self._tmpFileName, lazy=True)
+                self.assertEqual(method(lazyInstance), testDict)
+            lazyInstance = ConfigDictCache.readConfigDict(self._tmpFileName,
+                                                          lazy=True)
+            self.assertTrue(lazyInstance == testDict)
+            self.assertEqual(lazyInstance.pop('Fe'), testDict['Fe'])
+            self.assertFalse('Fe' in lazyInstance)
+            self.assertEqual(lazyInstance.pop('Fe', None), None)
+            self.assertEqual(lazyInstance.setdefault('Cu', None),
+                             testDict['Cu'])
+            self.assertEqual(list(lazyInstance.keys()), ['Cu'])
+            lazyInstance = ConfigDictCache.readConfigDict(self._tmpFileName,
+                                                          lazy=True)
+            del lazyInstance['Cu']
+            self.assertEqual(list(lazyInstance.items()),
+                             [('Fe', testDict['Fe'])])
+
+            # the cache can be disabled
+            shutil.rmtree(cacheDir)
+            os.environ["PYMCA_NO_CACHE"] = "1"
+            try:
+                readInstance = ConfigDictCache.readConfigDict(\
+                                                    self._tmpFileName)
+                self.assertEqual(readInstance, testDict)
+                self.assertFalse(os.path.exists(cacheDir))
+            finally:
+                del os.environ["PYMCA_NO_CACHE"]
+
+            # a cache that cannot be written is just not used
+            os.environ["PYMCA_CACHE_DIR"] = os.path.join(self._tmpFileName,
+                                                         "cache")
+            for lazy in [False, True]:
+                readInstance = ConfigDictCache.readConfigDict(\
+                                            self._tmpFileName, lazy=lazy)
+                self.assertEqual(readInstance, testDict)
+        finally:
+            if oldValue is None:
+                del os.environ["PYMCA_CACHE_DIR"]
+            else:
+                os.environ["PYMCA_CACHE_DIR"] = oldValue
+            if os.path.exists(cacheDir):
+                shutil.rmtree(cacheDir)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -120,6 +201,7 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testConfigDict("testConfigDictImport"))
         testSuite.addTest(testConfigDict("testConfigDictIO"))
+        testSuite.addTest(testConfigDict("testConfigDictCache"))
     return testSuite
 
 def test(auto=False):
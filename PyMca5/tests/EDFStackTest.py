@@ -0,0 +1,141 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+DEBUG = 0
+
+class testEDFStack(unittest.TestCase):
+    def setUp(self):
+        from PyMca5.PyMcaIO import EdfFile
+        self.tmpDir = tempfile.mkdtemp()
+        self.data = numpy.arange(6 * 4 * 5, dtype=numpy.float32)
+        self.data.shape = 6, 4, 5
+        self.fileList = []
+        for i in range(self.data.shape[0]):
+            fileName = os.path.join(self.tmpDir, "image_%02d.edf" % i)
+            edf = EdfFile.EdfFile(fileName, 'wb')
+            if i == 3:
+                # missing data at the end of the image
+                edf.WriteImage({}, self.data[i, :3])
+            else:
+                edf.WriteImage({}, self.data[i])
+            del edf
+            self.fileList.append(fileName)
+        self.data[3, 3:] = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def testLazyFileList(self):
+        if DEBUG:
+            print()
+            print("Testing the lazy access to a list of EDF files")
+        from PyMca5.PyMcaIO import EDFStack
+        progress = []
+        class Stack(EDFStack.EDFStack):
+            def onBegin(self, n):
+                progress.append(("begin", n))
+
+            def onEnd(self):
+                progress.append(("end",))
+
+        stack = Stack(self.fileList, lazy=True)
+        self.assertEqual(progress, [("begin", 6), ("end",)])
+        self.assertTrue(isinstance(stack.data, EDFStack.EDFFileListData))
+        self.assertEqual(stack.data.shape, self.data.shape)
+        self.assertTrue(numpy.all(stack.data[:] == self.data))
+        self.assertTrue(numpy.all(stack.data[1:5:2, 2, ::2] == \
+                                  self.data[1:5:2, 2, ::2]))
+        self.assertTrue(numpy.all(stack.data[-1] == self.data[-1]))
+
+        # the files are mapped, at most the cache size are kept open
+        data = EDFStack.EDFFileListData(self.fileList, cachesize=2)
+        for i in range(self.data.shape[0]):
+            self.assertTrue(numpy.all(data[i] == self.data[i]))
+        self.assertEqual(list(data._frames.keys()), [4, 5])
+        for frame in data._frames.values():
+            self.assertTrue(isinstance(frame, numpy.memmap))
+            self.assertEqual(frame.shape, self.data.shape[1:])
+
+        # the short file is decoded and padded
+        self.assertTrue(numpy.all(data[3] == self.data[3]))
+        self.assertEqual(list(data._frames.keys()), [5, 3])
+        self.assertFalse(isinstance(data._frames[3], numpy.memmap))
+
+        # a pixel spectrum only touches the mapped files
+        self.assertTrue(numpy.all(data[:, 2, 3] == self.data[:, 2, 3]))
+        self.assertEqual(len(data._frames), 2)
+
+        # concurrent readers share the cache
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(4)
+        try:
+            results = pool.map(lambda i: data[i % 6, 1], range(60))
+        finally:
+            pool.close()
+            pool.join()
+        for i, result in enumerate(results):
+            self.assertTrue(numpy.all(result == self.data[i % 6, 1]))
+        self.assertEqual(len(data._frames), 2)
+
+        # the first image gives the shape of the stack
+        data = EDFStack.EDFFileListData(self.fileList[3:] + self.fileList[:3])
+        self.assertEqual(data.shape, (6, 3, 5))
+        self.assertTrue(numpy.all(data[0] == self.data[3, :3]))
+        self.assertTrue(numpy.all(data[1:3] == self.data[4:, :3]))
+
+        # the eager loading gives the same stack
+        stack = EDFStack.EDFStack(self.fileList, lazy=False)
+        self.assertTrue(type(stack.data) is numpy.ndarray)
+        self.assertTrue(numpy.all(stack.data == self.data))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testEDFStack))
+    else:
+        # use a predefined order
+        testSuite.addTest(testEDFStack("testLazyFileList"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
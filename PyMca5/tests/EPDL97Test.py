@@ -0,0 +1,247 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import copy
+import numpy
+
+DEBUG = 0
+
+ATOMIC_SHELLS = ['M5', 'M4', 'M3', 'M2', 'M1', 'L3', 'L2', 'L1', 'K']
+
+def _readElement(EPDL97, element):
+    # one array per quantity, as the module used to keep the data
+    from PyMca5.PyMcaIO import specfile
+    sf = specfile.Specfile(EPDL97.EPDL97_FILE)
+    scanIndex = min(EPDL97.ElementList.index(element), 99)
+    scan = sf[scanIndex]
+    labels = scan.alllabels()
+    data = scan.data()
+    scan = None
+    sf = None
+    wdata = {}
+    for i, label in enumerate(labels):
+        label = label.lower()
+        if ('coherent' in label) and ('incoherent' not in label):
+            wdata['coherent'] = data[i, :] * 1
+        elif ('incoherent' in label) and ('plus' not in label):
+            wdata['compton'] = data[i, :] * 1
+        elif 'allother' in label:
+            wdata['all other'] = data[i, :] * 1
+        else:
+            label = label.replace(" ", "").split("(")[0]
+            if 'energy' in label:
+                wdata['energy'] = data[i, :] * 1
+            elif 'photoelectric' in label:
+                wdata['photoelectric'] = data[i, :] * 1
+            elif 'total' in label:
+                wdata['total'] = data[i, :] * 1
+            elif label[0].upper() in ['K', 'L', 'M']:
+                wdata[label.upper()] = data[i, :] * 1
+    wdata['pair'] = 0.0 * wdata['energy']
+    wdata['photo'] = wdata['total'] - wdata['compton'] - \
+                     wdata['coherent'] - wdata['pair']
+    if scanIndex > 17:
+        idx = wdata['all other'] > 0.0
+        delta = 0.0
+        for key in ATOMIC_SHELLS:
+            delta += wdata[key]
+        wdata['all other'] = (wdata['photo'] - delta) * idx
+    else:
+        wdata['all other'] = 0.0 * wdata['photo']
+    wdata['all other'][wdata['all other'] < 0.0] = 0.0
+    return wdata
+
+def _logInterpolation(x, x0, x1, y0, y1):
+    return numpy.exp((numpy.log(y0) * numpy.log(x1 / x) + \
+                      numpy.log(y1) * numpy.log(x / x0)) / \
+                     numpy.log(x1 / x0))
+
+def _getCrossSections(wdata, binding, energy, forcedShells):
+    # one energy at a time, as the module used to calculate them
+    wenergy = wdata['energy']
+    ddict = {}
+    for key in ['coherent', 'compton', 'pair', 'all other', 'photo',
+                'total'] + ATOMIC_SHELLS:
+        ddict[key] = numpy.zeros(len(energy))
+    for i, x in enumerate(energy):
+        if x > wenergy[-2]:
+            j1 = len(wenergy) - 1
+            j0 = j1 - 1
+        elif x <= wenergy[0]:
+            j1 = 1
+            j0 = 0
+        else:
+            j0 = numpy.nonzero(wenergy < x)[0].max()
+            j1 = j0 + 1
+        x0 = wenergy[j0]
+        x1 = wenergy[j1]
+        if (x == x1) and ((j1 + 1) < len(wenergy)):
+            if x1 == wenergy[j1 + 1]:
+                j0 = j1
+                j1 += 1
+                x0 = wenergy[j0]
+                x1 = wenergy[j1]
+        close = (j0 == j1) or ((x1 - x0) < 5.E-10) or ((x1 - x) < 5.E-10)
+        for key in ['coherent', 'compton', 'pair', 'all other']:
+            y0 = wdata[key][j0]
+            y1 = wdata[key][j1]
+            if close:
+                ddict[key][i] = y1
+            elif (y0 > 0) and (y1 > 0):
+                ddict[key][i] = _logInterpolation(x, x0, x1, y0, y1)
+            elif (y1 > 0) and ((x - x0) > 1.E-5):
+                ddict[key][i] = numpy.exp((numpy.log(y1) * \
+                                           numpy.log(x / x0)) / \
+                                          numpy.log(x1 / x0))
+        for key in ATOMIC_SHELLS:
+            y0 = wdata[key][j0]
+            if (y0 > 0.0) and (x >= binding[key]):
+                if close:
+                    ddict[key][i] = wdata[key][j1]
+                else:
+                    ddict[key][i] = _logInterpolation(x, x0, x1, y0,
+                                                      wdata[key][j1])
+            elif (key in forcedShells) or (x >= binding[key]):
+                l = numpy.nonzero(wdata[key] > 0.0)[0]
+                if not len(l):
+                    continue
+                j00 = l.min()
+                ddict[key][i] = _logInterpolation(x, wenergy[j00],
+                                                  wenergy[j00 + 1],
+                                                  wdata[key][j00],
+                                                  wdata[key][j00 + 1])
+        for key in ['all other'] + ATOMIC_SHELLS:
+            ddict['photo'][i] += ddict[key][i]
+        for key in ['coherent', 'compton', 'photo']:
+            ddict['total'][i] += ddict[key][i]
+    return ddict
+
+class testEPDL97(unittest.TestCase):
+    def setUp(self):
+        from PyMca5.PyMcaPhysics.xrf import PyMcaEPDL97
+        self._epdl97 = PyMcaEPDL97
+        self.elements = ['H', 'O', 'Ca', 'Fe', 'Pb', 'U']
+
+    def testPackedData(self):
+        if DEBUG:
+            print()
+            print("Testing the EPDL97 data of the elements")
+        for element in self.elements:
+            # initialize the element
+            self._epdl97.getElementCrossSections(element, 10.0)
+            reference = _readElement(self._epdl97, element)
+            wdata = self._epdl97.EPDL97_DICT[element]['EPDL97']
+            packed = self._epdl97._EPDL97_PACKED[element]
+            for key in reference:
+                self.assertTrue(numpy.all(wdata[key] == reference[key]),
+                                "Different %s data of %s" % (key, element))
+                self.assertTrue(numpy.may_share_memory(wdata[key], packed))
+
+    def testCrossSections(self):
+        if DEBUG:
+            print()
+            print("Testing the EPDL97 cross sections")
+        random = numpy.random.RandomState(23)
+        for element in self.elements:
+            self._epdl97.getElementCrossSections(element, 10.0)
+            wdata = _readElement(self._epdl97, element)
+            binding = self._epdl97.EPDL97_DICT[element]['binding']
+            # random energies, the tabulated ones (including the repeated
+            # energies of the absorption edges) and the binding energies
+            energies = [random.uniform(1.0, 100., 50),
+                        wdata['energy'][(wdata['energy'] > 1.0) & \
+                                        (wdata['energy'] < 200.)],
+                        numpy.array([binding[key] for key in ATOMIC_SHELLS \
+                                     if binding[key] > 1.0])]
+            for energy in energies:
+                for forcedShells in [[], ['K', 'L3']]:
+                    ddict = self._epdl97.getElementCrossSections(element,
+                                                    energy.tolist(),
+                                                    forcedShells)
+                    reference = _getCrossSections(wdata, binding, energy,
+                                                  forcedShells)
+                    self._assertCrossSectionsEqual(ddict, reference, element)
+
+    def testModifiedBindingEnergies(self):
+        if DEBUG:
+            print()
+            print("Testing the EPDL97 cross sections of modified elements")
+        ddict = self._epdl97.EPDL97_DICT['Fe']
+        original = ddict['original']
+        binding = copy.deepcopy(ddict['binding'])
+        energy = numpy.linspace(6.9, 7.3, 41)
+        try:
+            reference = self._epdl97.getElementCrossSections('Fe', energy)
+            # move the K edge of iron, the cached values cannot be used
+            modified = copy.deepcopy(binding)
+            modified['K'] = 7.0
+            self._epdl97.setElementBindingEnergies('Fe', modified)
+            ddict = self._epdl97.getElementCrossSections('Fe', energy)
+            expected = _getCrossSections(_readElement(self._epdl97, 'Fe'),
+                                         modified, energy, [])
+            self._assertCrossSectionsEqual(ddict, expected, 'Fe')
+            self.assertNotEqual(ddict['K'], reference['K'])
+            # the returned lists can be modified
+            ddict['K'][0] = -1.0
+            ddict = self._epdl97.getElementCrossSections('Fe', energy)
+            self.assertEqual(ddict['K'][0], expected['K'][0])
+        finally:
+            self._epdl97.EPDL97_DICT['Fe']['binding'] = binding
+            self._epdl97.EPDL97_DICT['Fe']['original'] = original
+
+    def _assertCrossSectionsEqual(self, ddict, reference, element):
+        for key in reference:
+            value = numpy.array(ddict[key])
+            self.assertTrue(numpy.allclose(value, reference[key],
+                                           rtol=1.0e-13, atol=0.0),
+                            "Different %s cross sections of %s" % \
+                            (key, element))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testEPDL97))
+    else:
+        # use a predefined order
+        testSuite.addTest(testEPDL97("testPackedData"))
+        testSuite.addTest(testEPDL97("testCrossSections"))
+        testSuite.addTest(testEPDL97("testModifiedBindingEnergies"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
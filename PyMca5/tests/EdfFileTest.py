@@ -116,6 +116,35 @@ def testEdfFileReadWrite(self):
         edf =None
         gc.collect()
 
+    def testEdfFileMemmap(self):
+        self.assertTrue(self.fileClass is not None)
+        data = numpy.arange(10000).astype(numpy.float32)
+        data.shape = 100, 100
+        edf = self.fileClass(self.fname, 'wb+')
+        edf.WriteImage({'Title': "title"}, data)
+        edf.WriteImage({'Title': "title2"}, data.astype(numpy.int32),
+                       ByteOrder="HighByteFirst", Append=1)
+        edf = None
+
+        edf = self.fileClass(self.fname, 'rb', memmap=True)
+        self.assertEqual(edf.GetNumImages(), 2)
+        for i in range(2):
+            readData = edf.GetData(i)
+            self.assertTrue(isinstance(readData, numpy.memmap))
+            self.assertTrue(numpy.alltrue(readData == data))
+            # region read, Pos and Size are given as (x, y)
+            readData = edf.GetData(i, Pos=(10, 20), Size=(5, 3))
+            self.assertEqual(readData.shape, (3, 5))
+            self.assertTrue(numpy.alltrue(readData == data[20:23, 10:15]))
+            readData = edf.GetData(i, Pos=(90, 95))
+            self.assertTrue(numpy.alltrue(readData == data[95:, 90:]))
+        readData = edf.GetData(1, DataType="DoubleValue")
+        self.assertEqual(readData.dtype, numpy.float64)
+        self.assertTrue(numpy.alltrue(readData == data))
+        readData = None
+        edf = None
+        gc.collect()
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -125,6 +154,7 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testEdfFile("testEdfFileImport"))
         testSuite.addTest(testEdfFile("testEdfFileReadWrite"))
+        testSuite.addTest(testEdfFile("testEdfFileMemmap"))
     return testSuite
 
 def test(auto=False):
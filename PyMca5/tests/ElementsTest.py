@@ -294,6 +294,129 @@ def testMaterialCrossSectionsCalculation(self):
                     self.assertTrue((100.0 * abs(yTest-yRef)/yRef) < 0.01)
                 energyIndex += 1
 
+    def testMaterialCrossSectionsEnergyArray(self):
+        if DEBUG:
+            print()
+            print("Testing Material Mass Attenuation Cross Sections on arrays")
+        energy = numpy.linspace(1.5, 90., 50)
+        for i in range(2):
+            # the second call is served from the cache
+            data = self._elements.getMaterialMassAttenuationCoefficients(\
+                                ['Water', 'Fe'], [0.7, 0.3], energy)
+            self.assertEqual(len(data['total']), len(energy))
+            for j in [0, 17, 49]:
+                refData = self._elements.getMaterialMassAttenuationCoefficients(\
+                                ['Water', 'Fe'], [0.7, 0.3], energy[j])
+                for key in ['coherent', 'compton', 'photo', 'pair', 'total']:
+                    self.assertEqual(data[key][j], refData[key][0])
+            refTotal = data['total'][0]
+            data['total'][0] = -1.0
+            # the cached values are not modified through the output
+            data = self._elements.getMaterialMassAttenuationCoefficients(\
+                                ['Water', 'Fe'], [0.7, 0.3], energy)
+            self.assertEqual(data['total'][0], refTotal)
+
+        # the cached values are discarded when the elements are updated
+        self.assertTrue('Fe' in self._elements._xcomPairLog10)
+        self.assertTrue(len(self._elements._massAttenuationCache))
+        self._elements.updateDict()
+        self.assertEqual(len(self._elements._xcomPairLog10), 0)
+        self.assertEqual(len(self._elements._massAttenuationCache), 0)
+        data = self._elements.getMaterialMassAttenuationCoefficients(\
+                                ['Water', 'Fe'], [0.7, 0.3], energy)
+        self.assertEqual(data['total'][0], refTotal)
+
+    def testMultilayerFluorescenceCache(self):
+        if DEBUG:
+            print()
+            print("Testing Multilayer Fluorescence cache")
+        matrix = ['Goethite', 4.0, 0.01, 1.0]
+        elementsList = [[26, 'Fe', 'K'], [82, 'Pb', 'L']]
+        attenuators = [['Air', 0.0012, 2.0, 1.0]]
+        refData = self._elements.getMultilayerFluorescence(matrix,
+                                        [15.0, 20.0],
+                                        elementsList=elementsList,
+                                        attenuators=attenuators,
+                                        forcepresent=1)
+        refRate = refData['Fe']['rates']['K xrays']
+        # the returned dictionary can be modified
+        refData['Fe']['rates']['K xrays'] = -1.0
+        data = self._elements.getMultilayerFluorescence(matrix,
+                                        [15.0, 20.0],
+                                        elementsList=elementsList,
+                                        attenuators=attenuators,
+                                        forcepresent=1)
+        self.assertEqual(data['Fe']['rates']['K xrays'], refRate)
+        # changing the attenuators changes the rates
+        data = self._elements.getMultilayerFluorescence(matrix,
+                                        [15.0, 20.0],
+                                        elementsList=elementsList,
+                                        attenuators=[['Air', 0.0012, 20.0, 1.0]],
+                                        forcepresent=1)
+        self.assertTrue(data['Fe']['rates']['K xrays'] < refRate)
+        # and the cache does not survive an update of the elements
+        self._elements.updateDict(energy=20.0)
+        self.assertEqual(len(self._elements._fluorescenceCache), 0)
+        self._elements.updateDict()
+
+    def _assertElementEqual(self, element, refElement):
+        self.assertEqual(sorted(element.keys()), sorted(refElement.keys()))
+        self.assertEqual(element['buildparameters'],
+                         refElement['buildparameters'])
+        for key in ['K xrays', 'L xrays', 'M xrays']:
+            self.assertEqual(element[key], refElement[key])
+            for line in refElement[key]:
+                self.assertEqual(element[line], refElement[line])
+
+    def testElementDictUpdate(self):
+        if DEBUG:
+            print()
+            print("Testing the update of the element dictionaries")
+        import copy
+        import pickle
+        import threading
+        elements = self._elements
+        try:
+            elements.updateDict(energy=15.0)
+            refElement = copy.deepcopy(elements.Element['Pb'])
+            # no overhead once updated
+            self.assertTrue(type(elements.Element['Pb']) is \
+                            elements._ElementDict)
+            self.assertEqual(refElement['buildparameters']['energy'], 15.0)
+            self.assertTrue('L3 xrays' in refElement)
+
+            # copies apply the pending update
+            for duplicate in [copy.deepcopy, copy.copy,
+                        lambda x: pickle.loads(pickle.dumps(x)),
+                        lambda x: pickle.loads(pickle.dumps(x, 2)), dict]:
+                elements.updateDict(energy=15.0)
+                element = duplicate(elements.Element['Pb'])
+                self._assertElementEqual(element, refElement)
+            elements.updateDict(energy=15.0)
+            element = copy.deepcopy(elements.Element['Pb'])
+            self.assertEqual(element.pop('buildparameters')['energy'], 15.0)
+            self.assertEqual(element.setdefault('Z', 0), 82)
+            elements.updateDict(energy=15.0)
+            self.assertEqual(elements.Element['Pb'].pop('nonexistent', 1), 1)
+            elements.updateDict(energy=15.0)
+            self.assertEqual(elements.Element['Pb'].setdefault('Z', 0), 82)
+
+            # several threads reading an element being updated
+            elements.updateDict(energy=15.0)
+            results = []
+            def read():
+                results.append(copy.deepcopy(elements.Element['Pb']))
+            threads = [threading.Thread(target=read) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(results), len(threads))
+            for element in results:
+                self._assertElementEqual(element, refElement)
+        finally:
+            elements.updateDict()
+
 
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
@@ -306,6 +429,9 @@ def getSuite(auto=True):
         testSuite.addTest(testElements("testElementCrossSectionsReadout"))
         testSuite.addTest(testElements("testElementCrossSectionsCalculation"))
         testSuite.addTest(testElements("testMaterialCrossSectionsCalculation"))
+        testSuite.addTest(testElements("testMaterialCrossSectionsEnergyArray"))
+        testSuite.addTest(testElements("testMultilayerFluorescenceCache"))
+        testSuite.addTest(testElements("testElementDictUpdate"))
     return testSuite
 
 def test(auto=False):
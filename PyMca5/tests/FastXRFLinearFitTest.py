@@ -0,0 +1,220 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+try:
+    import h5py
+    HDF5 = True
+except ImportError:
+    HDF5 = False
+
+DEBUG = 0
+
+class RecordingArray(object):
+    def __init__(self, data):
+        """
+        Array keeping the size of each of the regions read from it
+        """
+        self._array = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.reads = []
+
+    def __getitem__(self, key):
+        output = self._array[key]
+        self.reads.append(output.nbytes)
+        return output
+
+class testFastXRFLinearFit(unittest.TestCase):
+    def setUp(self):
+        from PyMca5 import PyMcaDataDir
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaIO import EdfFile
+        from PyMca5.PyMcaPhysics.xrf import FastXRFLinearFit
+        self._module = FastXRFLinearFit
+        self.tmpDir = tempfile.mkdtemp()
+
+        # Fe and Ca K lines on a constant background
+        x = numpy.arange(1024.)
+        gauss = lambda center, sigma: \
+                numpy.exp(-0.5 * ((x - center) / sigma) ** 2)
+        fe = gauss(320.0, 3.4) + 0.13 * gauss(352.9, 3.5)
+        ca = gauss(184.5, 2.9) + 0.13 * gauss(200.6, 3.0)
+        random = numpy.random.RandomState(11)
+        self.data = numpy.zeros((6, 7, 1024), numpy.float32)
+        for row in range(self.data.shape[0]):
+            for col in range(self.data.shape[1]):
+                self.data[row, col] = random.poisson(5 + \
+                                            (100 + 10 * row) * fe + \
+                                            (50 + 7 * col) * ca)
+
+        # one EDF file per row of the map
+        self.fileList = []
+        for row in range(self.data.shape[0]):
+            fileName = os.path.join(self.tmpDir, "row_%02d.edf" % row)
+            edf = EdfFile.EdfFile(fileName, 'wb')
+            edf.WriteImage({}, self.data[row])
+            del edf
+            self.fileList.append(fileName)
+
+        config = ConfigDict.ConfigDict()
+        config.read(os.path.join(PyMcaDataDir.PYMCA_DATA_DIR,
+                                 "McaTheory.cfg"))
+        config['fit']['energy'] = [20.0]
+        config['fit']['energyflag'] = [1]
+        config['fit']['energyweight'] = [1.0]
+        config['fit']['stripalgorithm'] = 1
+        config['fit']['snipwidth'] = 30
+        config['fit']['xmin'] = 100
+        config['fit']['xmax'] = 600
+        config['detector']['zero'] = 0.0
+        config['detector']['gain'] = 0.02
+        # Cu is not there, its areas are negative in many pixels and
+        # the secondary fits are needed
+        config['peaks'] = {'Fe': 'K', 'Ca': 'K', 'Cu': 'K'}
+        self.config = config
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def _fit(self, y, **kw):
+        fastFit = self._module.FastXRFLinearFit()
+        return fastFit.fitMultipleSpectra(y=y, configuration=self.config,
+                                          weight=0, **kw)
+
+    def _assertResultEqual(self, result, reference, label):
+        self.assertEqual(result['names'], reference['names'])
+        for key in ['parameters', 'uncertainties']:
+            self.assertTrue(numpy.allclose(result[key], reference[key],
+                                           rtol=1.0e-10, atol=1.0e-10),
+                            "Different %s with %s" % (key, label))
+
+    def testParallelAndStreamedFit(self):
+        if DEBUG:
+            print()
+            print("Testing the parallel fit of blocks of spectra")
+        # stripped background and fitted constant background, the latter
+        # gives negative Cu areas and secondary fits
+        for stripflag in [1, 0]:
+            self.config['fit']['stripflag'] = stripflag
+            self.config['fit']['continuum'] = 1 - stripflag
+            self._testParallelAndStreamedFit(secondaryFits=not stripflag)
+
+    def _testParallelAndStreamedFit(self, secondaryFits):
+        # the whole map read at once and fitted by the calling thread
+        reference = self._fit(self.data, maxMemory=self.data.nbytes * 2)
+        names = reference['names']
+        cu = names.index('Cu K')
+        self.assertTrue(numpy.all(reference['parameters'][cu] >= 0.0))
+        if secondaryFits:
+            self.assertTrue(numpy.any(reference['parameters'][cu] == 0.0))
+        fe = names.index('Fe K')
+        self.assertTrue(numpy.all(reference['parameters'][fe] > 0.0))
+
+        # the workers give the same result
+        for processes in [False, True]:
+            result = self._fit(self.data, workers=2, processes=processes)
+            self._assertResultEqual(result, reference,
+                                    "processes = %s" % processes)
+
+        # and so do the data read in blocks of less than one row
+        maxMemory = 3 * 1024 * 4
+        result = self._fit(self.data, maxMemory=maxMemory)
+        self._assertResultEqual(result, reference, "blocks")
+        result = self._fit(self.fileList, maxMemory=maxMemory, workers=2)
+        self._assertResultEqual(result, reference, "EDF files")
+        if HDF5:
+            fileName = os.path.join(self.tmpDir, "stack.h5")
+            h5 = h5py.File(fileName, "w")
+            try:
+                h5.create_dataset("data", data=self.data,
+                                  chunks=(1, 2, 1024))
+                result = self._fit(h5["data"], maxMemory=maxMemory,
+                                   workers=2)
+                self._assertResultEqual(result, reference, "HDF5 dataset")
+            finally:
+                h5.close()
+
+    def testMemoryBudget(self):
+        if DEBUG:
+            print()
+            print("Testing the blocks read under a memory budget")
+        getBlockList = self._module._getBlockList
+        for nRows, nColumns, spectrumSize, maxMemory in [(6, 7, 100, 10**6),
+                                                         (6, 7, 100, 2000),
+                                                         (6, 7, 100, 650),
+                                                         (6, 7, 100, 50),
+                                                         (1, 1, 100, 100)]:
+            covered = numpy.zeros((nRows, nColumns), numpy.int32)
+            for iStart, iEnd, jStart, jEnd in getBlockList(nRows, nColumns,
+                                                           spectrumSize,
+                                                           maxMemory):
+                covered[iStart:iEnd, jStart:jEnd] += 1
+                # at least one spectrum is read
+                nSpectra = (iEnd - iStart) * (jEnd - jStart)
+                self.assertTrue((nSpectra * spectrumSize <= maxMemory) or \
+                                (nSpectra == 1))
+            self.assertTrue(numpy.all(covered == 1))
+
+        # the fit never reads more than the budget at once
+        self.config['fit']['stripflag'] = 0
+        self.config['fit']['continuum'] = 1
+        reference = self._fit(self.data)
+        data = RecordingArray(self.data)
+        maxMemory = 3 * 1024 * 4
+        result = self._fit(data, maxMemory=maxMemory)
+        self._assertResultEqual(result, reference, "memory budget")
+        self.assertTrue(len(data.reads) > self.data.shape[0])
+        self.assertTrue(max(data.reads) <= maxMemory)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testFastXRFLinearFit))
+    else:
+        # use a predefined order
+        testSuite.addTest(\
+            testFastXRFLinearFit("testParallelAndStreamedFit"))
+        testSuite.addTest(testFastXRFLinearFit("testMemoryBudget"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
@@ -0,0 +1,192 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+try:
+    import h5py
+    HDF5 = True
+except ImportError:
+    HDF5 = False
+
+DEBUG = 0
+
+class testHDF5Reader(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.fileList = []
+        self.data = []
+        if not HDF5:
+            return
+        for i in range(2):
+            fileName = os.path.join(self.tmpDir, "data_%d.h5" % i)
+            data = numpy.arange(50 * 7 * 16,
+                                dtype=numpy.float64).reshape(50, 7, 16)
+            data += 1000 * i
+            h5 = h5py.File(fileName, "w")
+            h5.create_dataset("/entry/data", data=data, chunks=(4, 7, 16))
+            h5["/entry/monitor"] = numpy.arange(50.) + i
+            h5["/entry/contiguous"] = data[:, 0, :]
+            h5.close()
+            self.fileList.append(fileName)
+            self.data.append(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def testSlabLimits(self):
+        if DEBUG:
+            print()
+            print("Testing the slab limits")
+        if not HDF5:
+            print("skipping slab limits test, h5py not available")
+            return
+        from PyMca5.PyMcaIO import HDF5Reader
+        h5 = h5py.File(self.fileList[0], "r")
+        try:
+            dataset = h5["/entry/data"]
+            self.assertEqual(HDF5Reader.getSlabLimits(dataset),
+                             [(None, None)])
+            # ten rows per slab rounded down to complete chunks
+            rowBytes = 7 * 16 * 8
+            limits = HDF5Reader.getSlabLimits(dataset, nbytes=10 * rowBytes)
+            self.assertEqual(limits[0], (0, 8))
+            self.assertEqual(limits[-1], (48, 50))
+            for i in range(1, len(limits)):
+                self.assertEqual(limits[i][0], limits[i - 1][1])
+                self.assertEqual(limits[i][0] % 4, 0)
+            # less than one chunk per slab
+            limits = HDF5Reader.getSlabLimits(dataset, nbytes=rowBytes)
+            self.assertEqual(limits[0], (0, 4))
+            self.assertEqual(len(limits), 13)
+        finally:
+            h5.close()
+
+    def testReadDatasets(self):
+        if DEBUG:
+            print()
+            print("Testing the reassembly of the slabs")
+        if not HDF5:
+            print("skipping slab reassembly test, h5py not available")
+            return
+        from PyMca5.PyMcaIO import HDF5Reader
+        h5 = h5py.File(self.fileList[1], "r")
+        items = [(self.fileList[0], ["/entry/data", None, "/entry/monitor"]),
+                 (h5, ["/entry/data", "/entry/contiguous"]),
+                 (self.fileList[1], [None])]
+        try:
+            for workers in [1, 2]:
+                reader = HDF5Reader.HDF5Reader(workers=workers,
+                                               nbytes=7 * 16 * 8 * 10)
+                output = list(reader.readDatasets(items))
+                self.assertEqual(len(output), 3)
+                data, empty, monitor = output[0]
+                self.assertTrue(empty is None)
+                self.assertEqual(data.dtype, self.data[0].dtype)
+                self.assertTrue(numpy.all(data == self.data[0]))
+                self.assertTrue(numpy.all(monitor == numpy.arange(50.)))
+                data, contiguous = output[1]
+                self.assertTrue(numpy.all(data == self.data[1]))
+                self.assertTrue(numpy.all(contiguous == self.data[1][:, 0]))
+                self.assertEqual(output[2], [None])
+                self.assertEqual(reader.getBytesRead(),
+                                 2 * self.data[0].nbytes + 50 * 8 + \
+                                 self.data[1][:, 0].nbytes)
+            # the pool is kept for the next reader
+            pool = HDF5Reader._POOL
+            self.assertTrue(pool is not None)
+            reader = HDF5Reader.HDF5Reader(workers=2, nbytes=7 * 16 * 8)
+            for output in reader.readDatasets(items):
+                pass
+            self.assertTrue(HDF5Reader._POOL is pool)
+        finally:
+            h5.close()
+            HDF5Reader.closePool()
+
+    def testReadSelections(self):
+        if DEBUG:
+            print()
+            print("Testing the reading of dataset selections")
+        if not HDF5:
+            print("skipping selections test, h5py not available")
+            return
+        import functools
+        from PyMca5.PyMcaIO import HDF5Reader
+        h5 = h5py.File(self.fileList[1], "r")
+        selections = [(slice(start, start + 8), slice(None), slice(2, 12)) \
+                      for start in range(0, 50, 8)]
+        selections.append((slice(10, 20, 3),))
+        function = functools.partial(numpy.sum, axis=0)
+        try:
+            for workers in [1, 2]:
+                reader = HDF5Reader.HDF5Reader(workers=workers)
+                output = list(reader.readSelections(h5["/entry/data"],
+                                                    selections))
+                self.assertEqual(len(output), len(selections))
+                nbytes = 0
+                for data, selection in zip(output, selections):
+                    self.assertTrue(numpy.all(data == \
+                                              self.data[1][selection]))
+                    nbytes += data.nbytes
+                self.assertEqual(reader.getBytesRead(), nbytes)
+                # the reduction is done by the reading processes
+                output = list(reader.readSelections(h5["/entry/data"],
+                                                    selections, function))
+                for data, selection in zip(output, selections):
+                    self.assertTrue(numpy.all(data == \
+                                    self.data[1][selection].sum(axis=0)))
+                self.assertEqual(reader.getBytesRead(), nbytes)
+        finally:
+            h5.close()
+            HDF5Reader.closePool()
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testHDF5Reader))
+    else:
+        testSuite.addTest(testHDF5Reader("testSlabLimits"))
+        testSuite.addTest(testHDF5Reader("testReadDatasets"))
+        testSuite.addTest(testHDF5Reader("testReadSelections"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
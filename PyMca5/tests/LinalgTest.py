@@ -0,0 +1,135 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+DEBUG = 0
+
+class testLinalg(unittest.TestCase):
+    def setUp(self):
+        # three gaussians and a constant on a set of noisy spectra
+        x = numpy.arange(200.)
+        self.a = numpy.array([numpy.exp(-0.5 * ((x - c) / 5.) ** 2) \
+                              for c in [50., 100., 140.]] + \
+                             [numpy.ones(x.shape)]).T
+        random = numpy.random.RandomState(3)
+        parameters = random.uniform(100., 1000., (4, 25))
+        self.b = random.poisson(numpy.dot(self.a, parameters)).astype(\
+                                                            numpy.float64)
+        self.sigma = numpy.sqrt(self.b + 1.)
+
+    def _getReference(self, a, b, sigma):
+        # one spectrum at a time through the normal equations
+        n, k = a.shape[1], b.shape[1]
+        parameters = numpy.zeros((n, k))
+        uncertainties = numpy.zeros((n, k))
+        covariances = numpy.zeros((k, n, n))
+        for i in range(k):
+            A = a / sigma[:, i:i+1]
+            alpha = numpy.dot(A.T, A)
+            beta = numpy.dot(A.T, b[:, i:i+1] / sigma[:, i:i+1])
+            try:
+                covariance = numpy.linalg.inv(alpha)
+            except numpy.linalg.LinAlgError:
+                continue
+            parameters[:, i:i+1] = numpy.dot(covariance, beta)
+            uncertainties[:, i] = numpy.sqrt(numpy.diag(covariance))
+            covariances[i] = covariance
+        return parameters, uncertainties, covariances
+
+    def testWeightedLstsq(self):
+        if DEBUG:
+            print()
+            print("Testing the weighted fit of several spectra at once")
+        from PyMca5.PyMcaMath import linalg
+        reference = self._getReference(self.a, self.b, self.sigma)
+        result = linalg.weightedLstsq(self.a, self.b, self.sigma,
+                                      uncertainties=True, covariances=True)
+        for i, label in enumerate(["parameters", "uncertainties",
+                                   "covariances"]):
+            self.assertTrue(numpy.allclose(result[i], reference[i],
+                                           rtol=1.0e-10, atol=0.0),
+                            "Different %s" % label)
+
+        # lstsq uses it for statistical weights without SVD
+        result = linalg.lstsq(self.a, self.b, sigma_b=self.sigma, weight=1,
+                              svd=False, uncertainties=True)
+        self.assertTrue(numpy.allclose(result[0], reference[0],
+                                       rtol=1.0e-10, atol=0.0))
+        self.assertTrue(numpy.allclose(result[1], reference[1],
+                                       rtol=1.0e-10, atol=0.0))
+        # and it agrees with the SVD solution
+        result = linalg.lstsq(self.a, self.b, sigma_b=self.sigma, weight=1,
+                              svd=True, uncertainties=True)
+        self.assertTrue(numpy.allclose(result[0], reference[0],
+                                       rtol=1.0e-8))
+
+    def testWeightedLstsqSingular(self):
+        if DEBUG:
+            print()
+            print("Testing the weighted fit of spectra with singular matrix")
+        from PyMca5.PyMcaMath import linalg
+        # the second peak is not seen by the third spectrum
+        sigma = self.sigma * 1
+        sigma[80:120, 2] = numpy.inf
+        a = self.a * 1
+        a[:80, 1] = 0.0
+        a[120:, 1] = 0.0
+        reference = self._getReference(a, self.b, sigma)
+        result = linalg.weightedLstsq(a, self.b, sigma,
+                                      uncertainties=True, covariances=True)
+        self.assertTrue(numpy.all(result[0][:, 2] == 0.0))
+        self.assertTrue(numpy.all(result[1][:, 2] == 0.0))
+        good = [i for i in range(self.b.shape[1]) if i != 2]
+        for i in range(2):
+            self.assertTrue(numpy.allclose(result[i][:, good],
+                                           reference[i][:, good],
+                                           rtol=1.0e-10, atol=0.0))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testLinalg))
+    else:
+        # use a predefined order
+        testSuite.addTest(testLinalg("testWeightedLstsq"))
+        testSuite.addTest(testLinalg("testWeightedLstsqSingular"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
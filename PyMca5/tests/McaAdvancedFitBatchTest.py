@@ -0,0 +1,446 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import numpy
+try:
+    import h5py
+    HDF5 = True
+except ImportError:
+    HDF5 = False
+
+DEBUG = 0
+
+class testMcaAdvancedFitBatch(unittest.TestCase):
+    def setUp(self):
+        from PyMca5 import PyMcaDataDir
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaIO import EdfFile
+        from PyMca5.PyMcaPhysics.xrf import McaAdvancedFitBatch
+        self._batch = McaAdvancedFitBatch
+        self.tmpDir = tempfile.mkdtemp()
+        self.outputDir = os.path.join(self.tmpDir, "output")
+        os.mkdir(self.outputDir)
+
+        # Fe and Ca K lines with the widths given by the detector
+        self.nRows = 4
+        self.nColumns = 5
+        x = numpy.arange(1024.)
+        gauss = lambda center, sigma: \
+                numpy.exp(-0.5 * ((x - center) / sigma) ** 2)
+        fe = gauss(320.0, 3.4) + 0.13 * gauss(352.9, 3.5)
+        ca = gauss(184.5, 2.9) + 0.13 * gauss(200.6, 3.0)
+        self.data = numpy.zeros((self.nRows, self.nColumns, 1024),
+                                numpy.float32)
+        for row in range(self.nRows):
+            for col in range(self.nColumns):
+                self.data[row, col] = 5 + (100 + 10 * row) * fe + \
+                                      (50 + 7 * col) * ca
+
+        # one EDF file per row of the map
+        self.fileList = []
+        for row in range(self.nRows):
+            fileName = os.path.join(self.tmpDir, "row_%02d.edf" % row)
+            edf = EdfFile.EdfFile(fileName, 'wb')
+            edf.WriteImage({}, self.data[row])
+            del edf
+            self.fileList.append(fileName)
+
+        config = ConfigDict.ConfigDict()
+        config.read(os.path.join(PyMcaDataDir.PYMCA_DATA_DIR,
+                                 "McaTheory.cfg"))
+        config['fit']['energy'] = [20.0]
+        config['fit']['energyflag'] = [1]
+        config['fit']['energyweight'] = [1.0]
+        config['fit']['stripflag'] = 0
+        config['fit']['xmin'] = 100
+        config['fit']['xmax'] = 600
+        config['detector']['zero'] = 0.0
+        config['detector']['gain'] = 0.02
+        config['peaks'] = {'Fe': 'K', 'Ca': 'K'}
+        self.configFile = os.path.join(self.tmpDir, "fit.cfg")
+        config.write(self.configFile)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def _getHDF5Stack(self):
+        fileName = os.path.join(self.tmpDir, "stack.h5")
+        h5 = h5py.File(fileName, "w")
+        h5["/entry/data"] = self.data
+        h5.close()
+        return [fileName], {'x': None, 'y': '/data', 'm': None}
+
+    def _getBatch(self, fileList=None, outputDir=None, **kw):
+        if fileList is None:
+            fileList = self.fileList
+        if outputDir is None:
+            outputDir = self.outputDir
+        batch = self._batch.McaAdvancedFitBatch(self.configFile,
+                                                fileList,
+                                                outputDir,
+                                                **kw)
+        if not DEBUG:
+            batch.onNewFile = lambda ffile, filelist: None
+        return batch
+
+    def _getImages(self, batch):
+        images = batch._McaAdvancedFitBatch__images
+        return dict([(key, images[key].copy()) for key in images])
+
+    def _assertImagesEqual(self, images, refImages):
+        self.assertEqual(sorted(images.keys()), sorted(refImages.keys()))
+        for key in refImages:
+            self.assertTrue(numpy.allclose(images[key], refImages[key]),
+                            "Different %s image" % key)
+
+    def _getHDF5OutputName(self, outputDir=None):
+        if outputDir is None:
+            outputDir = self.outputDir
+        return os.path.join(outputDir, "IMAGES", "row_00_to_03.h5")
+
+    def _countFits(self, batch):
+        fits = []
+        startfit = batch.mcafit.startfit
+        def countFit(*var, **kw):
+            fits.append(1)
+            return startfit(*var, **kw)
+        batch.mcafit.startfit = countFit
+        return fits
+
+    def _interruptBatch(self, **kw):
+        # stop the batch when the third row is about to be read, as the
+        # stop button of the GUI would do
+        if "fitfiles" not in kw:
+            kw["fitfiles"] = 0
+        batch = self._getBatch(hdf5output=1, **kw)
+        swmr = []
+        def onNewFile(ffile, filelist):
+            if ffile != self.fileList[2]:
+                return
+            batch.pleaseBreak = 1
+            hdf5 = batch._McaAdvancedFitBatch__hdf5
+            if hdf5._swmr:
+                swmr.append(self._readFinishedRows())
+        batch.onNewFile = onNewFile
+        batch.processList()
+        return swmr
+
+    def _readFinishedRows(self):
+        # read the output from another process while the batch writes it
+        import subprocess
+        script = "import sys\n" + \
+                 "from PyMca5.PyMcaIO import BatchHDF5Output\n" + \
+                 "ddict = BatchHDF5Output.readBatchHDF5Output(sys.argv[1])\n" + \
+                 "print(list(ddict['finished'].astype(int)))\n"
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join([p for p in sys.path if p])
+        output = subprocess.check_output([sys.executable, "-c", script,
+                                          self._getHDF5OutputName()],
+                                         env=env)
+        if hasattr(output, "decode"):
+            output = output.decode('utf-8')
+        return output.strip().splitlines()[-1]
+
+    def testResumeInterruptedBatch(self):
+        if DEBUG:
+            print()
+            print("Testing the resume of an interrupted batch")
+        if not HDF5:
+            print("skipping resume test, h5py not available")
+            return
+        BatchHDF5Output = self._batch.BatchHDF5Output
+        refDir = os.path.join(self.tmpDir, "reference")
+        os.mkdir(refDir)
+        batch = self._getBatch(outputDir=refDir, fitfiles=0, hdf5output=1)
+        batch.processList()
+        refImages = self._getImages(batch)
+        refOutput = BatchHDF5Output.readBatchHDF5Output(\
+                                            self._getHDF5OutputName(refDir))
+        self.assertTrue(numpy.all(refOutput['finished']))
+
+        swmr = self._interruptBatch()
+        if len(swmr):
+            # the first row can be read while the batch runs
+            self.assertEqual(swmr[0], "[1, 0, 0, 0]")
+        elif DEBUG:
+            print("SWMR not supported, output not read while written")
+        output = BatchHDF5Output.readBatchHDF5Output(\
+                                            self._getHDF5OutputName())
+        self.assertEqual(list(output['finished']),
+                         [True, False, False, False])
+
+        # only the rows not finished are fitted
+        batch = self._getBatch(fitfiles=0, hdf5output=1)
+        fits = self._countFits(batch)
+        batch.processList()
+        self.assertEqual(len(fits), (self.nRows - 1) * self.nColumns)
+        self._assertImagesEqual(self._getImages(batch), refImages)
+        output = BatchHDF5Output.readBatchHDF5Output(\
+                                            self._getHDF5OutputName())
+        self.assertTrue(numpy.all(output['finished']))
+        for key in ['parameters_data', 'uncertainties_data', 'chisq']:
+            self.assertTrue(numpy.allclose(output[key], refOutput[key]),
+                            "Different %s in the HDF5 output" % key)
+
+        # nothing left to fit, the images come from the file
+        shutil.rmtree(os.path.join(self.outputDir, "IMAGES"), True)
+        os.mkdir(os.path.join(self.outputDir, "IMAGES"))
+        shutil.copy(self._getHDF5OutputName(refDir),
+                    self._getHDF5OutputName())
+        batch = self._getBatch(fitfiles=0, hdf5output=1)
+        fits = self._countFits(batch)
+        batch.processList()
+        self.assertEqual(len(fits), 0)
+        self._assertImagesEqual(self._getImages(batch), refImages)
+
+    def testResumeChangedConfiguration(self):
+        if DEBUG:
+            print()
+            print("Testing an interrupted batch with another configuration")
+        if not HDF5:
+            print("skipping resume test, h5py not available")
+            return
+        from PyMca5.PyMcaIO import ConfigDict
+        BatchHDF5Output = self._batch.BatchHDF5Output
+        self._interruptBatch()
+        output = BatchHDF5Output.readBatchHDF5Output(\
+                                            self._getHDF5OutputName())
+        self.assertEqual(list(output['finished']),
+                         [True, False, False, False])
+        oldHash = output['attributes']['configuration_hash']
+
+        config = ConfigDict.ConfigDict()
+        config.read(self.configFile)
+        config['fit']['maxiter'] = config['fit']['maxiter'] + 1
+        config.write(self.configFile)
+
+        # the partial output is not used, all the rows are fitted again
+        batch = self._getBatch(fitfiles=0, hdf5output=1)
+        fits = self._countFits(batch)
+        batch.processList()
+        self.assertEqual(len(fits), self.nRows * self.nColumns)
+        output = BatchHDF5Output.readBatchHDF5Output(\
+                                            self._getHDF5OutputName())
+        self.assertTrue(numpy.all(output['finished']))
+        self.assertNotEqual(output['attributes']['configuration_hash'],
+                            oldHash)
+
+    def testResumeKeepsOutput(self):
+        if DEBUG:
+            print()
+            print("Testing the outputs kept by a resumed batch")
+        if not HDF5:
+            print("skipping resume test, h5py not available")
+            return
+        from PyMca5.PyMcaIO import ConfigDict
+        BatchHDF5Output = self._batch.BatchHDF5Output
+        config = ConfigDict.ConfigDict()
+        config.read(self.configFile)
+        config['attenuators']['Matrix'] = [1, 'Goethite', 4.0, 0.01,
+                                           45.0, 45.0]
+        config.write(self.configFile)
+        refDir = os.path.join(self.tmpDir, "reference")
+        os.mkdir(refDir)
+        batch = self._getBatch(outputDir=refDir, fitfiles=0, hdf5output=1)
+        batch.processList()
+        refOutput = BatchHDF5Output.readBatchHDF5Output(\
+                                            self._getHDF5OutputName(refDir))
+
+        self._interruptBatch(fitfiles=1, concentrations=1)
+        listName = os.path.join(self.outputDir, "row_00_to_03_fitfilelist.py")
+        concentrationsName = glob.glob(os.path.join(self.outputDir,
+                                                    "*_concentrations.txt"))
+        self.assertEqual(len(concentrationsName), 1)
+        concentrationsName = concentrationsName[0]
+        f = open(concentrationsName)
+        text = f.read()
+        f.close()
+        # the second row was fitted but not flagged as finished
+        self.assertEqual(text.count("SOURCE:"), 2 * self.nColumns)
+
+        # the previous file cannot be opened for writing, as if the batch
+        # had been killed, it is only replaced once rebuilt
+        openFile = BatchHDF5Output.BatchHDF5Output._openFile
+        calls = []
+        def failingOpenFile(instance, filename):
+            calls.append(filename)
+            if len(calls) == 1:
+                raise IOError("File is already open for write")
+            return openFile(instance, filename)
+        BatchHDF5Output.BatchHDF5Output._openFile = failingOpenFile
+        try:
+            batch = self._getBatch(fitfiles=1, concentrations=1,
+                                   hdf5output=1)
+            fits = self._countFits(batch)
+            batch.processList()
+        finally:
+            BatchHDF5Output.BatchHDF5Output._openFile = openFile
+        self.assertEqual(len(fits), (self.nRows - 1) * self.nColumns)
+        self.assertEqual(calls, [self._getHDF5OutputName()] * 2)
+        self.assertFalse(os.path.exists(self._getHDF5OutputName() + ".tmp"))
+        output = BatchHDF5Output.readBatchHDF5Output(\
+                                            self._getHDF5OutputName())
+        self.assertTrue(numpy.all(output['finished']))
+        for key in ['parameters_data', 'uncertainties_data', 'chisq']:
+            self.assertTrue(numpy.allclose(output[key], refOutput[key]),
+                            "Different %s in the HDF5 output" % key)
+
+        # the text outputs of the first run are completed
+        f = open(listName)
+        lines = f.read().splitlines()
+        f.close()
+        self.assertEqual(lines[0], "fitfilelist = [")
+        self.assertEqual(lines[-1][-1], "]")
+        fitFiles = [line.rstrip(",]") for line in lines[1:]]
+        self.assertEqual(len(fitFiles), self.nRows * self.nColumns)
+        self.assertEqual(len(set(fitFiles)), len(fitFiles))
+        for fitFile in fitFiles:
+            self.assertTrue(os.path.exists(fitFile))
+        f = open(concentrationsName)
+        newText = f.read()
+        f.close()
+        self.assertEqual(newText.count("SOURCE:"), self.nRows * self.nColumns)
+        self.assertEqual(newText.split("SOURCE:")[1], text.split("SOURCE:")[1])
+
+        # a new run starts them again
+        os.remove(self._getHDF5OutputName())
+        batch = self._getBatch(fitfiles=1, concentrations=1, hdf5output=1)
+        batch.processList()
+        f = open(concentrationsName)
+        self.assertEqual(f.read().count("SOURCE:"),
+                         self.nRows * self.nColumns)
+        f.close()
+
+    def testExistingFitFilesWithWorkers(self):
+        if DEBUG:
+            print()
+            print("Testing the use of existing fit files by several workers")
+        batch = self._getBatch(fitfiles=1)
+        batch.processList()
+        refImages = self._getImages(batch)
+        fitFileList = glob.glob(os.path.join(self.outputDir,
+                                             "*_fitfilelist.py"))[0]
+        f = open(fitFileList)
+        refText = f.read()
+        f.close()
+
+        # fit again some spectra in the middle of the map
+        fitFiles = glob.glob(os.path.join(self.outputDir, "FIT", "*", "*.fit"))
+        for fitFile in fitFiles:
+            if ("row_01" in fitFile) and \
+               (fitFile[-8:] in ["0000.fit", "0001.fit", "0002.fit"]):
+                os.remove(fitFile)
+            elif ("row_02" in fitFile) and fitFile.endswith("0003.fit"):
+                os.remove(fitFile)
+        self.assertEqual(len(glob.glob(os.path.join(self.outputDir,
+                                                    "FIT", "*", "*.fit"))),
+                         len(fitFiles) - 4)
+        shutil.rmtree(os.path.join(self.outputDir, "IMAGES"))
+        batch = self._getBatch(fitfiles=1, overwrite=0, workers=2)
+        batch.processList()
+        self._assertImagesEqual(self._getImages(batch), refImages)
+        # the results are stored in the order of the spectra
+        f = open(fitFileList)
+        text = f.read()
+        f.close()
+        self.assertEqual(text, refText)
+
+    def testWarmStart(self):
+        if DEBUG:
+            print()
+            print("Testing warm start of the fits of a stack")
+        if not HDF5:
+            print("skipping warm start test, h5py not available")
+            return
+        fileList, selection = self._getHDF5Stack()
+        batch = self._getBatch(fileList=fileList, selection=selection,
+                               fitfiles=0, mcaoffset=1)
+        batch.processList()
+        refImages = self._getImages(batch)
+
+        # the first fitted spectrum of a row starts from the first
+        # fitted spectrum of the previous row
+        batch = self._getBatch(fileList=fileList, selection=selection,
+                               fitfiles=0, mcaoffset=1, warmstart=1)
+        seeds = []
+        setWarmStartSeed = batch.mcafit.setWarmStartSeed
+        def setSeed(seed):
+            seeds.append(seed)
+            setWarmStartSeed(seed)
+        batch.mcafit.setWarmStartSeed = setSeed
+        batch.processList()
+        self.assertEqual(len(seeds), self.nRows - 1)
+        images = self._getImages(batch)
+        # both fits stop at the same relative chi square tolerance
+        for key in ['Fe K', 'Ca K']:
+            self.assertTrue(numpy.allclose(images[key][:, 1:],
+                                           refImages[key][:, 1:],
+                                           rtol=1.0e-2))
+
+        # several workers do not use it to keep the results reproducible
+        batch = self._getBatch(fileList=fileList, selection=selection,
+                               fitfiles=0, mcaoffset=1, warmstart=1,
+                               workers=2)
+        batch.processList()
+        images = self._getImages(batch)
+        for key in refImages:
+            self.assertTrue(numpy.all(images[key] == refImages[key]))
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testMcaAdvancedFitBatch))
+    else:
+        testSuite.addTest(\
+            testMcaAdvancedFitBatch("testExistingFitFilesWithWorkers"))
+        testSuite.addTest(testMcaAdvancedFitBatch("testWarmStart"))
+        testSuite.addTest(\
+            testMcaAdvancedFitBatch("testResumeInterruptedBatch"))
+        testSuite.addTest(\
+            testMcaAdvancedFitBatch("testResumeChangedConfiguration"))
+        testSuite.addTest(testMcaAdvancedFitBatch("testResumeKeepsOutput"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
@@ -0,0 +1,183 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import copy
+import numpy
+
+DEBUG = 0
+
+class testMcaTheory(unittest.TestCase):
+    def setUp(self):
+        from PyMca5 import PyMcaDataDir
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaPhysics.xrf import Elements
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        self._elements = Elements
+        self._mcaTheory = ClassMcaTheory
+
+        # Fe and Ca K lines with the widths given by the detector
+        self.x = numpy.arange(1024.)
+        gauss = lambda center, sigma: \
+                numpy.exp(-0.5 * ((self.x - center) / sigma) ** 2)
+        fe = gauss(320.0, 3.4) + 0.13 * gauss(352.9, 3.5)
+        ca = gauss(184.5, 2.9) + 0.13 * gauss(200.6, 3.0)
+        self.y = 5 + 100 * fe + 50 * ca
+
+        config = ConfigDict.ConfigDict()
+        config.read(os.path.join(PyMcaDataDir.PYMCA_DATA_DIR,
+                                 "McaTheory.cfg"))
+        config['fit']['energy'] = [20.0]
+        config['fit']['energyflag'] = [1]
+        config['fit']['energyweight'] = [1.0]
+        config['fit']['stripflag'] = 0
+        config['fit']['xmin'] = 100
+        config['fit']['xmax'] = 600
+        config['detector']['zero'] = 0.0
+        config['detector']['gain'] = 0.02
+        config['peaks'] = {'Fe': 'K', 'Ca': 'K'}
+        config['attenuators']['Matrix'] = [1, 'Goethite', 4.0, 0.01,
+                                           45.0, 45.0]
+        self.config = config
+        self.goethite = copy.deepcopy(Elements.Material['Goethite'])
+
+    def tearDown(self):
+        self._elements.Material['Goethite'] = self.goethite
+
+    def _fit(self, mcafit):
+        mcafit.setData(self.x, self.y)
+        mcafit.estimate()
+        fitresult, result = mcafit.startfit(digest=1)
+        return fitresult, result
+
+    def _countConfigurations(self, mcafit):
+        configurations = []
+        configurePeaks = mcafit._McaTheory__configurePeaks
+        def countConfigurations():
+            configurations.append(1)
+            return configurePeaks()
+        mcafit._McaTheory__configurePeaks = countConfigurations
+        return configurations
+
+    def testConfigurationCache(self):
+        if DEBUG:
+            print()
+            print("Testing the cache of the peak descriptions")
+        mcafit = self._mcaTheory.McaTheory()
+        mcafit.configure(self.config)
+        fitresult, result = self._fit(mcafit)
+        fluoRates = copy.deepcopy(mcafit._fluoRates)
+        # the digested result completes the configuration
+        mcafit.clearConfigurationCache()
+        configurations = self._countConfigurations(mcafit)
+        mcafit.configure(self.config)
+        self.assertEqual(len(configurations), 1)
+
+        config = copy.deepcopy(self.config)
+        config['peaks'] = {'Fe': 'K', 'Ca': 'K', 'Cu': 'K'}
+        mcafit.configure(config)
+        self.assertEqual(len(configurations), 2)
+
+        # the cached description gives the same fit
+        mcafit.configure(self.config)
+        self.assertEqual(len(configurations), 2)
+        self.assertEqual(len(mcafit._configurationCache), 2)
+        fitresult2, result2 = self._fit(mcafit)
+        self.assertTrue(numpy.allclose(fitresult2[0], fitresult[0]))
+        for group in result['groups']:
+            self.assertEqual(result2[group]['fitarea'],
+                             result[group]['fitarea'])
+
+        # the cache is not modified through the instance
+        mcafit.PARAMETERS.append("Dummy")
+        mcafit.PEAKS0NAMES[0] = "Dummy"
+        mcafit.configure(config)
+        mcafit.configure(self.config)
+        self.assertEqual(len(configurations), 2)
+        self.assertFalse("Dummy" in mcafit.PARAMETERS)
+        self.assertFalse("Dummy" in mcafit.PEAKS0NAMES)
+
+        # the least recently used configuration is discarded
+        maxCache = self._mcaTheory.MAX_CONFIGURATION_CACHE
+        self._mcaTheory.MAX_CONFIGURATION_CACHE = 2
+        try:
+            config3 = copy.deepcopy(self.config)
+            config3['peaks'] = {'Fe': 'K'}
+            mcafit.configure(config3)
+            self.assertEqual(len(configurations), 3)
+            mcafit.configure(self.config)
+            self.assertEqual(len(configurations), 3)
+            mcafit.configure(config)
+            self.assertEqual(len(configurations), 4)
+            mcafit.configure(self.config)
+            self.assertEqual(len(configurations), 4)
+            mcafit.configure(config3)
+            self.assertEqual(len(configurations), 5)
+        finally:
+            self._mcaTheory.MAX_CONFIGURATION_CACHE = maxCache
+
+        # editing a material invalidates the description
+        mcafit.configure(self.config)
+        self.assertEqual(len(configurations), 5)
+        self._elements.Material['Goethite']['CompoundList'] = ['Fe1O2H1',
+                                                               'Ca1']
+        self._elements.Material['Goethite']['CompoundFraction'] = [0.5, 0.5]
+        mcafit.configure(self.config)
+        self.assertEqual(len(configurations), 6)
+        self.assertNotEqual(mcafit._fluoRates, fluoRates)
+
+        # as updating the element data
+        self._elements.Material['Goethite'] = copy.deepcopy(self.goethite)
+        self._elements.updateDict()
+        self.assertEqual(len(mcafit._configurationCache), 0)
+        mcafit.configure(self.config)
+        self.assertEqual(len(configurations), 7)
+        fitresult2, result2 = self._fit(mcafit)
+        self.assertTrue(numpy.allclose(fitresult2[0], fitresult[0]))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testMcaTheory))
+    else:
+        # use a predefined order
+        testSuite.addTest(testMcaTheory("testConfigurationCache"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
@@ -0,0 +1,121 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+DEBUG = 0
+
+class testNNMAModule(unittest.TestCase):
+    def setUp(self):
+        # two components with overlapping images
+        x = numpy.linspace(0, 1, 64)
+        spectra = numpy.array([numpy.exp(-0.5 * ((x - 0.3) / 0.05) ** 2),
+                               numpy.exp(-0.5 * ((x - 0.7) / 0.08) ** 2)])
+        nRows = 20
+        nColumns = 15
+        images = numpy.zeros((2, nRows, nColumns))
+        images[0] = numpy.outer(numpy.linspace(0, 1, nRows),
+                                numpy.ones(nColumns))
+        images[1] = numpy.outer(numpy.ones(nRows),
+                                numpy.linspace(1, 0.2, nColumns))
+        self.data = 100 * numpy.einsum('kij,kn->ijn', images, spectra)
+
+    def _getRelativeError(self, result):
+        images, values, vectors = result
+        data = numpy.einsum('kij,kn->ijn', images.astype(numpy.float64),
+                            vectors.astype(numpy.float64))
+        return numpy.sqrt(((data - self.data) ** 2).sum() / \
+                          (self.data ** 2).sum())
+
+    def testBlockNNMA(self):
+        from PyMca5.PyMcaMath.mva import NNMAModule
+        from PyMca5.PyMcaMath.mva import PCATools
+        if DEBUG:
+            print()
+            print("Testing NNMA in blocks of rows")
+        refResult = NNMAModule.nnma(self.data.copy(), 2, function="NMF",
+                                    eps=1.0e-6, maxcount=1000)
+        refError = self._getRelativeError(refResult)
+        self.assertTrue(refError < 1.0e-2)
+
+        # blocks of three rows
+        oldMaxMemory = PCATools.MAX_MEMORY
+        PCATools.MAX_MEMORY = 3 * 15 * 64 * 8
+        try:
+            for workers in [1, 2]:
+                result = NNMAModule.blockNNMA(self.data, 2, function="NMF",
+                                              eps=1.0e-6, maxcount=1000,
+                                              workers=workers, seed=0)
+                error = self._getRelativeError(result)
+                if DEBUG:
+                    print("Relative error %g nnma %g" % (error, refError))
+                self.assertTrue(error < 1.0e-2)
+                images, values, vectors = result
+                self.assertEqual(images.shape, (2, 20, 15))
+                self.assertEqual(vectors.shape, (2, 64))
+                self.assertTrue(images.min() >= 0)
+                self.assertTrue(vectors.min() >= 0)
+                self.assertTrue(abs(values.sum() - 100.) < 1.0)
+                self.assertTrue(numpy.allclose(values, refResult[1],
+                                               atol=2.0))
+
+            # the iterations can be stopped
+            iterations = []
+            def callback(ddict):
+                iterations.append(ddict['iteration'])
+                return ddict['iteration'] < 3
+            NNMAModule.blockNNMA(self.data, 2, callback=callback, seed=0)
+            self.assertEqual(iterations, [1, 2, 3])
+        finally:
+            PCATools.MAX_MEMORY = oldMaxMemory
+
+        # other methods are not implemented in blocks
+        self.assertRaises(ValueError, NNMAModule.blockNNMA, self.data, 2,
+                          function="NNSC")
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testNNMAModule))
+    else:
+        testSuite.addTest(testNNMAModule("testBlockNNMA"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
@@ -90,6 +90,140 @@ def testPCAToolsCovariance(self):
             self.assertTrue(numpy.allclose(numpyAvg, pymcaAvg))
             self.assertTrue(nData == nSpectra)
 
+    def testPCAToolsCovarianceAccumulator(self):
+        from PyMca5.PyMcaMath.mva.PCATools import getCovarianceMatrix
+        from PyMca5.PyMcaMath.mva.PCATools import CovarianceAccumulator
+        from PyMca5.PyMcaMath.mva.PCATools import getCovarianceAccumulator
+        x = numpy.arange(120.).reshape(4, 5, 6) ** 1.5
+        mask = numpy.ones((4, 5), dtype=bool)
+        mask[1, 2] = False
+        for center in [True, False]:
+            pymcaCov, pymcaAvg, nData = getCovarianceMatrix(x,
+                                                        force=False,
+                                                        center=center,
+                                                        spatial_mask=mask)
+            # accumulate in two parts and merge them
+            accumulator = getCovarianceAccumulator(x[:1],
+                                                   spatial_mask=mask[:1])
+            other = CovarianceAccumulator(x.shape[-1])
+            for i in range(1, x.shape[0]):
+                other.addSpectra(x[i], mask=mask[i])
+            accumulator.merge(other)
+            cov, avg, n = accumulator.getCovarianceMatrix(center=center)
+            self.assertTrue(n == nData)
+            self.assertTrue(numpy.allclose(pymcaAvg, avg))
+            self.assertTrue(numpy.allclose(pymcaCov, cov))
+
+            # data with the spectra as first index
+            y = numpy.transpose(x, (2, 0, 1))
+            accumulator = getCovarianceAccumulator(y, index=0,
+                                                   spatial_mask=mask)
+            cov, avg, n = accumulator.getCovarianceMatrix(center=center)
+            self.assertTrue(numpy.allclose(pymcaCov, cov))
+
+        # the binning and the weights are those of the accumulator
+        weights = numpy.linspace(0.5, 1.5, x.shape[-1])
+        accumulator = CovarianceAccumulator(x.shape[-1], binning=2,
+                                            weights=weights)
+        getCovarianceAccumulator(x[:2], accumulator=accumulator)
+        getCovarianceAccumulator(x[2:], binning=2, weights=weights * 1,
+                                 accumulator=accumulator)
+        cov, avg, n = accumulator.getCovarianceMatrix()
+        reference = getCovarianceAccumulator(x, binning=2, weights=weights)
+        refCov, refAvg, refN = reference.getCovarianceMatrix()
+        self.assertEqual(n, refN)
+        self.assertTrue(numpy.allclose(refCov, cov))
+        for kw in [{'binning': 1},
+                   {'binning': 3},
+                   {'weights': weights * 2},
+                   {'binning': 2, 'weights': weights[::-1]}]:
+            self.assertRaises(ValueError, getCovarianceAccumulator, x,
+                              accumulator=accumulator, **kw)
+        self.assertRaises(ValueError, getCovarianceAccumulator, x[:, :, :4],
+                          accumulator=accumulator)
+        # nothing was added by the rejected calls
+        self.assertEqual(accumulator.getNumberOfSpectra(), n)
+        other = CovarianceAccumulator(x.shape[-1], binning=2)
+        self.assertRaises(ValueError, accumulator.merge, other)
+        self.assertRaises(ValueError, other.merge, accumulator)
+
+    def testPCAToolsCovarianceHDF5(self):
+        try:
+            import h5py
+        except ImportError:
+            print("skipping HDF5 covariance test, h5py not available")
+            return
+        import os
+        import tempfile
+        from PyMca5.PyMcaMath.mva import PCATools
+        x = numpy.random.RandomState(0).poisson(10.0,
+                                (12, 5, 8)).astype(numpy.float64)
+        mask = numpy.ones((12, 5), dtype=bool)
+        mask[3, 1] = False
+        spectra = x[mask]
+        refCov = numpy.cov(spectra.T)
+        refAvg = spectra.mean(axis=0)
+        tmpFile = tempfile.mkstemp(suffix=".h5")
+        os.close(tmpFile[0])
+        threadPool = PCATools.ThreadPool
+        maxMemory = PCATools.MAX_MEMORY
+        workers = PCATools.WORKERS
+        readSelections = PCATools.HDF5Reader.HDF5Reader.readSelections
+        def noThreads(*var, **kw):
+            raise AssertionError("HDF5 dataset read from several threads")
+        reads = []
+        def countSelections(reader, dataset, selections, function=None):
+            selections = list(selections)
+            reads.append((reader._workers, len(selections)))
+            return readSelections(reader, dataset, selections, function)
+        h5 = h5py.File(tmpFile[1], "w")
+        h5.create_dataset("data", data=x, chunks=(3, 5, 8))
+        h5.create_dataset("data0", data=x.transpose(2, 0, 1),
+                          chunks=(8, 3, 5))
+        h5.close()
+        h5 = h5py.File(tmpFile[1], "r")
+        try:
+            PCATools.ThreadPool = noThreads
+            PCATools.HDF5Reader.HDF5Reader.readSelections = countSelections
+            PCATools.MAX_MEMORY = 3 * 5 * 8 * 8
+            for path, index in [("data", -1), ("data0", 0)]:
+                accumulator = PCATools.getCovarianceAccumulator(h5[path],
+                                                    index=index,
+                                                    spatial_mask=mask,
+                                                    workers=2)
+                cov, avg, n = accumulator.getCovarianceMatrix()
+                self.assertEqual(n, spectra.shape[0])
+                self.assertTrue(numpy.allclose(refCov, cov))
+                self.assertTrue(numpy.allclose(refAvg, avg))
+            self.assertEqual(reads, [(2, 4), (2, 4)])
+            # the covariance matrix of the dataset uses the accumulator
+            PCATools.WORKERS = 2
+            for path, index in [("data", -1), ("data0", 0)]:
+                cov, avg, n = PCATools.getCovarianceMatrix(h5[path],
+                                                           index=index,
+                                                           spatial_mask=mask)
+                self.assertEqual(n, spectra.shape[0])
+                self.assertTrue(numpy.allclose(refCov, cov))
+                self.assertTrue(numpy.allclose(refAvg, avg))
+            self.assertEqual(len(reads), 4)
+            # the other calculations read the dataset serially
+            images, eigenvalues, eigenvectors = \
+                    PCATools.randomizedPCA(h5["data"], ncomponents=2,
+                                           seed=0, workers=2)
+            refImages, refEigenvalues, refEigenvectors = \
+                    PCATools.randomizedPCA(x, ncomponents=2, seed=0,
+                                           workers=1)
+            self.assertTrue(numpy.allclose(eigenvalues, refEigenvalues))
+            self.assertTrue(numpy.allclose(images, refImages))
+        finally:
+            PCATools.ThreadPool = threadPool
+            PCATools.HDF5Reader.HDF5Reader.readSelections = readSelections
+            PCATools.HDF5Reader.closePool()
+            PCATools.MAX_MEMORY = maxMemory
+            PCATools.WORKERS = workers
+            h5.close()
+            os.remove(tmpFile[1])
+
     def testPCAToolsPCA(self):
         from PyMca5.PyMcaMath.mva.PCATools import numpyPCA
         x = numpy.array([[0.0,  2.0,  3.0],
@@ -131,6 +265,32 @@ def testPCAToolsPCA(self):
             self.assertTrue(numpy.allclose(eigenvalues, numpyEigenvalues))
             self.assertTrue(numpy.allclose(eigenvectors, numpyEigenvectors))
 
+    def testPCAToolsRandomizedPCA(self):
+        from PyMca5.PyMcaMath.mva.PCATools import numpyPCA, randomizedPCA
+        x = numpy.arange(600.).reshape(5, 6, 20)
+        x = numpy.sqrt(x) + numpy.cos(x) * numpy.arange(20.)
+        for center in [True, False]:
+            images, eigenvalues, eigenvectors = numpyPCA(x,
+                                                         ncomponents=3,
+                                                         force=False,
+                                                         center=center)
+            rImages, rEigenvalues, rEigenvectors = randomizedPCA(x,
+                                                         ncomponents=3,
+                                                         center=center,
+                                                         seed=0)
+            self.assertTrue(rImages.shape == images.shape)
+            self.assertTrue(numpy.allclose(eigenvalues, rEigenvalues,
+                                           rtol=1.0e-4))
+            for i in range(3):
+                # the eigenvectors can be multiplied by -1
+                sign = numpy.sign(numpy.dot(eigenvectors[i],
+                                            rEigenvectors[i]))
+                self.assertTrue(numpy.allclose(eigenvectors[i],
+                                               sign * rEigenvectors[i],
+                                               atol=1.0e-4))
+                self.assertTrue(numpy.allclose(images[i], sign * rImages[i],
+                                               rtol=1.0e-3, atol=1.0e-2))
+
     if MDP:
         def testPCAToolsMDP(self):
             from PyMca5.PyMcaMath.mva.PCATools import getCovarianceMatrix, numpyPCA
@@ -175,7 +335,10 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testPCATools("testPCAToolsImport"))
         testSuite.addTest(testPCATools("testPCAToolsCovariance"))
+        testSuite.addTest(testPCATools("testPCAToolsCovarianceAccumulator"))
+        testSuite.addTest(testPCATools("testPCAToolsCovarianceHDF5"))
         testSuite.addTest(testPCATools("testPCAToolsPCA"))
+        testSuite.addTest(testPCATools("testPCAToolsRandomizedPCA"))
         if MDP:
             testSuite.addTest(testPCATools("testPCAToolsMDP"))
     return testSuite
@@ -0,0 +1,117 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+DEBUG = 0
+
+class testSNIPModule(unittest.TestCase):
+    def setUp(self):
+        # peaks on a slowly varying background
+        x = numpy.arange(1024.)
+        random = numpy.random.RandomState(7)
+        self.spectra = numpy.zeros((12, x.size), numpy.float64)
+        for i in range(self.spectra.shape[0]):
+            spectrum = 50. * numpy.exp(-x / (300. + 10 * i)) + 2.
+            for center in [150., 400. + i, 640., 900.]:
+                spectrum += (100. + 20 * i) * \
+                            numpy.exp(-0.5 * ((x - center) / 4.) ** 2)
+            self.spectra[i] = random.poisson(spectrum)
+
+    def _getReferenceBackground(self, spectrum, width, smoothing, anchors):
+        # one spectrum at a time, as the fast linear fit used to do
+        from PyMca5.PyMcaMath.fitting import SpecfitFuns
+        background = SpecfitFuns.SavitskyGolay(spectrum, smoothing)
+        lastAnchor = 0
+        for anchor in anchors:
+            if (anchor > lastAnchor) and (anchor < background.size):
+                background[lastAnchor:anchor] = \
+                        SpecfitFuns.snip1d(background[lastAnchor:anchor],
+                                           width, 0)
+                lastAnchor = anchor
+        if lastAnchor < background.size:
+            background[lastAnchor:] = \
+                        SpecfitFuns.snip1d(background[lastAnchor:],
+                                           width, 0)
+        return background
+
+    def testMultipleSpectraBackground(self):
+        if DEBUG:
+            print()
+            print("Testing the background of several spectra at once")
+        from PyMca5.PyMcaMath import SNIPModule
+        for width, smoothing, anchors in [(30, 0, []),
+                                          (30, 5, []),
+                                          (20, 7, [300, 700]),
+                                          (40, 3, [700, 2000, 300, 0])]:
+            reference = numpy.array([self._getReferenceBackground(\
+                                            spectrum, width, smoothing,
+                                            sorted(anchors)) \
+                                     for spectrum in self.spectra])
+            background = SNIPModule.getMultipleSpectraBackground(\
+                                            self.spectra, width,
+                                            smoothing_width=smoothing,
+                                            anchors=anchors)
+            self.assertEqual(background.shape, self.spectra.shape)
+            self.assertTrue(numpy.allclose(background, reference,
+                                           rtol=1.0e-12, atol=0.0),
+                            "Different background, anchors %s" % anchors)
+            # channels along the first dimension
+            background = SNIPModule.getMultipleSpectraBackground(\
+                                            self.spectra.T.copy(), width,
+                                            smoothing_width=smoothing,
+                                            anchors=anchors, index=0)
+            self.assertTrue(numpy.allclose(background.T, reference,
+                                           rtol=1.0e-12, atol=0.0))
+        # the input spectra are not modified
+        self.assertTrue(numpy.all(self.spectra >= 0))
+        self.assertRaises(ValueError,
+                          SNIPModule.getMultipleSpectraBackground,
+                          self.spectra.reshape(3, 4, -1), 30, index=0)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testSNIPModule))
+    else:
+        # use a predefined order
+        testSuite.addTest(testSNIPModule("testMultipleSpectraBackground"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
@@ -143,6 +143,68 @@ def testSpecfileReadingCompatibleWithUserLocale(self):
                     (datacol[1], data[0][1]))
         gc.collect()
 
+    def testSpecfileUpdate(self):
+        #"""Test specfile update after appending to the file"""
+        self.testSpecfileImport()
+        self._sf = self.specfileClass.Specfile(self.fname)
+        self.assertEqual(self._sf.scanno(), 2)
+        text  = "4.9  16  64\n"
+        text += "\n"
+        text += "#S 30  Undefined command 2\n"
+        text += "#N 2\n"
+        text += "#L A  B\n"
+        text += "1  2\n"
+        f = open(self.fname, "ab")
+        if sys.version < '3.0':
+            f.write(text)
+        else:
+            f.write(bytes(text, 'utf-8'))
+        f.close()
+        # the file may not have a newer modification time
+        self.assertEqual(self._sf.update(), 1)
+        self.assertEqual(self._sf.scanno(), 3,
+                         'Expected 3 scans, got %s' % self._sf.scanno())
+        self._scan = self._sf.select('30.1')
+        self.assertEqual(self._scan.alllabels(), ['A', 'B'])
+        # the last scan of the previous read continues in the file
+        self._scan = self._sf.select('20.1')
+        datacol = self._scan.datacol(1)
+        self.assertEqual(len(datacol), 4)
+        self.assertEqual(datacol[3], 4.9)
+        self.assertEqual(self._sf.update(), 0)
+        gc.collect()
+
+    def testSpecfileMcaArray(self):
+        #"""Test reading all the mca of a scan at once"""
+        self.testSpecfileImport()
+        text  = "#F \n"
+        text += "\n"
+        text += "#S 1  mesh\n"
+        text += "#N 1\n"
+        text += "#L Point\n"
+        for point in range(3):
+            text += "%d\n" % point
+            for detector in range(2):
+                text += "@A %d %d %d\n" % (point, detector, point * detector)
+        f = open(self.fname, "wb")
+        if sys.version < '3.0':
+            f.write(text)
+        else:
+            f.write(bytes(text, 'utf-8'))
+        f.close()
+        self._sf = self.specfileClass.Specfile(self.fname)
+        self._scan = self._sf[0]
+        data = self._scan.allmca()
+        self.assertEqual(data.shape, (6, 3))
+        for i in range(6):
+            self.assertEqual(list(data[i]), list(self._scan.mca(i + 1)))
+        # second detector only
+        data = self._scan.allmca(2, 2)
+        self.assertEqual(list(data[:, 0]), [0, 1, 2])
+        self.assertEqual(list(data[:, 1]), [1, 1, 1])
+        self.assertEqual(self._scan.allmca(3, 2, 1).shape, (1, 3))
+        gc.collect()
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -154,6 +216,8 @@ def getSuite(auto=True):
         testSuite.addTest(testSpecfile("testSpecfileReading"))
         testSuite.addTest(\
             testSpecfile("testSpecfileReadingCompatibleWithUserLocale"))
+        testSuite.addTest(testSpecfile("testSpecfileUpdate"))
+        testSuite.addTest(testSpecfile("testSpecfileMcaArray"))
     return testSuite
 
 def test(auto=False):
@@ -200,6 +200,110 @@ def testStackBaseStack2DDataHandling(self):
         dummyArray = None
         referenceData = None
 
+    def testStackBaseROIIndex(self):
+        from PyMca5.PyMcaCore import StackBase
+        nrows = 20
+        ncolumns = 30
+        nchannels = 200
+        data = numpy.random.RandomState(0).poisson(10.0,
+                            (nrows, ncolumns, nchannels)).astype(numpy.float)
+        energy = 0.01 * numpy.arange(nchannels)
+        for data, mcaindex in [(data, 2),
+                               (numpy.transpose(data, (2, 0, 1)), 0)]:
+            stackBase = StackBase.StackBase()
+            stackBase.setStack(data * 1, mcaindex=mcaindex)
+            references = []
+            for i0, i1 in [(0, nchannels), (3, 9), (20, 180), (170, 200)]:
+                imiddle = (i0 + i1) // 2
+                references.append(stackBase.calculateROIImages(i0, i1,
+                                                    imiddle=imiddle,
+                                                    energy=energy))
+            stackBase.enableROIIndex()
+            self.assertTrue(stackBase._ROIIndex is not None)
+            j = 0
+            for i0, i1 in [(0, nchannels), (3, 9), (20, 180), (170, 200)]:
+                imiddle = (i0 + i1) // 2
+                imageDict = stackBase.calculateROIImages(i0, i1,
+                                                         imiddle=imiddle,
+                                                         energy=energy)
+                for key in references[j]:
+                    self.assertTrue(numpy.allclose(imageDict[key],
+                                                   references[j][key]),
+                        "Incorrect %s image from ROI index" % key)
+                j += 1
+            stackBase.disableROIIndex()
+        stackBase = None
+
+    def testStackBaseHDF5ROIImages(self):
+        from PyMca5.PyMcaCore import StackBase
+        try:
+            import h5py
+        except ImportError:
+            print("skipping HDF5 ROI images test, h5py not available")
+            return
+        import os
+        import tempfile
+        nrows = 20
+        ncolumns = 30
+        nchannels = 200
+        data = numpy.random.RandomState(0).poisson(10.0,
+                            (nrows, ncolumns, nchannels)).astype(numpy.float)
+        energy = 0.01 * numpy.arange(nchannels)
+        stackBase = StackBase.StackBase()
+        stackBase.setStack(data * 1, mcaindex=2)
+        reference = stackBase.calculateROIImages(20, 180, imiddle=100,
+                                                 energy=energy)
+        tmpFile = tempfile.mkstemp(suffix=".h5")
+        os.close(tmpFile[0])
+        threadPool = StackBase.ThreadPool
+        chunkMemory = StackBase.ROI_CHUNK_MEMORY
+        workers = StackBase.ROI_WORKERS
+        readSelections = StackBase.HDF5Reader.HDF5Reader.readSelections
+        def noThreads(*var, **kw):
+            raise AssertionError("HDF5 dataset read from several threads")
+        reads = []
+        def countSelections(reader, dataset, selections, function=None):
+            selections = list(selections)
+            reads.append((reader._workers, len(selections)))
+            return readSelections(reader, dataset, selections, function)
+        h5 = h5py.File(tmpFile[1], "w")
+        h5.create_dataset("data", data=data, chunks=(2, ncolumns, 50))
+        h5.create_dataset("data0", data=data.transpose(2, 0, 1),
+                          chunks=(50, 2, ncolumns))
+        h5.close()
+        h5 = h5py.File(tmpFile[1], "r")
+        try:
+            # several blocks, read by the processes of the HDF5 reader
+            StackBase.ThreadPool = noThreads
+            StackBase.HDF5Reader.HDF5Reader.readSelections = countSelections
+            StackBase.ROI_CHUNK_MEMORY = 4 * ncolumns * 160 * 8
+            StackBase.ROI_WORKERS = 2
+            for path, mcaIndex in [("data", 2), ("data0", 0)]:
+                stackBase = StackBase.StackBase()
+                stackBase.setStack(h5[path], mcaindex=mcaIndex)
+                imageDict = stackBase.calculateROIImages(20, 180,
+                                                         imiddle=100,
+                                                         energy=energy)
+                for key in reference:
+                    self.assertTrue(numpy.allclose(imageDict[key],
+                                                   reference[key]),
+                        "Incorrect %s image from HDF5 dataset" % key)
+            # the sum of the stack and the ROI images of each stack
+            self.assertEqual(len(reads), 4)
+            self.assertEqual(reads[1], (2, nrows // 4))
+            for nWorkers, nSelections in reads:
+                self.assertEqual(nWorkers, 2)
+                self.assertTrue(nSelections > 1)
+        finally:
+            StackBase.ThreadPool = threadPool
+            StackBase.HDF5Reader.HDF5Reader.readSelections = readSelections
+            StackBase.HDF5Reader.closePool()
+            StackBase.ROI_CHUNK_MEMORY = chunkMemory
+            StackBase.ROI_WORKERS = workers
+            stackBase = None
+            h5.close()
+            os.remove(tmpFile[1])
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -210,6 +314,8 @@ def getSuite(auto=True):
         testSuite.addTest(testStackBase("testStackBaseImport"))
         testSuite.addTest(testStackBase("testStackBaseStack1DDataHandling"))
         testSuite.addTest(testStackBase("testStackBaseStack2DDataHandling"))
+        testSuite.addTest(testStackBase("testStackBaseROIIndex"))
+        testSuite.addTest(testStackBase("testStackBaseHDF5ROIImages"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,144 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2014 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import shutil
+import tempfile
+import numpy
+
+DEBUG = 0
+
+class testStackSimpleFit(unittest.TestCase):
+    def setUp(self):
+        from PyMca5.PyMcaMath.fitting import SpecfitFuns
+        from PyMca5.PyMcaMath.fitting import SpecfitFunctions
+        from PyMca5.PyMcaMath.fitting import SimpleFitModule
+        from PyMca5.PyMcaMath.fitting import StackSimpleFit
+        self._functions = SpecfitFunctions
+        self._simpleFit = SimpleFitModule
+        self._stackSimpleFit = StackSimpleFit
+        self.tmpDir = tempfile.mkdtemp()
+
+        # one gaussian per spectrum, moving along the map
+        self.x = numpy.arange(200.)
+        self.nRows = 3
+        self.nColumns = 4
+        self.heights = numpy.zeros((self.nRows, self.nColumns))
+        self.positions = numpy.zeros((self.nRows, self.nColumns))
+        self.data = numpy.zeros((self.nRows, self.nColumns, 200))
+        for row in range(self.nRows):
+            for col in range(self.nColumns):
+                self.heights[row, col] = 100. + 10 * row + col
+                self.positions[row, col] = 80. + 2 * col + row
+                self.data[row, col] = 2 + SpecfitFuns.gauss(\
+                    [self.heights[row, col], self.positions[row, col], 8.],
+                    self.x)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def _processStack(self, data, dataIndex=None, workers=1,
+                      seed=False):
+        fit = self._simpleFit.SimpleFit()
+        fit.importFunctions(self._functions)
+        fit.setFitFunction('Gaussians')
+        if seed:
+            fit.setConfiguration({'fit': \
+                        {'function_estimation_policy': "Estimate once",
+                         'background_estimation_policy': "Estimate once"}})
+        stackFit = self._stackSimpleFit.StackSimpleFit(fit)
+        stackFit.setOutputDirectory(self.tmpDir)
+        stackFit.setOutputFileBaseName("stack_%d" % workers)
+        stackFit.setData(self.x, data)
+        stackFit.setDataIndex(dataIndex)
+        stackFit.setNumberOfWorkers(workers)
+        stackFit.setSeedFromNeighbours(seed)
+        stackFit.processStack()
+        return stackFit._images
+
+    def _assertImagesEqual(self, images, refImages):
+        self.assertEqual(sorted(images.keys()), sorted(refImages.keys()))
+        for key in refImages:
+            self.assertTrue(numpy.allclose(images[key], refImages[key]),
+                            "Different %s image" % key)
+
+    def testParallel(self):
+        if DEBUG:
+            print()
+            print("Testing the fit of a stack by several workers")
+        refImages = self._processStack(self.data)
+        self.assertTrue(numpy.allclose(refImages['Height'], self.heights))
+        self.assertTrue(numpy.allclose(refImages['Position'],
+                                       self.positions))
+        images = self._processStack(self.data, workers=2)
+        self._assertImagesEqual(images, refImages)
+
+        # spectra stored along the first dimension of a 2D stack
+        data = numpy.transpose(self.data.reshape(-1, self.data.shape[-1]))
+        data = data.copy()
+        for workers in [1, 2]:
+            images = self._processStack(data, dataIndex=0, workers=workers)
+            for key in refImages:
+                self.assertEqual(images[key].shape,
+                                 (self.nRows * self.nColumns, 1))
+                self.assertTrue(numpy.allclose(images[key].ravel(),
+                                               refImages[key].ravel()),
+                                "Different %s image" % key)
+
+    def testParallelSeedFromNeighbours(self):
+        if DEBUG:
+            print()
+            print("Testing the fit of a stack seeded from the neighbours")
+        refImages = self._processStack(self.data, seed=True)
+        self.assertTrue(numpy.allclose(refImages['Height'], self.heights))
+        self.assertTrue(numpy.allclose(refImages['Position'],
+                                       self.positions))
+        images = self._processStack(self.data, workers=2, seed=True)
+        self._assertImagesEqual(images, refImages)
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testStackSimpleFit))
+    else:
+        testSuite.addTest(testStackSimpleFit("testParallel"))
+        testSuite.addTest(testStackSimpleFit("testParallelSeedFromNeighbours"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    DEBUG = 1
+    test()
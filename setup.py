@@ -67,6 +67,10 @@
 else:
     SPECFILE_USE_GNU_SOURCE = int(SPECFILE_USE_GNU_SOURCE)
 
+# keep an index of the scans of large SPEC files next to them
+# to avoid scanning the whole file each time it is opened
+SPECFILE_USE_INDEX_FILE = int(os.getenv("SPECFILE_USE_INDEX_FILE", 1))
+
 ffile = open(os.path.join('PyMca5', '__init__.py'), 'r').readlines()
 for line in ffile:
     if line.startswith('__version__'):
@@ -175,7 +179,9 @@ def build_specfile(ext_modules):
         if SPECFILE_USE_GNU_SOURCE:
             specfile_define_macros = [('_GNU_SOURCE', 1)]
     else:
-        specfile_define_macros = define_macros
+        specfile_define_macros = define_macros[:]
+    if SPECFILE_USE_INDEX_FILE:
+        specfile_define_macros.append(('SPECFILE_USE_INDEX_FILE', None))
     srcfiles = [ 'sfheader','sfinit','sflists','sfdata','sfindex',
              'sflabel' ,'sfmca', 'sftools','locale_management','specfile_py']
     if sys.version >= '3.0':